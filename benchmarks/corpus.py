@@ -0,0 +1,195 @@
+"""Synthetic archive trees for benchmarking.
+
+generate_corpus() builds a directory tree of the given depth and fan-out,
+each directory holding born-digital PDFs (with a text layer), scanned PDFs
+(image-only pages, which send the indexer down the OCR path), PNG images,
+and zip archives.  Everything is derived from the seed, so the same spec
+always produces byte-for-byte the same tree.
+"""
+import random
+import struct
+import zipfile
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+_WORDS = (
+    "adapter address assembly board boot bus cable channel circuit clock"
+    " console controller cpu device diagnostic disk drive emulator field"
+    " firmware interface interrupt keyboard manual memory microcode module"
+    " monitor operator panel parity peripheral power printer processor"
+    " register reference schematic sector service switch system tape"
+    " terminal timing unit utility voltage"
+).split()
+
+
+@dataclass(frozen=True)
+class CorpusSpec:
+    """depth is the number of directory levels below the root, fanout the
+    number of subdirectories in each directory that has any.  files is
+    documents per directory; scanned is the fraction of PDFs that have no
+    text layer, images the fraction of documents that are PNGs."""
+
+    depth: int = 2
+    fanout: int = 3
+    files: int = 10
+    pages: int = 4
+    words: int = 200
+    scanned: float = 0.25
+    images: float = 0.1
+    archives: int = 1
+    seed: int = 1
+
+
+@dataclass
+class CorpusStats:
+    directories: int = 0
+    pdfs: int = 0
+    scanned: int = 0
+    images: int = 0
+    archives: int = 0
+    members: int = 0
+    pages: int = 0
+    bytes: int = 0
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(words))
+
+
+def make_pdf(pages: List[Optional[str]]) -> bytes:
+    """A minimal PDF with one page per entry: a string is set as text on
+    the page, None makes an image-only ("scanned") page."""
+    objects: List[bytes] = list()
+    page_ids = [5 + 2 * i for i in range(len(pages))]
+    kids = " ".join(f"{i} 0 R" for i in page_ids)
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    objects.append(
+        f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode()
+    )
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    pixels = bytes(
+        (x * 7 + y * 13) % 256 for y in range(32) for x in range(32)
+    )
+    objects.append(
+        b"<< /Type /XObject /Subtype /Image /Width 32 /Height 32"
+        b" /ColorSpace /DeviceGray /BitsPerComponent 8"
+        + f" /Length {len(pixels)} >>\nstream\n".encode()
+        + pixels
+        + b"\nendstream"
+    )
+    for page_id, text in zip(page_ids, pages):
+        if text is None:
+            content = b"q 612 0 0 792 0 0 cm /Im0 Do Q"
+        else:
+            lines = [text[i : i + 80] for i in range(0, len(text), 80)]
+            ops = ["BT /F1 10 Tf 12 TL 72 740 Td"]
+            for line in lines[:60]:
+                escaped = line.replace("\\", "\\\\").replace("(", "\\(")
+                escaped = escaped.replace(")", "\\)")
+                ops.append(f"({escaped}) Tj T*")
+            ops.append("ET")
+            content = "\n".join(ops).encode()
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792]"
+            f" /Resources << /Font << /F1 3 0 R >>"
+            f" /XObject << /Im0 4 0 R >> >>"
+            f" /Contents {page_id + 1} 0 R >>".encode()
+        )
+        objects.append(
+            f"<< /Length {len(content)} >>\nstream\n".encode()
+            + content
+            + b"\nendstream"
+        )
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = list()
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\n"
+        f"startxref\n{xref}\n%%EOF\n"
+    ).encode()
+    return bytes(out)
+
+
+def make_png(rng: random.Random, width: int = 64, height: int = 48) -> bytes:
+    """A grayscale PNG of noise."""
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        crc = zlib.crc32(kind + data) & 0xFFFFFFFF
+        return (
+            struct.pack(">I", len(data)) + kind + data + struct.pack(">I", crc)
+        )
+
+    rows = b"".join(
+        b"\0" + bytes(rng.randrange(256) for _ in range(width))
+        for _ in range(height)
+    )
+    header = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
+
+
+def _populate(
+    directory: Path,
+    spec: CorpusSpec,
+    rng: random.Random,
+    stats: CorpusStats,
+) -> None:
+    stats.directories += 1
+    for i in range(spec.files):
+        if rng.random() < spec.images:
+            data = make_png(rng)
+            path = directory / f"image-{i:04d}.png"
+            stats.images += 1
+        else:
+            scanned = rng.random() < spec.scanned
+            pages: List[Optional[str]] = [
+                None if scanned else _text(rng, spec.words)
+                for _ in range(spec.pages)
+            ]
+            data = make_pdf(pages)
+            path = directory / f"document-{i:04d}.pdf"
+            stats.pdfs += 1
+            stats.scanned += int(scanned)
+            stats.pages += spec.pages
+        path.write_bytes(data)
+        stats.bytes += len(data)
+    for i in range(spec.archives):
+        path = directory / f"bundle-{i:02d}.zip"
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+            for j in range(3):
+                pdf = make_pdf([_text(rng, spec.words)])
+                # Fixed timestamps keep the zip reproducible
+                info = zipfile.ZipInfo(
+                    f"member-{j}.pdf", (2000, 1, 1, 0, 0, 0)
+                )
+                zf.writestr(info, pdf)
+                stats.members += 1
+        stats.archives += 1
+        stats.bytes += path.stat().st_size
+
+
+def generate_corpus(root: Path, spec: CorpusSpec) -> CorpusStats:
+    """Fill root (which is created if need be) according to spec."""
+    rng = random.Random(spec.seed)
+    stats = CorpusStats()
+    stack = [(root, 0)]
+    while stack:
+        directory, level = stack.pop()
+        directory.mkdir(parents=True, exist_ok=True)
+        _populate(directory, spec, rng, stats)
+        if level < spec.depth:
+            for i in reversed(range(spec.fanout)):
+                stack.append((directory / f"folder-{i:02d}", level + 1))
+    return stats
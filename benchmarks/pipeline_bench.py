@@ -0,0 +1,231 @@
+"""Whole-pipeline benchmark.
+
+Generates a synthetic archive (see benchmarks/corpus.py), builds it from
+scratch and then again with nothing changed, and reports the time spent in
+each stage (scan, render, thumbnail, extract-fast, extract-ocr, index)
+from the build's run report.  Builds run with the stub tools from
+benchmarks/stubs.py, with the real ones, or both.
+
+Results are saved as JSON, named for the time and the commit, so that runs
+can be compared across commits with --compare.
+
+Run with ``python -m benchmarks.pipeline_bench``.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import time
+from dataclasses import asdict
+from datetime import datetime, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, Iterator, List, Optional
+
+from pdfarchive.index import Indexer
+from pdfarchive.scheduler import Budget
+
+from .corpus import CorpusSpec, generate_corpus
+from .stubs import write_stub_tools
+
+_REAL_TOOLS = ("gm", "pdftotext", "pdfinfo", "tesseract")
+_RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def build(root: Path, budget: Budget) -> Dict[str, Any]:
+    """Build the archive at root and summarize its run report."""
+    report_path = root.parent / f"{root.name}-report.json"
+    start = time.perf_counter()
+    Indexer(base_dir=root, budget=budget, report=report_path).build_site()
+    wall = time.perf_counter() - start
+    report = json.loads(report_path.read_text())
+    return {
+        "wall_time": wall,
+        "stages": {
+            name: {
+                "jobs": stage["jobs"],
+                "wall_time": stage["wall_time"],
+                "cpu_time": stage["cpu_time"],
+                "outcomes": stage["outcomes"],
+            }
+            for name, stage in report["stages"].items()
+        },
+        "tools": report["tools"],
+    }
+
+
+def bench(
+    spec: CorpusSpec, modes: List[str], budget: Budget, workdir: Path
+) -> Dict[str, Any]:
+    source = workdir / "corpus"
+    start = time.perf_counter()
+    stats = generate_corpus(source, spec)
+    generate_time = time.perf_counter() - start
+    stub_dir = write_stub_tools(workdir / "stubs")
+    results: Dict[str, Any] = {
+        "commit": _commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "budget": asdict(budget),
+        "spec": asdict(spec),
+        "corpus": asdict(stats),
+        "generate_time": generate_time,
+        "modes": dict(),
+    }
+    path = os.environ.get("PATH", "")
+    for mode in modes:
+        if mode == "real":
+            missing = [t for t in _REAL_TOOLS if not shutil.which(t)]
+            if missing:
+                print(f"Skipping real tools; not found: {', '.join(missing)}")
+                continue
+        else:
+            os.environ["PATH"] = f"{stub_dir}{os.pathsep}{path}"
+        try:
+            root = workdir / mode
+            shutil.copytree(source, root)
+            results["modes"][mode] = {
+                "cold": build(root, budget),
+                "warm": build(root, budget),
+            }
+        finally:
+            os.environ["PATH"] = path
+    return results
+
+
+def _rows(results: Dict[str, Any]) -> Iterator[tuple]:
+    for mode, runs in results["modes"].items():
+        for run, data in runs.items():
+            yield (mode, run, "total"), data["wall_time"]
+            for stage, s in data["stages"].items():
+                yield (mode, run, stage), s["wall_time"]
+
+
+def report(
+    results: Dict[str, Any], baseline: Optional[Dict[str, Any]]
+) -> None:
+    corpus = results["corpus"]
+    print(
+        f"commit {results['commit']}: {corpus['directories']} directories,"
+        f" {corpus['pdfs']} PDFs ({corpus['scanned']} scanned),"
+        f" {corpus['images']} images, {corpus['archives']} archives"
+    )
+    before = dict(_rows(baseline)) if baseline else dict()
+    header = f"{'mode':<6} {'run':<5} {'stage':<13} {'seconds':>10}"
+    if baseline:
+        header += f" {baseline['commit']:>10} {'ratio':>7}"
+    print(header)
+    for key, seconds in _rows(results):
+        line = f"{key[0]:<6} {key[1]:<5} {key[2]:<13} {seconds:>10.3f}"
+        if key in before:
+            old = before[key]
+            ratio = f"{seconds / old:>7.2f}" if old else f"{'-':>7}"
+            line += f" {old:>10.3f} {ratio}"
+        print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    defaults = CorpusSpec()
+    parser.add_argument("--depth", type=int, default=defaults.depth)
+    parser.add_argument("--fanout", type=int, default=defaults.fanout)
+    parser.add_argument(
+        "--files",
+        type=int,
+        default=defaults.files,
+        help="Documents per directory",
+    )
+    parser.add_argument(
+        "--pages", type=int, default=defaults.pages, help="Pages per PDF"
+    )
+    parser.add_argument(
+        "--words", type=int, default=defaults.words, help="Words per page"
+    )
+    parser.add_argument(
+        "--scanned",
+        type=float,
+        default=defaults.scanned,
+        help="Fraction of PDFs without a text layer",
+    )
+    parser.add_argument(
+        "--images",
+        type=float,
+        default=defaults.images,
+        help="Fraction of documents that are PNG images",
+    )
+    parser.add_argument(
+        "--archives",
+        type=int,
+        default=defaults.archives,
+        help="Zip archives per directory",
+    )
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument(
+        "--tools",
+        choices=("stub", "real", "both"),
+        default="stub",
+        help="Build with stub tools, the real ones, or both",
+    )
+    parser.add_argument("-j", "--jobs", type=float, default=None)
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=None,
+        help=f"Where to save results [{_RESULTS_DIR}/<time>-<commit>.json]",
+    )
+    parser.add_argument(
+        "--compare", type=Path, default=None, help="Earlier results file"
+    )
+    args = parser.parse_args()
+    spec = CorpusSpec(
+        depth=args.depth,
+        fanout=args.fanout,
+        files=args.files,
+        pages=args.pages,
+        words=args.words,
+        scanned=args.scanned,
+        images=args.images,
+        archives=args.archives,
+        seed=args.seed,
+    )
+    budget = Budget.default()
+    if args.jobs:
+        budget = Budget(cpu=args.jobs, memory=budget.memory, tmp=budget.tmp)
+    modes = ["stub", "real"] if args.tools == "both" else [args.tools]
+    # The per-file log lines would swamp the timings
+    logging.disable(logging.INFO)
+    with TemporaryDirectory() as tmpdir:
+        results = bench(spec, modes, budget, Path(tmpdir))
+    baseline = None
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+    report(results, baseline)
+    output = args.output
+    if output is None:
+        stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+        output = _RESULTS_DIR / f"{stamp}-{results['commit']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=1) + "\n")
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
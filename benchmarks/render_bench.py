@@ -0,0 +1,68 @@
+"""Index-page rendering benchmark.
+
+Renders the index page of a synthetic directory with an increasing number
+of entries and reports the time per entry, which should stay roughly flat
+(that is, total time should grow linearly with the number of entries).
+
+Run with ``python -m benchmarks.render_bench``.
+"""
+import argparse
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import List, Tuple
+
+from pdfarchive.render import PageData, PageRenderer, template_environment
+
+
+def _page(n: int) -> PageData:
+    base = Path("/archive/manuals")
+    files = [base / f"document-{i:06d}.pdf" for i in range(n)]
+    dirs = [base / f"folder-{i:05d}" for i in range(n // 10)]
+    archives = [base / f"bundle-{i:05d}.zip" for i in range(n // 100)]
+    return PageData(
+        title="manuals",
+        top_name="archive",
+        top_dir="..",
+        partial_path="manuals",
+        search_url="/cgi-bin/search.cgi",
+        is_root=False,
+        files=files,
+        dirs=dirs,
+        archives=archives,
+    )
+
+
+def bench(sizes: List[int], repeat: int) -> List[Tuple[int, float]]:
+    renderer = PageRenderer(template_environment())
+    results: List[Tuple[int, float]] = list()
+    with TemporaryDirectory() as tmpdir:
+        out = Path(tmpdir) / "index.html"
+        for n in sizes:
+            page = _page(n)
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                renderer.write(page, out)
+                best = min(best, time.perf_counter() - start)
+            results.append((n, best))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=[1000, 2000, 4000, 8000, 16000, 32000],
+        help="Comma-separated entry counts",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print(f"{'entries':>8} {'seconds':>10} {'us/entry':>10}")
+    for n, seconds in bench(args.sizes, args.repeat):
+        print(f"{n:>8} {seconds:>10.4f} {seconds / n * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Fast, deterministic stand-ins for the external tools.
+
+They do no real work, so a build with them on the PATH measures the
+indexer's own overhead: scanning, scheduling, process creation, rendering,
+bookkeeping, and indexing.  Their output depends only on their input:
+
+* pdffonts lists a font, and pdftotext emits a page of text per page,
+  only for PDFs with a text operator in them, so "scanned" documents from
+  the corpus generator still go down the OCR path;
+* pdfinfo counts page objects;
+* gm writes a placeholder image per requested page;
+* tesseract writes a page naming each input image, and takes lists of
+  images as the real one does.
+"""
+from pathlib import Path
+from typing import Dict
+
+_STUBS: Dict[str, str] = {
+    "pdftotext": r"""#!/bin/sh
+# pdftotext [options] input.pdf output.txt
+for a; do src="$out"; out="$a"; done
+: > "$out"
+if grep -q " Tj" "$src"; then
+  pages=$(grep -a -o "/Type /Page /" "$src" | wc -l)
+  i=1
+  while [ "$i" -le "$pages" ]; do
+    printf 'text of %s page %d\n\f' "$(basename "$src")" "$i" >> "$out"
+    i=$((i + 1))
+  done
+fi
+""",
+    "pdffonts": r"""#!/bin/sh
+for a; do src="$a"; done
+echo "name                                 type              encoding"
+echo "------------------------------------ ----------------- ---------"
+if grep -q " Tj" "$src"; then
+  echo "Helvetica                            Type 1            Standard"
+fi
+""",
+    "pdfinfo": r"""#!/bin/sh
+for a; do src="$a"; done
+pages=$(grep -a -o "/Type /Page /" "$src" | wc -l)
+echo "Producer:       stub"
+echo "Pages:          $pages"
+""",
+    "gm": r"""#!/bin/sh
+for a; do out="$a"; done
+case "$*" in
+*+adjoin*)
+  range=$(echo "$*" | sed -n 's/.*\[\([0-9]*\)-\([0-9]*\)\].*/\1 \2/p')
+  # The whole document: call it one page
+  set -- ${range:-0 0}
+  i=$1
+  while [ "$i" -le "$2" ]; do
+    printf 'II*\0' > "$(printf "$out" "$i")"
+    i=$((i + 1))
+  done
+  ;;
+*)
+  printf '\211PNG\r\n\032\n' > "$out"
+  ;;
+esac
+""",
+    "tesseract": r"""#!/bin/sh
+# tesseract input outputbase, where input may list images one per line
+case "$1" in
+*.lst)
+  : > "$2.txt"
+  while IFS= read -r image; do
+    printf 'recognized text of %s\n\f' "$(basename "$image")" >> "$2.txt"
+  done < "$1"
+  ;;
+*)
+  printf 'recognized text of %s\n\f' "$(basename "$1")" > "$2.txt"
+  ;;
+esac
+""",
+}
+
+
+def write_stub_tools(directory: Path) -> Path:
+    """Write the stubs into directory and return it, ready to be put at
+    the front of PATH."""
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, script in _STUBS.items():
+        path = directory / name
+        path.write_text(script)
+        path.chmod(0o755)
+    return directory
@@ -0,0 +1,216 @@
+"""Reading documents out of archives without unpacking them.
+
+Zip files are read through their central directory and tar files (plain or
+compressed) as a stream, so listing an archive or pulling documents out of
+it never writes the archive's contents to disk.  A single compressed
+document (e.g. manual.pdf.gz) is treated as an archive of one member.
+
+The external tools all want a real file, so a member is spilled to a
+temporary file just before it is processed and deleted right after; only
+as many members as fit in an archive job's temporary space are on disk
+at a time.
+
+Zip members are up to date as long as their CRC is unchanged.  Tar keeps
+no checksum, so a tar member is taken to be up to date as long as its
+size and mtime (in whole seconds) are; a member replaced within the same
+second by another of the same size isn't noticed.
+
+Members whose names are absolute or climb out of the archive with ".."
+are ignored, since their outputs would land outside the Thumbs and Text
+trees, as are encrypted zip members.  .7z archives are not read.
+"""
+import gzip
+import lzma
+import os
+import shutil
+import tarfile
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+from typing import (
+    IO,
+    Collection,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    cast,
+)
+
+from .tree import DOCUMENT_SUFFIXES
+
+# Separates an archive's path from a member's name in manifest keys, as in
+# "manuals/bundle.zip!/scan.pdf".
+MEMBER_SEPARATOR = "!/"
+
+# What can go wrong reading a damaged or truncated archive (zipfile raises
+# RuntimeError for an encrypted member)
+ARCHIVE_ERRORS = (
+    zipfile.BadZipFile,
+    RuntimeError,
+    tarfile.TarError,
+    lzma.LZMAError,
+    EOFError,
+    OSError,
+)
+
+_CHUNK = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class ArchiveMember:
+    """A document inside an archive.  checksum changes whenever the
+    member's content does (as far as the archive format can tell us)."""
+
+    archive: Path
+    name: str
+    size: int
+    checksum: str
+
+    @property
+    def path(self) -> PurePosixPath:
+        return PurePosixPath(self.name)
+
+
+def _is_tar(archive: Path) -> bool:
+    name = archive.name.lower()
+    return name.endswith((".tar", ".tar.gz", ".tgz", ".tar.xz", ".txz"))
+
+
+def _member_name(name: str) -> Optional[str]:
+    """name, normalized, if it is a document we can safely index."""
+    path = PurePosixPath(name)
+    if path.is_absolute() or ".." in path.parts or not path.parts:
+        return None
+    if path.suffix.lower() not in DOCUMENT_SUFFIXES:
+        return None
+    return str(path)
+
+
+def _single_member(archive: Path) -> Optional[ArchiveMember]:
+    name = _member_name(archive.stem)
+    if name is None:
+        return None
+    st = archive.stat()
+    return ArchiveMember(
+        archive=archive,
+        name=name,
+        size=st.st_size,
+        checksum=f"mtime:{st.st_mtime_ns}",
+    )
+
+
+def _open_single(archive: Path) -> IO[bytes]:
+    if archive.suffix.lower() == ".xz":
+        return cast(IO[bytes], lzma.open(archive))
+    return cast(IO[bytes], gzip.open(archive))
+
+
+def _zip_members(
+    zf: zipfile.ZipFile, archive: Path
+) -> Iterator[Tuple[ArchiveMember, zipfile.ZipInfo]]:
+    seen = set()
+    for info in zf.infolist():
+        # Encrypted members can't be read without a password
+        if info.is_dir() or info.flag_bits & 0x1:
+            continue
+        name = _member_name(info.filename)
+        if name is None or name in seen:
+            continue
+        seen.add(name)
+        yield ArchiveMember(
+            archive=archive,
+            name=name,
+            size=info.file_size,
+            checksum=f"crc:{info.CRC:08x}",
+        ), info
+
+
+def _tar_member(ti: tarfile.TarInfo, archive: Path) -> Optional[ArchiveMember]:
+    if not ti.isfile():
+        return None
+    name = _member_name(ti.name)
+    if name is None:
+        return None
+    return ArchiveMember(
+        archive=archive,
+        name=name,
+        size=ti.size,
+        checksum=f"mtime:{int(ti.mtime)}",
+    )
+
+
+def is_readable(archive: Path) -> bool:
+    suffix = archive.suffix.lower()
+    return suffix in (".zip", ".gz", ".xz") or _is_tar(archive)
+
+
+def list_members(archive: Path) -> List[ArchiveMember]:
+    """The documents in archive, in archive order.  For a compressed tar
+    file, this means decompressing the whole thing (but not storing it).
+    Raises one of ARCHIVE_ERRORS if the archive can't be read."""
+    if not is_readable(archive):
+        return list()
+    if archive.suffix.lower() == ".zip":
+        with zipfile.ZipFile(archive) as zf:
+            return [m for m, _ in _zip_members(zf, archive)]
+    if _is_tar(archive):
+        members: List[ArchiveMember] = list()
+        seen = set()
+        with tarfile.open(archive, "r|*") as tf:
+            for ti in tf:
+                m = _tar_member(ti, archive)
+                if m is not None and m.name not in seen:
+                    seen.add(m.name)
+                    members.append(m)
+        return members
+    single = _single_member(archive)
+    return [single] if single else list()
+
+
+def iter_members(
+    archive: Path, names: Optional[Collection[str]] = None
+) -> Generator[Tuple[ArchiveMember, IO[bytes]], None, None]:
+    """Yield each document in archive (or just those named in names) with
+    a stream of its content, in one pass over the archive.  Each stream is
+    only good until the next member is asked for."""
+    if not is_readable(archive):
+        return
+    if archive.suffix.lower() == ".zip":
+        with zipfile.ZipFile(archive) as zf:
+            for member, info in _zip_members(zf, archive):
+                if names is not None and member.name not in names:
+                    continue
+                with zf.open(info) as stream:
+                    yield member, stream
+        return
+    if _is_tar(archive):
+        seen = set()
+        with tarfile.open(archive, "r|*") as tf:
+            for ti in tf:
+                tar_member = _tar_member(ti, archive)
+                if tar_member is None or tar_member.name in seen:
+                    continue
+                seen.add(tar_member.name)
+                if names is not None and tar_member.name not in names:
+                    continue
+                tar_stream = tf.extractfile(ti)
+                if tar_stream is not None:
+                    yield tar_member, tar_stream
+        return
+    single = _single_member(archive)
+    if single is None or (names is not None and single.name not in names):
+        return
+    with _open_single(archive) as single_stream:
+        yield single, single_stream
+
+
+def spill(member: ArchiveMember, stream: IO[bytes], directory: Path) -> Path:
+    """Copy a member's content to a file in directory, keeping its suffix
+    (the tools go by it), and return the file's path."""
+    path = directory / f"member{member.path.suffix.lower()}"
+    with open(path, "wb") as f:
+        shutil.copyfileobj(stream, f, _CHUNK)
+    os.chmod(path, 0o600)
+    return path
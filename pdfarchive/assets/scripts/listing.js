@@ -0,0 +1,156 @@
+/* Virtualized file listing for paged directories.
+
+   The static page has one page of files.  This fetches the directory's
+   listing of all of them and replaces that page with a grid tall enough
+   for every file, of which only the rows on screen (and a couple either
+   side) are ever in the document, so thumbnails are only fetched as
+   they scroll into view.  If the listing can't be fetched (no
+   JavaScript, or a file: URL) the static page and its links to the
+   others are left as they are. */
+
+window.cellwidth=180;
+window.cellheight=170;
+window.overscan=2;
+
+function stemof(name) {
+    var dot = name.lastIndexOf(".");
+    return dot > 0 ? name.slice(0, dot) : name;
+}
+
+function makecell(listing, index) {
+    var name = listing.files[index];
+    var stem = stemof(name);
+    var quoted = encodeURIComponent(stem);
+    var cell = document.createElement("div");
+    cell.className = "file";
+    cell.id = "fileid_" + index;
+    var link = document.createElement("a");
+    link.href = encodeURIComponent(name);
+    var img = document.createElement("img");
+    var thumb = listing.thumbs + "/" + quoted + "_thumb.png";
+    var sprites = listing.sprites;
+    if (sprites) {
+        /* Its cell in the directory's sprite sheets, or if they're not
+           there, the thumbnail itself */
+        var n = index % sprites.sheet_size;
+        var x = (n % sprites.columns) * sprites.cell[0];
+        var y = Math.floor(n / sprites.columns) * sprites.cell[1];
+        var sheet = Math.floor(index / sprites.sheet_size);
+        img.src = listing.thumbs + "/sprites-" + sheet + ".png";
+        img.style.width = sprites.cell[0] + "px";
+        img.style.height = sprites.cell[1] + "px";
+        img.style.objectFit = "none";
+        img.style.objectPosition = "-" + x + "px -" + y + "px";
+        img.onerror = function() {
+            img.onerror = null;
+            img.removeAttribute("style");
+            img.src = thumb;
+        };
+    } else {
+        img.src = thumb;
+    }
+    img.alt = "[" + stem + "]";
+    img.title = img.alt;
+    link.appendChild(img);
+    link.appendChild(document.createElement("br"));
+    link.appendChild(document.createTextNode(stem));
+    cell.appendChild(link);
+    cell.appendChild(document.createElement("br"));
+    var text = document.createElement("a");
+    text.href = listing.text + "/" + quoted + ".txt";
+    text.appendChild(document.createTextNode("[text]"));
+    cell.appendChild(text);
+    return cell;
+}
+
+function VirtualList(grid, listing) {
+    this.grid = grid;
+    this.listing = listing;
+    this.cells = {};
+    this.columns = 1;
+    this.pending = false;
+}
+
+VirtualList.prototype.layout = function() {
+    this.columns = Math.max(1, Math.floor(this.grid.clientWidth / cellwidth));
+    var rows = Math.ceil(this.listing.files.length / this.columns);
+    this.grid.style.height = (rows * cellheight) + "px";
+    for (var index in this.cells) {
+        this.grid.removeChild(this.cells[index]);
+    }
+    this.cells = {};
+    this.render();
+};
+
+VirtualList.prototype.render = function() {
+    this.pending = false;
+    var top = this.grid.getBoundingClientRect().top;
+    var first = Math.floor(Math.max(0, -top) / cellheight) - overscan;
+    var last = Math.ceil((window.innerHeight - top) / cellheight) + overscan;
+    var start = Math.max(0, first * this.columns);
+    var end = Math.min(this.listing.files.length, last * this.columns);
+    for (var index in this.cells) {
+        if (index < start || index >= end) {
+            this.grid.removeChild(this.cells[index]);
+            delete this.cells[index];
+        }
+    }
+    for (var i = start; i < end; i++) {
+        if (i in this.cells) {
+            continue;
+        }
+        var row = Math.floor(i / this.columns);
+        var cell = makecell(this.listing, i);
+        cell.style.left = ((i % this.columns) * cellwidth) + "px";
+        cell.style.top = (row * cellheight) + "px";
+        if (row % 2 === 0) {
+            cell.classList.add("shaded");  /* First, third, etc. */
+        }
+        this.cells[i] = cell;
+        this.grid.appendChild(cell);
+    }
+};
+
+VirtualList.prototype.schedule = function() {
+    if (!this.pending) {
+        this.pending = true;
+        window.requestAnimationFrame(this.render.bind(this));
+    }
+};
+
+function startlisting(container, listing) {
+    var grid = document.getElementById("filegrid");
+    var pagination = document.getElementById("pagination");
+    if (pagination) {
+        pagination.style.display = "none";
+    }
+    grid.textContent = "";
+    grid.className = "virtualgrid";
+    var list = new VirtualList(grid, listing);
+    list.layout();
+    /* Start where this page's files would be */
+    var first = parseInt(container.dataset.first, 10) || 0;
+    if (first) {
+        var row = Math.floor(first / list.columns);
+        var top = grid.getBoundingClientRect().top + window.pageYOffset;
+        window.scrollTo(0, top + row * cellheight);
+    }
+    window.addEventListener("scroll", list.schedule.bind(list));
+    window.addEventListener("resize", list.layout.bind(list));
+}
+
+document.addEventListener("DOMContentLoaded", function() {
+    var container = document.getElementById("filelist");
+    if (!container || !container.dataset.listing || !window.fetch) {
+        return;
+    }
+    fetch(container.dataset.listing)
+        .then(function(response) {
+            if (!response.ok) {
+                throw new Error(response.statusText);
+            }
+            return response.json();
+        })
+        .then(function(listing) { startlisting(container, listing); })
+        .catch(function() { /* Keep the static page */ });
+});
@@ -0,0 +1,205 @@
+/*
+ * Client-side search over the static index written by
+ * pdfarchive.staticsearch.  Only meta.json, the term shards for the
+ * prefixes of the query words, and the document shards for the hits that
+ * are shown are fetched; shards are cached for the life of the page.
+ *
+ * Expects a form#searchform containing input#searchterms, and a
+ * div#searchresults.  The index lives in search/ next to search.html.
+ */
+(function () {
+    var indexBase = "search/";
+    var resultLimit = 50;
+    var metaPromise = null;
+    var shardCache = {};
+
+    function fetchJSON(path) {
+        if (!(path in shardCache)) {
+            shardCache[path] = fetch(indexBase + path).then(function (r) {
+                if (!r.ok) {
+                    return null;
+                }
+                return r.json();
+            });
+        }
+        return shardCache[path];
+    }
+
+    function loadMeta() {
+        if (metaPromise === null) {
+            metaPromise = fetchJSON("meta.json");
+        }
+        return metaPromise;
+    }
+
+    function escapeRegExp(s) {
+        return s.replace(/[-\/\\^$*+?.()|[\]{}]/g, "\\$&");
+    }
+
+    function stripChars(word, chars, leading) {
+        var re = leading
+            ? new RegExp("^[" + escapeRegExp(chars) + "]+")
+            : new RegExp("[" + escapeRegExp(chars) + "]+$");
+        return chars ? word.replace(re, "") : word;
+    }
+
+    /* Must match WordRules.words() in pdfarchive/textindex.py */
+    function words(meta, text) {
+        if (meta.ascii7) {
+            text = text.normalize("NFKD").replace(/[^\x00-\x7f]/g, "");
+        }
+        text = text.toLowerCase();
+        var splitter = new RegExp(
+            "[^" + escapeRegExp(meta.word_characters) + "]+");
+        var seen = {};
+        var result = [];
+        text.split(splitter).forEach(function (word) {
+            word = stripChars(word, meta.ignore_first, true);
+            word = stripChars(word, meta.ignore_last, false);
+            if (!word ||
+                meta.begin_characters.indexOf(word[0]) < 0 ||
+                meta.end_characters.indexOf(word[word.length - 1]) < 0 ||
+                meta.stopwords.indexOf(word) >= 0 ||
+                seen[word]) {
+                return;
+            }
+            seen[word] = true;
+            result.push(word);
+        });
+        return result;
+    }
+
+    /* Must match shard_name() in pdfarchive/staticsearch.py */
+    function shardName(meta, term) {
+        return Array.from(term.slice(0, meta.prefix_length)).map(function (c) {
+            return /[a-z0-9]/.test(c) ? c : "_" + c.charCodeAt(0).toString(16);
+        }).join("");
+    }
+
+    function termScores(meta, shard, term) {
+        var scores = {};
+        var flat = (shard && shard[term]) || [];
+        var df = flat.length / 2;
+        var idf = Math.log(1 + Math.max(meta.n_docs, 1) / (1 + df));
+        var docId = 0;
+        for (var i = 0; i < flat.length; i += 2) {
+            docId += flat[i];
+            scores[docId] = (1 + Math.log(flat[i + 1])) * idf;
+        }
+        return scores;
+    }
+
+    function search(query) {
+        return loadMeta().then(function (meta) {
+            var terms = words(meta, query);
+            if (!terms.length) {
+                return [];
+            }
+            return Promise.all(terms.map(function (term) {
+                return fetchJSON("terms/" + shardName(meta, term) + ".json");
+            })).then(function (shards) {
+                var scores = null;
+                terms.forEach(function (term, i) {
+                    var ts = termScores(meta, shards[i], term);
+                    if (scores === null) {
+                        scores = ts;
+                        return;
+                    }
+                    var combined = {};
+                    Object.keys(scores).forEach(function (d) {
+                        if (d in ts) {
+                            combined[d] = scores[d] + ts[d];
+                        }
+                    });
+                    scores = combined;
+                });
+                var ranked = Object.keys(scores).map(function (d) {
+                    return [parseInt(d, 10), scores[d]];
+                }).sort(function (a, b) {
+                    return b[1] - a[1] || a[0] - b[0];
+                });
+                return liveHits(meta, ranked, []);
+            });
+        });
+    }
+
+    /*
+     * The documents for the best of the ranked hits, up to resultLimit.
+     * Term shards that only removed documents were in aren't rewritten
+     * until the index is next merged, so some hits may be for documents
+     * that are gone; they have no entry in the document shards, and more
+     * hits are looked at in their place.
+     */
+    function liveHits(meta, ranked, hits) {
+        var batch = ranked.slice(0, resultLimit - hits.length);
+        if (!batch.length) {
+            return Promise.resolve(hits);
+        }
+        return Promise.all(batch.map(function (hit) {
+            var n = Math.floor(hit[0] / meta.docs_per_shard);
+            return fetchJSON("docs/" + n + ".json").then(function (docs) {
+                var doc = docs && docs[String(hit[0])];
+                return doc && {
+                    source: doc[0],
+                    text: meta.text_links === false ? null : doc[1],
+                    score: hit[1]
+                };
+            });
+        })).then(function (found) {
+            hits = hits.concat(found.filter(function (h) { return h; }));
+            return liveHits(meta, ranked.slice(batch.length), hits);
+        });
+    }
+
+    function render(container, hits) {
+        container.textContent = "";
+        if (!hits.length) {
+            container.textContent = "No matching documents.";
+            return;
+        }
+        var list = document.createElement("ol");
+        hits.forEach(function (hit) {
+            var item = document.createElement("li");
+            var doc = document.createElement("a");
+            doc.href = encodeURI(hit.source);
+            doc.textContent = hit.source;
+            item.appendChild(doc);
+            if (hit.text) {
+                var text = document.createElement("a");
+                text.href = "Text/" + encodeURI(hit.text);
+                text.textContent = "[text]";
+                item.appendChild(document.createTextNode(" "));
+                item.appendChild(text);
+            }
+            list.appendChild(item);
+        });
+        container.appendChild(list);
+    }
+
+    window.pdfarchiveSearch = search;
+
+    document.addEventListener("DOMContentLoaded", function () {
+        var form = document.getElementById("searchform");
+        var input = document.getElementById("searchterms");
+        var results = document.getElementById("searchresults");
+        if (!form || !input || !results) {
+            return;
+        }
+        function run() {
+            history.replaceState(null, "", "?q=" +
+                encodeURIComponent(input.value));
+            search(input.value).then(function (hits) {
+                render(results, hits);
+            });
+        }
+        form.addEventListener("submit", function (e) {
+            e.preventDefault();
+            run();
+        });
+        var q = new URLSearchParams(window.location.search).get("q");
+        if (q) {
+            input.value = q;
+            run();
+        }
+    });
+})();
@@ -24,6 +24,13 @@ function addalt() {
     $.each($(".dir"),     function(k,v){ dircallback(k,v);});
 }
 
+/* Resizing fires continuously; reshade once it has settled */
+window.shadetimer=null;
+function scheduleaddalt() {
+    clearTimeout(window.shadetimer);
+    window.shadetimer = setTimeout(addalt, 100);
+}
+
 $(document).ready(addalt);
-$(window).resize(addalt);
+$(window).resize(scheduleaddalt);
 	
@@ -0,0 +1,232 @@
+"""Writing outputs so that nobody ever sees half of one.
+
+Every output goes to a temporary file next to its final path and is
+renamed into place once it is complete, so a tool that is killed part way
+through (by the OOM killer, a timeout, or the operator) leaves at worst a
+stray temporary file, never a truncated thumbnail, text file, or page
+that a later run or a reader would take for the real thing.
+
+The temporary name is derived from the final one, hidden, and keeps its
+suffix, since gm and tesseract go by the suffix to decide what to write.
+It also names the process and thread writing it, so that two writers of
+the same output (concurrent builds, say) never write to the same file;
+stray_temporaries() finds whatever a killed run left.
+
+Outputs are for a web server to read, so they are made readable by
+everyone (and directories searchable) explicitly, rather than by setting
+the umask, which would change it for every thread in the process.
+
+An output that comes out the same as the one already there is not
+replaced, so its mtime stays put and a sync to the web servers or a CDN
+sees nothing new.  What is added, changed, or removed can be noted in a
+ChangeLog, which the build writes out (to changes.json by default) for
+whatever publishes the site to push just those.
+"""
+import glob
+import json
+import os
+import shutil
+import stat
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Dict, Iterator, List, Optional
+
+OUTPUT_MODE = 0o644
+DIRECTORY_MODE = 0o755
+CHANGES_NAME = "changes.json"
+
+_CHUNK = 1024 * 1024
+_KINDS = ("added", "changed", "removed")
+
+
+class ChangeLog:
+    """The outputs under base_dir that a build has added, changed, and
+    removed.  An output added and then removed again was never there; one
+    removed and then written again has changed."""
+
+    def __init__(self, base_dir: Path) -> None:
+        self.base_dir = base_dir
+        self._changes: Dict[str, str] = dict()
+        self._lock = threading.Lock()
+
+    def _name(self, path: Path) -> str:
+        try:
+            return str(path.relative_to(self.base_dir))
+        except ValueError:
+            return str(path)
+
+    def record(self, path: Path, kind: str) -> None:
+        """Note that path was added, changed, or removed."""
+        name = self._name(path)
+        with self._lock:
+            was = self._changes.get(name)
+            if was == "added" and kind == "removed":
+                del self._changes[name]
+                return
+            if was == "added":
+                kind = "added"
+            elif was == "removed" and kind != "removed":
+                kind = "changed"
+            self._changes[name] = kind
+
+    def __len__(self) -> int:
+        return len(self._changes)
+
+    def clear(self) -> None:
+        """Start afresh, for the next of a series of updates."""
+        with self._lock:
+            self._changes = dict()
+
+    def as_dict(self) -> Dict[str, List[str]]:
+        with self._lock:
+            return {
+                kind: sorted(n for n, k in self._changes.items() if k == kind)
+                for kind in _KINDS
+            }
+
+    def write(self, path: Path) -> None:
+        write_atomically(path, json.dumps(self.as_dict(), indent=1) + "\n")
+
+
+def temporary_path(path: Path, keep_suffix: bool = True) -> Path:
+    """Where this thread should write path before renaming it into place.
+    Without keep_suffix, the suffix is hidden too, from whatever picks up
+    files by their suffix, such as node_exporter's textfile collector."""
+    writer = f"{os.getpid()}-{threading.get_ident()}"
+    if not keep_suffix:
+        return path.with_name(f".{path.name}.{writer}.tmp")
+    return path.with_name(f".{path.stem}.{writer}.tmp{path.suffix}")
+
+
+def stray_temporaries(path: Path) -> List[Path]:
+    """The temporary files for path that any writer has left behind,
+    including those of versions that didn't name the writer."""
+    stem, suffix = glob.escape(path.stem), glob.escape(path.suffix)
+    strays = list(path.parent.glob(f".{stem}.[0-9]*-[0-9]*.tmp{suffix}"))
+    old = path.with_name(f".{path.stem}.tmp{path.suffix}")
+    if old.exists():
+        strays.append(old)
+    return strays
+
+
+def same_content(a: Path, b: Path) -> bool:
+    """Whether files a and b hold the same bytes."""
+    try:
+        if a.stat().st_size != b.stat().st_size:
+            return False
+        with open(a, "rb") as fa, open(b, "rb") as fb:
+            while True:
+                chunk = fa.read(_CHUNK)
+                if chunk != fb.read(_CHUNK):
+                    return False
+                if not chunk:
+                    return True
+    except FileNotFoundError:
+        return False
+
+
+def replace_if_changed(
+    tmp: Path, path: Path, changes: Optional[ChangeLog] = None
+) -> bool:
+    """Rename tmp to path, unless path already has the same content, in
+    which case tmp is removed and path left alone.  Returns whether path
+    changed."""
+    if same_content(tmp, path):
+        tmp.unlink()
+        return False
+    existed = path.exists()
+    # tmp may be a hardlink to a cached object, so leave it alone unless
+    # it needs fixing
+    if stat.S_IMODE(os.stat(tmp).st_mode) != OUTPUT_MODE:
+        os.chmod(tmp, OUTPUT_MODE)
+    os.replace(tmp, path)
+    if changes is not None:
+        changes.record(path, "changed" if existed else "added")
+    return True
+
+
+def remove(path: Path, changes: Optional[ChangeLog] = None) -> None:
+    """Remove path, if it is there."""
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        return
+    if changes is not None:
+        changes.record(path, "removed")
+
+
+def remove_tree(path: Path, changes: Optional[ChangeLog] = None) -> None:
+    """Remove the directory path and everything in it."""
+    if changes is not None:
+        for f in path.rglob("*"):
+            if not f.is_dir():
+                changes.record(f, "removed")
+    shutil.rmtree(path)
+
+
+@contextmanager
+def atomic_output(
+    path: Path, changes: Optional[ChangeLog] = None, keep_suffix: bool = True
+) -> Iterator[Path]:
+    """Yield the temporary path for a tool to write path to.  When the
+    block finishes, whatever the tool wrote replaces path, unless it is
+    the same as what is there; if it wrote nothing, path is removed, since
+    whatever was there is out of date.  If the block raises, path is left
+    alone and the temporary file removed."""
+    tmp = temporary_path(path, keep_suffix)
+    tmp.unlink(missing_ok=True)
+    try:
+        yield tmp
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    if tmp.exists():
+        replace_if_changed(tmp, path, changes)
+    else:
+        remove(path, changes)
+
+
+@contextmanager
+def atomic_open(
+    path: Path,
+    mode: str = "w",
+    changes: Optional[ChangeLog] = None,
+    keep_suffix: bool = True,
+) -> Iterator[IO]:
+    """Like open(path, mode), but path only changes when the file is
+    closed without an exception, and then only if its content did."""
+    with atomic_output(path, changes, keep_suffix) as tmp:
+        with open(tmp, mode) as f:
+            yield f
+
+
+def make_directory(path: Path) -> None:
+    """Create path and any missing parents, with DIRECTORY_MODE whatever
+    the umask."""
+    missing: List[Path] = list()
+    parent = path
+    while not parent.exists():
+        missing.append(parent)
+        parent = parent.parent
+    path.mkdir(parents=True, exist_ok=True)
+    for directory in missing:
+        os.chmod(directory, DIRECTORY_MODE)
+
+
+def write_atomically(
+    path: Path,
+    text: str,
+    changes: Optional[ChangeLog] = None,
+    keep_suffix: bool = True,
+) -> None:
+    make_directory(path.parent)
+    with atomic_open(path, changes=changes, keep_suffix=keep_suffix) as f:
+        f.write(text)
+
+
+def copy_atomically(
+    source: Path, path: Path, changes: Optional[ChangeLog] = None
+) -> None:
+    with atomic_output(path, changes) as tmp:
+        shutil.copyfile(source, tmp)
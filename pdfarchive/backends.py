@@ -0,0 +1,402 @@
+"""Rasterization and text extraction backends.
+
+Everything the build needs to know about a document before OCR (a
+thumbnail, whether it has fonts, its text layer, how many pages it has,
+and its pages as images for tesseract) goes through a Backend.
+
+The "tools" backend runs GraphicsMagick and Poppler's command-line tools,
+as pdfarchive always has.  The "inprocess" backend does the same work with
+PyMuPDF and Pillow (pip install pdfarchive[inprocess]), without a fork,
+an exec, or a trip through the filesystem per step, and keeps recently
+used documents open, so the thumbnail, triage, text, and OCR stages of
+one document parse it once.  MuPDF is not thread-safe, so the in-process
+backend does one thing at a time; the OCR it feeds still runs in
+parallel.
+
+OCR itself is the OCRPool's business, whichever backend is used.
+"""
+import logging
+import re
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple, Type
+
+from .external import ExecutionEngine, default_engine
+from .gmbatch import GMBatchPool
+from .ocr import page_count
+from .triage import has_fonts, image_pages
+
+DEFAULT_BACKEND = "tools"
+
+
+def _page_number(p: Path) -> int:
+    match = re.search(r"(\d+)$", p.stem)
+    return int(match.group(1)) if match else 0
+
+
+def _geometry(geometry: str) -> Tuple[int, int]:
+    """Width and height from a gm geometry or density like "150x100"."""
+    width, _, height = geometry.partition("x")
+    return int(width), int(height or width)
+
+
+class Backend(ABC):
+    # The executables the backend runs, which must be installed
+    executables: Tuple[str, ...] = ()
+
+    def __init__(self, logger: Optional[logging.Logger] = None) -> None:
+        self.logger = logger or logging.getLogger(__name__)
+
+    @property
+    def can_triage(self) -> bool:
+        """Whether has_fonts() can ever give an answer."""
+        return True
+
+    @abstractmethod
+    def thumbnail(self, source: Path, output: Path, geometry: str) -> None:
+        """Write a PNG of the first page of source (a PDF or an image),
+        scaled to fit geometry, to output.  If that fails, output is not
+        written."""
+
+    @abstractmethod
+    def has_fonts(self, pdf: Path) -> Optional[bool]:
+        """Whether pdf uses any fonts; None if we can't tell."""
+
+    @abstractmethod
+    def image_pages(self, pdf: Path) -> Optional[Set[int]]:
+        """Which pages of pdf (numbered from 0) show any images; None if
+        we can't tell."""
+
+    @abstractmethod
+    def pdf_text(self, pdf: Path, output: Path) -> None:
+        """Write the text layer of pdf to output, each page followed by a
+        form feed, as pdftotext does.  If that fails, output is not
+        written."""
+
+    @abstractmethod
+    def page_count(self, pdf: Path) -> Optional[int]:
+        """How many pages pdf has; None if we can't tell."""
+
+    @abstractmethod
+    def render_pages(
+        self,
+        pdf: Path,
+        first: int,
+        last: Optional[int],
+        directory: Path,
+        density: str,
+        depth: str,
+    ) -> List[Path]:
+        """Rasterize pages first through last (zero-based, inclusive;
+        last None for the end of the document) of pdf at density, for
+        OCR, into images in directory.  Returns the images in page order;
+        pages that could not be rendered are missing."""
+
+    @abstractmethod
+    def sprite_sheet(
+        self,
+        thumbs: Sequence[Optional[Path]],
+        output: Path,
+        geometry: str,
+        columns: int,
+    ) -> None:
+        """Write a PNG of thumbs, each centred in a cell of geometry,
+        columns cells to a row, to output, leaving the cells of None
+        transparent.  If that fails, output is not written."""
+
+    def close(self) -> None:
+        pass
+
+
+class ToolBackend(Backend):
+    """gm (or a gm batch pool), pdftotext, pdfinfo, and, if installed,
+    pdffonts and pdfimages."""
+
+    executables = ("gm", "pdftotext", "pdfinfo")
+
+    def __init__(
+        self,
+        logger: Optional[logging.Logger] = None,
+        engine: Optional[ExecutionEngine] = None,
+        gm_batch: Optional[GMBatchPool] = None,
+        has_pdffonts: bool = False,
+        has_pdfimages: bool = False,
+    ) -> None:
+        super().__init__(logger)
+        self.engine = engine or default_engine()
+        self.gm_batch = gm_batch
+        self.has_pdffonts = has_pdffonts
+        self.has_pdfimages = has_pdfimages
+
+    def _run(self, args: List[str]) -> None:
+        self.engine.run(args, self.logger)
+
+    @property
+    def can_triage(self) -> bool:
+        return self.has_pdffonts
+
+    def thumbnail(self, source: Path, output: Path, geometry: str) -> None:
+        args = [
+            "convert",
+            "-geometry",
+            geometry,
+            f"{source}[0]",
+            "-resize",
+            geometry,
+            "-strip",
+            f"{output}",
+        ]
+        if self.gm_batch:
+            self.gm_batch.run(args)
+        else:
+            self._run(["gm"] + args)
+
+    def has_fonts(self, pdf: Path) -> Optional[bool]:
+        if not self.has_pdffonts:
+            return None
+        return has_fonts(pdf, self.logger, self.engine)
+
+    def image_pages(self, pdf: Path) -> Optional[Set[int]]:
+        if not self.has_pdfimages:
+            return None
+        return image_pages(pdf, self.logger, self.engine)
+
+    def pdf_text(self, pdf: Path, output: Path) -> None:
+        self._run(["pdftotext", "-q", f"{pdf}", f"{output}"])
+
+    def page_count(self, pdf: Path) -> Optional[int]:
+        return page_count(pdf, self.logger, self.engine)
+
+    def render_pages(
+        self,
+        pdf: Path,
+        first: int,
+        last: Optional[int],
+        directory: Path,
+        density: str,
+        depth: str,
+    ) -> List[Path]:
+        if last is None:
+            source = f"{pdf}" if first == 0 else f"{pdf}[{first}-]"
+        else:
+            source = f"{pdf}[{first}-{last}]"
+        # +adjoin writes one TIFF per page, numbered by the %d
+        self._run(
+            [
+                "gm",
+                "convert",
+                "-density",
+                density,
+                source,
+                "-depth",
+                depth,
+                "-strip",
+                "-background",
+                "white",
+                "+adjoin",
+                f"{directory / 'page-%04d.tif'}",
+            ]
+        )
+        return sorted(directory.glob("page-*.tif"), key=_page_number)
+
+    def sprite_sheet(
+        self,
+        thumbs: Sequence[Optional[Path]],
+        output: Path,
+        geometry: str,
+        columns: int,
+    ) -> None:
+        # null: is an empty tile
+        self._run(
+            [
+                "gm",
+                "montage",
+                "-background",
+                "none",
+                "-geometry",
+                f"{geometry}>+0+0",
+                "-tile",
+                f"{columns}x",
+                *[f"{t}" if t else "null:" for t in thumbs],
+                f"{output}",
+            ]
+        )
+
+
+class InProcessBackend(Backend):
+    """PyMuPDF for PDFs and Pillow for images."""
+
+    def __init__(
+        self, logger: Optional[logging.Logger] = None, open_documents: int = 4
+    ) -> None:
+        super().__init__(logger)
+        try:
+            try:
+                import pymupdf
+            except ImportError:
+                # PyMuPDF before 1.24.3
+                import fitz as pymupdf
+            from PIL import Image
+        except ImportError as exc:
+            raise RuntimeError(
+                "The inprocess backend needs PyMuPDF and Pillow:"
+                " pip install pdfarchive[inprocess]"
+            ) from exc
+        self._fitz: Any = pymupdf
+        self._image: Any = Image
+        self.open_documents = open_documents
+        self._documents: "OrderedDict[Tuple[Path, int, int], Any]" = (
+            OrderedDict()
+        )
+        self._lock = threading.RLock()
+
+    def _open(self, pdf: Path) -> Any:
+        """The open document for this version of pdf.  Call with the lock
+        held."""
+        st = pdf.stat()
+        key = (pdf, st.st_size, st.st_mtime_ns)
+        if key in self._documents:
+            self._documents.move_to_end(key)
+            return self._documents[key]
+        document = self._fitz.open(pdf)
+        self._documents[key] = document
+        while len(self._documents) > self.open_documents:
+            _, oldest = self._documents.popitem(last=False)
+            oldest.close()
+        return document
+
+    def _failed(self, what: str, source: Path, exc: Exception) -> None:
+        self.logger.warning(f"Cannot {what} '{source}': {exc}")
+
+    def thumbnail(self, source: Path, output: Path, geometry: str) -> None:
+        width, height = _geometry(geometry)
+        try:
+            if source.suffix.lower() != ".pdf":
+                with self._image.open(source) as image:
+                    image.thumbnail((width, height))
+                    image.save(output, format="PNG")
+                return
+            with self._lock:
+                page = self._open(source)[0]
+                zoom = min(width / page.rect.width, height / page.rect.height)
+                pixmap = page.get_pixmap(
+                    matrix=self._fitz.Matrix(zoom, zoom), alpha=False
+                )
+                pixmap.save(output, output="png")
+        except Exception as exc:
+            output.unlink(missing_ok=True)
+            self._failed("thumbnail", source, exc)
+
+    def has_fonts(self, pdf: Path) -> Optional[bool]:
+        try:
+            with self._lock:
+                return any(page.get_fonts() for page in self._open(pdf))
+        except Exception as exc:
+            self._failed("list fonts of", pdf, exc)
+            return None
+
+    def image_pages(self, pdf: Path) -> Optional[Set[int]]:
+        try:
+            with self._lock:
+                return {
+                    i
+                    for i, page in enumerate(self._open(pdf))
+                    if page.get_images()
+                }
+        except Exception as exc:
+            self._failed("list images of", pdf, exc)
+            return None
+
+    def pdf_text(self, pdf: Path, output: Path) -> None:
+        try:
+            with self._lock:
+                text = "".join(
+                    f"{page.get_text()}\f" for page in self._open(pdf)
+                )
+        except Exception as exc:
+            self._failed("extract text from", pdf, exc)
+            return
+        output.write_text(text)
+
+    def page_count(self, pdf: Path) -> Optional[int]:
+        try:
+            with self._lock:
+                return int(self._open(pdf).page_count)
+        except Exception as exc:
+            self._failed("count pages of", pdf, exc)
+            return None
+
+    def render_pages(
+        self,
+        pdf: Path,
+        first: int,
+        last: Optional[int],
+        directory: Path,
+        density: str,
+        depth: str,
+    ) -> List[Path]:
+        # Greyscale at 8 bits rather than depth: tesseract binarizes it
+        # anyway.
+        dpi, _ = _geometry(density)
+        images: List[Path] = list()
+        try:
+            with self._lock:
+                document = self._open(pdf)
+                end = document.page_count - 1
+                if last is not None:
+                    end = min(end, last)
+                for number in range(first, end + 1):
+                    image = directory / f"page-{number:04d}.png"
+                    document[number].get_pixmap(
+                        dpi=dpi, colorspace=self._fitz.csGRAY, alpha=False
+                    ).save(image)
+                    images.append(image)
+        except Exception as exc:
+            self._failed("rasterize", pdf, exc)
+        return images
+
+    def sprite_sheet(
+        self,
+        thumbs: Sequence[Optional[Path]],
+        output: Path,
+        geometry: str,
+        columns: int,
+    ) -> None:
+        width, height = _geometry(geometry)
+        rows = -(-len(thumbs) // columns)
+        sheet = self._image.new(
+            "RGBA",
+            (width * min(columns, len(thumbs)), height * rows),
+            (0, 0, 0, 0),
+        )
+        for n, thumb in enumerate(thumbs):
+            if thumb is None:
+                continue
+            row, column = divmod(n, columns)
+            try:
+                with self._image.open(thumb) as image:
+                    image.thumbnail((width, height))
+                    sheet.paste(
+                        image.convert("RGBA"),
+                        (
+                            column * width + (width - image.width) // 2,
+                            row * height + (height - image.height) // 2,
+                        ),
+                    )
+            except Exception as exc:
+                self._failed("read thumbnail", thumb, exc)
+        sheet.save(output, format="PNG")
+
+    def close(self) -> None:
+        with self._lock:
+            for document in self._documents.values():
+                document.close()
+            self._documents.clear()
+
+
+BACKENDS: Dict[str, Type[Backend]] = {
+    "tools": ToolBackend,
+    "inprocess": InProcessBackend,
+}
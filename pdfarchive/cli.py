@@ -4,7 +4,16 @@ This is the CLI for the PDF Archiver
 """
 import argparse
 
+from .backends import BACKENDS, DEFAULT_BACKEND
+from .context import DEFAULT_CACHE_SIZE
+from .external import parse_tool_policies
 from .index import Indexer
+from .ocrpool import DEFAULT_OCR_POOL, OCR_POOLS
+from .scheduler import Budget, parse_size
+from .textstore import DEFAULT_TEXT_STORE, TEXT_STORES
+from .watch import DEFAULT_QUIET, watch
+from .worker import work
+from .workqueue import DEFAULT_LEASE
 
 
 def main() -> None:
@@ -51,7 +60,286 @@ def main() -> None:
         "--indexer_config_dir",
         help="Destination location of text indexer configuration",
     )
+    parser.add_argument(
+        "--hash-content",
+        help=(
+            "Hash source files whose mtime changed but size did not before"
+            " rebuilding their thumbnails and text"
+        ),
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--ocr-batch-pages",
+        help="Pages of a scanned PDF to rasterize and OCR per job [4]",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--page-size",
+        help=(
+            "Split the index page of each directory into pages of this many"
+            " documents, with a listing that the pages show a screenful at"
+            " a time; 0 for one page however many there are [0]"
+        ),
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--sprites",
+        help=(
+            "Also pack each directory's thumbnails into a few sprite sheets,"
+            " and have the index pages use those"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--text-store",
+        help=(
+            "Keep extracted text as one file per document, or in a"
+            " compressed pack per directory"
+            f" [{DEFAULT_TEXT_STORE}]"
+        ),
+        choices=TEXT_STORES,
+        default=DEFAULT_TEXT_STORE,
+    )
+    parser.add_argument(
+        "--text-gz",
+        help=(
+            "With --text-store packs, also export each document's text as"
+            " .txt.gz, for a web server to serve as .txt"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--dry-run",
+        help=(
+            "Print what a build would do and how long it would likely take,"
+            " and stop"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--swish-e",
+        help=(
+            "Also build a swish-e index of the extracted text (default:"
+            " if swish-e is installed and not --static-search)"
+        ),
+        action=argparse.BooleanOptionalAction,
+        default=None,
+    )
+    parser.add_argument(
+        "--static-search",
+        help=(
+            "Write a static, sharded search index and search page instead"
+            " of linking to /cgi-bin/search.cgi"
+        ),
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--gm-batch",
+        help=(
+            "Make thumbnails with one long-lived 'gm batch' process per"
+            " worker instead of one gm per file"
+        ),
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--tool-policy",
+        help=(
+            "Limits for one external tool, as TOOL:KEY=VALUE[,KEY=VALUE...];"
+            " keys are timeout (seconds), jobs, nice, ionice (class 1-3),"
+            " and memory (address space, e.g. 2G).  May be repeated, e.g."
+            " --tool-policy tesseract:timeout=900,memory=2G"
+        ),
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--report",
+        help=(
+            "Where to write the JSON run report"
+            " [<indexer-config-dir>/run-report.json]"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--change-manifest",
+        help=(
+            "Where to list the outputs this run added, changed, and removed"
+            " [<indexer-config-dir>/changes.json]"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--prometheus-textfile",
+        help=(
+            "Also write build metrics here, for node_exporter's textfile"
+            " collector (e.g. /var/lib/node_exporter/pdfarchive.prom)"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--backend",
+        help=(
+            "How to make thumbnails, extract text layers, and rasterize"
+            " pages for OCR: with gm and Poppler's tools, or in-process"
+            f" with PyMuPDF and Pillow [{DEFAULT_BACKEND}]"
+        ),
+        choices=sorted(BACKENDS),
+        default=DEFAULT_BACKEND,
+    )
+    parser.add_argument(
+        "--ocr-pool",
+        help=(
+            "How to OCR page images and scans: with batches of tesseract"
+            " runs, or with tesserocr, which loads tesseract's models once"
+            f" per worker [{DEFAULT_OCR_POOL}]"
+        ),
+        choices=sorted(OCR_POOLS),
+        default=DEFAULT_OCR_POOL,
+    )
+    parser.add_argument(
+        "--cache",
+        help=(
+            "Directory of a content-addressed store of thumbnails and text,"
+            " so that identical documents (in this archive or any other"
+            " using the same store) are only processed once"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-size",
+        help=(
+            "Size beyond which the least recently used outputs are evicted"
+            f" from the --cache store, e.g. 50G [{DEFAULT_CACHE_SIZE}M]"
+        ),
+        type=parse_size,
+        default=DEFAULT_CACHE_SIZE,
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--watch",
+        help=(
+            "After building the site, keep running and update the pages,"
+            " thumbnails, text, and search index of whatever directories"
+            " change"
+        ),
+        action="store_true",
+        default=False,
+    )
+    mode.add_argument(
+        "--coordinate",
+        help=(
+            "Queue thumbnail and text jobs for --work processes (on any"
+            " machine sharing the archive) instead of running them, then"
+            " index the text once they are done"
+        ),
+        action="store_true",
+        default=False,
+    )
+    mode.add_argument(
+        "--work",
+        help=(
+            "Work on the jobs queued by a --coordinate process until its"
+            " run is finished"
+        ),
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--quiet-period",
+        help=(
+            "With --watch, seconds without changes to wait for before"
+            f" updating [{DEFAULT_QUIET:g}]"
+        ),
+        type=float,
+        default=DEFAULT_QUIET,
+    )
+    parser.add_argument(
+        "--queue",
+        help=(
+            "Directory holding the distributed work queue, on storage every"
+            " machine shares [<indexer-config-dir>/queue]"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--lease",
+        help=(
+            "Seconds a worker may go without renewing its claim on a job"
+            f" before the job is handed to another worker [{DEFAULT_LEASE:g}]"
+        ),
+        type=float,
+        default=DEFAULT_LEASE,
+    )
+    parser.add_argument(
+        "--worker-id",
+        help="Name of this worker in the queue [<hostname>-<pid>]",
+        default=None,
+    )
+    default_budget = Budget.default()
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        "--cpus",
+        help=(
+            "CPU budget for concurrent thumbnail and text extraction jobs"
+            f" [{default_budget.cpu:g}]"
+        ),
+        type=float,
+        default=default_budget.cpu,
+    )
+    parser.add_argument(
+        "-m",
+        "--memory",
+        help=(
+            "Memory budget for concurrent jobs, e.g. 8G"
+            f" [{default_budget.memory}M]"
+        ),
+        type=parse_size,
+        default=default_budget.memory,
+    )
+    parser.add_argument(
+        "--tmp-space",
+        help=(
+            "Temporary disk budget for concurrent jobs, e.g. 20G"
+            f" [{default_budget.tmp}M]"
+        ),
+        type=parse_size,
+        default=default_budget.tmp,
+    )
     args = parser.parse_args()
+    if args.text_gz and args.text_store != "packs":
+        parser.error("--text-gz needs --text-store packs")
+    if args.swish_e and args.text_store == "packs":
+        parser.error("--swish-e cannot index --text-store packs")
+    try:
+        tool_policies = parse_tool_policies(args.tool_policy)
+    except ValueError as exc:
+        parser.error(str(exc))
+    budget = Budget(cpu=args.jobs, memory=args.memory, tmp=args.tmp_space)
+    if args.work:
+        work(
+            base_dir=args.base_dir,
+            queue_dir=args.queue,
+            lease=args.lease,
+            worker_id=args.worker_id,
+            report=args.report,
+            change_manifest=args.change_manifest,
+            debug=args.debug,
+            resolve=args.resolve,
+            indexer_config_dir=args.indexer_config_dir,
+            budget=budget,
+            ocr_batch_pages=args.ocr_batch_pages,
+            gm_batch=args.gm_batch,
+            tool_policies=tool_policies,
+            backend=args.backend,
+            ocr_pool=args.ocr_pool,
+        )
+        return
     index = Indexer(
         base_dir=args.base_dir,
         base_url=args.base_url,
@@ -59,5 +347,36 @@ def main() -> None:
         debug=args.debug,
         resolve=args.resolve,
         indexer_config_dir=args.indexer_config_dir,
+        budget=budget,
+        hash_content=args.hash_content,
+        ocr_batch_pages=args.ocr_batch_pages,
+        swish_e=args.swish_e,
+        static_search=args.static_search,
+        gm_batch=args.gm_batch,
+        tool_policies=tool_policies,
+        report=args.report,
+        change_manifest=args.change_manifest,
+        prometheus_textfile=args.prometheus_textfile,
+        coordinate=args.coordinate,
+        queue_dir=args.queue,
+        lease=args.lease,
+        cache_dir=args.cache,
+        cache_size=args.cache_size,
+        backend=args.backend,
+        ocr_pool=args.ocr_pool,
+        page_size=args.page_size,
+        sprites=args.sprites,
+        text_store=args.text_store,
+        text_gz=args.text_gz,
+        dry_run=args.dry_run,
     )
+    if args.dry_run:
+        try:
+            print(index.plan().report(index.scheduler.budget.cpu))
+        finally:
+            index.close()
+        return
+    if args.watch:
+        watch(index, quiet=args.quiet_period)
+        return
     index.build_site()
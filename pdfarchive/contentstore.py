@@ -0,0 +1,255 @@
+"""A content-addressed cache of thumbnails and text.
+
+Byte-identical documents filed in several places (or in several archive
+roots) need only be thumbnailed and OCRed once.  Outputs are stored under
+a key made from the kind of output, the fingerprint of the tools and
+settings that made it, and the SHA-256 of the source document; an output
+whose key is already in the store is hardlinked (or, across filesystems,
+copied) into place instead of being rebuilt.  Since outputs are only ever
+replaced by renaming a new file over them, never rewritten in place, a
+hardlinked output can't corrupt the stored copy.
+
+Within a run, a job for a document identical to one already being built
+doesn't build it too: it leaves a callback, which is called once the
+first job has stored its output (or given up).
+
+The store keeps its own SQLite index of object sizes and last use, and
+once the objects add up to more than max_size, the least recently used
+are evicted.  Outputs already linked from the store stay where they are.
+A linked output shares its mode and mtime with the object and every other
+link to it, so outputs are only chmodded if they aren't 0644 already
+(which stored objects are), and the tree scan leaves Thumbs and Text be.
+Fetches are linked outside the store's lock, and the times they were used
+are written to the index in batches: before evicting, and on close().
+"""
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from enum import Enum
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .atomic import (
+    ChangeLog,
+    make_directory,
+    replace_if_changed,
+    temporary_path,
+)
+from .manifest import hash_file
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+)
+"""
+
+Waiter = Callable[[bool], None]
+
+
+class Lookup(Enum):
+    FETCHED = "fetched"
+    WAITING = "waiting"
+    BUILD = "build"
+
+
+def cache_key(kind: str, fingerprint: str, digest: str) -> str:
+    settings = hashlib.sha256(fingerprint.encode()).hexdigest()[:16]
+    return f"{kind}-{settings}-{digest}"
+
+
+def _link_or_copy(source: Path, target: Path) -> None:
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class ContentStore:
+    def __init__(
+        self,
+        directory: Path,
+        max_size: int,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        """max_size is in MiB, like the scheduler's Budget."""
+        self.directory = directory
+        self.max_size = max_size * 1024 * 1024
+        self.logger = logger or logging.getLogger(__name__)
+        self._objects = directory / "objects"
+        self._objects.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Other builds may be using the store at the same time
+        self._conn = sqlite3.connect(
+            str(directory / "index.sqlite3"),
+            timeout=60,
+            check_same_thread=False,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+        # The size of every object, kept up to date as we store and evict,
+        # so only a store that goes over max_size looks at the index.
+        # Other builds' objects are counted when we next evict.
+        self._total = self._stored_size()
+        self._digests: Dict[Tuple[Path, int, int], str] = dict()
+        self._in_flight: Dict[str, List[Waiter]] = dict()
+        # When objects were fetched, not yet written to the index
+        self._used: Dict[str, float] = dict()
+
+    def _path(self, key: str) -> Path:
+        return self._objects / key[-64:][:2] / key
+
+    def digest(self, source: Path) -> str:
+        """SHA-256 of source, computed once per version of the file."""
+        st = source.stat()
+        memo = (source, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if memo in self._digests:
+                return self._digests[memo]
+        digest = hash_file(source)
+        with self._lock:
+            self._digests[memo] = digest
+        return digest
+
+    def lookup(
+        self,
+        key: str,
+        output: Path,
+        on_ready: Waiter,
+        changes: Optional[ChangeLog] = None,
+    ) -> Lookup:
+        """Link the object for key to output if there is one (FETCHED).
+        If another job is building it, queue on_ready to be called when it
+        is done, with whether it was stored (WAITING).  Otherwise the
+        caller should build output and then call finish() (BUILD)."""
+        while True:
+            with self._lock:
+                if key in self._in_flight:
+                    self._in_flight[key].append(on_ready)
+                    return Lookup.WAITING
+                if not self._path(key).exists():
+                    self._in_flight[key] = list()
+                    return Lookup.BUILD
+            # If it is evicted before we can link it, think again
+            if self.fetch(key, output, changes):
+                return Lookup.FETCHED
+
+    def fetch(
+        self, key: str, output: Path, changes: Optional[ChangeLog] = None
+    ) -> bool:
+        """Link the object for key to output, if there is one."""
+        path = self._path(key)
+        if not path.exists():
+            return False
+        make_directory(output.parent)
+        tmp = temporary_path(output)
+        tmp.unlink(missing_ok=True)
+        try:
+            _link_or_copy(path, tmp)
+        except FileNotFoundError:
+            # Evicted, by us or by another build
+            tmp.unlink(missing_ok=True)
+            return False
+        replace_if_changed(tmp, output, changes)
+        with self._lock:
+            self._used[key] = time.time()
+        return True
+
+    def finish(self, key: str, output: Optional[Path]) -> None:
+        """Store output (if the build succeeded) under key, and tell the
+        jobs waiting for it."""
+        with self._lock:
+            if output is not None and output.exists():
+                self._store(key, output)
+            else:
+                output = None
+            waiters = self._in_flight.pop(key, list())
+        for on_ready in waiters:
+            on_ready(output is not None)
+
+    def _store(self, key: str, output: Path) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{key}.{uuid.uuid4().hex}.tmp")
+        _link_or_copy(output, tmp)
+        os.replace(tmp, path)
+        size = path.stat().st_size
+        replaced = self._conn.execute(
+            "SELECT size FROM objects WHERE key = ?", (key,)
+        ).fetchone()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO objects (key, size, last_used)"
+            " VALUES (?, ?, ?)",
+            (key, size, time.time()),
+        )
+        self._conn.commit()
+        self._total += size - (replaced[0] if replaced else 0)
+        if self._total > self.max_size:
+            self._evict()
+
+    def _write_used(self) -> None:
+        # Call with the lock held.
+        if not self._used:
+            return
+        self._conn.executemany(
+            "UPDATE objects SET last_used = ? WHERE key = ?",
+            [(used, key) for key, used in self._used.items()],
+        )
+        self._conn.commit()
+        self._used = dict()
+
+    def release_waiters(self) -> int:
+        """Tell every job still waiting on a build that it isn't coming
+        (its builder failed), and return how many there were."""
+        with self._lock:
+            stranded = self._in_flight
+            self._in_flight = dict()
+        count = 0
+        for waiters in stranded.values():
+            for on_ready in waiters:
+                on_ready(False)
+                count += 1
+        return count
+
+    def _stored_size(self) -> int:
+        (total,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM objects"
+        ).fetchone()
+        return total
+
+    def _evict(self) -> None:
+        # Other builds may have stored or evicted objects since we last
+        # looked
+        total = self._stored_size()
+        self._total = total
+        if total <= self.max_size:
+            return
+        self._write_used()
+        cur = self._conn.execute(
+            "SELECT key, size FROM objects ORDER BY last_used"
+        )
+        evicted: List[str] = list()
+        for key, size in cur.fetchall():
+            if total <= self.max_size:
+                break
+            self._path(key).unlink(missing_ok=True)
+            evicted.append(key)
+            total -= size
+        self._conn.executemany(
+            "DELETE FROM objects WHERE key = ?", [(k,) for k in evicted]
+        )
+        self._conn.commit()
+        self._total = total
+        self.logger.debug(f"Evicted {len(evicted)} objects from the store")
+
+    def close(self) -> None:
+        with self._lock:
+            self._write_used()
+            self._conn.close()
@@ -0,0 +1,475 @@
+"""Build context: everything about a run that is the same for every
+directory in the archive.
+
+The root Indexer creates one BuildContext; every directory below it gets
+the same object, so executables are located, templates are loaded, and the
+logger is configured once per run rather than once per directory.
+
+Nothing about a build is kept in the process (its working directory, its
+umask, or module globals), so any number of builds can run at once, each
+with its own BuildContext.  They share the compiled templates, and can
+share an ExecutionEngine and a GMBatchPool, which are then left open for
+whoever passed them in to close.
+"""
+import inspect
+import logging
+import shutil
+from contextlib import ExitStack
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Union
+from urllib.parse import ParseResult, urlparse
+
+from jinja2 import Environment
+
+from .atomic import CHANGES_NAME, ChangeLog, stray_temporaries
+from .backends import BACKENDS, DEFAULT_BACKEND, Backend, ToolBackend
+from .contentstore import ContentStore
+from .external import ExecutionEngine, ToolPolicy
+from .gmbatch import GMBatchPool
+from .manifest import Manifest, tool_fingerprint
+from .metrics import Metrics
+from .ocr import partial_path
+from .ocrpool import (
+    DEFAULT_OCR_POOL,
+    OCR_POOLS,
+    OCRPool,
+    TesseractPool,
+    TesserocrPool,
+)
+from .planner import TIMINGS_NAME, Planner
+from .render import PageRenderer, default_renderer
+from .scheduler import Budget, Scheduler
+from .staticsearch import SEARCH_DIR, check_export_dir
+from .textstore import DEFAULT_TEXT_STORE, TEXT_STORES, TextStore
+from .workqueue import DEFAULT_LEASE, QUEUE_DIR, Coordinator, WorkQueue
+
+# Changing any of these invalidates the corresponding outputs in the
+# build manifest.
+THUMB_GEOMETRY = "150x100"
+OCR_DENSITY = "120x120"
+OCR_DEPTH = "4"
+
+# MiB
+DEFAULT_CACHE_SIZE = 10 * 1024
+
+# What swish-e is configured by, in indexer_config_dir
+SWISH_E_CONF = "swish-e.conf"
+
+_DEFAULT_EXECUTABLES = ToolBackend.executables + TesseractPool.executables
+
+
+def get_logger(debug: bool = False) -> logging.Logger:
+    """The package logger, with our handler attached exactly once no
+    matter how many times it is asked for."""
+    logger = logging.getLogger("pdfarchive.index")
+    if not any(getattr(h, "_pdfarchive", False) for h in logger.handlers):
+        ch = logging.StreamHandler()
+        formatter = logging.Formatter(
+            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+        )
+        ch.setFormatter(formatter)
+        setattr(ch, "_pdfarchive", True)
+        logger.addHandler(ch)
+    logger.setLevel("DEBUG" if debug else "INFO")
+    return logger
+
+
+def _canonical_url(
+    base_url: Union[str, ParseResult, Path, None], base_dir: Path
+) -> ParseResult:
+    if not base_url:
+        base_url = base_dir
+    for cls in inspect.getmro(type(base_url)):
+        # pathlib.Path is generally the parent of the base_dir class,
+        # which is a PosixPath or a WindowsPath.
+        #
+        # Mypy can't figure out that if Path is somewhere in our class
+        # hierarchy, we certainly do have an as_uri() method
+        if cls is Path:
+            base_url = base_url.as_uri()  # type: ignore
+            break
+    if type(base_url) is str:
+        base_url = urlparse(base_url)
+    if type(base_url) is ParseResult:
+        return base_url
+    # Shouldn't be able to happen, but mypy wasn't smart enough to
+    # realize that type(base_url) would be ParseResult by now
+    raise RuntimeError(f"base_url {base_url} could not be established")
+
+
+def check_for_installed_executables(
+    logger: logging.Logger,
+    swish_e: bool = False,
+    executables: Sequence[str] = _DEFAULT_EXECUTABLES,
+) -> bool:
+    """Raise if one of the executables (those the backend and OCR pool
+    run) is missing.  Returns whether swish-e is wanted and available."""
+    for exe in executables:
+        if not shutil.which(exe):
+            raise RuntimeError(f"{exe} not found on path")
+    if not swish_e:
+        return False
+    if not shutil.which("swish-e"):
+        logger.warning("swish-e not found on path.  Cannot create text index.")
+        return False
+    return True
+
+
+def want_swish_e(
+    logger: logging.Logger,
+    swish_e: Optional[bool],
+    static_search: bool,
+    text_store: str,
+) -> bool:
+    """Whether to build a swish-e index.  Unless told, build one whenever
+    swish-e is installed and nothing else is searching the text, as this
+    always has; the index pages only link to /cgi-bin/search.cgi if so."""
+    if swish_e is not None:
+        return swish_e
+    if static_search:
+        return False
+    if not shutil.which("swish-e"):
+        logger.warning(
+            "swish-e not found on path, so the index pages have no search"
+            " link.  Pass --static-search to search with the built-in"
+            " index."
+        )
+        return False
+    if text_store == "packs":
+        logger.warning(
+            "swish-e cannot index packed text, so the index pages have no"
+            " search link.  Pass --static-search to search with the"
+            " built-in index."
+        )
+        return False
+    logger.warning(
+        "Building a swish-e index for /cgi-bin/search.cgi.  swish-e support"
+        " is deprecated: pass --static-search to search with the built-in"
+        " index instead, or --no-swish-e to stop building it."
+    )
+    return True
+
+
+def check_for_pdffonts(logger: logging.Logger) -> bool:
+    """pdffonts is optional: without it, every PDF goes through pdftotext
+    before we find out whether it needs OCR."""
+    if shutil.which("pdffonts"):
+        return True
+    logger.warning("pdffonts not found on path.  Cannot triage PDFs.")
+    return False
+
+
+def recover_interrupted(
+    manifest: Manifest, base_dir: Path, logger: logging.Logger
+) -> None:
+    """Clean up after the jobs an earlier run didn't finish.  Outputs are
+    only ever renamed into place complete, so all they can have left
+    behind is temporary files, and the partial text of OCR jobs, which is
+    kept for them to resume from."""
+    jobs = manifest.interrupted()
+    if not jobs:
+        return
+    resumable = 0
+    for kind, source, output, pages in jobs:
+        output_path = base_dir / output
+        for stray in stray_temporaries(output_path):
+            stray.unlink(missing_ok=True)
+        if not (base_dir / source).exists():
+            partial_path(output_path).unlink(missing_ok=True)
+            manifest.forget(kind, source)
+        elif pages:
+            resumable += 1
+    logger.info(
+        f"{len(jobs)} jobs were interrupted by an earlier run;"
+        f" {resumable} can resume part way through"
+    )
+
+
+@dataclass(frozen=True)
+class BuildContext:
+    base_dir: Path
+    base_url: ParseResult
+    archive_title: str
+    indexer_config_dir: Path
+    resolve: bool
+    debug: bool
+    # Only look: nothing in the archive is written, not even the manifest
+    dry_run: bool
+    logger: logging.Logger
+    jinja_environment: Environment
+    renderer: PageRenderer
+    scheduler: Scheduler
+    manifest: Manifest
+    ocr_batch_pages: int
+    swish_e: bool
+    has_swishe: bool
+    backend: Backend
+    ocr: OCRPool
+    static_search: bool
+    gm_batch: Optional[GMBatchPool]
+    engine: ExecutionEngine
+    metrics: Metrics
+    report: Optional[Path]
+    prometheus_textfile: Optional[Path]
+    coordinator: Optional[Coordinator]
+    cache: Optional[ContentStore]
+    page_size: int
+    sprites: bool
+    planner: Planner
+    changes: ChangeLog
+    change_manifest: Optional[Path]
+    text_store: str
+    text_gz: bool
+    texts: TextStore
+    # Whether the engine, gm batch pool, scheduler, and manifest were made
+    # for this build, and so are closed with it
+    owns_engine: bool
+    owns_gm_batch: bool
+    owns_scheduler: bool
+    owns_manifest: bool
+
+    @classmethod
+    def create(
+        cls,
+        base_dir: Union[str, Path, None],
+        base_url: Union[str, ParseResult, Path, None] = None,
+        archive_title: str = "",
+        debug: bool = False,
+        resolve: bool = True,
+        indexer_config_dir: Union[str, Path, None] = None,
+        budget: Optional[Budget] = None,
+        scheduler: Optional[Scheduler] = None,
+        manifest: Optional[Manifest] = None,
+        hash_content: bool = False,
+        ocr_batch_pages: int = 4,
+        swish_e: Optional[bool] = None,
+        static_search: bool = False,
+        gm_batch: Union[bool, GMBatchPool] = False,
+        tool_policies: Optional[Dict[str, ToolPolicy]] = None,
+        engine: Optional[ExecutionEngine] = None,
+        report: Union[str, Path, None] = None,
+        prometheus_textfile: Union[str, Path, None] = None,
+        coordinate: bool = False,
+        queue_dir: Union[str, Path, None] = None,
+        lease: float = DEFAULT_LEASE,
+        cache_dir: Union[str, Path, None] = None,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+        backend: str = DEFAULT_BACKEND,
+        ocr_pool: str = DEFAULT_OCR_POOL,
+        page_size: int = 0,
+        sprites: bool = False,
+        logger: Optional[logging.Logger] = None,
+        change_manifest: Union[str, Path, None] = None,
+        text_store: str = DEFAULT_TEXT_STORE,
+        text_gz: bool = False,
+        dry_run: bool = False,
+    ) -> "BuildContext":
+        """Set up a build of the archive in base_dir.  The scheduler
+        (made from budget), manifest, engine (made from tool_policies),
+        and gm_batch pool are made here unless passed in; those passed in
+        are left for the caller to close.  indexer_config_dir (base_dir/
+        config by default) holds the manifest, the text index, the run
+        report, and the change manifest, unless report and change_manifest
+        say otherwise.
+
+        hash_content settles a changed mtime by hashing the source.
+        Scanned PDFs are OCRed ocr_batch_pages pages to a job.  backend
+        ("tools" or "inprocess") makes thumbnails and rasterizes pages,
+        and ocr_pool ("tesseract" or "tesserocr") recognizes them.
+        static_search exports the text index for search.html; swish_e
+        builds a swish-e index for /cgi-bin/search.cgi as well.
+        coordinate queues the jobs in queue_dir for workers instead of
+        running them.  cache_dir names a content store, kept to
+        cache_size MiB, shared by identical documents.  page_size splits
+        index pages, sprites packs thumbnails into sheets, and text_store
+        "packs" (with text_gz, .txt.gz exports too) packs the text.
+        With dry_run, the build is only planned: the manifest is read
+        into memory, and nothing is recovered, cached, or queued.
+        """
+        # Put everything into canonically-typed form  (Path can accept a
+        # Path as input)
+        if not base_dir:
+            raise RuntimeError("base_dir must be specified")
+        base_path = Path(base_dir)
+        url = _canonical_url(base_url, base_path)
+        # Do path resolution (if required).  Resolution is turned on by
+        # default, but if you have part of your tree symlinked from
+        # somewhere else, it will break.  Either way, jobs run on worker
+        # threads, so paths must not be relative to the cwd.
+        if resolve:
+            base_path = base_path.resolve()
+        else:
+            base_path = base_path.absolute()
+        if indexer_config_dir:
+            config_dir = Path(indexer_config_dir)
+        else:
+            config_dir = Path(base_path / "config")
+
+        if backend not in BACKENDS:
+            raise RuntimeError(f"Unknown backend '{backend}'")
+        if ocr_pool not in OCR_POOLS:
+            raise RuntimeError(f"Unknown OCR pool '{ocr_pool}'")
+        if text_store not in TEXT_STORES:
+            raise RuntimeError(f"Unknown text store '{text_store}'")
+        if text_store != "packs" and text_gz:
+            raise RuntimeError(".txt.gz export needs the packs text store")
+        if text_store == "packs" and swish_e:
+            raise RuntimeError("swish-e cannot index packed text")
+        if static_search:
+            check_export_dir(base_path / SEARCH_DIR)
+        executables = (
+            BACKENDS[backend].executables + OCR_POOLS[ocr_pool].executables
+        )
+        if logger is None:
+            logger = get_logger(debug)
+        swish_e = want_swish_e(logger, swish_e, static_search, text_store)
+        has_swishe = check_for_installed_executables(
+            logger, swish_e, executables
+        )
+        has_pdffonts = backend == "tools" and check_for_pdffonts(logger)
+        # Without it, every page without text is OCRed, as it always was
+        has_pdfimages = backend == "tools" and bool(shutil.which("pdfimages"))
+
+        # If anything goes wrong, close whatever was made for this build
+        with ExitStack() as cleanup:
+            owns_scheduler = scheduler is None
+            if scheduler is None:
+                scheduler = Scheduler(budget=budget, logger=logger)
+                cleanup.callback(scheduler.shutdown)
+            owns_gm_batch = gm_batch is True
+            owns_engine = engine is None
+            if engine is None:
+                engine = ExecutionEngine(policies=tool_policies, logger=logger)
+                cleanup.callback(engine.close)
+            if gm_batch is True:
+                gm_batch = GMBatchPool(logger=logger, engine=engine)
+                cleanup.callback(gm_batch.close)
+            selected_backend: Backend
+            if backend == "tools":
+                selected_backend = ToolBackend(
+                    logger=logger,
+                    engine=engine,
+                    gm_batch=gm_batch or None,
+                    has_pdffonts=has_pdffonts,
+                    has_pdfimages=has_pdfimages,
+                )
+            else:
+                selected_backend = BACKENDS[backend](logger=logger)
+            cleanup.callback(selected_backend.close)
+            # One recognizer per CPU the jobs may use
+            workers = max(1, int(scheduler.budget.cpu))
+            ocr: OCRPool
+            if ocr_pool == "tesserocr":
+                ocr = TesserocrPool(logger=logger)
+            else:
+                ocr = TesseractPool(workers, logger=logger, engine=engine)
+            cleanup.callback(ocr.close)
+            owns_manifest = manifest is None
+            if manifest is None:
+                manifest = Manifest(
+                    config_dir / "manifest.sqlite3",
+                    base_dir=base_path,
+                    hash_content=hash_content,
+                    read_only=dry_run,
+                )
+                cleanup.callback(manifest.close)
+                # The tools backend's thumbnails are what they always were
+                thumbnailer = tool_fingerprint(["gm"], THUMB_GEOMETRY)
+                if backend != "tools":
+                    thumbnailer = tool_fingerprint(
+                        [], f"{backend}:{THUMB_GEOMETRY}"
+                    )
+                manifest.set_fingerprint("thumbnail", thumbnailer)
+                manifest.set_fingerprint(
+                    "text",
+                    tool_fingerprint(
+                        executables,
+                        f"{backend}:{ocr.version}:{OCR_DENSITY}:{OCR_DEPTH}",
+                    ),
+                )
+            if not dry_run:
+                recover_interrupted(manifest, base_path, logger)
+            metrics = Metrics(base_dir=base_path)
+            engine.listeners.append(metrics.record_command)
+            renderer = default_renderer()
+            coordinator = None
+            if coordinate and not dry_run:
+                queue = WorkQueue(
+                    Path(queue_dir) if queue_dir else config_dir / QUEUE_DIR,
+                    lease=lease,
+                )
+                coordinator = Coordinator(queue, logger=logger)
+            cache = None
+            if cache_dir and not dry_run:
+                cache = ContentStore(
+                    Path(cache_dir), cache_size, logger=logger
+                )
+                cleanup.callback(cache.close)
+
+            context = cls(
+                base_dir=base_path,
+                base_url=url,
+                archive_title=archive_title or base_path.name,
+                indexer_config_dir=config_dir,
+                resolve=resolve,
+                debug=debug,
+                dry_run=dry_run,
+                logger=logger,
+                jinja_environment=renderer.environment,
+                renderer=renderer,
+                scheduler=scheduler,
+                manifest=manifest,
+                ocr_batch_pages=max(1, ocr_batch_pages),
+                swish_e=swish_e,
+                has_swishe=has_swishe,
+                backend=selected_backend,
+                ocr=ocr,
+                static_search=static_search,
+                gm_batch=gm_batch or None,
+                engine=engine,
+                metrics=metrics,
+                report=Path(report)
+                if report
+                else config_dir / "run-report.json",
+                prometheus_textfile=(
+                    Path(prometheus_textfile) if prometheus_textfile else None
+                ),
+                coordinator=coordinator,
+                cache=cache,
+                page_size=max(0, page_size),
+                sprites=sprites,
+                planner=Planner(config_dir / TIMINGS_NAME),
+                changes=ChangeLog(base_path),
+                change_manifest=(
+                    Path(change_manifest)
+                    if change_manifest
+                    else config_dir / CHANGES_NAME
+                ),
+                text_store=text_store,
+                text_gz=text_gz,
+                texts=TextStore(base_path / "Text"),
+                owns_engine=owns_engine,
+                owns_gm_batch=owns_gm_batch,
+                owns_scheduler=owns_scheduler,
+                owns_manifest=owns_manifest,
+            )
+            cleanup.pop_all()
+        return context
+
+    def close(self) -> None:
+        """Close the tools, the content store, and whichever of the
+        scheduler, engine, gm batch pool, and manifest were made for this
+        build."""
+        if self.gm_batch and self.owns_gm_batch:
+            self.gm_batch.close()
+        self.backend.close()
+        self.ocr.close()
+        if self.owns_engine:
+            self.engine.close()
+        if self.cache:
+            self.cache.close()
+        if self.owns_scheduler:
+            self.scheduler.shutdown()
+        if self.owns_manifest:
+            self.manifest.close()
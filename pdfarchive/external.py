@@ -1,35 +1,426 @@
+"""Execution engine for external tools.
+
+Every external command runs through an ExecutionEngine, which owns an
+asyncio event loop on a background thread.  Callers on any thread submit a
+command and block until it finishes; the loop enforces, per tool:
+
+* a default timeout, after which the whole process group is killed (gm
+  runs ghostscript as a child, so killing just gm isn't enough);
+* a concurrency limit;
+* a niceness and, if ionice(1) is installed, an I/O scheduling class;
+* an optional cap on address space (RLIMIT_AS).
+
+Children are reaped with wait4(), so each command's CPU time and peak RSS
+are recorded, both in its CommandResult and in per-tool totals.
+
+Niceness and the memory cap are applied to the child right after it is
+started, with setpriority() and prlimit(), rather than in a preexec_fn,
+which is unsafe when other threads are running.  Children are started on
+a few spawner threads rather than on the loop's, since forking a large
+process can take long enough to hold up every other command's timeout.
+
+Tools that serve many commands from one long-lived process (gm batch)
+are started with spawn(), which applies the same policy, and report each
+command they serve with report(), so it is counted like any other.
+"""
+import asyncio
+import functools
+import os
+import resource
+import shutil
+import signal
 import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, replace
 from logging import Logger
-from typing import List, Optional
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
+from .scheduler import parse_size
 
-def run(
-    args: List[str],
-    logger: Optional[Logger] = None,
-    timeout: Optional[int] = None,
-) -> None:
-    argstr = " ".join(args)
-    if logger:
-        logger.info(f"Running command '{argstr}'")
+
+@dataclass(frozen=True)
+class ToolPolicy:
+    """How to run one tool.  timeout is in seconds, memory in MiB;
+    ionice_class is 1 (realtime), 2 (best-effort) or 3 (idle)."""
+
+    timeout: Optional[float] = None
+    concurrency: Optional[int] = None
+    nice: int = 0
+    ionice_class: Optional[int] = None
+    memory: Optional[int] = None
+
+    def updated(self, spec: str) -> "ToolPolicy":
+        """Apply a comma-separated list of key=value settings, e.g.
+        "timeout=900,jobs=8,nice=10,ionice=3,memory=2G".  A value of
+        "none" removes a limit."""
+        changes: Dict[str, object] = dict()
+        for item in spec.split(","):
+            key, _, value = item.partition("=")
+            key = key.strip()
+            value = value.strip()
+            unset = value.lower() in ("none", "")
+            if key == "timeout":
+                changes["timeout"] = None if unset else float(value)
+            elif key in ("jobs", "concurrency"):
+                changes["concurrency"] = None if unset else int(value)
+            elif key == "nice":
+                changes["nice"] = 0 if unset else int(value)
+            elif key == "ionice":
+                changes["ionice_class"] = None if unset else int(value)
+            elif key == "memory":
+                changes["memory"] = None if unset else parse_size(value)
+            else:
+                raise ValueError(f"Unknown tool policy setting '{key}'")
+        return replace(self, **changes)  # type: ignore
+
+
+# Threads to start children on
+_SPAWNERS = 4
+
+DEFAULT_POLICIES: Dict[str, ToolPolicy] = {
+    "gm": ToolPolicy(timeout=600, nice=5),
+    "pdftotext": ToolPolicy(timeout=300),
+    "pdfinfo": ToolPolicy(timeout=60),
+    "tesseract": ToolPolicy(timeout=1800, nice=10, ionice_class=3),
+    "swish-e": ToolPolicy(nice=10, ionice_class=3),
+}
+
+
+def parse_tool_policies(
+    specs: List[str], policies: Optional[Dict[str, ToolPolicy]] = None
+) -> Dict[str, ToolPolicy]:
+    """Turn strings like "tesseract:timeout=900,memory=2G" into policies,
+    starting from policies (or the defaults)."""
+    result = dict(policies or DEFAULT_POLICIES)
+    for spec in specs:
+        tool, sep, settings = spec.partition(":")
+        if not sep:
+            raise ValueError(f"Tool policy '{spec}' should be TOOL:KEY=VALUE")
+        result[tool] = result.get(tool, ToolPolicy()).updated(settings)
+    return result
+
+
+@dataclass
+class CommandResult:
+    args: List[str]
+    returncode: Optional[int] = None
+    stdout: bytes = b""
+    stderr: bytes = b""
+    wall_time: float = 0.0
+    user_time: float = 0.0
+    system_time: float = 0.0
+    max_rss: int = 0  # KiB
+    timed_out: bool = False
+
+    @property
+    def cpu_time(self) -> float:
+        return self.user_time + self.system_time
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0 and not self.timed_out
+
+
+@dataclass
+class ToolStats:
+    commands: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    wall_time: float = 0.0
+    user_time: float = 0.0
+    system_time: float = 0.0
+    max_rss: int = 0  # KiB, the largest seen from any one command
+
+    def add(self, result: CommandResult) -> None:
+        self.commands += 1
+        if result.timed_out:
+            self.timeouts += 1
+        elif result.returncode != 0:
+            self.failures += 1
+        self.wall_time += result.wall_time
+        self.user_time += result.user_time
+        self.system_time += result.system_time
+        self.max_rss = max(self.max_rss, result.max_rss)
+
+
+async def _read_all(
+    loop: asyncio.AbstractEventLoop, pipe: Optional[object]
+) -> bytes:
+    if pipe is None:
+        return b""
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), pipe
+    )
+    try:
+        return await reader.read()
+    finally:
+        transport.close()
+
+
+async def _wait4(pid: int) -> Tuple[int, resource.struct_rusage]:
+    loop = asyncio.get_running_loop()
     try:
-        proc = subprocess.run(args, capture_output=True, timeout=timeout)
-    except subprocess.TimeoutExpired:
+        pidfd: Optional[int] = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    if pidfd is not None:
+        exited = asyncio.Event()
+        loop.add_reader(pidfd, exited.set)
+        try:
+            await exited.wait()
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+        _, status, rusage = os.wait4(pid, 0)
+        return os.waitstatus_to_exitcode(status), rusage
+    delay = 0.001
+    while True:
+        wpid, status, rusage = os.wait4(pid, os.WNOHANG)
+        if wpid:
+            return os.waitstatus_to_exitcode(status), rusage
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.1)
+
+
+class ExecutionEngine:
+    def __init__(
+        self,
+        policies: Optional[Dict[str, ToolPolicy]] = None,
+        logger: Optional[Logger] = None,
+    ) -> None:
+        self.policies = dict(DEFAULT_POLICIES)
+        if policies:
+            self.policies.update(policies)
+        self.logger = logger
+        self.stats: Dict[str, ToolStats] = dict()
+        # Called, on the caller's thread, with each finished command
+        self.listeners: List[Callable[[CommandResult], None]] = list()
+        self._stats_lock = threading.Lock()
+        self._semaphores: Dict[str, asyncio.Semaphore] = dict()
+        self._ionice = shutil.which("ionice")
+        self._spawner = ThreadPoolExecutor(
+            _SPAWNERS, thread_name_prefix="pdfarchive-spawn"
+        )
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever,
+            name="pdfarchive-exec",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def policy(self, args: List[str]) -> ToolPolicy:
+        return self.policies.get(Path(args[0]).name, ToolPolicy())
+
+    def _semaphore(self, tool: str, limit: int) -> asyncio.Semaphore:
+        # Only ever called on the loop thread.
+        if tool not in self._semaphores:
+            self._semaphores[tool] = asyncio.Semaphore(limit)
+        return self._semaphores[tool]
+
+    def _command(self, args: List[str], policy: ToolPolicy) -> List[str]:
+        if policy.ionice_class is None or not self._ionice:
+            return args
+        return [self._ionice, "-c", str(policy.ionice_class)] + args
+
+    def _limit(self, pid: int, policy: ToolPolicy) -> None:
+        try:
+            if policy.nice:
+                os.setpriority(os.PRIO_PROCESS, pid, policy.nice)
+            if policy.memory:
+                limit = policy.memory * 1024 * 1024
+                resource.prlimit(pid, resource.RLIMIT_AS, (limit, limit))
+        except (OSError, AttributeError):
+            # The child may already be gone, or the platform may not
+            # support prlimit; neither is worth failing the command for.
+            pass
+
+    def spawn(self, args: List[str], **kwargs: Any) -> subprocess.Popen:
+        """Start a long-lived process for args, under its tool's policy and
+        in a session of its own, for the caller to talk to, time out, and
+        kill (with os.killpg) itself.  kwargs are passed to Popen."""
+        policy = self.policy(args)
+        proc = subprocess.Popen(
+            self._command(args, policy), start_new_session=True, **kwargs
+        )
+        self._limit(proc.pid, policy)
+        return proc
+
+    def report(self, result: CommandResult) -> None:
+        """Count a command that was run other than by run(), such as one
+        served by a spawned process, and tell the listeners about it."""
+        with self._stats_lock:
+            self.stats.setdefault(Path(result.args[0]).name, ToolStats()).add(
+                result
+            )
+        for listener in list(self.listeners):
+            listener(result)
+
+    async def run_async(
+        self,
+        args: List[str],
+        timeout: Optional[float] = None,
+        cwd: Union[str, Path, None] = None,
+    ) -> CommandResult:
+        tool = Path(args[0]).name
+        policy = self.policy(args)
+        if timeout is None:
+            timeout = policy.timeout
+        if policy.concurrency:
+            async with self._semaphore(tool, policy.concurrency):
+                return await self._execute(args, timeout, cwd)
+        return await self._execute(args, timeout, cwd)
+
+    async def _execute(
+        self,
+        args: List[str],
+        timeout: Optional[float],
+        cwd: Union[str, Path, None],
+    ) -> CommandResult:
+        loop = asyncio.get_running_loop()
+        result = CommandResult(args=args)
+        start = time.monotonic()
+        spawn = functools.partial(
+            self.spawn,
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+        )
+        try:
+            proc = await loop.run_in_executor(self._spawner, spawn)
+        except OSError as exc:
+            result.returncode = 127
+            result.stderr = str(exc).encode()
+            return result
+        outputs = asyncio.gather(
+            _read_all(loop, proc.stdout), _read_all(loop, proc.stderr)
+        )
+        try:
+            result.stdout, result.stderr = await asyncio.wait_for(
+                asyncio.shield(outputs), timeout
+            )
+        except asyncio.TimeoutError:
+            result.timed_out = True
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            result.stdout, result.stderr = await outputs
+        returncode, rusage = await _wait4(proc.pid)
+        # We reaped it ourselves; don't let Popen try again.
+        proc.returncode = returncode
+        result.returncode = returncode
+        result.wall_time = time.monotonic() - start
+        result.user_time = rusage.ru_utime
+        result.system_time = rusage.ru_stime
+        result.max_rss = rusage.ru_maxrss
+        with self._stats_lock:
+            self.stats.setdefault(Path(args[0]).name, ToolStats()).add(result)
+        return result
+
+    def submit(
+        self,
+        args: List[str],
+        timeout: Optional[float] = None,
+        cwd: Union[str, Path, None] = None,
+    ) -> Future:
+        return asyncio.run_coroutine_threadsafe(
+            self.run_async(args, timeout, cwd), self._loop
+        )
+
+    def run(
+        self,
+        args: List[str],
+        logger: Optional[Logger] = None,
+        timeout: Optional[float] = None,
+        cwd: Union[str, Path, None] = None,
+    ) -> CommandResult:
+        """Run args to completion from any thread, logging as we go."""
+        logger = logger or self.logger
+        argstr = " ".join(args)
         if logger:
+            logger.info(f"Running command '{argstr}'")
+        result: CommandResult = self.submit(args, timeout, cwd).result()
+        for listener in list(self.listeners):
+            listener(result)
+        if not logger:
+            return result
+        if result.timed_out:
             logger.error(
-                f"Command '{argstr}' timed out after {timeout} seconds"
+                f"Command '{argstr}' timed out after"
+                f" {result.wall_time:.1f} seconds and was killed"
             )
-            return
-    if proc.returncode != 0:
-        if logger:
+        elif result.returncode != 0:
             logger.warning(
-                f"Command '{argstr}' failed: rc {proc.returncode}\n"
-                + f" -> stdout: {proc.stdout.decode()}\n"
-                f" -> stderr: {proc.stderr.decode()}"
+                f"Command '{argstr}' failed: rc {result.returncode}\n"
+                + f" -> stdout: {result.stdout.decode(errors='replace')}\n"
+                f" -> stderr: {result.stderr.decode(errors='replace')}"
             )
-    else:
-        if logger:
+        else:
             logger.debug(
-                f"Command '{argstr}' succeeded\n"
-                + f" -> stdout: {proc.stdout.decode()}\n"
-                f" -> stderr: {proc.stderr.decode()}"
+                f"Command '{argstr}' succeeded"
+                f" (cpu {result.cpu_time:.2f}s, rss {result.max_rss}KiB)\n"
+                + f" -> stdout: {result.stdout.decode(errors='replace')}\n"
+                f" -> stderr: {result.stderr.decode(errors='replace')}"
+            )
+        return result
+
+    def log_stats(self, logger: Logger) -> None:
+        with self._stats_lock:
+            stats = sorted(self.stats.items())
+        for tool, s in stats:
+            logger.info(
+                f"{tool}: {s.commands} commands ({s.failures} failed,"
+                f" {s.timeouts} timed out), wall {s.wall_time:.1f}s,"
+                f" user {s.user_time:.1f}s, sys {s.system_time:.1f}s,"
+                f" peak rss {s.max_rss}KiB"
             )
+
+    def close(self) -> None:
+        if self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._spawner.shutdown()
+
+
+_default_engine: Optional[ExecutionEngine] = None
+_default_lock = threading.Lock()
+
+
+def default_engine() -> ExecutionEngine:
+    global _default_engine
+    with _default_lock:
+        if _default_engine is None:
+            _default_engine = ExecutionEngine()
+        return _default_engine
+
+
+def run(
+    args: List[str],
+    logger: Optional[Logger] = None,
+    timeout: Optional[float] = None,
+    engine: Optional[ExecutionEngine] = None,
+) -> None:
+    (engine or default_engine()).run(args, logger, timeout)
+
+
+def run_output(
+    args: List[str],
+    logger: Optional[Logger] = None,
+    timeout: Optional[float] = None,
+    engine: Optional[ExecutionEngine] = None,
+) -> Optional[str]:
+    """Like run(), but return the command's standard output if it
+    succeeded, and None if it did not."""
+    result = (engine or default_engine()).run(args, logger, timeout)
+    if not result.ok:
+        return None
+    return result.stdout.decode(errors="replace")
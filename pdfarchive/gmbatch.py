@@ -0,0 +1,260 @@
+"""Long-lived GraphicsMagick processes for thumbnailing.
+
+Forking a fresh ``gm convert`` for each small image costs more than the
+resize itself.  ``gm batch`` reads one command per line from its standard
+input and, with ``-feedback on``, answers each with PASS or FAIL, so a
+single process can do thousands of conversions.
+
+A GMBatchPool hands each worker thread its own GMBatch, so there is one
+gm process per scheduler worker slot and no locking around the pipes.
+
+The processes are started by the ExecutionEngine, under gm's policy, and
+each command they serve is reported to it.  A command that gets no answer
+within gm's timeout has the process (and the ghostscript it may have
+started) killed; the next command starts another.  Commands gm batch
+can't express run through the engine on their own.
+"""
+import os
+import select
+import signal
+import subprocess
+import threading
+import time
+import uuid
+from collections import deque
+from itertools import takewhile
+from logging import Logger
+from typing import Deque, List, Optional
+
+from .external import CommandResult, ExecutionEngine, default_engine
+
+
+def _quote(arg: str) -> Optional[str]:
+    # gm batch splits lines on whitespace, honoring double quotes, and
+    # with "-escape unix" takes a backslash to escape what follows.  We
+    # cannot express an argument containing a double quote, a backslash,
+    # or a newline.
+    if any(c in arg for c in '"\\\n\r'):
+        return None
+    return f'"{arg}"'
+
+
+class GMBatch:
+    def __init__(
+        self,
+        logger: Optional[Logger] = None,
+        timeout: Optional[float] = None,
+        executable: str = "gm",
+        engine: Optional[ExecutionEngine] = None,
+    ) -> None:
+        """timeout is for each command, gm's policy timeout by default."""
+        self.logger = logger
+        self.engine = engine or default_engine()
+        if timeout is None:
+            timeout = self.engine.policy([executable]).timeout
+        self.timeout = timeout
+        self.executable = executable
+        self._proc: Optional[subprocess.Popen] = None
+        self._buf = b""
+        self._stderr: Deque[str] = deque(maxlen=50)
+        self._stderr_ready = threading.Condition()
+
+    def _start(self) -> subprocess.Popen:
+        proc = self.engine.spawn(
+            [
+                self.executable,
+                "batch",
+                "-echo",
+                "off",
+                "-feedback",
+                "on",
+                "-escape",
+                "unix",
+                "-stop-on-error",
+                "off",
+                "-",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        # Drain stderr so a chatty gm can't fill the pipe and stall.
+        threading.Thread(
+            target=self._drain_stderr, args=(proc,), daemon=True
+        ).start()
+        self._buf = b""
+        return proc
+
+    def _drain_stderr(self, proc: subprocess.Popen) -> None:
+        if proc.stderr is None:
+            return
+        for line in proc.stderr:
+            with self._stderr_ready:
+                self._stderr.append(line.decode(errors="replace").rstrip())
+                self._stderr_ready.notify_all()
+
+    def _readline(
+        self, proc: subprocess.Popen, deadline: Optional[float]
+    ) -> Optional[str]:
+        if proc.stdout is None:
+            return None
+        fd = proc.stdout.fileno()
+        while b"\n" not in self._buf:
+            wait = None
+            if deadline is not None:
+                wait = max(0.0, deadline - time.monotonic())
+            ready, _, _ = select.select([fd], [], [], wait)
+            if not ready:
+                return None
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                return None
+            self._buf += chunk
+        line, self._buf = self._buf.split(b"\n", 1)
+        return line.decode(errors="replace").strip()
+
+    def _send(self, proc: subprocess.Popen, line: str) -> bool:
+        try:
+            if proc.stdin is None:
+                raise BrokenPipeError
+            proc.stdin.write(line.encode() + b"\n")
+            proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            self._kill()
+            return False
+        return True
+
+    def _answer(self, proc: subprocess.Popen, line: str) -> Optional[str]:
+        """PASS or FAIL for the command line just sent, or None if gm
+        died or didn't answer in time (and has been killed)."""
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        while True:
+            answer = self._readline(proc, deadline)
+            if answer is None:
+                if self.logger:
+                    self.logger.error(
+                        f"gm batch gave no answer to '{line}' within"
+                        f" {self.timeout} seconds, or died; killed it"
+                    )
+                self._kill()
+                return None
+            if answer in ("PASS", "FAIL"):
+                return answer
+
+    def _failure_stderr(self, proc: subprocess.Popen) -> List[str]:
+        """What gm wrote to stderr for the command that just failed.
+        stderr is read on another thread, so the lines may not all have
+        arrived yet: follow the command with one that fails naming a
+        marker, and take the lines that come before the marker's."""
+        marker = f"pdfarchive-stderr-{uuid.uuid4().hex}"
+        line = f'identify "{marker}"'
+        if self._send(proc, line) and self._answer(proc, line) is not None:
+            with self._stderr_ready:
+                self._stderr_ready.wait_for(
+                    lambda: any(marker in s for s in self._stderr),
+                    self.timeout,
+                )
+        with self._stderr_ready:
+            lines = list(self._stderr)
+        return list(takewhile(lambda s: marker not in s, lines))
+
+    def run(self, args: List[str]) -> bool:
+        """Run one gm command (args without the leading "gm"), e.g.
+        ["convert", "in.png", "out.png"].  Returns True if gm reported
+        success."""
+        quoted = [_quote(a) for a in args]
+        if any(q is None for q in quoted):
+            if self.logger:
+                self.logger.debug(f"Cannot batch {args}; running directly")
+            result = self.engine.run(
+                [self.executable] + args, self.logger, self.timeout
+            )
+            return result.ok
+        if self._proc is None or self._proc.poll() is not None:
+            self._proc = self._start()
+        proc = self._proc
+        line = " ".join(q for q in quoted if q is not None)
+        if self.logger:
+            self.logger.info(f"Running batched command 'gm {line}'")
+        with self._stderr_ready:
+            self._stderr.clear()
+        result = CommandResult(args=[self.executable] + args)
+        start = time.monotonic()
+        answer = self._answer(proc, line) if self._send(proc, line) else None
+        result.wall_time = time.monotonic() - start
+        if answer is None:
+            result.timed_out = True
+        else:
+            result.returncode = 0 if answer == "PASS" else 1
+        if answer == "FAIL":
+            stderr = "\n".join(self._failure_stderr(proc))
+            result.stderr = stderr.encode()
+            if self.logger:
+                self.logger.warning(
+                    f"Batched command 'gm {line}' failed\n"
+                    + f" -> stderr: {stderr}"
+                )
+        self.engine.report(result)
+        return result.ok
+
+    def _kill(self) -> None:
+        if self._proc is not None:
+            try:
+                os.killpg(self._proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self._proc.wait()
+            self._proc = None
+
+    def close(self) -> None:
+        if self._proc is None:
+            return
+        try:
+            if self._proc.stdin is not None:
+                self._proc.stdin.close()
+            self._proc.wait(timeout=self.timeout)
+        except (subprocess.TimeoutExpired, OSError):
+            self._kill()
+        self._proc = None
+
+
+class GMBatchPool:
+    """One GMBatch per thread that asks for one."""
+
+    def __init__(
+        self,
+        logger: Optional[Logger] = None,
+        executable: str = "gm",
+        engine: Optional[ExecutionEngine] = None,
+    ) -> None:
+        self.logger = logger
+        self.executable = executable
+        self.engine = engine
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all: List[GMBatch] = list()
+
+    def get(self) -> GMBatch:
+        batch = getattr(self._local, "batch", None)
+        if batch is None:
+            batch = GMBatch(
+                logger=self.logger,
+                executable=self.executable,
+                engine=self.engine,
+            )
+            self._local.batch = batch
+            with self._lock:
+                self._all.append(batch)
+        return batch
+
+    def run(self, args: List[str]) -> bool:
+        return self.get().run(args)
+
+    def close(self) -> None:
+        with self._lock:
+            for batch in self._all:
+                batch.close()
+            self._all = list()
+        self._local = threading.local()
@@ -3,41 +3,176 @@ files and JPGs and subdirectories of PDF files and JPGs.  Skip any
 directory named "Text" or "Thumbs" since those contain extracted text
 and preview images.
 
-This first version is synchronous.  Some level of parallelism is clearly
-desirable, but the text-extraction task, in particular, is extremely disk- and
-CPU-intensive, and figuring out a way to rate-limit it will be difficult.
+Thumbnailing and text extraction are handed to a Scheduler, which runs them
+in parallel within a CPU, memory, and temporary-disk budget; the
+text-extraction task, in particular, is extremely disk- and CPU-intensive, so
+it is rate-limited by its estimated cost rather than by a simple job count.
 """
-import inspect
-import logging
-import os
+import itertools
 import re
 import shutil
+import threading
+from functools import partial
 from pathlib import Path
-from tempfile import TemporaryDirectory
-from typing import List, Union
-from urllib.parse import ParseResult, quote, urlparse
+from tempfile import TemporaryDirectory, mkdtemp
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
-from jinja2 import Environment, FileSystemLoader
-
-from .external import run
+from .archive import (
+    ARCHIVE_ERRORS,
+    MEMBER_SEPARATOR,
+    ArchiveMember,
+    iter_members,
+    list_members,
+    spill,
+)
+from .atomic import (
+    atomic_output,
+    copy_atomically,
+    make_directory,
+    remove,
+    remove_tree,
+    replace_if_changed,
+    temporary_path,
+    write_atomically,
+)
+from .backends import Backend
+from .contentstore import Lookup, cache_key
+from .context import (
+    OCR_DENSITY,
+    OCR_DEPTH,
+    SWISH_E_CONF,
+    THUMB_GEOMETRY,
+    BuildContext,
+)
+from .metrics import BuildResult, file_size
+from .ocr import PageAssembler, ocr_pages
+from .planner import Plan, ProgressReporter, format_duration
+from .render import (
+    LISTING_NAME,
+    PageData,
+    page_name,
+    page_number,
+    paginate,
+    write_listing,
+)
+from .scheduler import JobClass, Scheduler
+from .sprites import SPRITES_NAME, cell_size, pack_sprites
+from .staticsearch import SEARCH_DIR, export_static_index
+from .textindex import TextIndex, WordRules
+from .textstore import PACK_INDEX_NAME
+from .tree import DirectoryNode, scan_shallow, scan_tree
+from .triage import Layout, classify, page_runs, pages_needing_ocr, split_pages
+from .workqueue import Task
 
 _here = Path(__file__).parent
 
-_skipdirs = ("scripts", "css", "config", "Thumbs", "Text")
+# Generated output directories, which are never scanned for documents;
+# with static search, SEARCH_DIR is one too
+SKIP_DIRS = ("scripts", "css", "config", "Thumbs", "Text")
+
+# In indexer_config_dir while a build has texts it hasn't indexed yet
+_INDEX_PENDING = "textindex-pending"
+
+
+class _Spilling:
+    """Where a run of ARCHIVE jobs is up to in an archive.  Each job
+    spills what fits and puts back the member it stopped at, stream and
+    all, for the next, so the archive is only opened and read once."""
+
+    def __init__(
+        self,
+        archive: Path,
+        members: Generator[Tuple[ArchiveMember, IO[bytes]], None, None],
+    ) -> None:
+        self.archive = archive
+        self.done = False
+        self._members = members
+        self._next: Optional[Tuple[ArchiveMember, IO[bytes]]] = None
+
+    def take(self) -> Optional[Tuple[ArchiveMember, IO[bytes]]]:
+        """The next member and its content, or None once there are no
+        more."""
+        item = self._next
+        if item is not None:
+            self._next = None
+            return item
+        item = next(self._members, None)
+        if item is None:
+            self.close()
+        return item
 
+    def put_back(self, item: Tuple[ArchiveMember, IO[bytes]]) -> None:
+        self._next = item
 
-def _uplink(l_id: str) -> str:
-    fragment = """
-            <div id="containing_{containing_id}">
-            <i data-feather="arrow-up-circle"></i>
-            <a href="../index.html">
-            Parent Folder
-            </a>
-            </div>
-            <div style="clear: both"></div>
-            <hr>
-            """
-    return fragment.format(containing_id=l_id)
+    def close(self) -> None:
+        self.done = True
+        self._next = None
+        self._members.close()
+
+
+class _Spill:
+    """Documents spilled out of an archive, each to a directory of its own
+    under a temporary directory, for jobs submitted through this to work
+    on.  Once the job spilling them and every one of those jobs is over,
+    the temporary directory is removed and on_empty() called."""
+
+    def __init__(
+        self, scheduler: Scheduler, on_empty: Callable[[], None]
+    ) -> None:
+        self.scheduler = scheduler
+        self.on_empty = on_empty
+        self.root = Path(mkdtemp(prefix="pdfarchive-spill-"))
+        self._count = itertools.count()
+        self._lock = threading.Lock()
+        # The job spilling the documents holds one reference
+        self._jobs = 1
+
+    def directory(self) -> Path:
+        """A new directory to spill one document into."""
+        directory = self.root / str(next(self._count))
+        directory.mkdir()
+        return directory
+
+    def submit(
+        self,
+        job_class: JobClass,
+        fn: Callable[..., None],
+        *args: Any,
+        estimate: float = 0.0,
+    ) -> None:
+        with self._lock:
+            self._jobs += 1
+        self.scheduler.submit(
+            job_class, self._run, fn, *args, estimate=estimate
+        )
+
+    def _run(self, fn: Callable[..., None], *args: Any) -> None:
+        try:
+            fn(*args)
+        finally:
+            self.release()
+
+    def release(self) -> None:
+        with self._lock:
+            self._jobs -= 1
+            empty = not self._jobs
+        if empty:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self.on_empty()
 
 
 def _check_file_for_text(f: Path) -> bool:
@@ -58,124 +193,132 @@ def _check_file_for_text(f: Path) -> bool:
 class Indexer:
     def __init__(
         self,
-        base_dir: Union[str, Path, None],
-        base_url: Union[str, ParseResult, Path, None] = None,
-        archive_title: str = "",
-        debug: bool = False,
-        resolve: bool = True,
-        indexer_config_dir: Union[str, Path, None] = None,
+        base_dir: Union[str, Path, None] = None,
         current_dir: Union[str, Path, None] = None,
+        context: Optional[BuildContext] = None,
+        node: Optional[DirectoryNode] = None,
+        **settings: Any,
     ) -> None:
         """We presume that the document tree is writeable all the way up to
         the base_dir.  Assets will be copied to it, and the Thumbs and Text
         directories (and their subdirectories) will be created as needed.
 
-        Things will end messily if the indexer cannot write to a destination.
+        settings go to BuildContext.create(), unless context (shared by
+        every directory in a build) is given.  The tree below current_dir
+        is scanned once, up front, unless node (its already-scanned
+        DirectoryNode) is given.
         """
-        # Put everything into canonically-typed form  (Path can accept a
-        # Path as input)
-        if not base_dir:
-            raise RuntimeError("base_dir must be specified")
-        self.base_dir = Path(base_dir)
-
-        if not base_url:
-            base_url = self.base_dir
-        for cls in inspect.getmro(type(base_url)):
-            # pathlib.Path is generally the parent of the base_dir class,
-            # which is a PosixPath or a WindowsPath.
-            #
-            # Mypy can't figure out that if Path is somewhere in our class
-            # hierarchy, we certainly do have an as_uri() method
-            if cls is Path:
-                base_url = base_url.as_uri()  # type: ignore
-                break
-        if type(base_url) is str:
-            base_url = urlparse(base_url)
-        if type(base_url) is ParseResult:
-            self.base_url = base_url
-        else:
-            # Shouldn't be able to happen, but mypy wasn't smart enough to
-            # realize that type(base_url) would be ParseResult by now
-            raise RuntimeError(f"base_url {base_url} could not be established")
-        if current_dir:
-            self.current_dir = Path(current_dir)
-        else:
-            self.current_dir = self.base_dir
-        if indexer_config_dir:
-            self.indexer_config_dir = Path(indexer_config_dir)
-        else:
-            self.indexer_config_dir = Path(self.base_dir / "config")
-        self.resolve = resolve
-        self.debug = debug
-
-        # Set up logging
-        self.logger = logging.getLogger(__name__)
-        ch = logging.StreamHandler()
-        formatter = logging.Formatter(
-            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-        )
-        ch.setFormatter(formatter)
-        self.logger.addHandler(ch)
-        self.logger.setLevel("INFO")
-        self.logger.info(f"Indexer created for {self.current_dir}")
-        if self.debug:
-            self.logger.setLevel("DEBUG")
-            self.logger.debug(
-                f"Debugging enabled for indexer at {self.current_dir}"
-            )
+        owns_context = context is None
+        if context is None:
+            context = BuildContext.create(base_dir=base_dir, **settings)
+        self.context = context
+        self.base_dir = context.base_dir
+        self.base_url = context.base_url
+        self.archive_title = context.archive_title
+        self.indexer_config_dir = context.indexer_config_dir
+        self.resolve = context.resolve
+        self.debug = context.debug
+        self.logger = context.logger
+        self.jinja_environment = context.jinja_environment
+        self.scheduler = context.scheduler
+        self.manifest = context.manifest
+        self.ocr_batch_pages = context.ocr_batch_pages
+        self.swish_e = context.swish_e
+        self.has_swishe = context.has_swishe
+        self.static_search = context.static_search
+        self.skip_dirs: Tuple[str, ...] = SKIP_DIRS + (
+            (SEARCH_DIR,) if self.static_search else ()
+        )
+        self.gm_batch = context.gm_batch
+        self.engine = context.engine
+        self.metrics = context.metrics
+        self.backend = context.backend
+        self.ocr = context.ocr
+        self.cache = context.cache
+        self.planner = context.planner
+        self.changes = context.changes
+        self.texts = context.texts
+        # Whether the search index has to look at every text, rather than
+        # just those this build changed
+        self._index_all = True
 
-        # Do path resolution (if required) and sanity checks.
-        # Resolution is turned on by default, but if you have part of your
-        # tree symlinked from somewhere else, it will break.
-        if resolve:
-            self.base_dir = self.base_dir.resolve()
-            self.current_dir = self.current_dir.resolve()
-        self.relative_path = self.current_dir.relative_to(self.base_dir)
-        if not self.relative_path:
-            raise RuntimeError(
-                f"{self.base_dir} does not contain {self.current_dir}"
-            )
-        if self.relative_path == Path("."):
-            self.is_root = True
-            self.path_to_base = self.relative_path
+        if node is not None:
+            self.current_dir = node.path
+            self.relative_path = node.relative_path
         else:
-            path_to_base = Path()
-            walk_path = Path(self.current_dir)
-            while walk_path and walk_path != self.base_dir:
-                path_to_base = Path(".." / path_to_base)
-                walk_path = walk_path.parent
-            self.path_to_base = path_to_base
-            self.is_root = False
-
-        self.has_swishe = False
-        self.check_for_installed_executables()
-
-        # Set cwd and umask
-        os.chdir(self.current_dir)
-        os.umask(0o022)
-
-        if self.is_root:
-            self.copy_sitewide_files()
+            if current_dir:
+                self.current_dir = Path(current_dir)
+            else:
+                self.current_dir = self.base_dir
+            if self.resolve:
+                self.current_dir = self.current_dir.resolve()
+            else:
+                self.current_dir = self.current_dir.absolute()
+            self.relative_path = self.current_dir.relative_to(self.base_dir)
+        self.logger.info(f"Indexer created for {self.current_dir}")
+        self.is_root = self.relative_path == Path(".")
+        self.path_to_base = Path(*([".."] * len(self.relative_path.parts)))
 
-        if archive_title:
-            self.archive_title = archive_title
-        else:
-            self.archive_title = self.base_dir.name
-        # Set up template environment
-        self.jinja_environment = Environment(
-            loader=FileSystemLoader(Path(_here / "templates"))
-        )
+        if node is None:
+            try:
+                node = self._scan()
+            except BaseException:
+                if owns_context:
+                    context.close()
+                raise
+        self.node = node
+        self.dirs: List[Path] = [d.path for d in node.dirs]
+        self.files: List[Path] = node.files
+        self.archives: List[Path] = node.archives
+        self._shadowed = self._find_shadowed()
 
-        # Figure out what's in the directory
-        self.dirs: List[Path] = list()
-        self.files: List[Path] = list()
-        self.archives: List[Path] = list()
-        self.get_directory_components()
+        self._members: Dict[Path, List[ArchiveMember]] = dict()
+        # Set while plan() is finding out what there is to do
+        self._plan: Optional[Plan] = None
+        self._probe: Optional[Backend] = None
 
         self.children: List[Indexer] = list()
 
-    def _run(self, args: List[str]) -> None:
-        run(args, self.logger)
+    def _scan(self) -> DirectoryNode:
+        """Figure out what's in the directory (and, if we are where the
+        build starts, everything below it)."""
+        dry_run = self.context.dry_run
+        if self.is_root and not dry_run:
+            self.copy_sitewide_files()
+        skip = self.skip_dirs if self.is_root else ()
+        with self.metrics.measure("scan", directory=self.relative_path):
+            node = scan_tree(
+                self.current_dir, self.relative_path, skip, not dry_run
+            )
+        nodes = list(node.walk())
+        self.metrics.outcome("scan", "directories", n=len(nodes))
+        self.metrics.outcome(
+            "scan", "documents", n=sum(len(d.files) for d in nodes)
+        )
+        self.metrics.outcome(
+            "scan", "archives", n=sum(len(d.archives) for d in nodes)
+        )
+        return node
+
+    def _find_shadowed(self) -> Set[Path]:
+        """Documents whose thumbnail and text would be named the same as
+        those of another document here (foo.pdf and foo.png, say): only the
+        first of them by name gets any, and the rest are skipped."""
+        first: Dict[str, Path] = dict()
+        shadowed: Set[Path] = set()
+        for f in self.files:
+            if f.stem not in first:
+                first[f.stem] = f
+                continue
+            self.logger.warning(
+                f"'{f}' has the same name as '{first[f.stem].name}' but for"
+                " its suffix, so it gets no thumbnail or text of its own"
+            )
+            shadowed.add(f)
+        return shadowed
+
+    def _run(self, args: List[str], cwd: Optional[Path] = None) -> None:
+        self.engine.run(args, self.logger, cwd=cwd)
 
     @property
     def path_to_base_str(self) -> str:
@@ -185,271 +328,950 @@ class Indexer:
     def relative_path_str(self) -> str:
         return str(self.relative_path)
 
-    def check_for_installed_executables(self) -> None:
-        for exe in ("gm", "pdftotext", "gocr", "tesseract"):
-            if not shutil.which(exe):
-                raise RuntimeError(f"{exe} not found on path")
-        if self.is_root:
-            if not shutil.which("swish-e"):
-                self.logger.warning(
-                    "swish-e not found on path.  Cannot create text index."
-                )
-                return
-            self.has_swishe = True
-
     def get_directory_components(self) -> None:
-        dirs: List[Path] = list()
-        files: List[Path] = list()
-        archives: List[Path] = list()
-        # Categorize contents and incidentally
-        # set file mode appropriately
-        # TODO: add archive expansion
-        rescan = True
-        while rescan:
-            dirs = list()
-            files = list()
-            archives = list()
-            for child in self.current_dir.iterdir():
-                if child.is_dir():
-                    # Skip the top-level scripts, css, Thumbs, and Text dirs
-                    if self.is_root and child.name in _skipdirs:
-                        continue
-                    dirs.append(child)
-                if child.is_file():
-                    if child.suffix.lower() in (".pdf", ".jpg", ".png"):
-                        files.append(child)
-                    if child.suffix.lower() in (
-                        ".zip",
-                        ".gz",
-                        ".tar",
-                        ".xz",
-                        ".7z",
-                    ):
-                        archives.append(child)
-                    child.chmod(0o644)
-            rescan = False  # When we do archive expansion we will set it to
-            # true after expanding archives
-        self.dirs = dirs
-        self.files = files
-        self.archives = archives
-
-    def generate_index_page(self) -> str:
-        if self.is_root:
-            enc_t = ""
-            enc_b = ""
-        else:
-            enc_t = _uplink("top")
-            enc_b = _uplink("bottom")
-
-        file_content = self.generate_file_content()
-        dir_content = self.generate_dir_content()
-        archive_content = self.generate_archive_content()
-
-        page_content = (
-            enc_t + file_content + dir_content + archive_content + enc_b
-        )
+        """Rescan just this directory."""
+        skip = self.skip_dirs if self.is_root else ()
+        node = scan_shallow(self.current_dir, self.relative_path, skip)
+        self.node = node
+        self.dirs = [d.path for d in node.dirs]
+        self.files = node.files
+        self.archives = node.archives
+        self._shadowed = self._find_shadowed()
 
-        template = self.jinja_environment.get_template("index.template")
+    def page_data(self) -> PageData:
         if self.base_dir == self.current_dir:
             title = self.archive_title
         else:
             title = self.current_dir.name
-        page = template.render(
+        # No search link at all if there is nothing to search with
+        search_url = ""
+        if self.static_search:
+            search_url = f"{self.path_to_base_str}/search.html"
+        elif self.has_swishe:
+            search_url = "/cgi-bin/search.cgi"
+        return PageData(
             title=title,
-            page_content=page_content,
             top_name=self.archive_title,
             top_dir=self.path_to_base_str,
+            partial_path=self.relative_path_str,
+            search_url=search_url,
+            is_root=self.is_root,
+            files=self.files,
+            dirs=self.dirs,
+            archives=self.archives,
+            archive_members={
+                a: [m.name for m in self.members(a)] for a in self.archives
+            },
+            sprite_cell=(
+                cell_size(THUMB_GEOMETRY) if self.context.sprites else None
+            ),
         )
-        return page
+
+    def generate_index_page(self) -> str:
+        return self.context.renderer.render(self.page_data())
 
     def generate_dir_content(self) -> str:
         if not self.dirs:
             return ""
-        tbl_template = self.jinja_environment.get_template("dirtable.template")
-        dir_template = self.jinja_environment.get_template("dir.template")
-        dir_string = ""
-        for c, d in enumerate(self.dirs):
-            dir_string += dir_template.render(
-                dir_id=str(c), dir_name=quote(d.name)
-            )
-        return tbl_template.render(dirs=dir_string)
+        return self.context.renderer.render_table("dirtable", self.page_data())
 
     def generate_archive_content(self) -> str:
         if not self.archives:
             return ""
-        tbl_template = self.jinja_environment.get_template(
-            "archivetable.template"
-        )
-        arc_template = self.jinja_environment.get_template("archive.template")
-        arc_string = ""
-        for c, a in enumerate(self.archives):
-            fname = quote(a.name)
-            basename = quote(a.stem)
-            arc_string += arc_template.render(
-                archive_id=str(c), archive_name=fname, base_name=basename
-            )
-        return tbl_template.render(archives=arc_string)
+        return self.context.renderer.render_table(
+            "archivetable", self.page_data()
+        )
 
     def generate_file_content(self) -> str:
         if not self.files:
             return ""
-        tbl_template = self.jinja_environment.get_template(
-            "filetable.template"
-        )
-        file_template = self.jinja_environment.get_template("file.template")
-        file_string = ""
-        for c, f in enumerate(self.files):
-            fname = quote(f.name)
-            basename = quote(f.stem)
-            file_string += file_template.render(
-                file_id=str(c),
-                file_name=fname,
-                partial_path=self.relative_path_str,
-                base_path=self.path_to_base_str,
-                base_name=basename,
-                thumb_name=f"{basename}_thumb.png",
-                text_name=f"{basename}.txt",
-            )
-        return tbl_template.render(files=file_string)
+        return self.context.renderer.render_table(
+            "filetable", self.page_data()
+        )
 
     def generate_thumbnails(self) -> None:
-        """Someday we should do this with pgmagick, but I can't get boost
-        to work in my environment with it right now."""
+        """Queue a thumbnail job for each file.  The jobs run on the
+        scheduler; call self.scheduler.wait() to wait for them."""
         for f in self.files:
-            thumb_name = f"{f.stem}_thumb.png"
-            thumb_path = Path(
-                self.path_to_base / "Thumbs" / self.relative_path / thumb_name
-            )
-            try:
-                thumb_path.stat()
-                self.logger.info(f"{thumb_path} already exists")
+            if f in self._shadowed:
                 continue
-            except FileNotFoundError:
-                pass
-            args = [
-                "gm",
-                "convert",
-                "-geometry",
-                "150x100",
-                f"{f}[0]",
-                "-resize",
-                "150x100",
-                "-strip",
-                f"{thumb_path}",
-            ]
-            thumb_path.parent.mkdir(exist_ok=True, parents=True)
-            self._run(args)
-            try:
-                thumb_path.stat()
-            except FileNotFoundError:
-                shutil.copyfile(
-                    Path(_here / "assets" / "png" / "no_image.png"), thumb_path
+            thumb_path = self._thumb_path(f)
+            if self.manifest.is_fresh("thumbnail", f, thumb_path):
+                self.logger.info(f"{thumb_path} is up to date")
+                self.metrics.outcome(
+                    "thumbnail", "cached", f, self.relative_path_str
                 )
+                continue
+            self._submit(
+                Task("thumbnail", self.relative_path_str, f.name),
+                JobClass.THUMBNAIL,
+                self.make_thumbnail,
+                f,
+                estimate=self.planner.thumbnail(f),
+            )
 
-    def extract_text(self) -> None:
+    def make_sprites(self) -> None:
+        """Bring this directory's sprite sheets up to date with its
+        thumbnails, which must all have been made by now."""
+        directory = self.base_dir / "Thumbs" / self.relative_path
+        if not self.files and not (directory / SPRITES_NAME).exists():
+            return
+        with self.metrics.measure("sprites", directory=self.relative_path_str):
+            rebuilt = pack_sprites(
+                [self._thumb_path(f) for f in self.files],
+                directory,
+                THUMB_GEOMETRY,
+                self.backend,
+                self.logger,
+                self.changes,
+            )
+        self.metrics.outcome(
+            "sprites", "built", directory=self.relative_path_str, n=rebuilt
+        )
+
+    def _thumb_path(self, f: Path) -> Path:
+        return Path(
+            self.base_dir
+            / "Thumbs"
+            / self.relative_path
+            / f"{f.stem}_thumb.png"
+        )
+
+    def make_thumbnail(self, f: Path) -> None:
         """Someday we should do this with pgmagick, but I can't get boost
         to work in my environment with it right now."""
+        thumb_path = self._thumb_path(f)
+        if not self._dedup(
+            "thumbnail", f, thumb_path, JobClass.THUMBNAIL, self.make_thumbnail
+        ):
+            return
+        started = self.manifest.begin("thumbnail", f, thumb_path)
+        outcome = self._make_thumbnail(f, thumb_path, f)
+        recorded = self._record("thumbnail", f, thumb_path, started)
+        self._stored(
+            "thumbnail", f, thumb_path, recorded and outcome == "built"
+        )
+
+    def _make_thumbnail(
+        self, source: Path, thumb_path: Path, name: Path
+    ) -> str:
+        """Thumbnail source into thumb_path.  name is the document's path
+        in the archive tree, which source need not be.  Returns the
+        outcome: "built", or "placeholder" if the backend failed."""
+        directory = self.relative_path_str
+        with self.metrics.measure("thumbnail", name, directory) as m:
+            m.bytes_in = file_size(source)
+            make_directory(thumb_path.parent)
+            with atomic_output(thumb_path, self.changes) as tmp:
+                self.backend.thumbnail(source, tmp, THUMB_GEOMETRY)
+                if tmp.exists():
+                    outcome = "built"
+                else:
+                    shutil.copyfile(
+                        Path(_here / "assets" / "png" / "no_image.png"), tmp
+                    )
+                    outcome = "placeholder"
+            m.bytes_out = file_size(thumb_path)
+        self.metrics.outcome("thumbnail", outcome, name, directory)
+        return outcome
+
+    def extract_text(self) -> None:
+        """Queue a low-effort text extraction job for each file.  PDFs that
+        yield no text get a follow-up OCR job.  The jobs run on the
+        scheduler; call self.scheduler.wait() to wait for them."""
         for f in self.files:
-            text_name = f"{f.stem}.txt"
-            text_path = Path(
-                self.path_to_base / "Text" / self.relative_path / text_name
+            if f in self._shadowed:
+                continue
+            text_path = self._text_path(f)
+            if self._text_fresh(f, text_path):
+                self.logger.info(f"{text_path} is up to date")
+                self.metrics.outcome(
+                    "extract-fast", "cached", f, self.relative_path_str
+                )
+                continue
+            self._submit(
+                Task("text", self.relative_path_str, f.name),
+                JobClass.EXTRACT_FAST,
+                self.extract_fast,
+                f,
+                estimate=self.planner.text(f, probe=self._probe),
             )
+
+    def _text_fresh(self, f: Path, text_path: Path) -> bool:
+        """Whether the text of f is up to date, as a text file or packed."""
+        stat = self.texts.stat(text_path)
+        return stat is not None and self.manifest.is_fresh(
+            "text", f, text_path, output_mtime_ns=stat[1]
+        )
+
+    def _text_path(self, f: Path) -> Path:
+        return Path(
+            self.base_dir / "Text" / self.relative_path / f"{f.stem}.txt"
+        )
+
+    def extract_fast(self, f: Path) -> None:
+        text_path = self._text_path(f)
+        if not self._dedup(
+            "text", f, text_path, JobClass.EXTRACT_FAST, self.extract_fast
+        ):
+            return
+        started = self.manifest.begin("text", f, text_path)
+        if f.suffix.lower() != ".pdf":
+            found = self._extract_image_text(f, text_path, f)
+            recorded = self._record("text", f, text_path, started)
+            self._stored("text", f, text_path, recorded and found)
+            return
+        pages, needed = self._extract_pdf_text(f, text_path, f)
+        if pages and not needed:
+            recorded = self._record("text", f, text_path, started)
+            self._stored("text", f, text_path, recorded)
+            return
+        self.extract_ocr(f, pages, started, needed)
+
+    def _cache_key(self, kind: str, f: Path) -> str:
+        assert self.cache is not None
+        return cache_key(
+            kind, self.manifest.fingerprint(kind), self.cache.digest(f)
+        )
+
+    def _dedup(
+        self,
+        kind: str,
+        f: Path,
+        output: Path,
+        job_class: JobClass,
+        build: Callable[[Path], None],
+    ) -> bool:
+        """Whether to go ahead and build output from f.  With a content
+        store, the output of an identical document is linked into place
+        (and recorded) instead; if one is being built right now, that
+        happens once it is done, or, if it fails, build is queued again."""
+        if self.cache is None:
+            return True
+        key = self._cache_key(kind, f)
+        on_ready = partial(
+            self._dedup_ready, key, kind, f, output, job_class, build
+        )
+        found = self.cache.lookup(key, output, on_ready, self.changes)
+        if found is Lookup.FETCHED:
+            self._deduplicated(kind, f, output)
+        return found is Lookup.BUILD
+
+    def _dedup_ready(
+        self,
+        key: str,
+        kind: str,
+        f: Path,
+        output: Path,
+        job_class: JobClass,
+        build: Callable[[Path], None],
+        stored: bool,
+    ) -> None:
+        if (
+            stored
+            and self.cache
+            and self.cache.fetch(key, output, self.changes)
+        ):
+            self._deduplicated(kind, f, output)
+        else:
+            self.scheduler.submit(job_class, build, f)
+
+    def _deduplicated(self, kind: str, f: Path, output: Path) -> None:
+        self.logger.info(f"{output} is a copy of an identical document's")
+        self.manifest.record(kind, f, output)
+        stage = "thumbnail" if kind == "thumbnail" else "extract-fast"
+        self.metrics.outcome(stage, "deduplicated", f, self.relative_path_str)
+
+    def _record(
+        self,
+        kind: str,
+        f: Path,
+        output: Path,
+        started: Optional[Tuple[int, int]],
+    ) -> bool:
+        """Record output in the manifest, unless f changed while it was
+        being built from f; returns whether it was recorded."""
+        if self.manifest.record(kind, f, output, started=started):
+            return True
+        self.logger.info(f"'{f}' changed while {output} was being built")
+        return False
+
+    def _stored(self, kind: str, f: Path, output: Path, ok: bool) -> None:
+        """Put output in the content store, if it was built successfully,
+        and release any jobs waiting for it."""
+        if self.cache is not None:
+            self.cache.finish(self._cache_key(kind, f), output if ok else None)
+
+    def _extract_image_text(
+        self, source: Path, text_path: Path, name: Path
+    ) -> bool:
+        directory = self.relative_path_str
+        with self.metrics.measure("extract-fast", name, directory) as m:
+            m.bytes_in = file_size(source)
+            make_directory(text_path.parent)
+            (text,) = self.ocr.recognize([source])
+            write_atomically(text_path, text, self.changes)
+            found = _check_file_for_text(text_path)
+            m.bytes_out = file_size(text_path)
+        outcome = "built" if found else "empty"
+        self.metrics.outcome("extract-fast", outcome, name, directory)
+        return found
+
+    def _triage(self, source: Path, name: Path) -> Optional[bool]:
+        """Whether source has any fonts; None if we can't tell."""
+        if not self.backend.can_triage:
+            return None
+        directory = self.relative_path_str
+        with self.metrics.measure("triage", name, directory) as m:
+            m.bytes_in = file_size(source)
+            fonts = self.backend.has_fonts(source)
+        outcome = {True: "fonts", False: "no-fonts", None: "unknown"}[fonts]
+        self.metrics.outcome("triage", outcome, name, directory)
+        return fonts
+
+    def _extract_pdf_text(
+        self, source: Path, text_path: Path, name: Path
+    ) -> Tuple[List[str], List[int]]:
+        """Extract the text layer of source, unless triage says it has
+        none, and return the text of each page (an empty list if there is
+        no text layer at all) and which of them need OCR."""
+        directory = self.relative_path_str
+        make_directory(text_path.parent)
+        if self._triage(source, name) is False:
+            self.logger.info(f"'{name}' has no fonts; skipping pdftotext")
+            self.metrics.outcome("extract-fast", "skipped", name, directory)
+            return list(), list()
+        # If the text turns out to need OCR, it goes no further than the
+        # temporary file: the OCR output replaces text_path in one go.
+        tmp = temporary_path(text_path)
+        with self.metrics.measure("extract-fast", name, directory) as m:
+            m.bytes_in = file_size(source)
+            self.backend.pdf_text(source, tmp)
             try:
-                text_path.stat()
-                self.logger.info(f"{text_path} already exists")
-                continue
+                pages = split_pages(tmp.read_text(errors="replace"))
             except FileNotFoundError:
-                pass
-            if f.suffix.lower() == ".pdf":
-                args = ["pdftotext", "-q", f"{f}", f"{text_path}"]
-            else:
-                args = ["gocr", "-i", f"'{f}'", "-o", f"{text_path}"]
-            text_path.parent.mkdir(exist_ok=True, parents=True)
-            self._run(args)
-            try:
-                if _check_file_for_text(text_path):
-                    self.logger.info(
-                        f"Low-effort extraction for '{text_path}' succeeded"
+                pages = list()
+            m.bytes_out = file_size(tmp)
+        # Pages without text that show no images have nothing to OCR
+        images = (
+            self.backend.image_pages(source)
+            if pages_needing_ocr(pages)
+            else None
+        )
+        layout = classify(pages, images)
+        if layout is Layout.TEXT:
+            replace_if_changed(tmp, text_path, self.changes)
+        else:
+            tmp.unlink(missing_ok=True)
+        if layout is Layout.TEXT:
+            self.logger.info(
+                f"Low-effort extraction for '{text_path}' succeeded"
+            )
+            outcome = "built"
+        elif layout is Layout.MIXED:
+            outcome = "mixed"
+        else:
+            outcome = "needs-ocr"
+        self.metrics.outcome("extract-fast", outcome, name, directory)
+        return pages, pages_needing_ocr(pages, images)
+
+    def _ocr_plan(
+        self,
+        source: Path,
+        pages: Sequence[str],
+        needed: Optional[Sequence[int]] = None,
+    ) -> Tuple[int, List[int]]:
+        """How many pages source has and which of them need OCR, given
+        the page texts pdftotext found (if any), and which of those need
+        it if that is known.  A count of 0 means we couldn't find out."""
+        if pages:
+            if needed is None:
+                needed = pages_needing_ocr(pages)
+            return len(pages), list(needed)
+        count = self.backend.page_count(source) or 0
+        return count, list(range(count))
+
+    def extract_ocr(
+        self,
+        f: Path,
+        pages: Sequence[str] = (),
+        started: Optional[Tuple[int, int]] = None,
+        needed: Optional[Sequence[int]] = None,
+    ) -> None:
+        """Queue OCR of the pages of a PDF that have no text, in batches of
+        pages.  pages is the text of each page, if pdftotext found any,
+        started what manifest.begin() returned, and needed which pages to
+        OCR, if not all those without text.  If we can't find out how many
+        pages there are, fall back to OCRing the whole document in one
+        job."""
+        self._queue_ocr(
+            f,
+            self._text_path(f),
+            f,
+            pages,
+            needed=needed,
+            on_complete=lambda text_path: self._ocr_complete(
+                f, text_path, started
+            ),
+            on_progress=lambda done, size: self.manifest.progress(
+                "text", f, done, size
+            ),
+            resume=self.manifest.resume_point("text", f),
+        )
+
+    def _queue_ocr(
+        self,
+        source: Path,
+        text_path: Path,
+        name: Path,
+        pages: Sequence[str],
+        on_complete: Callable[[Path], None],
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        resume: Tuple[int, int] = (0, 0),
+        submit: Optional[Callable[..., Any]] = None,
+        needed: Optional[Sequence[int]] = None,
+    ) -> None:
+        """Queue the OCR jobs for source (known as name) with submit (the
+        scheduler's, unless given), and call on_complete(text_path) once
+        they have all put their pages in text_path."""
+        submit = submit or self.scheduler.submit
+        self.logger.info(f"Extracting text the hard way for '{name}'")
+        with self.metrics.measure(
+            "extract-ocr", name, self.relative_path_str
+        ) as m:
+            m.bytes_in = file_size(source)
+            count, needed = self._ocr_plan(source, pages, needed)
+        if not count:
+            self.logger.warning(
+                f"Cannot count pages of '{name}'; OCRing it all at once"
+            )
+            submit(
+                JobClass.PDF_OCR,
+                self.extract_ocr_document,
+                source,
+                text_path,
+                name,
+                on_complete,
+                estimate=self.planner.text(source),
+            )
+            return
+        if len(needed) < count:
+            self.logger.info(
+                f"OCRing {len(needed)} of {count} pages of '{name}'"
+            )
+        assembler = PageAssembler(
+            text_path,
+            count,
+            on_complete=on_complete,
+            on_progress=on_progress,
+            resume=resume,
+            changes=self.changes,
+        )
+        if assembler.resumed:
+            self.logger.info(
+                f"Resuming OCR of '{name}' after page {assembler.resumed}"
+            )
+            needed = [p for p in needed if p >= assembler.resumed]
+        runs = list(page_runs(needed, self.ocr_batch_pages))
+        self._add_text_pages(assembler, pages, needed)
+        if not runs:
+            # Everything was done before we were interrupted
+            assembler.add(count, [])
+        for first, last in runs:
+            submit(
+                JobClass.PAGE_OCR,
+                self.extract_ocr_pages,
+                source,
+                first,
+                last,
+                assembler,
+                name,
+                estimate=self.planner.ocr_pages(last - first + 1),
+            )
+
+    def _add_text_pages(
+        self,
+        assembler: PageAssembler,
+        pages: Sequence[str],
+        needed: Sequence[int],
+    ) -> None:
+        skip = set(needed)
+        for i, text in enumerate(pages):
+            if i not in skip and i >= assembler.resumed:
+                assembler.add(i, [text])
+
+    def extract_ocr_pages(
+        self,
+        f: Path,
+        first: int,
+        last: int,
+        assembler: PageAssembler,
+        name: Optional[Path] = None,
+    ) -> None:
+        """OCR pages first to last of f (known as name, if not f) into
+        assembler."""
+        name = name or f
+        self.logger.debug(f"OCRing pages {first}-{last} of '{name}'")
+        with self.metrics.measure("extract-ocr", name, self.relative_path_str):
+            texts = ocr_pages(
+                f, first, last, self._render_pages, self.ocr.recognize
+            )
+            assembler.add(first, texts)
+        self.metrics.outcome(
+            "extract-ocr", "pages", name, self.relative_path_str, n=len(texts)
+        )
+
+    def _render_pages(
+        self, pdf: Path, first: int, last: Optional[int], directory: Path
+    ) -> List[Path]:
+        return self.backend.render_pages(
+            pdf, first, last, directory, OCR_DENSITY, OCR_DEPTH
+        )
+
+    def _ocr_complete(
+        self, f: Path, text_path: Path, started: Optional[Tuple[int, int]]
+    ) -> None:
+        found = self._finish_ocr(f, text_path)
+        recorded = self._record("text", f, text_path, started)
+        self._stored("text", f, text_path, recorded and found)
+
+    def _finish_ocr(self, name: Path, text_path: Path) -> bool:
+        """Put a placeholder in text_path if OCR found nothing.  Returns
+        whether it found anything."""
+        outcome = "built"
+        if not _check_file_for_text(text_path):
+            # Well, crap.
+            write_atomically(
+                text_path,
+                f"Could not extract text from {name.name}\n",
+                self.changes,
+            )
+            outcome = "placeholder"
+        m = self.metrics.current()
+        if m is not None:
+            m.bytes_out += file_size(text_path)
+        self.metrics.outcome(
+            "extract-ocr", outcome, name, self.relative_path_str
+        )
+        return outcome == "built"
+
+    def extract_ocr_document(
+        self,
+        f: Path,
+        text_path: Path,
+        name: Path,
+        on_complete: Callable[[Path], None],
+    ) -> None:
+        """OCR all of f (known as name) into text_path in one go, and call
+        on_complete(text_path)."""
+        with self.metrics.measure(
+            "extract-ocr", name, self.relative_path_str
+        ) as m:
+            m.bytes_in = file_size(f)
+            self._ocr_document(f, text_path, name)
+            on_complete(text_path)
+
+    def _ocr_document(self, source: Path, text_path: Path, name: Path) -> None:
+        """OCR all of source in one go, however many pages it has."""
+        texts = ocr_pages(
+            source, 0, None, self._render_pages, self.ocr.recognize
+        )
+        write_atomically(text_path, "".join(texts), self.changes)
+        self.metrics.outcome(
+            "extract-ocr",
+            "pages",
+            name,
+            self.relative_path_str,
+            n=len(texts),
+        )
+
+    def members(self, archive: Path) -> List[ArchiveMember]:
+        """The documents in archive (listed once per Indexer, and only
+        read from the archive again once it has changed)."""
+        if archive not in self._members:
+            members = self.manifest.members(archive)
+            if members is None:
+                try:
+                    members = list_members(archive)
+                except ARCHIVE_ERRORS as exc:
+                    self.logger.warning(
+                        f"Cannot read archive '{archive}': {exc}"
                     )
-                    continue  # Next file, please
-            except FileNotFoundError:
-                pass
-            if f.suffix.lower() == ".pdf":
-                self.logger.info(f"Extracting text the hard way for '{f}'")
-                with TemporaryDirectory() as tmpdir:
-                    self.logger.debug(f"Type(tmpdir) -> {type(tmpdir)}")
-                    self.logger.debug(f"tmpdir -> {tmpdir}")
-                    td_path = Path(tmpdir)
-                    tmpfile = Path(td_path / f"{f.stem}.tif")
-                    # We're assuming that 16-intensity @120dpi should be enough
-                    # for text recognition
-                    # Stage 1: convert to TIFF
-                    args = [
-                        "gm",
-                        "convert",
-                        "-density",
-                        "120x120",
-                        f"{f}",
-                        "-depth",
-                        "4",
-                        "-strip",
-                        "-background",
-                        "white",
-                        "-monitor",
-                        "-debug",
-                        "Cache",
-                        f"{tmpfile}",
-                    ]
-                    self._run(args)
-                    # Stage 2: Run tesseract on it (very CPU- and memory- and
-                    # disk-intensive)
-                    #
-                    # Note that tesseract automatically adds the .txt, so...
-                    tess_output = Path(text_path.with_suffix(""))
-                    args = ["tesseract", f"{tmpfile}", f"{tess_output}"]
-                    self._run(args)
-                    if not _check_file_for_text(text_path):
-                        # Well, crap.
-                        with open(text_path, "w") as tf:
-                            tf.write(f"Could not extract text from {f.name}\n")
+                    members = list()
+                else:
+                    if not self.context.dry_run:
+                        self.manifest.record_members(archive, members)
+            self._members[archive] = members
+        return self._members[archive]
+
+    def _member_paths(
+        self, archive: Path, member: ArchiveMember
+    ) -> Tuple[Path, Path]:
+        """Where the thumbnail and text of an archive member go: in a
+        directory named for the archive, under Thumbs and Text."""
+        inner = Path(self.relative_path / archive.name / member.path)
+        return (
+            Path(self.base_dir / "Thumbs" / inner.parent)
+            / f"{inner.stem}_thumb.png",
+            Path(self.base_dir / "Text" / inner.parent) / f"{inner.stem}.txt",
+        )
+
+    def process_archives(self) -> None:
+        """Queue a job for each archive with documents whose thumbnails or
+        text are out of date."""
+        for archive in self.archives:
+            stale = set()
+            estimate = 0.0
+            for member in self.members(archive):
+                thumb_path, text_path = self._member_paths(archive, member)
+                name = archive / member.path
+                for kind, stage, output in (
+                    ("thumbnail", "thumbnail", thumb_path),
+                    ("text", "extract-fast", text_path),
+                ):
+                    exists = (
+                        self.texts.exists(output) if kind == "text" else None
+                    )
+                    if self.manifest.is_member_fresh(
+                        kind, member, output, exists
+                    ):
+                        self.metrics.outcome(
+                            stage, "cached", name, self.relative_path_str
+                        )
+                    else:
+                        stale.add(member.name)
+                        if kind == "thumbnail":
+                            estimate += self.planner.thumbnail(name)
+                        else:
+                            estimate += self.planner.text(
+                                name, size=member.size
+                            )
+            if stale:
+                self._submit(
+                    Task(
+                        "archive",
+                        self.relative_path_str,
+                        archive.name,
+                        members=tuple(sorted(stale)),
+                    ),
+                    JobClass.ARCHIVE,
+                    self.spill_archive,
+                    archive,
+                    stale,
+                    estimate=estimate,
+                )
+
+    def spill_archive(self, archive: Path, names: Set[str]) -> None:
+        """Spill the named documents out of archive, as many as fit in an
+        ARCHIVE job's temporary space, and queue jobs of their own for
+        their thumbnails and text, so that they are worked on in parallel.
+        The space stays reserved until those are done and the documents
+        removed; then another job carries on from there in the archive."""
+        self.logger.info(f"Spilling {len(names)} documents from '{archive}'")
+        self._spill_more(_Spilling(archive, iter_members(archive, names)))
+
+    def _spill_more(self, spilling: "_Spilling") -> None:
+        limit = self.scheduler.costs[JobClass.ARCHIVE].tmp * 1024 * 1024
+        release_tmp = self.scheduler.retain()
+
+        def spill_rest() -> None:
+            release_tmp()
+            if not spilling.done:
+                self.scheduler.submit(
+                    JobClass.ARCHIVE, self._spill_more, spilling
+                )
+
+        spilled = _Spill(self.scheduler, spill_rest)
+        size = 0
+        try:
+            while True:
+                item = self._read_member(spilling)
+                if item is None:
+                    break
+                member, stream = item
+                if size and size + member.size > limit:
+                    spilling.put_back(item)
+                    break
+                path = spill(member, stream, spilled.directory())
+                size += member.size
+                self.queue_member(spilled, spilling.archive, member, path)
+        except BaseException:
+            spilling.close()
+            raise
+        finally:
+            spilled.release()
+
+    def _read_member(
+        self, spilling: "_Spilling"
+    ) -> Optional[Tuple[ArchiveMember, IO[bytes]]]:
+        """The next member from spilling, or None if there are no more or
+        the rest of the archive can't be read."""
+        try:
+            return spilling.take()
+        except ARCHIVE_ERRORS as exc:
+            spilling.close()
+            self.logger.warning(
+                f"Cannot read archive '{spilling.archive}': {exc}"
+            )
+            return None
+
+    def queue_member(
+        self,
+        spilled: "_Spill",
+        archive: Path,
+        member: ArchiveMember,
+        path: Path,
+    ) -> None:
+        """Queue jobs to bring the thumbnail and text of member, spilled
+        to path, up to date."""
+        thumb_path, text_path = self._member_paths(archive, member)
+        name = archive / member.path
+        if not self.manifest.is_member_fresh("thumbnail", member, thumb_path):
+            spilled.submit(
+                JobClass.THUMBNAIL,
+                self.member_thumbnail,
+                member,
+                path,
+                thumb_path,
+                name,
+                estimate=self.planner.thumbnail(name),
+            )
+        if not self.manifest.is_member_fresh(
+            "text", member, text_path, self.texts.exists(text_path)
+        ):
+            spilled.submit(
+                JobClass.EXTRACT_FAST,
+                self.member_text,
+                spilled,
+                member,
+                path,
+                text_path,
+                name,
+                estimate=self.planner.text(name, size=member.size),
+            )
+
+    def member_thumbnail(
+        self, member: ArchiveMember, path: Path, thumb_path: Path, name: Path
+    ) -> None:
+        self._make_thumbnail(path, thumb_path, name)
+        self.manifest.record_member("thumbnail", member, thumb_path)
+
+    def member_text(
+        self,
+        spilled: "_Spill",
+        member: ArchiveMember,
+        path: Path,
+        text_path: Path,
+        name: Path,
+    ) -> None:
+        """Extract the text of member, spilled to path, queueing jobs for
+        whatever pages need OCR."""
+        if path.suffix.lower() == ".pdf":
+            pages, needed = self._extract_pdf_text(path, text_path, name)
+            if not pages or needed:
+                self._queue_ocr(
+                    path,
+                    text_path,
+                    name,
+                    pages,
+                    needed=needed,
+                    on_complete=partial(self._member_ocr_complete, member),
+                    submit=spilled.submit,
+                )
+                return
+        else:
+            self._extract_image_text(path, text_path, name)
+        self.manifest.record_member("text", member, text_path)
+
+    def _member_ocr_complete(
+        self, member: ArchiveMember, text_path: Path
+    ) -> None:
+        self._finish_ocr(member.archive / member.path, text_path)
+        self.manifest.record_member("text", member, text_path)
+
+    def process_archive(self, archive: Path, names: Set[str]) -> None:
+        """Stream the named documents out of archive, one at a time, and
+        bring their thumbnails and text up to date, all in the calling
+        thread (a distributed worker's archive task, which runs alongside
+        the worker's other tasks)."""
+        self.logger.info(f"Processing {len(names)} documents in '{archive}'")
+        spilling = _Spilling(archive, iter_members(archive, names))
+        with TemporaryDirectory() as tmpdir:
+            while True:
+                item = self._read_member(spilling)
+                if item is None:
+                    break
+                member, stream = item
+                spilled = spill(member, stream, Path(tmpdir))
+                try:
+                    self.process_member(archive, member, spilled)
+                finally:
+                    spilled.unlink()
+
+    def process_member(
+        self, archive: Path, member: ArchiveMember, spilled: Path
+    ) -> None:
+        thumb_path, text_path = self._member_paths(archive, member)
+        name = archive / member.path
+        if not self.manifest.is_member_fresh("thumbnail", member, thumb_path):
+            self._make_thumbnail(spilled, thumb_path, name)
+            self.manifest.record_member("thumbnail", member, thumb_path)
+        if self.manifest.is_member_fresh(
+            "text", member, text_path, self.texts.exists(text_path)
+        ):
+            return
+        self._build_text(spilled, text_path, name)
+        self.manifest.record_member("text", member, text_path)
+
+    def _build_text(self, source: Path, text_path: Path, name: Path) -> None:
+        """Extract the text of source, OCRing whatever pages need it, all
+        in the calling thread rather than in jobs of their own."""
+        if source.suffix.lower() != ".pdf":
+            self._extract_image_text(source, text_path, name)
+            return
+        pages, needed = self._extract_pdf_text(source, text_path, name)
+        if pages and not needed:
+            return
+        with self.metrics.measure(
+            "extract-ocr", name, self.relative_path_str
+        ) as m:
+            m.bytes_in = file_size(source)
+            count, needed = self._ocr_plan(source, pages, needed)
+            if count:
+                assembler = PageAssembler(
+                    text_path,
+                    count,
+                    on_complete=lambda _: None,
+                    changes=self.changes,
+                )
+                self._add_text_pages(assembler, pages, needed)
+                for first, last in page_runs(needed, self.ocr_batch_pages):
+                    texts = ocr_pages(
+                        source,
+                        first,
+                        last,
+                        self._render_pages,
+                        self.ocr.recognize,
+                    )
+                    assembler.add(first, texts)
+            else:
+                self._ocr_document(source, text_path, name)
+            self._finish_ocr(name, text_path)
+
+    def _submit(
+        self,
+        task: Task,
+        job_class: JobClass,
+        fn: Callable[..., None],
+        *args: Any,
+        estimate: float = 0.0,
+    ) -> None:
+        """Run fn(*args) on the scheduler or, when coordinating a
+        distributed build, queue task for a worker instead.  When
+        planning, just add it to the plan."""
+        if self._plan is not None:
+            path = self.current_dir / task.name
+            self._plan.add(
+                task.kind, path.relative_to(self.base_dir), estimate
+            )
+            return
+        coordinator = self.context.coordinator
+        if coordinator is None:
+            self.scheduler.submit(job_class, fn, *args, estimate=estimate)
+        else:
+            coordinator.add(task, partial(self.record_task, task))
+
+    def run_task(self, task: Task) -> None:
+        """Do a task from the work queue, start to finish, in the calling
+        thread.  The build manifest is left to the coordinator."""
+        source = self.current_dir / task.name
+        if task.kind == "thumbnail":
+            self._make_thumbnail(source, self._thumb_path(source), source)
+        elif task.kind == "text":
+            self._build_text(source, self._text_path(source), source)
+        elif task.kind == "archive":
+            self.process_archive(source, set(task.members))
+        else:
+            raise RuntimeError(f"Unknown task kind '{task.kind}'")
+
+    def record_task(self, task: Task) -> None:
+        """Record the outputs of a task a worker has finished."""
+        source = self.current_dir / task.name
+        if task.kind == "thumbnail":
+            self.manifest.record("thumbnail", source, self._thumb_path(source))
+        elif task.kind == "text":
+            self.manifest.record("text", source, self._text_path(source))
+        elif task.kind == "archive":
+            for member in self.members(source):
+                if member.name not in task.members:
+                    continue
+                outputs = self._member_paths(source, member)
+                for kind, output in zip(("thumbnail", "text"), outputs):
+                    if output.exists():
+                        self.manifest.record_member(kind, member, output)
 
     def write_index_page(self) -> None:
-        with open("index.html", "w") as f:
-            page = self.generate_index_page()
-            f.write(page)
+        """Write index.html, or with a page_size, index.html and as many
+        more pages as it takes, and the directory's listing, and remove
+        any pages and listing left over from before."""
+        index_page = self.current_dir / "index.html"
+        page_size = self.context.page_size
+        data = self.page_data()
+        pages = paginate(data, page_size) if page_size else [data]
+        with self.metrics.measure(
+            "render", index_page, self.relative_path_str
+        ) as m:
+            for page in pages:
+                path = self.current_dir / page_name(page.page)
+                self.context.renderer.write(page, path, self.changes)
+                m.bytes_out += file_size(path)
+            listing = self.current_dir / LISTING_NAME
+            if page_size:
+                write_listing(data, page_size, listing, self.changes)
+                m.bytes_out += file_size(listing)
+            else:
+                remove(listing, self.changes)
+        for path in self.current_dir.glob("index-*.html"):
+            number = page_number(path.name)
+            if number is not None and number > len(pages):
+                remove(path, self.changes)
 
     def copy_sitewide_files(self) -> None:
         if self.current_dir != self.base_dir:
             self.logger.error(
-                "Cannot copy sitewide files since cwd "
+                "Cannot copy sitewide files since "
                 + f"{self.current_dir} != base directory "
                 + f"{self.base_dir}"
             )
             return
-        tgt_scriptdir = Path(self.path_to_base / "scripts")
-        tgt_scriptdir.mkdir(exist_ok=True)
+        tgt_scriptdir = Path(self.base_dir / "scripts")
+        make_directory(tgt_scriptdir)
         src_scriptdir = Path(_here / "assets" / "scripts")
         for scriptfile in src_scriptdir.iterdir():
-            shutil.copyfile(scriptfile, Path(tgt_scriptdir / scriptfile.name))
-        tgt_cssdir = Path(self.path_to_base / "css")
-        tgt_cssdir.mkdir(exist_ok=True)
+            copy_atomically(
+                scriptfile, Path(tgt_scriptdir / scriptfile.name), self.changes
+            )
+        tgt_cssdir = Path(self.base_dir / "css")
+        make_directory(tgt_cssdir)
         src_cssdir = Path(_here / "assets" / "css")
         for cssfile in src_cssdir.iterdir():
-            shutil.copyfile(cssfile, Path(tgt_cssdir / cssfile.name))
-        shutil.copyfile(
+            copy_atomically(
+                cssfile, Path(tgt_cssdir / cssfile.name), self.changes
+            )
+        copy_atomically(
             _here / "assets" / "file-text.svg",
             Path(self.base_dir / "favicon.svg"),
+            self.changes,
         )
         self.indexer_config_dir.mkdir(exist_ok=True)
-        shutil.copyfile(
+        copy_atomically(
             _here / "assets" / "site.conf",
             self.indexer_config_dir / "site.conf",
         )
 
     def write_indexer_config(self) -> Path:
         confdir = self.indexer_config_dir
-        fname = "swish-e.conf"
-        conf_file = Path(confdir / fname)
+        conf_file = Path(confdir / SWISH_E_CONF)
         conf_template = self.jinja_environment.get_template(
             "swish-e.conf.template"
         )
@@ -459,45 +1281,403 @@ class Indexer:
             text_dir=f"{self.base_dir / 'Text'}",
             relative_dir=f"{self.relative_path_str}",
         )
-        with open(conf_file, "w") as f:
-            f.write(indexer_conf)
+        write_atomically(conf_file, indexer_conf)
         return conf_file
 
-    def index_text(self) -> None:
+    def begin_text_changes(self) -> None:
+        """Note that the build is about to change texts, so that if it is
+        cut short before they are indexed, the next build has the search
+        index look at every text, and not just at those it changes."""
+        pending = self.indexer_config_dir / _INDEX_PENDING
+        # Distributed workers' texts aren't in our change log
+        self._index_all = (
+            pending.exists() or self.context.coordinator is not None
+        )
+        pending.touch()
+
+    def changed_texts(self, text_index: TextIndex) -> Set[Path]:
+        """The texts this build has added, changed, or removed, whether
+        as text files or in packs."""
+        text_dir = self.base_dir / "Text"
+        paths: Set[Path] = set()
+        for names in self.changes.as_dict().values():
+            for name in names:
+                path = self.base_dir / name
+                if text_dir not in path.parents:
+                    continue
+                if path.name == PACK_INDEX_NAME:
+                    paths |= text_index.directory_paths(
+                        path.parent.relative_to(text_dir), recursive=False
+                    )
+                elif path.suffix == ".txt":
+                    paths.add(path)
+        return paths
+
+    def index_text(self, directories: Optional[Sequence[Path]] = None) -> None:
+        """Bring the built-in text index up to date.  Only the texts this
+        build changed are looked at (or if that isn't known, those whose
+        size or mtime changed since the last run are read), and with
+        directories (relative to base_dir), only those in and below
+        them."""
+        if not self.is_root:
+            self.logger.error("Cannot index text from non-root Indexer")
+            return
+        rules = WordRules.from_config(self.indexer_config_dir / "site.conf")
+        with self.metrics.measure("index", directory=self.relative_path_str):
+            with TextIndex(
+                self.indexer_config_dir / "textindex",
+                self.base_dir / "Text",
+                rules=rules,
+            ) as text_index:
+                if directories is not None:
+                    added, removed = text_index.update_directories(directories)
+                elif self._index_all or not text_index.restored:
+                    added, removed = text_index.update()
+                else:
+                    added, removed = text_index.update(
+                        self.changed_texts(text_index)
+                    )
+                self.logger.info(
+                    f"Text index updated: {added} documents indexed,"
+                    f" {removed} removed"
+                )
+                if self.static_search:
+                    self.write_static_search(text_index)
+        (self.indexer_config_dir / _INDEX_PENDING).unlink(missing_ok=True)
+        self.metrics.outcome("index", "indexed", n=added)
+        self.metrics.outcome("index", "removed", n=removed)
+
+    def write_static_search(self, text_index: TextIndex) -> None:
+        # Documents in archives can't be linked to; link to the archive.
+        sources = {
+            str(Path(output).relative_to("Text")): source.split(
+                MEMBER_SEPARATOR
+            )[0]
+            for output, source in self.manifest.sources("text").items()
+        }
+        # Packed text is only there to link to as files with --text-gz
+        written = export_static_index(
+            text_index,
+            sources,
+            self.base_dir / SEARCH_DIR,
+            changes=self.changes,
+            text_links=(
+                self.context.text_store != "packs" or self.context.text_gz
+            ),
+        )
+        self.logger.info(f"Static search index: {written} files updated")
+        template = self.jinja_environment.get_template("search.template")
+        write_atomically(
+            self.base_dir / "search.html",
+            template.render(top_name=self.archive_title),
+            self.changes,
+        )
+
+    def index_text_swish_e(self) -> None:
         if not self.is_root:
             self.logger.error("Cannot index text from non-root Indexer")
             return
         swconf = self.write_indexer_config()
-        os.chdir(self.indexer_config_dir)  # Will write output to cwd
         args = ["swish-e", "-c", f"{swconf}"]
-        self._run(args)
-        os.chdir(self.current_dir)
+        # swish-e writes its output to its working directory
+        with self.metrics.measure("index", directory=self.relative_path_str):
+            self._run(args, cwd=self.indexer_config_dir)
 
     def build_outputs(self) -> None:
         self.write_index_page()
         self.generate_thumbnails()
         self.extract_text()
+        self.process_archives()
 
-    def build_site(self) -> None:
-        self.build_outputs()
-        # Now recurse down the tree
-        for child in self.current_dir.iterdir():
-            if child.is_dir():
-                # Skip the top-level scripts, css, config, Thumbs, and Text
-                # dirs
-                if self.is_root and child.name in _skipdirs:
+    def remove_stale_outputs(self) -> None:
+        """Remove the thumbnails and text of documents, archives, and
+        subdirectories that are no longer in this directory."""
+        stems = {f.stem for f in self.files}
+        names = {a.name for a in self.archives} | {d.name for d in self.dirs}
+        for top, suffix in (("Thumbs", "_thumb.png"), ("Text", ".txt")):
+            output_dir = self.base_dir / top / self.relative_path
+            if not output_dir.is_dir():
+                continue
+            for output in output_dir.iterdir():
+                if output.name.startswith("."):
+                    # In progress
                     continue
-                child.chmod(0o755)
-                childindexer = self.__class__(
-                    base_url=self.base_url,
-                    base_dir=self.base_dir,
-                    current_dir=child,
-                    resolve=self.resolve,
-                    debug=self.debug,
+                if output.is_dir():
+                    if output.name not in names:
+                        self.logger.info(f"Removing stale '{output}'")
+                        remove_tree(output, self.changes)
+                elif output.name.endswith(suffix):
+                    if output.name[: -len(suffix)] not in stems:
+                        self.logger.info(f"Removing stale '{output}'")
+                        remove(output, self.changes)
+        text_dir = self.base_dir / "Text" / self.relative_path
+        dropped = self.texts.prune(
+            text_dir, {f"{stem}.txt" for stem in stems}, self.changes
+        )
+        if dropped:
+            self.logger.info(
+                f"Dropped {dropped} stale texts from '{text_dir}'"
+            )
+
+    def update_directories(
+        self, trees: Sequence[Path], directories: Sequence[Path]
+    ) -> int:
+        """Rebuild what is out of date in and below each of trees, and in
+        each of directories, drop the outputs of whatever has gone from
+        them, and bring the search index up to date with the result.
+        Returns how many jobs failed.  Only the root Indexer can do
+        this."""
+        if not self.is_root:
+            self.logger.error("Cannot update from non-root Indexer")
+            return 0
+        self.begin_text_changes()
+        nodes: List[DirectoryNode] = list()
+        indexers: List[Indexer] = list()
+        for path in trees:
+            relative_path = path.relative_to(self.base_dir)
+            skip = self.skip_dirs if path == self.base_dir else ()
+            nodes.extend(scan_tree(path, relative_path, skip).walk())
+        for path in directories:
+            relative_path = path.relative_to(self.base_dir)
+            skip = self.skip_dirs if path == self.base_dir else ()
+            nodes.append(scan_shallow(path, relative_path, skip))
+        with self.scheduler.held():
+            for node in nodes:
+                indexer = self.__class__(
+                    base_dir=self.base_dir, context=self.context, node=node
                 )
-                self.children.append(childindexer)
-                childindexer.build_site()
-        # If and only if we are the root node and we have swish-e
-        # installed, index the collected text
-        if self.is_root and self.has_swishe:
-            self.index_text()
+                indexer.remove_stale_outputs()
+                indexer.build_outputs()
+                indexers.append(indexer)
+        failed = self.finish_jobs()
+        failed += self.finish_sprites(indexers)
+        failed += self.finish_text(indexers)
+        relative_paths = [
+            p.relative_to(self.base_dir) for p in (*trees, *directories)
+        ]
+        self.update_search(relative_paths)
+        return failed
+
+    def build_tree(self) -> None:
+        """Write the index pages and queue the jobs for this directory
+        and everything below it."""
+        self.build_outputs()
+        for child_node in self.node.dirs:
+            childindexer = self.__class__(
+                base_dir=self.base_dir, context=self.context, node=child_node
+            )
+            self.children.append(childindexer)
+            childindexer.build_tree()
+
+    def build_site(self) -> Optional[BuildResult]:
+        """Build this directory and everything below it.  From the root,
+        finish the build and return what it did."""
+        if not self.is_root:
+            with self.scheduler.held():
+                self.build_tree()
+            return None
+        try:
+            failed = self.build_root()
+        finally:
+            self.close()
+        return self.metrics.result(
+            failed, self.context.report, self.changes.as_dict()
+        )
+
+    def build_root(self) -> int:
+        """Build everything from the root, search index and all, and
+        return how many jobs failed, leaving the tools open (for
+        build_site() to close, or for watch() to carry on with)."""
+        if not self.is_root:
+            self.logger.error("Cannot build from non-root Indexer")
+            return 0
+        self.begin_text_changes()
+        # Queue everything before starting anything, so the longest jobs
+        # go first.
+        with self.scheduler.held():
+            self.build_tree()
+        # Everything below the root has been queued; the text has to be
+        # complete before we can index it.
+        failed = self.finish_jobs()
+        failed += self.finish_sprites(self.walk())
+        failed += self.finish_text(self.walk())
+        self.update_search()
+        return failed
+
+    def plan(self) -> Plan:
+        """The jobs building this directory and everything below it would
+        run, and how long each is likely to take, asking the backend how
+        many pages each PDF has and whether it needs OCR.  Nothing is
+        built."""
+        plan = Plan()
+        for node in self.node.walk():
+            indexer = self
+            if node is not self.node:
+                indexer = self.__class__(
+                    base_dir=self.base_dir, context=self.context, node=node
+                )
+            indexer._plan, indexer._probe = plan, self.backend
+            try:
+                indexer.generate_thumbnails()
+                indexer.extract_text()
+                indexer.process_archives()
+            finally:
+                indexer._plan, indexer._probe = None, None
+        return plan
+
+    def finish_jobs(self) -> int:
+        """Wait for every queued job, and record what they built, logging
+        an ETA as we go.  Returns how many jobs failed."""
+        _, remaining = self.scheduler.progress()
+        if remaining:
+            workers = self.scheduler.budget.cpu
+            self.logger.info(
+                f"About {format_duration(remaining)} of work queued;"
+                f" {format_duration(remaining / workers)} on"
+                f" {workers:g} CPUs"
+            )
+        reporter = ProgressReporter(self.scheduler, self.logger)
+        reporter.start()
+        try:
+            errors: List[Any] = list(self.scheduler.wait())
+            # Jobs left waiting on an identical document whose build
+            # failed have to build their own.
+            while self.cache and self.cache.release_waiters():
+                errors.extend(self.scheduler.wait())
+            if self.context.coordinator:
+                errors.extend(self.context.coordinator.wait())
+        finally:
+            reporter.stop()
+        if errors:
+            self.logger.warning(f"{len(errors)} jobs failed")
+        self.manifest.flush()
+        return len(errors)
+
+    def walk(self) -> Iterator["Indexer"]:
+        """This Indexer and those of the directories build_tree() went
+        into below it."""
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def finish_sprites(self, indexers: Iterable["Indexer"]) -> int:
+        """If sprites were asked for, pack the thumbnails of each of
+        indexers' directories, now that they are all made.  Returns how
+        many directories' sheets failed."""
+        if not self.context.sprites:
+            return 0
+        for indexer in indexers:
+            self.scheduler.submit(JobClass.THUMBNAIL, indexer.make_sprites)
+        errors = self.scheduler.wait()
+        if errors:
+            self.logger.warning(f"{len(errors)} sprite sheets failed")
+        return len(errors)
+
+    def text_directories(self) -> List[Path]:
+        """The directories under Text holding the text of this directory's
+        documents, and of the documents in its archives."""
+        text_dir = self.base_dir / "Text" / self.relative_path
+        directories = [text_dir]
+        for archive in self.archives:
+            top = text_dir / archive.name
+            if top.is_dir():
+                directories.append(top)
+                directories.extend(d for d in top.rglob("*") if d.is_dir())
+        return directories
+
+    def store_text(self, directories: Sequence[Path]) -> None:
+        """Pack the text in each of directories, or with the files text
+        store, unpack it."""
+        packs = self.context.text_store == "packs"
+        n = 0
+        with self.metrics.measure("pack", directory=self.relative_path_str):
+            for directory in directories:
+                if packs:
+                    n += self.texts.pack(
+                        directory, self.context.text_gz, self.changes
+                    )
+                else:
+                    n += self.texts.unpack(directory, self.changes)
+        self.metrics.outcome(
+            "pack",
+            "packed" if packs else "unpacked",
+            directory=self.relative_path_str,
+            n=n,
+        )
+
+    def finish_text(self, indexers: Iterable["Indexer"]) -> int:
+        """Pack the text of each of indexers' directories, now that it is
+        all extracted, or with the files text store, unpack whatever was
+        packed.  Returns how many directories failed."""
+        packs = self.context.text_store == "packs"
+        for indexer in indexers:
+            directories = indexer.text_directories()
+            if not packs:
+                directories = [
+                    d for d in directories if (d / PACK_INDEX_NAME).exists()
+                ]
+            if directories:
+                self.scheduler.submit(
+                    JobClass.EXTRACT_FAST, indexer.store_text, directories
+                )
+        errors = self.scheduler.wait()
+        if errors:
+            self.logger.warning(f"{len(errors)} text packs failed")
+        return len(errors)
+
+    def update_search(
+        self, directories: Optional[Sequence[Path]] = None
+    ) -> None:
+        self.index_text(directories)
+        # If and only if swish-e was asked for and is installed, build its
+        # index too
+        if self.has_swishe:
+            self.index_text_swish_e()
+
+    def close(self) -> None:
+        """Shut down the tools, the scheduler, and the manifest (those the
+        context made for this build) and write the run report, once the
+        build is over.  After a dry run, there is nothing to write."""
+        if self.context.dry_run:
+            self.context.close()
+            return
+        self.planner.learn(self.metrics)
+        self.engine.listeners.remove(self.metrics.record_command)
+        self.engine.log_stats(self.logger)
+        self.metrics.finish()
+        self.write_run_report()
+        self.write_change_manifest()
+        self.context.close()
+
+    def write_change_manifest(self) -> None:
+        """Write out what the build has added, changed, and removed so
+        far, for whatever publishes the site."""
+        if not self.context.change_manifest:
+            return
+        self.changes.write(self.context.change_manifest)
+        self.logger.info(
+            f"{len(self.changes)} outputs changed; list written to"
+            f" {self.context.change_manifest}"
+        )
+
+    def write_run_report(self) -> None:
+        tools = self.engine.stats
+        if self.context.report:
+            self.metrics.write_report(self.context.report, tools)
+            self.logger.info(f"Run report written to {self.context.report}")
+        if self.context.prometheus_textfile:
+            self.metrics.write_prometheus(
+                self.context.prometheus_textfile, tools
+            )
+
+
+def build_archive(base_dir: Union[str, Path], **settings: Any) -> BuildResult:
+    """Build the whole archive in base_dir, with the settings an Indexer
+    takes, and return what was done.  Safe to call from several threads
+    at once for different archives."""
+    if settings.get("current_dir") or settings.get("node"):
+        raise RuntimeError("build_archive() builds the whole archive")
+    result = Indexer(base_dir=base_dir, **settings).build_site()
+    if result is None:
+        raise RuntimeError(f"Could not build archive '{base_dir}'")
+    return result
@@ -0,0 +1,471 @@
+"""Build manifest: remembers, for every generated output, what it was
+generated from.
+
+Each row is keyed by the kind of output ("thumbnail" or "text") and the
+source path relative to the archive root, and records the source's size and
+mtime (and, optionally, a content hash) along with a fingerprint of the
+tools and options that produced the output.  If any of those differ on a
+later run, the output is stale and gets rebuilt.
+
+Checking freshness needs only a stat() of the source and output and a
+database lookup, so an unchanged tree can be verified without running
+anything.
+
+Documents inside archives are keyed by the archive's path and the member's
+name, joined by MEMBER_SEPARATOR.  They have no mtime of their own, so
+their rows hold 0 there and, in place of a content hash, whatever checksum
+the archive keeps for the member.
+
+A second table journals the jobs in flight.  A job is entered there,
+and committed, before it starts, and removed when its output is recorded,
+so whatever is left at startup was interrupted.  OCR jobs also note how
+many pages they have finished, so that an interrupted document can pick
+up where it left off if it hasn't changed in the meantime.
+
+The documents in each archive are remembered too, against the archive's
+size and mtime, so that an unchanged compressed tar file needn't be
+decompressed all the way through just to list it.
+
+An output with no row at all is taken to be from before there was a
+manifest, and adopted if it is newer than its source, until the first
+run with a manifest has finished; after that, it is rebuilt.
+
+A read-only Manifest (for a dry run) works on a copy in memory, taken
+without touching the database or its write-ahead log on disk, and
+records nothing.
+"""
+import hashlib
+import json
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .archive import MEMBER_SEPARATOR, ArchiveMember
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    kind TEXT NOT NULL,
+    source TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT,
+    fingerprint TEXT NOT NULL,
+    output TEXT NOT NULL,
+    PRIMARY KEY (kind, source)
+);
+CREATE TABLE IF NOT EXISTS journal (
+    kind TEXT NOT NULL,
+    source TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    output TEXT NOT NULL,
+    started REAL NOT NULL,
+    pages INTEGER NOT NULL DEFAULT 0,
+    partial_size INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (kind, source)
+);
+CREATE TABLE IF NOT EXISTS archives (
+    source TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    members TEXT NOT NULL
+);
+"""
+
+_COMMIT_INTERVAL = 100
+
+# The user_version of a manifest whose outputs have all been adopted
+_ADOPTED_VERSION = 1
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def tool_fingerprint(tools: Sequence[str], options: str = "") -> str:
+    """Identify a tool chain without running it.
+
+    Asking each tool for its version would cost a subprocess; instead, use
+    the resolved path, size, and mtime of each executable, which change
+    whenever the tool is upgraded.
+    """
+    parts = list()
+    for tool in tools:
+        exe = shutil.which(tool)
+        if exe is None:
+            parts.append(f"{tool}:missing")
+            continue
+        exe_path = Path(exe).resolve()
+        st = exe_path.stat()
+        parts.append(f"{tool}:{exe_path}:{st.st_size}:{st.st_mtime_ns}")
+    parts.append(options)
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def _copy_in_memory(path: Path) -> sqlite3.Connection:
+    """An in-memory copy of the database at path (empty if there is
+    none), made from a copy of it and its write-ahead log, since even a
+    read-only connection leaves a log and an index next to the database."""
+    memory = sqlite3.connect(":memory:", check_same_thread=False)
+    if not path.exists():
+        return memory
+    with TemporaryDirectory() as tmpdir:
+        copy = Path(tmpdir) / path.name
+        shutil.copyfile(path, copy)
+        wal = path.with_name(f"{path.name}-wal")
+        if wal.exists():
+            shutil.copyfile(wal, copy.with_name(f"{copy.name}-wal"))
+        source = sqlite3.connect(str(copy))
+        try:
+            source.backup(memory)
+        finally:
+            source.close()
+    return memory
+
+
+class Manifest:
+    def __init__(
+        self,
+        path: Path,
+        base_dir: Path,
+        hash_content: bool = False,
+        read_only: bool = False,
+    ) -> None:
+        self.path = path
+        self.base_dir = base_dir
+        self.hash_content = hash_content
+        self.read_only = read_only
+        # Workers record results from their own threads; serialize access.
+        self._lock = threading.Lock()
+        if read_only:
+            self._conn = _copy_in_memory(path)
+        else:
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            self._conn = sqlite3.connect(str(path), check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # With WAL, NORMAL survives the process being killed, which is
+            # what the journal is for, without an fsync for every job.
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+        # Outputs from before there was a manifest are adopted until the
+        # first run with one has finished, and from then on rebuilt
+        (version,) = self._conn.execute("PRAGMA user_version").fetchone()
+        self.adopting = version < _ADOPTED_VERSION
+        self._uncommitted = 0
+        self._fingerprints: Dict[str, str] = dict()
+
+    def set_fingerprint(self, kind: str, fingerprint: str) -> None:
+        self._fingerprints[kind] = fingerprint
+
+    def fingerprint(self, kind: str) -> str:
+        return self._fingerprints.get(kind, "")
+
+    def _key(self, source: Path) -> str:
+        try:
+            return str(source.relative_to(self.base_dir))
+        except ValueError:
+            return str(source)
+
+    def member_key(self, member: ArchiveMember) -> str:
+        return f"{self._key(member.archive)}{MEMBER_SEPARATOR}{member.name}"
+
+    def _lookup(
+        self, kind: str, source: Path
+    ) -> Optional[Tuple[int, int, Optional[str], str, str]]:
+        return self._lookup_key(kind, self._key(source))
+
+    def _lookup_key(
+        self, kind: str, key: str
+    ) -> Optional[Tuple[int, int, Optional[str], str, str]]:
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT size, mtime_ns, sha256, fingerprint, output"
+                " FROM outputs WHERE kind = ? AND source = ?",
+                (kind, key),
+            )
+            return cur.fetchone()
+
+    def is_fresh(
+        self,
+        kind: str,
+        source: Path,
+        output: Path,
+        output_mtime_ns: Optional[int] = None,
+    ) -> bool:
+        """Return True if output is up to date with respect to source and
+        the current tool fingerprint for kind.  For an output that is not a
+        file of its own (packed text), give its mtime_ns instead."""
+        try:
+            src_st = source.stat()
+            if output_mtime_ns is None:
+                output_mtime_ns = output.stat().st_mtime_ns
+        except FileNotFoundError:
+            return False
+        fingerprint = self._fingerprints.get(kind, "")
+        row = self._lookup(kind, source)
+        if row is None:
+            # An output from before there was a manifest: adopt it if it
+            # is newer than its source rather than redoing days of OCR.
+            if self.adopting and output_mtime_ns >= src_st.st_mtime_ns:
+                if not self.read_only:
+                    self.record(kind, source, output)
+                return True
+            return False
+        size, mtime_ns, sha256, old_fingerprint, old_output = row
+        if old_fingerprint != fingerprint or old_output != self._key(output):
+            return False
+        if size != src_st.st_size:
+            return False
+        if mtime_ns == src_st.st_mtime_ns:
+            return True
+        if not (self.hash_content and sha256):
+            return False
+        # Same size, new mtime: a touch or a copy.  The hash settles it.
+        if hash_file(source) != sha256:
+            return False
+        if not self.read_only:
+            self.record(kind, source, output, sha256=sha256)
+        return True
+
+    def is_member_fresh(
+        self,
+        kind: str,
+        member: ArchiveMember,
+        output: Path,
+        exists: Optional[bool] = None,
+    ) -> bool:
+        """Like is_fresh(), for a document inside an archive.  For an
+        output that is not a file of its own, say whether it exists."""
+        if not (output.exists() if exists is None else exists):
+            return False
+        row = self._lookup_key(kind, self.member_key(member))
+        if row is None:
+            return False
+        size, _, checksum, fingerprint, old_output = row
+        return (
+            fingerprint == self._fingerprints.get(kind, "")
+            and old_output == self._key(output)
+            and size == member.size
+            and checksum == member.checksum
+        )
+
+    def members(self, archive: Path) -> Optional[List[ArchiveMember]]:
+        """The documents in archive as last listed, if it hasn't changed
+        since."""
+        st = archive.stat()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, members FROM archives"
+                " WHERE source = ?",
+                (self._key(archive),),
+            ).fetchone()
+        if row is None or row[:2] != (st.st_size, st.st_mtime_ns):
+            return None
+        return [
+            ArchiveMember(archive, name, size, checksum)
+            for name, size, checksum in json.loads(row[2])
+        ]
+
+    def record_members(
+        self, archive: Path, members: Sequence[ArchiveMember]
+    ) -> None:
+        """Note the documents just listed in archive."""
+        st = archive.stat()
+        listing = [(m.name, m.size, m.checksum) for m in members]
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO archives"
+                " (source, size, mtime_ns, members) VALUES (?, ?, ?, ?)",
+                (
+                    self._key(archive),
+                    st.st_size,
+                    st.st_mtime_ns,
+                    json.dumps(listing),
+                ),
+            )
+            self._uncommitted += 1
+
+    def record(
+        self,
+        kind: str,
+        source: Path,
+        output: Path,
+        sha256: Optional[str] = None,
+        started: Optional[Tuple[int, int]] = None,
+    ) -> bool:
+        """Note that output was just generated from source: from the
+        version of it that begin() returned, if given, unless source has
+        changed since, in which case nothing is recorded (so the output
+        is rebuilt next time) and False returned."""
+        st = source.stat()
+        if started is not None and started != (st.st_size, st.st_mtime_ns):
+            self.forget(kind, self._key(source))
+            return False
+        if sha256 is None and self.hash_content:
+            sha256 = hash_file(source)
+        self._insert(
+            kind, self._key(source), st.st_size, st.st_mtime_ns, sha256, output
+        )
+        return True
+
+    def record_member(
+        self, kind: str, member: ArchiveMember, output: Path
+    ) -> None:
+        """Note that output was just generated from an archive member."""
+        self._insert(
+            kind,
+            self.member_key(member),
+            member.size,
+            0,
+            member.checksum,
+            output,
+        )
+
+    def _insert(
+        self,
+        kind: str,
+        key: str,
+        size: int,
+        mtime_ns: int,
+        sha256: Optional[str],
+        output: Path,
+    ) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO outputs"
+                " (kind, source, size, mtime_ns, sha256, fingerprint, output)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    kind,
+                    key,
+                    size,
+                    mtime_ns,
+                    sha256,
+                    self._fingerprints.get(kind, ""),
+                    self._key(output),
+                ),
+            )
+            self._conn.execute(
+                "DELETE FROM journal WHERE kind = ? AND source = ?",
+                (kind, key),
+            )
+            self._uncommitted += 1
+            if self._uncommitted >= _COMMIT_INTERVAL:
+                self._conn.commit()
+                self._uncommitted = 0
+
+    def begin(self, kind: str, source: Path, output: Path) -> Tuple[int, int]:
+        """Journal a job that is about to build output from source, and
+        return the size and mtime_ns of the version of source it builds
+        from, for record().  If the same version of source was already in
+        progress, its progress is kept."""
+        st = source.stat()
+        key = self._key(source)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns FROM journal"
+                " WHERE kind = ? AND source = ?",
+                (kind, key),
+            ).fetchone()
+            if row != (st.st_size, st.st_mtime_ns):
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO journal"
+                    " (kind, source, size, mtime_ns, output, started)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        kind,
+                        key,
+                        st.st_size,
+                        st.st_mtime_ns,
+                        self._key(output),
+                        time.time(),
+                    ),
+                )
+            self._conn.commit()
+            self._uncommitted = 0
+        return (st.st_size, st.st_mtime_ns)
+
+    def progress(
+        self, kind: str, source: Path, pages: int, partial_size: int
+    ) -> None:
+        """Note that the first pages pages of source's output, partial_size
+        bytes of it, are safely on disk."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE journal SET pages = ?, partial_size = ?"
+                " WHERE kind = ? AND source = ?",
+                (pages, partial_size, kind, self._key(source)),
+            )
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def resume_point(self, kind: str, source: Path) -> Tuple[int, int]:
+        """The pages and partial_size last noted for an interrupted job on
+        source, or (0, 0) if there is none or source has changed."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, pages, partial_size FROM journal"
+                " WHERE kind = ? AND source = ?",
+                (kind, self._key(source)),
+            ).fetchone()
+        if row is None:
+            return 0, 0
+        size, mtime_ns, pages, partial_size = row
+        try:
+            st = source.stat()
+        except FileNotFoundError:
+            return 0, 0
+        if (size, mtime_ns) != (st.st_size, st.st_mtime_ns):
+            return 0, 0
+        return pages, partial_size
+
+    def interrupted(self) -> List[Tuple[str, str, str, int]]:
+        """(kind, source, output, pages) for every job in the journal, with
+        source and output relative to the archive root."""
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT kind, source, output, pages FROM journal"
+                " ORDER BY started"
+            )
+            return cur.fetchall()
+
+    def forget(self, kind: str, source: str) -> None:
+        """Drop a job from the journal (source as interrupted() gave it)."""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM journal WHERE kind = ? AND source = ?",
+                (kind, source),
+            )
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def sources(self, kind: str) -> Dict[str, str]:
+        """Map each recorded output of kind to its source, both relative to
+        the archive root."""
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT output, source FROM outputs WHERE kind = ?", (kind,)
+            )
+            return dict(cur.fetchall())
+
+    def flush(self) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def close(self) -> None:
+        if self.adopting and not self.read_only:
+            with self._lock:
+                self._conn.execute(f"PRAGMA user_version = {_ADOPTED_VERSION}")
+        self.flush()
+        with self._lock:
+            self._conn.close()
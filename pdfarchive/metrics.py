@@ -0,0 +1,357 @@
+"""Per-stage build metrics.
+
+Each unit of work is wrapped in Metrics.measure(), which times it and
+collects the CPU time of every external command run on that thread while
+it is open (the ExecutionEngine reports each finished command to
+record_command()).  Things that happen without doing any work, such as an
+output found to be up to date, are counted with outcome().
+
+Totals are kept per stage, per directory, and per file, and can be written
+as a JSON run report and as a Prometheus textfile for node_exporter's
+textfile collector.  Commands run by a gm batch process are not seen, so
+thumbnail CPU time is missing when --gm-batch is used.
+
+A finished build also hands its caller a BuildResult: how much there was,
+how long it took, what failed, and the totals of each stage.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field, replace
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from .atomic import write_atomically
+from .external import CommandResult, ToolStats
+
+STAGES = (
+    "scan",
+    "render",
+    "thumbnail",
+    "sprites",
+    "triage",
+    "extract-fast",
+    "extract-ocr",
+    "pack",
+    "index",
+)
+
+
+@dataclass
+class StageStats:
+    jobs: int = 0
+    wall_time: float = 0.0
+    cpu_time: float = 0.0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    outcomes: Dict[str, int] = field(default_factory=dict)
+
+    def add(self, m: "Measurement") -> None:
+        self.jobs += 1
+        self.wall_time += m.wall_time
+        self.cpu_time += m.cpu_time
+        self.bytes_in += m.bytes_in
+        self.bytes_out += m.bytes_out
+
+    def count(self, outcome: str, n: int = 1) -> None:
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + n
+
+
+@dataclass
+class Measurement:
+    """Filled in by the code being measured: bytes_in and bytes_out are
+    up to it, wall_time and cpu_time are taken care of."""
+
+    stage: str
+    path: Optional[str] = None
+    directory: Optional[str] = None
+    bytes_in: int = 0
+    bytes_out: int = 0
+    wall_time: float = 0.0
+    cpu_time: float = 0.0
+
+
+@dataclass
+class BuildResult:
+    base_dir: Optional[Path]
+    wall_time: float
+    directories: int
+    documents: int
+    archives: int
+    # Jobs that raised, which the stages' "failed" outcomes break down
+    failed_jobs: int
+    stages: Dict[str, StageStats]
+    report: Optional[Path] = None
+    # The outputs added, changed, and removed, relative to base_dir
+    changes: Dict[str, List[str]] = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed_jobs
+
+
+def file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+class Metrics:
+    def __init__(self, base_dir: Optional[Path] = None) -> None:
+        self.base_dir = base_dir
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.stages: Dict[str, StageStats] = {s: StageStats() for s in STAGES}
+        self.directories: Dict[str, Dict[str, StageStats]] = dict()
+        self.files: Dict[Tuple[str, str], StageStats] = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _name(self, path: Union[str, Path, None]) -> Optional[str]:
+        if path is None:
+            return None
+        path = Path(path)
+        if self.base_dir is not None:
+            try:
+                return str(path.relative_to(self.base_dir))
+            except ValueError:
+                pass
+        return str(path)
+
+    def _targets(
+        self, stage: str, path: Optional[str], directory: Optional[str]
+    ) -> List[StageStats]:
+        # Call with the lock held.
+        targets = [self.stages.setdefault(stage, StageStats())]
+        if directory is not None:
+            per_dir = self.directories.setdefault(directory, dict())
+            targets.append(per_dir.setdefault(stage, StageStats()))
+        if path is not None:
+            targets.append(self.files.setdefault((path, stage), StageStats()))
+        return targets
+
+    @contextmanager
+    def measure(
+        self,
+        stage: str,
+        path: Union[str, Path, None] = None,
+        directory: Union[str, Path, None] = None,
+    ) -> Iterator[Measurement]:
+        m = Measurement(
+            stage=stage,
+            path=self._name(path),
+            directory=None if directory is None else str(directory),
+        )
+        outer = getattr(self._local, "current", None)
+        self._local.current = m
+        start = time.monotonic()
+        try:
+            yield m
+        except BaseException:
+            self.outcome(stage, "failed", path, directory)
+            raise
+        finally:
+            m.wall_time = time.monotonic() - start
+            self._local.current = outer
+            with self._lock:
+                for target in self._targets(stage, m.path, m.directory):
+                    target.add(m)
+
+    def outcome(
+        self,
+        stage: str,
+        outcome: str,
+        path: Union[str, Path, None] = None,
+        directory: Union[str, Path, None] = None,
+        n: int = 1,
+    ) -> None:
+        """Count an outcome (e.g. "built", "cached", "failed")."""
+        name = self._name(path)
+        dirname = None if directory is None else str(directory)
+        with self._lock:
+            for target in self._targets(stage, name, dirname):
+                target.count(outcome, n)
+
+    def current(self) -> Optional[Measurement]:
+        """The innermost measurement open on this thread, if any."""
+        return getattr(self._local, "current", None)
+
+    def record_command(self, result: CommandResult) -> None:
+        """Charge a finished command's CPU time to the measurement open on
+        this thread, if there is one."""
+        m = self.current()
+        if m is not None:
+            m.cpu_time += result.cpu_time
+
+    def finish(self) -> None:
+        self.finished = time.time()
+
+    def reset(self) -> None:
+        """Start counting afresh, for the next of a series of runs."""
+        with self._lock:
+            self.started = time.time()
+            self.finished = None
+            self.stages = {s: StageStats() for s in STAGES}
+            self.directories = dict()
+            self.files = dict()
+
+    def result(
+        self,
+        failed_jobs: int = 0,
+        report: Optional[Path] = None,
+        changes: Optional[Dict[str, List[str]]] = None,
+    ) -> BuildResult:
+        finished = self.finished or time.time()
+        with self._lock:
+            scan = self.stages.get("scan", StageStats()).outcomes
+            return BuildResult(
+                base_dir=self.base_dir,
+                wall_time=finished - self.started,
+                directories=scan.get("directories", 0),
+                documents=scan.get("documents", 0),
+                archives=scan.get("archives", 0),
+                failed_jobs=failed_jobs,
+                stages={
+                    s: replace(v, outcomes=dict(v.outcomes))
+                    for s, v in self.stages.items()
+                },
+                report=report,
+                changes=changes or dict(),
+            )
+
+    def report(
+        self, tools: Optional[Dict[str, ToolStats]] = None
+    ) -> Dict[str, Any]:
+        finished = self.finished or time.time()
+        with self._lock:
+            files = [
+                dict(path=path, stage=stage, **asdict(stats))
+                for (path, stage), stats in self.files.items()
+            ]
+            files.sort(key=lambda f: f["wall_time"], reverse=True)
+            return {
+                "started": _isotime(self.started),
+                "finished": _isotime(finished),
+                "wall_time": finished - self.started,
+                "stages": {s: asdict(v) for s, v in self.stages.items()},
+                "tools": {t: asdict(v) for t, v in (tools or {}).items()},
+                "directories": {
+                    d: {s: asdict(v) for s, v in stages.items()}
+                    for d, stages in sorted(self.directories.items())
+                },
+                "files": files,
+            }
+
+    def write_report(
+        self, path: Path, tools: Optional[Dict[str, ToolStats]] = None
+    ) -> None:
+        write_atomically(path, json.dumps(self.report(tools), indent=1) + "\n")
+
+    def write_prometheus(
+        self, path: Path, tools: Optional[Dict[str, ToolStats]] = None
+    ) -> None:
+        finished = self.finished or time.time()
+        lines: List[str] = list()
+
+        def gauge(
+            name: str, help: str, samples: List[Tuple[str, Any]]
+        ) -> None:
+            lines.append(f"# HELP pdfarchive_{name} {help}")
+            lines.append(f"# TYPE pdfarchive_{name} gauge")
+            for labels, value in samples:
+                lines.append(f"pdfarchive_{name}{labels} {value}")
+
+        with self._lock:
+            stages = sorted(self.stages.items())
+            gauge(
+                "build_wall_seconds",
+                "Wall time of the last build.",
+                [("", finished - self.started)],
+            )
+            gauge(
+                "build_finished_timestamp_seconds",
+                "When the last build finished.",
+                [("", finished)],
+            )
+            gauge(
+                "stage_jobs",
+                "Units of work done in each stage in the last build.",
+                [(_labels(stage=s), v.jobs) for s, v in stages],
+            )
+            gauge(
+                "stage_wall_seconds",
+                "Seconds spent working in each stage, summed over jobs.",
+                [(_labels(stage=s), v.wall_time) for s, v in stages],
+            )
+            gauge(
+                "stage_cpu_seconds",
+                "CPU seconds used by external tools in each stage.",
+                [(_labels(stage=s), v.cpu_time) for s, v in stages],
+            )
+            gauge(
+                "stage_read_bytes",
+                "Bytes of input consumed by each stage.",
+                [(_labels(stage=s), v.bytes_in) for s, v in stages],
+            )
+            gauge(
+                "stage_written_bytes",
+                "Bytes of output produced by each stage.",
+                [(_labels(stage=s), v.bytes_out) for s, v in stages],
+            )
+            gauge(
+                "stage_outcomes",
+                "Outcomes (built, cached, failed, ...) in each stage.",
+                [
+                    (_labels(stage=s, outcome=o), n)
+                    for s, v in stages
+                    for o, n in sorted(v.outcomes.items())
+                ],
+            )
+        tool_stats = sorted((tools or {}).items())
+        gauge(
+            "tool_commands",
+            "Commands run, per external tool.",
+            [(_labels(tool=t), v.commands) for t, v in tool_stats],
+        )
+        gauge(
+            "tool_failures",
+            "Commands that failed, per external tool.",
+            [(_labels(tool=t), v.failures) for t, v in tool_stats],
+        )
+        gauge(
+            "tool_timeouts",
+            "Commands killed for running too long, per external tool.",
+            [(_labels(tool=t), v.timeouts) for t, v in tool_stats],
+        )
+        gauge(
+            "tool_cpu_seconds",
+            "CPU seconds used, per external tool.",
+            [
+                (_labels(tool=t), v.user_time + v.system_time)
+                for t, v in tool_stats
+            ],
+        )
+        gauge(
+            "tool_max_rss_bytes",
+            "Largest resident set of any one command, per external tool.",
+            [(_labels(tool=t), v.max_rss * 1024) for t, v in tool_stats],
+        )
+        # Written as .<name>.prom.<writer>.tmp, which the textfile
+        # collector skips
+        write_atomically(path, "\n".join(lines) + "\n", keep_suffix=False)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels: str) -> str:
+    inner = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+    return "{" + inner + "}"
+
+
+def _isotime(t: float) -> str:
+    return datetime.fromtimestamp(t, timezone.utc).isoformat()
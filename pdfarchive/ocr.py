@@ -0,0 +1,146 @@
+"""Page-level OCR for scanned PDFs.
+
+Rather than rasterizing a whole document into one multipage TIFF and
+handing that to a single tesseract, a document is split into small batches
+of pages.  Each batch is rasterized, recognized, and its images deleted as
+one job, so temporary storage is bounded by the batch size times the number
+of jobs running at once, and a large document can keep every worker busy.
+A PageAssembler collects the results and writes them out in page order as
+soon as each contiguous run of pages is complete.
+"""
+import os
+import re
+import threading
+from logging import Logger
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .atomic import ChangeLog, replace_if_changed
+from .external import ExecutionEngine, run_output
+
+# Recognizes images, returning the text of each
+Recognizer = Callable[[List[Path]], List[str]]
+# Rasterizes pages first through last of a PDF into a directory, and
+# returns the images in page order
+Renderer = Callable[[Path, int, Optional[int], Path], List[Path]]
+
+
+def page_count(
+    pdf: Path,
+    logger: Optional[Logger] = None,
+    engine: Optional[ExecutionEngine] = None,
+) -> Optional[int]:
+    """Ask pdfinfo how many pages a PDF has; None if it can't tell us."""
+    output = run_output(["pdfinfo", f"{pdf}"], logger, engine=engine)
+    if output is None:
+        return None
+    match = re.search(r"^Pages:\s+(\d+)", output, re.MULTILINE)
+    if not match:
+        return None
+    return int(match.group(1))
+
+
+def ocr_pages(
+    pdf: Path,
+    first: int,
+    last: Optional[int],
+    render: Renderer,
+    recognize: Recognizer,
+) -> List[str]:
+    """Rasterize, with render, and recognize pages first through last
+    (zero-based, inclusive; last None for the rest of the document) of
+    pdf.  Returns one string per page; pages that could not be converted
+    or recognized come back empty."""
+    with TemporaryDirectory() as tmpdir:
+        images = render(pdf, first, last, Path(tmpdir))
+        texts = recognize(images) if images else list()
+    if last is None:
+        return texts
+    # If we got fewer pages than we asked for, keep the page numbering of
+    # later batches intact.
+    expected = last - first + 1
+    texts.extend([""] * (expected - len(texts)))
+    return texts[:expected]
+
+
+def partial_path(text_path: Path) -> Path:
+    return text_path.with_suffix(".txt.partial")
+
+
+class PageAssembler:
+    """Accumulates the text of one document's pages, which may arrive in
+    any order, and appends it to a partial file in page order.  When the
+    last page is in, the partial file is renamed to text_path (unless
+    that already holds the same text), noting the change in changes, and
+    on_complete is called.
+
+    Each time pages are appended, on_progress (if given) is called with
+    the number of pages and bytes now in the partial file.  Given those
+    numbers from an interrupted run as resume, the assembler keeps that
+    much of the partial file and starts from the page after; resumed says
+    how many pages it kept."""
+
+    def __init__(
+        self,
+        text_path: Path,
+        pages: int,
+        on_complete: Callable[[Path], None],
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        resume: Tuple[int, int] = (0, 0),
+        changes: Optional[ChangeLog] = None,
+    ) -> None:
+        self.text_path = text_path
+        self.pages = pages
+        self.on_complete = on_complete
+        self.on_progress = on_progress
+        self.partial_path = partial_path(text_path)
+        self.changes = changes
+        self._lock = threading.Lock()
+        self._pending: Dict[int, str] = dict()
+        self._next = 0
+        self._done = False
+        self.partial_path.parent.mkdir(exist_ok=True, parents=True)
+        resumed, size = resume
+        try:
+            if (
+                0 < resumed <= pages
+                and self.partial_path.stat().st_size >= size
+            ):
+                # Anything past size was written after the last progress
+                # note, and may be incomplete.
+                os.truncate(self.partial_path, size)
+                self._next = resumed
+        except FileNotFoundError:
+            pass
+        if not self._next:
+            self.partial_path.write_text("")
+
+    @property
+    def resumed(self) -> int:
+        return self._next
+
+    def add(self, first: int, texts: List[str]) -> None:
+        """Add the text of pages first onwards.  Adding no pages just
+        checks whether the document is complete, as it may be when
+        resumed."""
+        with self._lock:
+            for offset, text in enumerate(texts):
+                if first + offset >= self._next:
+                    self._pending[first + offset] = text
+            ready: List[str] = list()
+            while self._next in self._pending:
+                ready.append(self._pending.pop(self._next))
+                self._next += 1
+            if ready:
+                with open(self.partial_path, "a") as f:
+                    f.write("".join(ready))
+                if self.on_progress:
+                    self.on_progress(
+                        self._next, self.partial_path.stat().st_size
+                    )
+            done = self._next >= self.pages and not self._done
+            self._done = self._done or done
+        if done:
+            replace_if_changed(self.partial_path, self.text_path, self.changes)
+            self.on_complete(self.text_path)
@@ -0,0 +1,224 @@
+"""Long-lived OCR for page images and scanned images.
+
+Starting tesseract means loading its language models, which for a small
+scan takes longer than recognizing it.  An OCRPool takes images from
+every job that needs OCR, PDF pages and PNG or JPG documents alike, and
+recognizes them with as few model loads as it can.
+
+A TesseractPool has a thread per CPU pulling images off one queue.  Each
+thread takes whatever has arrived within a few milliseconds, up to
+max_batch images, and hands them all to one tesseract in list mode (an
+input file naming one image per line), which loads the models once and
+separates the pages of its output with form feeds.  If the output doesn't
+split into as many pages as there were images (an image tesseract could
+not read, say), the batch is run again one image at a time.
+
+A TesserocrPool (pip install pdfarchive[tesserocr]) goes further: each
+thread that asks gets its own tesseract API object, models loaded once
+for the life of the run, as GMBatchPool does for gm.
+"""
+import logging
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Type
+
+from .external import ExecutionEngine, default_engine
+
+DEFAULT_OCR_POOL = "tesseract"
+DEFAULT_LINGER = 0.05
+DEFAULT_MAX_BATCH = 16
+
+_Request = Tuple[Path, "Future[str]"]
+
+
+class OCRPool(ABC):
+    # The executables the pool runs, which must be installed
+    executables: Tuple[str, ...] = ()
+
+    def __init__(self, logger: Optional[logging.Logger] = None) -> None:
+        self.logger = logger or logging.getLogger(__name__)
+
+    @property
+    def version(self) -> str:
+        """Whatever identifies the OCR engine beyond its executables, for
+        the build manifest."""
+        return ""
+
+    @abstractmethod
+    def recognize(self, images: Sequence[Path]) -> List[str]:
+        """The text of each image, each ending with a form feed, or empty
+        if it could not be recognized."""
+
+    def close(self) -> None:
+        pass
+
+
+class TesseractPool(OCRPool):
+    executables = ("tesseract",)
+
+    def __init__(
+        self,
+        workers: int = 1,
+        logger: Optional[logging.Logger] = None,
+        engine: Optional[ExecutionEngine] = None,
+        linger: float = DEFAULT_LINGER,
+        max_batch: int = DEFAULT_MAX_BATCH,
+    ) -> None:
+        super().__init__(logger)
+        self.engine = engine or default_engine()
+        self.linger = linger
+        self.max_batch = max(1, max_batch)
+        self._queue: "queue.Queue[Optional[_Request]]" = queue.Queue()
+        self._threads = [
+            threading.Thread(
+                target=self._work, name=f"pdfarchive-ocr-{i}", daemon=True
+            )
+            for i in range(max(1, workers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def recognize(self, images: Sequence[Path]) -> List[str]:
+        futures: List["Future[str]"] = list()
+        for image in images:
+            future: "Future[str]" = Future()
+            self._queue.put((image, future))
+            futures.append(future)
+        return [f.result() for f in futures]
+
+    def _batch(self, first: _Request) -> Tuple[List[_Request], bool]:
+        """first and whatever else arrives within linger seconds, and
+        whether we were told to stop meanwhile."""
+        batch = [first]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _work(self) -> None:
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            batch, stop = self._batch(request)
+            images = [image for image, _ in batch]
+            try:
+                texts = self._tesseract(images)
+            except Exception as exc:
+                for _, future in batch:
+                    future.set_exception(exc)
+            else:
+                for (_, future), text in zip(batch, texts):
+                    future.set_result(text)
+            if stop:
+                return
+
+    def _run_one(self, image: Path, directory: Path) -> str:
+        # Note that tesseract automatically adds the .txt
+        output = directory / "page"
+        self.engine.run(["tesseract", f"{image}", f"{output}"], self.logger)
+        try:
+            text = output.with_suffix(".txt").read_text(errors="replace")
+        except FileNotFoundError:
+            return ""
+        output.with_suffix(".txt").unlink()
+        return text
+
+    def _tesseract(self, images: List[Path]) -> List[str]:
+        with TemporaryDirectory() as tmpdir:
+            directory = Path(tmpdir)
+            listable = [i for i in images if "\n" not in f"{i}"]
+            if len(images) == 1 or len(listable) < len(images):
+                return [self._run_one(i, directory) for i in images]
+            image_list = directory / "images.lst"
+            image_list.write_text("".join(f"{i}\n" for i in images))
+            text = self._run_one(image_list, directory)
+            pages = text.split("\f")
+            if pages and not pages[-1].strip():
+                pages.pop()
+            if len(pages) == len(images):
+                return [f"{page}\f" for page in pages]
+            self.logger.debug(
+                f"tesseract returned {len(pages)} pages for {len(images)}"
+                " images; running them one at a time"
+            )
+            return [self._run_one(i, directory) for i in images]
+
+    def close(self) -> None:
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+class TesserocrPool(OCRPool):
+    def __init__(
+        self,
+        workers: int = 1,
+        logger: Optional[logging.Logger] = None,
+        engine: Optional[ExecutionEngine] = None,
+    ) -> None:
+        super().__init__(logger)
+        try:
+            import tesserocr
+        except ImportError as exc:
+            raise RuntimeError(
+                "The tesserocr OCR pool needs tesserocr:"
+                " pip install pdfarchive[tesserocr]"
+            ) from exc
+        self._tesserocr: Any = tesserocr
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all: List[Any] = list()
+
+    @property
+    def version(self) -> str:
+        return f"tesserocr:{self._tesserocr.tesseract_version()}"
+
+    def _api(self) -> Any:
+        api = getattr(self._local, "api", None)
+        if api is None:
+            api = self._tesserocr.PyTessBaseAPI()
+            self._local.api = api
+            with self._lock:
+                self._all.append(api)
+        return api
+
+    def recognize(self, images: Sequence[Path]) -> List[str]:
+        api = self._api()
+        texts: List[str] = list()
+        for image in images:
+            try:
+                api.SetImageFile(f"{image}")
+                texts.append(f"{api.GetUTF8Text()}\f")
+            except RuntimeError as exc:
+                self.logger.warning(f"Cannot OCR '{image}': {exc}")
+                texts.append("")
+        return texts
+
+    def close(self) -> None:
+        with self._lock:
+            for api in self._all:
+                api.End()
+            self._all = list()
+        self._local = threading.local()
+
+
+OCR_POOLS: Dict[str, Type[OCRPool]] = {
+    "tesseract": TesseractPool,
+    "tesserocr": TesserocrPool,
+}
@@ -0,0 +1,268 @@
+"""Estimating how long a build will take, before and while it runs.
+
+Every job is submitted with an estimate of the seconds of work it will
+take, from the size and kind of its document and from how long that kind
+of work took in earlier runs (kept in indexer_config_dir/timings.json):
+a thumbnail takes so long, pdftotext so long per MiB, and OCR so long per
+page.  Whether a PDF will need OCR, and how many pages it has, aren't
+known until its text job runs, so a PDF's estimate allows for the share
+of earlier PDFs that needed OCR and the pages per MiB they had; a dry run
+asks the backend instead.
+
+The Scheduler starts the longest jobs first, so that a few thousand-page
+scans found at the end of the tree don't run on alone long after
+everything else is done, and keeps count of the estimated work done and
+remaining, from which a ProgressReporter logs an ETA.
+"""
+import json
+import logging
+import threading
+import time
+from dataclasses import asdict, dataclass, field, fields
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .atomic import write_atomically
+from .backends import Backend
+from .metrics import Metrics
+from .scheduler import Scheduler
+
+TIMINGS_NAME = "timings.json"
+DEFAULT_PROGRESS_INTERVAL = 60.0
+
+_MIB = 1024 * 1024
+_IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg")
+
+
+@dataclass
+class Timings:
+    """Seconds of work per unit of each kind of job, and what PDFs have
+    turned out to be like."""
+
+    thumbnail: float = 0.3
+    image_text: float = 2.0
+    pdf_text_per_mib: float = 0.2
+    ocr_per_page: float = 2.5
+    # Of the PDFs whose text was extracted, how many needed OCR, and how
+    # many pages per MiB those had
+    ocr_share: float = 0.3
+    pages_per_mib: float = 4.0
+
+    @classmethod
+    def load(cls, path: Path) -> "Timings":
+        try:
+            saved = json.loads(path.read_text())
+        except (FileNotFoundError, ValueError):
+            return cls()
+        timings = cls()
+        for f in fields(cls):
+            value = saved.get(f.name) if isinstance(saved, dict) else None
+            if isinstance(value, (int, float)) and value >= 0:
+                setattr(timings, f.name, float(value))
+        return timings
+
+    def save(self, path: Path) -> None:
+        write_atomically(path, json.dumps(asdict(self), indent=2) + "\n")
+
+    def learn(self, metrics: Metrics) -> None:
+        """Fold the per-file timings of a finished run into these.  Each
+        run counts for as much as all the runs before it together."""
+        thumbs: List[float] = list()
+        images: List[float] = list()
+        pdf_time = pdf_bytes = 0.0
+        ocr_time = ocr_pages = ocr_bytes = 0.0
+        pdfs: Dict[str, bool] = dict()
+        for (path, stage), stats in metrics.files.items():
+            suffix = Path(path).suffix.lower()
+            if stage == "thumbnail" and stats.jobs:
+                thumbs.append(stats.wall_time / stats.jobs)
+            elif stage == "extract-fast" and stats.jobs:
+                if suffix in _IMAGE_SUFFIXES:
+                    images.append(stats.wall_time / stats.jobs)
+                elif suffix == ".pdf":
+                    pdf_time += stats.wall_time
+                    pdf_bytes += stats.bytes_in
+                    pdfs.setdefault(path, False)
+            elif stage == "extract-ocr" and stats.outcomes.get("pages"):
+                ocr_time += stats.wall_time
+                ocr_pages += stats.outcomes["pages"]
+                ocr_bytes += stats.bytes_in
+                pdfs[path] = True
+        if thumbs:
+            self._blend("thumbnail", sum(thumbs) / len(thumbs))
+        if images:
+            self._blend("image_text", sum(images) / len(images))
+        if pdf_bytes:
+            self._blend("pdf_text_per_mib", pdf_time / (pdf_bytes / _MIB))
+        if ocr_pages:
+            self._blend("ocr_per_page", ocr_time / ocr_pages)
+        if ocr_pages and ocr_bytes:
+            self._blend("pages_per_mib", ocr_pages / (ocr_bytes / _MIB))
+        if pdfs:
+            self._blend("ocr_share", sum(pdfs.values()) / len(pdfs))
+
+    def _blend(self, name: str, measured: float) -> None:
+        setattr(self, name, (getattr(self, name) + measured) / 2)
+
+
+class Planner:
+    """Estimates jobs from the Timings in path (if given), and keeps
+    them up to date."""
+
+    def __init__(self, path: Optional[Path] = None) -> None:
+        self.path = path
+        self.timings = Timings.load(path) if path else Timings()
+
+    def learn(self, metrics: Metrics) -> None:
+        """Learn from a finished run, and save what we learned."""
+        self.timings.learn(metrics)
+        if self.path:
+            self.timings.save(self.path)
+
+    def thumbnail(self, f: Path) -> float:
+        return self.timings.thumbnail
+
+    def text(
+        self,
+        f: Path,
+        size: Optional[int] = None,
+        probe: Optional[Backend] = None,
+    ) -> float:
+        """The text of f, which is size bytes long (if not f's size).
+        With probe, ask that backend whether a PDF needs OCR and how many
+        pages it has, rather than guessing."""
+        t = self.timings
+        if f.suffix.lower() != ".pdf":
+            return t.image_text
+        if size is None:
+            try:
+                size = f.stat().st_size
+            except OSError:
+                size = 0
+        mib = size / _MIB
+        extract = t.pdf_text_per_mib * mib
+        if probe is not None:
+            pages = probe.page_count(f)
+            if pages is None:
+                pages = round(t.pages_per_mib * mib)
+            fonts = probe.has_fonts(f)
+            if fonts is True:
+                return extract
+            if fonts is False:
+                return t.ocr_per_page * pages
+            return extract + t.ocr_share * t.ocr_per_page * pages
+        return extract + t.ocr_share * t.ocr_per_page * t.pages_per_mib * mib
+
+    def ocr_pages(self, pages: int) -> float:
+        return self.timings.ocr_per_page * pages
+
+
+@dataclass
+class PlannedJob:
+    kind: str
+    path: Path
+    estimate: float
+
+
+@dataclass
+class Plan:
+    """The jobs a build would run, with their estimates."""
+
+    jobs: List[PlannedJob] = field(default_factory=list)
+
+    def add(self, kind: str, path: Path, estimate: float) -> None:
+        self.jobs.append(PlannedJob(kind, path, estimate))
+
+    @property
+    def total(self) -> float:
+        return sum(j.estimate for j in self.jobs)
+
+    def wall_time(self, workers: float) -> float:
+        """Roughly how long the jobs would take on workers CPUs."""
+        return self.total / max(workers, 1.0)
+
+    def report(self, workers: float, longest: int = 10) -> str:
+        lines = [f"{'job':<12}{'count':>10}{'CPU time':>14}"]
+        for kind in sorted({j.kind for j in self.jobs}):
+            jobs = [j for j in self.jobs if j.kind == kind]
+            estimate = sum(j.estimate for j in jobs)
+            lines.append(
+                f"{kind:<12}{len(jobs):>10}{format_duration(estimate):>14}"
+            )
+        lines.append(
+            f"{'total':<12}{len(self.jobs):>10}"
+            f"{format_duration(self.total):>14}"
+        )
+        lines.append(
+            f"Estimated time on {workers:g} CPUs:"
+            f" {format_duration(self.wall_time(workers))}"
+        )
+        biggest = sorted(self.jobs, key=lambda j: j.estimate, reverse=True)
+        if biggest[:longest]:
+            lines.append("Longest jobs:")
+        for job in biggest[:longest]:
+            lines.append(
+                f"  {format_duration(job.estimate):>10}  {job.kind}"
+                f"  {job.path}"
+            )
+        return "\n".join(lines)
+
+
+def format_duration(seconds: float) -> str:
+    minutes, secs = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}"
+
+
+class ProgressReporter:
+    """Logs the scheduler's progress through its estimated work, and an
+    ETA from how fast it has gone so far, every interval seconds until
+    stopped."""
+
+    def __init__(
+        self,
+        scheduler: Scheduler,
+        logger: Optional[logging.Logger] = None,
+        interval: float = DEFAULT_PROGRESS_INTERVAL,
+    ) -> None:
+        self.scheduler = scheduler
+        self.logger = logger or logging.getLogger(__name__)
+        self.interval = interval
+        self._started = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="pdfarchive-progress", daemon=True
+        )
+
+    def eta(self) -> Optional[float]:
+        """Seconds until the estimated work is done, if there's been
+        enough progress to tell."""
+        done, remaining = self.scheduler.progress()
+        if not done:
+            return None
+        elapsed = time.monotonic() - self._started
+        return remaining * elapsed / done
+
+    def report(self) -> None:
+        done, remaining = self.scheduler.progress()
+        if not done + remaining:
+            return
+        percent = 100 * done / (done + remaining)
+        eta = self.eta()
+        self.logger.info(
+            f"Estimated {percent:.0f}% done; ETA "
+            + ("unknown" if eta is None else format_duration(eta))
+        )
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def start(self) -> None:
+        self._started = time.monotonic()
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
@@ -0,0 +1,299 @@
+"""Index-page rendering.
+
+The page template loops over the directory's entries itself, including
+the per-entry templates, so a page is rendered in one pass; entries are
+produced lazily and the output is written to disk a chunk at a time with
+Template.generate(), so neither the entry list nor the page is ever
+assembled into one big string.  Templates are compiled once, when the
+PageRenderer is created, and the environment never goes back to the
+filesystem to check whether they have changed.  Rendering changes
+nothing in the renderer, so every build in the process shares the one
+default_renderer().
+
+A directory too big for one page can be split into pages of page_size
+documents, index.html, index-2.html, and so on, each linking to its
+neighbours, with the folders and archives on the first.  Alongside them
+goes index.json, a compact listing of every document in the directory;
+the pages' listing.js fetches it and shows the whole directory, keeping
+only the rows on screen in the document and loading only their
+thumbnails, so a directory of twenty thousand scans opens as quickly as
+one of twenty.  Without JavaScript (or from a file: URL, where it can't
+fetch the listing) the static pages are still there.
+"""
+import json
+import re
+import threading
+from dataclasses import dataclass, field, replace
+from pathlib import Path, PurePosixPath
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+from urllib.parse import quote
+
+from jinja2 import Environment, FileSystemLoader
+
+from .atomic import ChangeLog, atomic_open, write_atomically
+from .sprites import SHEET_COLUMNS, SHEET_SIZE, sprite_position
+
+_here = Path(__file__).parent
+
+LISTING_NAME = "index.json"
+_PAGE_NAME = re.compile(r"index-(\d+)\.html")
+
+# Neighbouring pages linked to on either side of the current one
+_PAGE_WINDOW = 2
+
+_UPLINK = """
+            <div id="containing_{containing_id}">
+            <i data-feather="arrow-up-circle"></i>
+            <a href="../index.html">
+            Parent Folder
+            </a>
+            </div>
+            <div style="clear: both"></div>
+            <hr>
+            """
+
+
+def uplink(l_id: str) -> str:
+    return _UPLINK.format(containing_id=l_id)
+
+
+def template_environment() -> Environment:
+    return Environment(
+        loader=FileSystemLoader(Path(_here / "templates")),
+        auto_reload=False,
+    )
+
+
+def page_name(page: int) -> str:
+    return "index.html" if page == 1 else f"index-{page}.html"
+
+
+def page_number(name: str) -> Optional[int]:
+    """The page a file name is for, if it is one of the extra pages of a
+    paged directory."""
+    match = _PAGE_NAME.fullmatch(name)
+    return int(match.group(1)) if match else None
+
+
+def page_links(page: int, pages: int) -> List[Tuple[int, str]]:
+    """Links to the first and last pages and those near page, as (page,
+    file name) pairs, with (0, "") marking a gap."""
+    wanted = {1, pages} | set(
+        range(max(1, page - _PAGE_WINDOW), min(pages, page + _PAGE_WINDOW) + 1)
+    )
+    links: List[Tuple[int, str]] = list()
+    for n in sorted(wanted):
+        if links and n > links[-1][0] + 1:
+            links.append((0, ""))
+        links.append((n, page_name(n)))
+    return links
+
+
+def file_entries(
+    files: Sequence[Path],
+    first: int = 0,
+    sprite_cell: Optional[Tuple[int, int]] = None,
+) -> Iterator[Dict[str, str]]:
+    for c, f in enumerate(files, first):
+        basename = quote(f.stem)
+        entry = {
+            "file_id": str(c),
+            "file_name": quote(f.name),
+            "base_name": basename,
+            "thumb_name": f"{basename}_thumb.png",
+            "text_name": f"{basename}.txt",
+        }
+        if sprite_cell:
+            sheet, x, y = sprite_position(c, sprite_cell)
+            entry["sprite_sheet"] = sheet
+            entry["sprite_style"] = (
+                f"width:{sprite_cell[0]}px;height:{sprite_cell[1]}px;"
+                f"object-fit:none;object-position:-{x}px -{y}px"
+            )
+        yield entry
+
+
+def dir_entries(dirs: Sequence[Path]) -> Iterator[Dict[str, str]]:
+    for c, d in enumerate(dirs):
+        yield {"dir_id": str(c), "dir_name": quote(d.name)}
+
+
+def member_entries(members: Sequence[str]) -> List[Dict[str, str]]:
+    entries = list()
+    for c, name in enumerate(members):
+        path = PurePosixPath(name)
+        stem = quote(str(path.with_suffix("")))
+        entries.append(
+            {
+                "member_id": str(c),
+                "member_name": quote(name),
+                "base_name": stem,
+                "thumb_name": f"{stem}_thumb.png",
+                "text_name": f"{stem}.txt",
+            }
+        )
+    return entries
+
+
+def archive_entries(
+    archives: Sequence[Path],
+    members: Mapping[Path, Sequence[str]],
+) -> Iterator[Dict[str, Any]]:
+    for c, a in enumerate(archives):
+        yield {
+            "archive_id": str(c),
+            "archive_name": quote(a.name),
+            "base_name": quote(a.stem),
+            "members": member_entries(members.get(a, ())),
+        }
+
+
+@dataclass
+class PageData:
+    """Everything that goes into one directory's index page."""
+
+    title: str
+    top_name: str
+    top_dir: str
+    partial_path: str
+    search_url: str
+    is_root: bool
+    files: Sequence[Path]
+    dirs: Sequence[Path]
+    archives: Sequence[Path]
+    # The names of the documents in each archive
+    archive_members: Mapping[Path, Sequence[str]] = field(default_factory=dict)
+    # For paged directories: which page this is, of how many, and where
+    # the full listing is.  files are then just this page's, starting
+    # with the directory's first_file'th document.
+    page: int = 1
+    pages: int = 1
+    listing: str = ""
+    first_file: int = 0
+    # The size of a thumbnail's cell in the directory's sprite sheets, if
+    # the pages are to use them
+    sprite_cell: Optional[Tuple[int, int]] = None
+
+
+def paginate(page: PageData, page_size: int) -> List[PageData]:
+    """Split page into pages of page_size documents (at least one page,
+    even for an empty directory)."""
+    files = page.files
+    count = max(1, -(-len(files) // page_size))
+    return [
+        replace(
+            page,
+            files=files[n * page_size : (n + 1) * page_size],
+            dirs=page.dirs if n == 0 else [],
+            archives=page.archives if n == 0 else [],
+            page=n + 1,
+            pages=count,
+            listing=LISTING_NAME,
+            first_file=n * page_size,
+        )
+        for n in range(count)
+    ]
+
+
+def write_listing(
+    page: PageData,
+    page_size: int,
+    path: Path,
+    changes: Optional[ChangeLog] = None,
+) -> None:
+    """Write the listing of every document in page (which must not have
+    been paginated yet) for listing.js."""
+    listing: Dict[str, Any] = {
+        "page_size": page_size,
+        "thumbs": f"{page.top_dir}/Thumbs/{page.partial_path}",
+        "text": f"{page.top_dir}/Text/{page.partial_path}",
+        "files": [f.name for f in page.files],
+    }
+    if page.sprite_cell:
+        listing["sprites"] = {
+            "cell": list(page.sprite_cell),
+            "columns": SHEET_COLUMNS,
+            "sheet_size": SHEET_SIZE,
+        }
+    write_atomically(path, json.dumps(listing, separators=(",", ":")), changes)
+
+
+class PageRenderer:
+    def __init__(self, environment: Environment) -> None:
+        self.environment = environment
+        # Compile everything now; includes resolve from the cache later.
+        self.templates = {
+            name: environment.get_template(name)
+            for name in environment.list_templates()
+            if name.endswith(".template")
+        }
+        self.index_template = self.templates["index.template"]
+
+    def _context(self, page: PageData) -> Dict[str, Any]:
+        return {
+            "title": page.title,
+            "top_name": page.top_name,
+            "top_dir": page.top_dir,
+            "search_url": page.search_url,
+            "base_path": page.top_dir,
+            "partial_path": page.partial_path,
+            "uplink_top": "" if page.is_root else uplink("top"),
+            "uplink_bottom": "" if page.is_root else uplink("bottom"),
+            "has_files": bool(page.files),
+            "has_dirs": bool(page.dirs),
+            "has_archives": bool(page.archives),
+            "files": file_entries(
+                page.files, page.first_file, page.sprite_cell
+            ),
+            "listing": page.listing,
+            "first_file": page.first_file,
+            "page": page.page,
+            "pages": page.pages,
+            "page_links": page_links(page.page, page.pages),
+            "prev_page": page_name(page.page - 1) if page.page > 1 else "",
+            "next_page": (
+                page_name(page.page + 1) if page.page < page.pages else ""
+            ),
+            "dirs": dir_entries(page.dirs),
+            "archives": archive_entries(page.archives, page.archive_members),
+        }
+
+    def generate(self, page: PageData) -> Iterator[str]:
+        return self.index_template.generate(**self._context(page))
+
+    def render(self, page: PageData) -> str:
+        return "".join(self.generate(page))
+
+    def write(
+        self, page: PageData, path: Path, changes: Optional[ChangeLog] = None
+    ) -> None:
+        with atomic_open(path, changes=changes) as f:
+            for chunk in self.generate(page):
+                f.write(chunk)
+
+    def render_table(self, name: str, page: PageData) -> str:
+        """Render just one of filetable, dirtable, or archivetable."""
+        return self.templates[f"{name}.template"].render(**self._context(page))
+
+
+_default_renderer: Optional[PageRenderer] = None
+_default_lock = threading.Lock()
+
+
+def default_renderer() -> PageRenderer:
+    """The process-wide PageRenderer, compiled the first time it is asked
+    for."""
+    global _default_renderer
+    with _default_lock:
+        if _default_renderer is None:
+            _default_renderer = PageRenderer(template_environment())
+        return _default_renderer
@@ -0,0 +1,310 @@
+"""Resource-budgeted job scheduler.
+
+Thumbnailing and text extraction are dominated by external processes, so
+the work is run on a pool of threads that spend nearly all their time
+waiting on children.  What actually needs limiting is not the number of
+threads but how much CPU, memory, and temporary disk the children are
+using at once.  Each job is tagged with a JobClass; each class has a cost,
+and a job is only started once its cost fits within what remains of the
+global Budget.  Cheap jobs may overtake an expensive one that does not yet
+fit, so a long queue of OCR work does not starve thumbnailing.
+
+Jobs may come with an estimate of how many seconds of work they are.
+Those that fit are started longest first, which keeps the end of a run
+from being one long job running alone, and the estimates of the jobs
+done and still to do are kept for progress reports.  A job that submits
+follow-up jobs hands that much of its own estimate on to them.  While
+the scheduler is held, jobs are queued but not started, so that
+everything there is to do can be queued before the longest is picked.
+
+Pending jobs are kept in a heap per cost, longest first.  Every job in a
+heap costs the same, so if the head of one doesn't fit, none of the rest
+do, and picking the next job to start only looks at the heads.
+"""
+import heapq
+import itertools
+import logging
+import math
+import os
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+class JobClass(Enum):
+    THUMBNAIL = "thumbnail"
+    EXTRACT_FAST = "extract_fast"
+    IMAGE_OCR = "image_ocr"
+    PDF_OCR = "pdf_ocr"
+    PAGE_OCR = "page_ocr"
+    ARCHIVE = "archive"
+    DOCUMENT = "document"
+
+
+@dataclass(frozen=True)
+class Cost:
+    """Resources a job holds while it runs.  Memory and tmp are in MiB."""
+
+    cpu: float = 1.0
+    memory: int = 0
+    tmp: int = 0
+
+    def clamp(self, budget: "Budget") -> "Cost":
+        # A job bigger than the whole budget would never start; let it run
+        # by itself instead.
+        return Cost(
+            cpu=min(self.cpu, budget.cpu),
+            memory=min(self.memory, budget.memory),
+            tmp=min(self.tmp, budget.tmp),
+        )
+
+
+# pdftotext is cheap; the OCR fallback is the thing that runs boxes out of
+# memory and disk.  PDF_OCR is the whole-document fallback (gm convert to a
+# multipage TIFF, then tesseract); PAGE_OCR is one small batch of pages.
+# ARCHIVE spills documents out of an archive into temporary storage, as
+# many as its tmp allows, for jobs of their own to work on.  DOCUMENT takes
+# one PDF through pdftotext and whatever OCR it needs, as a distributed
+# worker does.
+DEFAULT_COSTS: Dict[JobClass, Cost] = {
+    JobClass.THUMBNAIL: Cost(cpu=1.0, memory=128, tmp=0),
+    JobClass.EXTRACT_FAST: Cost(cpu=1.0, memory=64, tmp=0),
+    JobClass.IMAGE_OCR: Cost(cpu=1.0, memory=256, tmp=0),
+    JobClass.PDF_OCR: Cost(cpu=2.0, memory=1024, tmp=2048),
+    JobClass.PAGE_OCR: Cost(cpu=1.0, memory=384, tmp=64),
+    JobClass.ARCHIVE: Cost(cpu=1.0, memory=512, tmp=512),
+    JobClass.DOCUMENT: Cost(cpu=1.0, memory=512, tmp=256),
+}
+
+
+def _total_memory_mib() -> int:
+    try:
+        pages = os.sysconf("SC_PHYS_PAGES")
+        page_size = os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 4096
+    return int(pages * page_size / (1024 * 1024))
+
+
+def parse_size(size: str) -> int:
+    """Turn a size like "512", "512M", "8G" or "1T" into MiB."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kKmMgGtT]?)i?[bB]?\s*", size)
+    if not match:
+        raise ValueError(f"Cannot parse size '{size}'")
+    value = float(match.group(1))
+    unit = match.group(2).upper()
+    multiplier = {"K": 1 / 1024, "": 1, "M": 1, "G": 1024, "T": 1024 * 1024}
+    return int(value * multiplier[unit])
+
+
+@dataclass(frozen=True)
+class Budget:
+    """Global limits across all running jobs.  Memory and tmp are in MiB."""
+
+    cpu: float
+    memory: int
+    tmp: int
+
+    @classmethod
+    def default(cls) -> "Budget":
+        return cls(
+            cpu=float(os.cpu_count() or 1),
+            memory=_total_memory_mib() // 2,
+            tmp=10 * 1024,
+        )
+
+
+@dataclass
+class _Job:
+    # Longest first, then first come first served
+    order: Tuple[float, int]
+    cost: Cost = field(compare=False)
+    future: Future = field(compare=False)
+    thunk: Callable[[], Any] = field(compare=False)
+    # The part of the job's estimate not handed on to follow-up jobs
+    credit: float = field(compare=False, default=0.0)
+    # Whether the job's tmp stays reserved after it returns
+    retained: bool = field(compare=False, default=False)
+
+    def __lt__(self, other: "_Job") -> bool:
+        return self.order < other.order
+
+
+class Scheduler:
+    def __init__(
+        self,
+        budget: Optional[Budget] = None,
+        costs: Optional[Dict[JobClass, Cost]] = None,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self.budget = budget or Budget.default()
+        self.costs = dict(DEFAULT_COSTS)
+        if costs:
+            self.costs.update(costs)
+        self.logger = logger or logging.getLogger(__name__)
+        min_cpu = min(c.clamp(self.budget).cpu for c in self.costs.values())
+        workers = max(1, math.ceil(self.budget.cpu / max(min_cpu, 0.1)))
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="pdfarchive"
+        )
+        self._lock = threading.Condition()
+        self._pending: Dict[Cost, List[_Job]] = dict()
+        self._sequence = itertools.count()
+        self._local = threading.local()
+        # How many held() blocks are open
+        self._held = 0
+        self._done = 0.0
+        self._remaining = 0.0
+        self._cpu = 0.0
+        self._memory = 0
+        self._tmp = 0
+        self._running = 0
+        self._outstanding = 0
+        self._errors: List[BaseException] = list()
+
+    def __enter__(self) -> "Scheduler":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.shutdown()
+
+    def _fits(self, cost: Cost) -> bool:
+        # With nothing running, anything fits, so that tmp retained past
+        # its job can't hold up the jobs that will let it go.
+        return not self._running or (
+            self._cpu + cost.cpu <= self.budget.cpu
+            and self._memory + cost.memory <= self.budget.memory
+            and self._tmp + cost.tmp <= self.budget.tmp
+        )
+
+    def _dispatch(self) -> None:
+        # Called with self._lock held.
+        if self._held:
+            return
+        while True:
+            heads = [
+                heap[0]
+                for cost, heap in self._pending.items()
+                if heap and self._fits(cost)
+            ]
+            if not heads:
+                return
+            job = heapq.heappop(self._pending[min(heads).cost])
+            cost = job.cost
+            self._cpu += cost.cpu
+            self._memory += cost.memory
+            self._tmp += cost.tmp
+            self._running += 1
+            self._executor.submit(self._execute, job)
+
+    def _execute(self, job: _Job) -> None:
+        cost, future = job.cost, job.future
+        self._local.job = job
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(job.thunk())
+                except BaseException as exc:
+                    self.logger.exception(f"Job failed: {exc}")
+                    future.set_exception(exc)
+                    with self._lock:
+                        self._errors.append(exc)
+        finally:
+            self._local.job = None
+            with self._lock:
+                self._cpu -= cost.cpu
+                self._memory -= cost.memory
+                if not job.retained:
+                    self._tmp -= cost.tmp
+                self._running -= 1
+                self._done += job.credit
+                self._remaining -= job.credit
+                self._outstanding -= 1
+                self._dispatch()
+                self._lock.notify_all()
+
+    def submit(
+        self,
+        job_class: JobClass,
+        fn: Callable[..., Any],
+        *args: Any,
+        estimate: float = 0.0,
+        **kwargs: Any,
+    ) -> Future:
+        """Queue fn(*args, **kwargs) to run once the cost of job_class fits
+        in the budget, ahead of jobs with smaller estimates (in seconds).
+        Jobs may themselves submit follow-up jobs."""
+        cost = self.costs[job_class].clamp(self.budget)
+        future: Future = Future()
+        job = _Job(
+            order=(-estimate, next(self._sequence)),
+            cost=cost,
+            future=future,
+            thunk=lambda: fn(*args, **kwargs),
+            credit=estimate,
+        )
+        parent: Optional[_Job] = getattr(self._local, "job", None)
+        with self._lock:
+            handed_on = 0.0
+            if parent is not None:
+                handed_on = min(parent.credit, estimate)
+                parent.credit -= handed_on
+            self._remaining += estimate - handed_on
+            self._outstanding += 1
+            heapq.heappush(self._pending.setdefault(cost, list()), job)
+            self._dispatch()
+        return future
+
+    def retain(self) -> Callable[[], None]:
+        """Called from a job that leaves temporary files behind for other
+        jobs: keep its tmp reserved after it returns, until the function
+        returned is called."""
+        job: _Job = self._local.job
+        with self._lock:
+            job.retained = True
+
+        def release() -> None:
+            with self._lock:
+                self._tmp -= job.cost.tmp
+                self._dispatch()
+                self._lock.notify_all()
+
+        return release
+
+    @contextmanager
+    def held(self) -> Iterator[None]:
+        """Queue jobs without starting any until the block is over, and
+        every other held() block on this scheduler (another build's) is
+        over too."""
+        with self._lock:
+            self._held += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._held -= 1
+                self._dispatch()
+
+    def progress(self) -> Tuple[float, float]:
+        """The estimated seconds of work done so far and still to do."""
+        with self._lock:
+            return (self._done, max(self._remaining, 0.0))
+
+    def wait(self) -> List[BaseException]:
+        """Block until every submitted job, including jobs submitted while
+        waiting, has finished.  Returns (and clears) the errors raised by
+        failed jobs."""
+        with self._lock:
+            while self._outstanding:
+                self._lock.wait()
+            errors = self._errors
+            self._errors = list()
+        return errors
+
+    def shutdown(self) -> None:
+        self.wait()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,124 @@
+"""Thumbnail sprite sheets.
+
+A directory's thumbnails can also be packed into sprite sheets, so that
+its index page costs a few requests (and a few reads on the web server)
+rather than one per document.  Each sheet is a grid of SHEET_COLUMNS
+cells the size of a thumbnail, holding SHEET_SIZE thumbnails in the
+order the directory lists its documents, each centred in its cell, so
+where a document's thumbnail is can be worked out from its position in
+the directory alone, and the index pages can be written before the
+thumbnails are made.
+
+Next to the sheets in the directory's Thumbs folder, sprites.json
+records the size and mtime of every thumbnail that went into each sheet;
+a sheet is rebuilt only when one of those changes, a thumbnail appears or
+goes, or the directory's documents move from one sheet to another.
+"""
+import json
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .atomic import (
+    ChangeLog,
+    atomic_output,
+    make_directory,
+    remove,
+    write_atomically,
+)
+from .backends import Backend
+
+SPRITES_NAME = "sprites.json"
+SHEET_SIZE = 100
+SHEET_COLUMNS = 10
+
+# The thumbnail in a cell (None for an empty cell), and its size and
+# mtime when the sheet was made
+_Member = Tuple[Optional[str], int, int]
+
+
+def sheet_name(sheet: int) -> str:
+    return f"sprites-{sheet}.png"
+
+
+def cell_size(geometry: str) -> Tuple[int, int]:
+    """The size of a sprite cell for thumbnails made at geometry."""
+    width, _, height = geometry.partition("x")
+    return int(width), int(height or width)
+
+
+def sprite_position(index: int, cell: Tuple[int, int]) -> Tuple[str, int, int]:
+    """The sheet holding the thumbnail of a directory's index'th document,
+    and the offset of its cell in the sheet."""
+    sheet, n = divmod(index, SHEET_SIZE)
+    row, column = divmod(n, SHEET_COLUMNS)
+    return sheet_name(sheet), column * cell[0], row * cell[1]
+
+
+def _member(thumb: Path) -> _Member:
+    try:
+        st = thumb.stat()
+    except FileNotFoundError:
+        return (None, 0, 0)
+    return (thumb.name, st.st_size, st.st_mtime_ns)
+
+
+def _read_state(path: Path) -> Dict[str, Any]:
+    try:
+        state = json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return dict()
+    return state if isinstance(state, dict) else dict()
+
+
+def pack_sprites(
+    thumbs: Sequence[Path],
+    directory: Path,
+    geometry: str,
+    backend: Backend,
+    logger: Optional[logging.Logger] = None,
+    changes: Optional[ChangeLog] = None,
+) -> int:
+    """Bring the sprite sheets of thumbs (one per document of a
+    directory, in order, whether or not it exists yet) in directory up to
+    date.  Returns how many sheets were rebuilt."""
+    logger = logger or logging.getLogger(__name__)
+    state_path = directory / SPRITES_NAME
+    state = _read_state(state_path)
+    cell = list(cell_size(geometry))
+    old: List[List[List[Any]]] = list()
+    if state.get("cell") == cell and state.get("columns") == SHEET_COLUMNS:
+        old = state.get("sheets", [])
+    sheets: List[List[_Member]] = list()
+    rebuilt = 0
+    for first in range(0, len(thumbs), SHEET_SIZE):
+        chunk = thumbs[first : first + SHEET_SIZE]
+        members = [_member(t) for t in chunk]
+        sheets.append(members)
+        number = len(sheets) - 1
+        output = directory / sheet_name(number)
+        was = old[number] if number < len(old) else None
+        if output.exists() and was == [list(m) for m in members]:
+            continue
+        make_directory(directory)
+        with atomic_output(output, changes) as tmp:
+            backend.sprite_sheet(
+                [t if m[0] else None for t, m in zip(chunk, members)],
+                tmp,
+                geometry,
+                SHEET_COLUMNS,
+            )
+            if not tmp.exists():
+                logger.warning(f"Could not make sprite sheet '{output}'")
+        rebuilt += 1
+    for number in range(len(sheets), len(old)):
+        remove(directory / sheet_name(number), changes)
+    if rebuilt or len(sheets) != len(old):
+        write_atomically(
+            state_path,
+            json.dumps(
+                {"cell": cell, "columns": SHEET_COLUMNS, "sheets": sheets}
+            ),
+            changes,
+        )
+    return rebuilt
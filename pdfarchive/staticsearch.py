@@ -0,0 +1,255 @@
+"""Export the text index as static files that the browser can search
+without a CGI.
+
+The export goes in a ``search`` directory at the archive root:
+
+* ``meta.json``: the word-splitting rules (so the browser tokenizes queries
+  the way documents were tokenized), the shard prefix length, the list of
+  term shards, and the document count;
+* ``terms/<prefix>.json``: every term beginning with prefix, mapped to its
+  postings as a flat list of alternating document-id deltas and term
+  frequencies;
+* ``docs/<n>.json``: the source and text paths of documents with ids from
+  n * docs_per_shard up to (but not including) (n + 1) * docs_per_shard.
+
+A query then costs one term shard per distinct prefix among its words, plus
+the document shards for the hits that are displayed.  Shards whose content
+has not changed are not rewritten, so a CDN can keep serving them from
+cache, and after an update of the index only the shards it touched are
+recomputed.
+"""
+import json
+import re
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .atomic import ChangeLog, make_directory, remove, replace_if_changed
+from .textindex import TextIndex
+
+# Where the export goes, under the archive root
+SEARCH_DIR = "search"
+_FORMAT_VERSION = 1
+_EXPORT_NAMES = ("meta.json", "terms", "docs")
+
+
+def shard_name(term: str, prefix_length: int) -> str:
+    # Terms may contain dots and dashes (or anything else in
+    # WordCharacters), which we don't want in file names.  Must match
+    # shardName() in assets/scripts/search.js.
+    return "".join(
+        c if re.match(r"[a-z0-9]", c) else f"_{ord(c):x}"
+        for c in term[:prefix_length]
+    )
+
+
+def check_export_dir(out_dir: Path) -> None:
+    """Refuse to export into out_dir if it holds anything but an earlier
+    export (an archive folder with the same name, say)."""
+    try:
+        names = [p.name for p in out_dir.iterdir()]
+    except FileNotFoundError:
+        return
+    except NotADirectoryError:
+        names = [out_dir.name]
+    foreign = [
+        n for n in names if n not in _EXPORT_NAMES and not n.endswith(".tmp")
+    ]
+    if foreign:
+        raise RuntimeError(
+            f"'{out_dir}' is not a static search export (it holds"
+            f" '{foreign[0]}'); move it aside to use static search"
+        )
+
+
+def _write_json(
+    path: Path, content: Any, changes: Optional[ChangeLog] = None
+) -> bool:
+    data = json.dumps(content, separators=(",", ":"))
+    tmp = path.with_suffix(".json.tmp")
+    tmp.write_text(data)
+    return replace_if_changed(tmp, path, changes)
+
+
+def _flat_postings(postings: List[Tuple[int, int]]) -> List[int]:
+    flat: List[int] = list()
+    previous = 0
+    for doc_id, tf in postings:
+        flat.append(doc_id - previous)
+        flat.append(tf)
+        previous = doc_id
+    return flat
+
+
+def _read_meta(out_dir: Path) -> Dict[str, Any]:
+    try:
+        with open(out_dir / "meta.json") as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return dict()
+    return meta if isinstance(meta, dict) else dict()
+
+
+def _doc_shard(
+    text_index: TextIndex,
+    sources: Dict[str, str],
+    n: int,
+    docs_per_shard: int,
+) -> Dict[str, List[str]]:
+    docs: Dict[str, List[str]] = dict()
+    for doc_id in range(n * docs_per_shard, (n + 1) * docs_per_shard):
+        text_path = text_index.paths.get(doc_id)
+        if text_path is None:
+            continue
+        source = sources.get(text_path)
+        if source is None:
+            source = str(Path(text_path).with_suffix(".pdf"))
+        docs[str(doc_id)] = [source, text_path]
+    return docs
+
+
+def export_static_index(
+    text_index: TextIndex,
+    sources: Dict[str, str],
+    out_dir: Path,
+    prefix_length: int = 2,
+    docs_per_shard: int = 1000,
+    changes: Optional[ChangeLog] = None,
+    text_links: bool = True,
+) -> int:
+    """Write the static search index for text_index into out_dir.
+
+    sources maps each text file path, relative to the text directory, to
+    the path of the document it was extracted from, relative to the
+    archive root; text files with no known source are assumed to come from
+    a PDF of the same name.  Without text_links, search results link to
+    the documents only, not to their text.  Returns the number of shard
+    files written.
+
+    If out_dir holds an export of the index as it was since it was opened,
+    only the shards with terms and documents that have changed since then
+    are recomputed.  Shards with only removed documents' terms are left
+    as they are, and search.js skips the hits with no document; a merge
+    of the whole index has everything recomputed.
+    """
+    terms_dir = out_dir / "terms"
+    docs_dir = out_dir / "docs"
+    make_directory(terms_dir)
+    make_directory(docs_dir)
+    rules = text_index.rules
+    meta: Dict[str, Any] = {
+        "version": _FORMAT_VERSION,
+        "prefix_length": prefix_length,
+        "docs_per_shard": docs_per_shard,
+        "n_docs": len(text_index.docs),
+        "word_characters": rules.word_characters,
+        "ignore_first": rules.ignore_first,
+        "ignore_last": rules.ignore_last,
+        "begin_characters": rules.begin_characters,
+        "end_characters": rules.end_characters,
+        "ascii7": rules.ascii7,
+        "stopwords": sorted(rules.stopwords),
+        "text_links": text_links,
+        "generation": text_index.generation,
+    }
+    previous = _read_meta(out_dir)
+    changed = None
+    if all(
+        previous.get(k) == meta[k]
+        for k in ("version", "prefix_length", "docs_per_shard")
+    ):
+        changed = text_index.changes_since(previous.get("generation", -1))
+    if changed is None:
+        written, term_shards = _export_all_terms(
+            text_index, terms_dir, prefix_length, changes
+        )
+        doc_shards = {doc_id // docs_per_shard for doc_id in text_index.paths}
+        stale_docs = {
+            int(p.stem) for p in docs_dir.glob("*.json") if p.stem.isdigit()
+        }
+    else:
+        terms, doc_ids = changed
+        written, term_shards = _export_terms(
+            text_index,
+            terms_dir,
+            prefix_length,
+            {term[:prefix_length] for term in terms},
+            set(previous.get("term_shards", ())),
+            changes,
+        )
+        doc_shards = {doc_id // docs_per_shard for doc_id in doc_ids}
+        stale_docs = set()
+
+    for n in sorted(doc_shards):
+        docs = _doc_shard(text_index, sources, n, docs_per_shard)
+        if docs:
+            written += _write_json(docs_dir / f"{n}.json", docs, changes)
+            stale_docs.discard(n)
+        else:
+            stale_docs.add(n)
+    for n in stale_docs:
+        remove(docs_dir / f"{n}.json", changes)
+
+    meta["term_shards"] = sorted(term_shards)
+    written += _write_json(out_dir / "meta.json", meta, changes)
+    return written
+
+
+def _export_all_terms(
+    text_index: TextIndex,
+    terms_dir: Path,
+    prefix_length: int,
+    changes: Optional[ChangeLog],
+) -> Tuple[int, Set[str]]:
+    """Write every term shard, and drop those that are no longer needed.
+    Returns the number written, and the names of all of them."""
+    written = 0
+    term_shards: Set[str] = set()
+    shard: Dict[str, List[int]] = dict()
+    current = ""
+    for term, postings in text_index.items():
+        name = shard_name(term, prefix_length)
+        if name != current and shard:
+            written += _write_json(
+                terms_dir / f"{current}.json", shard, changes
+            )
+            term_shards.add(current)
+            shard = dict()
+        current = name
+        shard[term] = _flat_postings(postings)
+    if shard:
+        written += _write_json(terms_dir / f"{current}.json", shard, changes)
+        term_shards.add(current)
+    for p in terms_dir.glob("*.json"):
+        if p.stem not in term_shards:
+            remove(p, changes)
+    return written, term_shards
+
+
+def _export_terms(
+    text_index: TextIndex,
+    terms_dir: Path,
+    prefix_length: int,
+    prefixes: Set[str],
+    term_shards: Set[str],
+    changes: Optional[ChangeLog],
+) -> Tuple[int, Set[str]]:
+    """Rewrite the shards of the terms beginning with prefixes, given the
+    names of all the shards there were.  Returns the number written, and
+    the names of all the shards there are now."""
+    written = 0
+    for prefix in sorted(prefixes):
+        name = shard_name(prefix, prefix_length)
+        # A prefix shorter than prefix_length is a whole term, which has
+        # the shard to itself
+        shard = {
+            term: _flat_postings(postings)
+            for term, postings in text_index.items(prefix)
+            if term[:prefix_length] == prefix
+        }
+        if shard:
+            written += _write_json(terms_dir / f"{name}.json", shard, changes)
+            term_shards.add(name)
+        else:
+            remove(terms_dir / f"{name}.json", changes)
+            term_shards.discard(name)
+    return written, term_shards
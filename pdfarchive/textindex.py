@@ -0,0 +1,618 @@
+"""A small incremental full-text index for the extracted text, replacing
+swish-e.
+
+Words are split and normalized by the same rules swish-e used, read from
+the WordCharacters, IgnoreFirstChar, IgnoreLastChar, BeginCharacters,
+EndCharacters, TranslateCharacters, and IgnoreWords directives in
+site.conf.
+
+The index lives in a directory of immutable segments plus a small JSON
+catalog.  Each segment is a pair of files:
+
+* ``seg-N.dict``: a header, a table of fixed-width entries (one per term,
+  sorted by term) and the term strings, so a term can be binary-searched
+  directly in a memory map;
+* ``seg-N.post``: the postings, each a run of (document-id delta, term
+  frequency) pairs encoded as varints.
+
+Adding documents writes a new segment; removing or changing a document
+marks its old id deleted in the catalog.  Segments are merged a few of
+about the same size at a time, streaming term by term, and once deleted
+documents outnumber live ones everything is merged into one segment
+without them.  The
+catalog is replaced atomically after the segments it names are on disk, so
+an interrupted update leaves the previous index intact.
+"""
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+import unicodedata
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from .textstore import TextStore
+
+_MAGIC = b"PAI1"
+_HEADER = struct.Struct("<4sI")
+# term offset, term length, postings offset, postings length, doc frequency
+_ENTRY = struct.Struct("<IIQII")
+# Segments of about the same size merged at a time
+_MERGE_FACTOR = 8
+
+# Approximately swish-e's compiled-in SwishDefault stopword list.
+SWISH_DEFAULT_STOPWORDS = frozenset(
+    """a about an and are as at be but by for from has have he his in is it
+    its more new of on one or said say says she that the their they this to
+    was who will with you""".split()
+)
+
+
+def encode_varint(value: int, out: bytearray) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varints(buf: bytes) -> Iterator[int]:
+    value = 0
+    shift = 0
+    for byte in buf:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        yield value
+        value = 0
+        shift = 0
+
+
+def encode_postings(postings: Iterable[Tuple[int, int]]) -> bytes:
+    """postings must be sorted by document id."""
+    out = bytearray()
+    previous = 0
+    for doc_id, tf in postings:
+        encode_varint(doc_id - previous, out)
+        encode_varint(tf, out)
+        previous = doc_id
+    return bytes(out)
+
+
+def decode_postings(buf: bytes) -> List[Tuple[int, int]]:
+    postings: List[Tuple[int, int]] = list()
+    values = decode_varints(buf)
+    doc_id = 0
+    for delta in values:
+        doc_id += delta
+        postings.append((doc_id, next(values)))
+    return postings
+
+
+@dataclass(frozen=True)
+class WordRules:
+    word_characters: str = "abcdefghijklmnopqrstuvwxyz0123456789.-"
+    ignore_first: str = ".-"
+    ignore_last: str = ".-"
+    begin_characters: str = "abcdefghijklmnopqrstuvwxyz0123456789"
+    end_characters: str = "abcdefghijklmnopqrstuvwxyz0123456789"
+    ascii7: bool = True
+    stopwords: FrozenSet[str] = field(default=SWISH_DEFAULT_STOPWORDS)
+
+    @classmethod
+    def from_config(cls, path: Path) -> "WordRules":
+        """Read the word-splitting directives from a swish-e config file
+        such as assets/site.conf; anything missing keeps its default."""
+        settings: Dict[str, str] = dict()
+        with open(path, "r", errors="replace") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                key, _, value = line.partition(" ")
+                settings[key] = value.strip()
+        kwargs: Dict[str, Any] = dict()
+        for directive, attr in (
+            ("WordCharacters", "word_characters"),
+            ("IgnoreFirstChar", "ignore_first"),
+            ("IgnoreLastChar", "ignore_last"),
+            ("BeginCharacters", "begin_characters"),
+            ("EndCharacters", "end_characters"),
+        ):
+            if directive in settings:
+                kwargs[attr] = settings[directive]
+        if "TranslateCharacters" in settings:
+            kwargs["ascii7"] = settings["TranslateCharacters"] == ":ascii7:"
+        if "IgnoreWords" in settings:
+            words = settings["IgnoreWords"]
+            if words == "SwishDefault":
+                kwargs["stopwords"] = SWISH_DEFAULT_STOPWORDS
+            else:
+                kwargs["stopwords"] = frozenset(words.lower().split())
+        return cls(**kwargs)
+
+    @property
+    def fingerprint(self) -> str:
+        return json.dumps(
+            [
+                self.word_characters,
+                self.ignore_first,
+                self.ignore_last,
+                self.begin_characters,
+                self.end_characters,
+                self.ascii7,
+                sorted(self.stopwords),
+            ]
+        )
+
+    def words(self, text: str) -> Iterator[str]:
+        if self.ascii7:
+            text = (
+                unicodedata.normalize("NFKD", text)
+                .encode("ascii", "ignore")
+                .decode("ascii")
+            )
+        text = text.lower()
+        splitter = "[^" + re.escape(self.word_characters) + "]+"
+        for word in re.split(splitter, text):
+            word = word.lstrip(self.ignore_first).rstrip(self.ignore_last)
+            if not word:
+                continue
+            if word[0] not in self.begin_characters:
+                continue
+            if word[-1] not in self.end_characters:
+                continue
+            if word in self.stopwords:
+                continue
+            yield word
+
+
+class _Segment:
+    def __init__(self, directory: Path, name: str) -> None:
+        self.name = name
+        self._dict_file = open(directory / f"{name}.dict", "rb")
+        self._post_file = open(directory / f"{name}.post", "rb")
+        self._dict = mmap.mmap(
+            self._dict_file.fileno(), 0, access=mmap.ACCESS_READ
+        )
+        post_size = os.fstat(self._post_file.fileno()).st_size
+        self._post: Optional[mmap.mmap] = None
+        if post_size:
+            self._post = mmap.mmap(
+                self._post_file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        magic, self.n_terms = _HEADER.unpack_from(self._dict, 0)
+        if magic != _MAGIC:
+            raise RuntimeError(f"{name}.dict is not an index segment")
+        self._terms_base = _HEADER.size + self.n_terms * _ENTRY.size
+
+    def close(self) -> None:
+        self._dict.close()
+        if self._post is not None:
+            self._post.close()
+        self._dict_file.close()
+        self._post_file.close()
+
+    def _entry(self, i: int) -> Tuple[bytes, int, int, int]:
+        t_off, t_len, p_off, p_len, df = _ENTRY.unpack_from(
+            self._dict, _HEADER.size + i * _ENTRY.size
+        )
+        start = self._terms_base + t_off
+        return self._dict[start : start + t_len], p_off, p_len, df
+
+    def _postings_at(self, p_off: int, p_len: int) -> List[Tuple[int, int]]:
+        if self._post is None:
+            return list()
+        return decode_postings(self._post[p_off : p_off + p_len])
+
+    def postings(self, term: str) -> List[Tuple[int, int]]:
+        key = term.encode()
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_term, p_off, p_len, _ = self._entry(mid)
+            if mid_term < key:
+                lo = mid + 1
+            elif mid_term > key:
+                hi = mid
+            else:
+                return self._postings_at(p_off, p_len)
+        return list()
+
+    def items(
+        self, prefix: str = ""
+    ) -> Iterator[Tuple[str, List[Tuple[int, int]]]]:
+        key = prefix.encode()
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in range(lo, self.n_terms):
+            term, p_off, p_len, _ = self._entry(i)
+            if not term.startswith(key):
+                return
+            yield term.decode(), self._postings_at(p_off, p_len)
+
+
+def _write_segment(
+    directory: Path,
+    name: str,
+    terms: Iterable[Tuple[str, List[Tuple[int, int]]]],
+) -> None:
+    """Write terms, which come in term (UTF-8 byte) order with their
+    postings sorted, as they come: only the term strings are held until
+    the end, in a temporary file."""
+    n_terms = 0
+    term_offset = 0
+    post_offset = 0
+    with open(directory / f"{name}.post", "wb") as post, open(
+        directory / f"{name}.dict", "wb"
+    ) as dict_file, tempfile.TemporaryFile(dir=directory) as term_blob:
+        dict_file.write(_HEADER.pack(_MAGIC, 0))
+        for term, term_postings in terms:
+            encoded_term = term.encode()
+            encoded = encode_postings(term_postings)
+            dict_file.write(
+                _ENTRY.pack(
+                    term_offset,
+                    len(encoded_term),
+                    post_offset,
+                    len(encoded),
+                    len(term_postings),
+                )
+            )
+            term_blob.write(encoded_term)
+            post.write(encoded)
+            term_offset += len(encoded_term)
+            post_offset += len(encoded)
+            n_terms += 1
+        term_blob.seek(0)
+        shutil.copyfileobj(term_blob, dict_file)
+        dict_file.seek(0)
+        dict_file.write(_HEADER.pack(_MAGIC, n_terms))
+        for f in (post, dict_file):
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class TextIndex:
+    """Incrementally maintained index of the text under text_dir, in
+    .txt files or packed, stored in index_dir."""
+
+    def __init__(
+        self,
+        index_dir: Path,
+        text_dir: Path,
+        rules: Optional[WordRules] = None,
+    ) -> None:
+        self.index_dir = index_dir
+        self.text_dir = text_dir
+        self.store = TextStore(text_dir)
+        self.rules = rules or WordRules()
+        self.index_dir.mkdir(exist_ok=True, parents=True)
+        self._catalog_path = self.index_dir / "catalog.json"
+        self._segments: Dict[str, _Segment] = dict()
+        self._load_catalog()
+
+    def _load_catalog(self) -> None:
+        catalog: Dict[str, Any] = {
+            "rules": self.rules.fingerprint,
+            "docs": {},
+            "deleted": [],
+            "segments": [],
+            "next_id": 0,
+            "next_segment": 0,
+            "generation": 0,
+        }
+        # Whether the index is the one saved last time, rather than a new
+        # one (because there wasn't one, or the rules have changed)
+        self.restored = False
+        try:
+            with open(self._catalog_path, "r") as f:
+                stored = json.load(f)
+            if stored.get("rules") == self.rules.fingerprint:
+                catalog = stored
+                self.restored = True
+        except (FileNotFoundError, ValueError):
+            pass
+        # docs maps relative text path -> [doc id, size, mtime_ns]
+        self.docs: Dict[str, List[int]] = catalog["docs"]
+        self.deleted: Set[int] = set(catalog["deleted"])
+        self.segment_names: List[str] = catalog["segments"]
+        self.next_id: int = catalog["next_id"]
+        self.next_segment: int = catalog["next_segment"]
+        # Counts the updates that changed anything
+        self.generation: int = catalog.get("generation", 0)
+        self.paths = {v[0]: k for k, v in self.docs.items()}
+        # What the updates since the index was opened changed, for
+        # changes_since(); None once that isn't known
+        self._opened = self.generation
+        self._updated_terms: Optional[Set[str]] = (
+            set() if self.restored else None
+        )
+        self._updated_docs: Set[int] = set()
+
+    def _save_catalog(self) -> None:
+        catalog = {
+            "rules": self.rules.fingerprint,
+            "docs": self.docs,
+            "deleted": sorted(self.deleted),
+            "segments": self.segment_names,
+            "next_id": self.next_id,
+            "next_segment": self.next_segment,
+            "generation": self.generation,
+        }
+        tmp = self._catalog_path.with_suffix(".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(catalog, f)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp.replace(self._catalog_path)
+        self._remove_unreferenced()
+
+    def _remove_unreferenced(self) -> None:
+        live = set(self.segment_names)
+        for p in self.index_dir.glob("seg-*"):
+            if p.stem not in live:
+                seg = self._segments.pop(p.stem, None)
+                if seg is not None:
+                    seg.close()
+                p.unlink()
+
+    def _segment(self, name: str) -> _Segment:
+        if name not in self._segments:
+            self._segments[name] = _Segment(self.index_dir, name)
+        return self._segments[name]
+
+    def close(self) -> None:
+        for seg in self._segments.values():
+            seg.close()
+        self._segments = dict()
+
+    def __enter__(self) -> "TextIndex":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def _new_segment_name(self) -> str:
+        name = f"seg-{self.next_segment:06d}"
+        self.next_segment += 1
+        return name
+
+    def update(
+        self, paths: Optional[Iterable[Path]] = None
+    ) -> Tuple[int, int]:
+        """Bring the index up to date.  With no paths, stat every document
+        under text_dir and reindex the ones whose size or mtime changed and
+        drop the ones that are gone; otherwise consider only the given
+        paths.  Returns the number of documents (added or changed, removed).
+        """
+        if paths is None:
+            current = self.store.scan()
+            candidates = set(current) | set(self.docs)
+        else:
+            current = dict()
+            candidates = set()
+            for p in paths:
+                rel = str(Path(p).relative_to(self.text_dir))
+                candidates.add(rel)
+                stat = self.store.stat(Path(rel))
+                if stat is not None:
+                    current[rel] = stat
+        removed = 0
+        new_terms: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        added = 0
+        for rel in sorted(candidates):
+            old = self.docs.get(rel)
+            stat = current.get(rel)
+            if old is not None and stat is not None:
+                if (old[1], old[2]) == stat:
+                    continue
+            if old is not None:
+                self.deleted.add(old[0])
+                self._updated_docs.add(old[0])
+                del self.paths[old[0]]
+                del self.docs[rel]
+                if stat is None:
+                    removed += 1
+            if stat is None:
+                continue
+            text = self.store.read(Path(rel))
+            if text is None:
+                # Gone since it was statted; it is out of the index now
+                if old is not None:
+                    removed += 1
+                continue
+            doc_id = self.next_id
+            self.next_id += 1
+            counts = Counter(self.rules.words(text))
+            for term, tf in counts.items():
+                new_terms[term].append((doc_id, tf))
+            self.docs[rel] = [doc_id, stat[0], stat[1]]
+            self.paths[doc_id] = rel
+            self._updated_docs.add(doc_id)
+            added += 1
+        if not added and not removed:
+            return (0, 0)
+        self.generation += 1
+        if self._updated_terms is not None:
+            self._updated_terms.update(new_terms)
+        if new_terms:
+            name = self._new_segment_name()
+            _write_segment(
+                self.index_dir,
+                name,
+                (
+                    (term, new_terms[term])
+                    for term in sorted(new_terms, key=lambda t: t.encode())
+                ),
+            )
+            self.segment_names.append(name)
+        self._compact()
+        return (added, removed)
+
+    def update_directories(
+        self, directories: Iterable[Path]
+    ) -> Tuple[int, int]:
+        """Like update(), but only for the text files in the given
+        directories (relative to text_dir) and below them."""
+        paths: Set[Path] = set()
+        for directory in directories:
+            if directory == Path("."):
+                return self.update()
+            paths.update(self.directory_paths(directory))
+        return self.update(paths)
+
+    def directory_paths(
+        self, directory: Path, recursive: bool = True
+    ) -> Set[Path]:
+        """The text files in directory (relative to text_dir), and unless
+        not recursive below it, that are there now or are in the index."""
+        paths = {
+            self.text_dir / rel
+            for rel in self.store.scan(directory, recursive)
+        }
+        for rel in self.docs:
+            parent = Path(rel).parent
+            if parent == directory or (
+                recursive and directory in parent.parents
+            ):
+                paths.add(self.text_dir / rel)
+        return paths
+
+    def _tier(self, name: str) -> int:
+        size = (self.index_dir / f"{name}.post").stat().st_size
+        return int(math.log(max(size, 1), _MERGE_FACTOR))
+
+    def _merge_segments(self, names: List[str]) -> str:
+        name = self._new_segment_name()
+        _write_segment(self.index_dir, name, self._merged(names))
+        return name
+
+    def _compact(self) -> None:
+        """Merge segments of about the same size (within a factor of
+        _MERGE_FACTOR) once there are _MERGE_FACTOR of them, so a posting
+        is rewritten about once for each time its segment grows by that
+        factor, and save the catalog.  Deleted documents are dropped from
+        what is merged, but only forgotten by a merge of everything, once
+        there are more of them than live ones."""
+        if len(self.deleted) > len(self.docs):
+            self.merge()
+            return
+        while True:
+            tiers: Dict[int, List[str]] = defaultdict(list)
+            for name in self.segment_names:
+                tiers[self._tier(name)].append(name)
+            full = [t for t in tiers.values() if len(t) >= _MERGE_FACTOR]
+            if not full:
+                break
+            merged = self._merge_segments(full[0])
+            self.segment_names = [
+                n for n in self.segment_names if n not in full[0]
+            ] + [merged]
+        self._save_catalog()
+
+    def merge(self) -> None:
+        """Merge every segment into one, dropping deleted documents."""
+        name = self._merge_segments(self.segment_names)
+        self.segment_names = [name]
+        self.deleted = set()
+        # Whatever was exported may still have the deleted documents in it
+        self.generation += 1
+        self._updated_terms = None
+        self._save_catalog()
+
+    def changes_since(
+        self, generation: int
+    ) -> Optional[Tuple[Set[str], Set[int]]]:
+        """The terms that have gained postings, and the ids of the
+        documents added or removed, since the index was at generation; or
+        None if they aren't known, which they are only for the updates
+        made since the index was opened.  Terms that only removed
+        documents had are not among them, since those aren't known."""
+        if self._updated_terms is None:
+            return None
+        if not self._opened <= generation <= self.generation:
+            return None
+        return (self._updated_terms, self._updated_docs)
+
+    def items(
+        self, prefix: str = ""
+    ) -> Iterator[Tuple[str, List[Tuple[int, int]]]]:
+        """Every term (beginning with prefix) with its live postings, in
+        term (UTF-8 byte) order, merged across segments without loading
+        them all at once."""
+        return self._merged(self.segment_names, prefix)
+
+    def _merged(
+        self, names: List[str], prefix: str = ""
+    ) -> Iterator[Tuple[str, List[Tuple[int, int]]]]:
+        streams = [self._segment(n).items(prefix) for n in names]
+        merged = heapq.merge(*streams, key=lambda item: item[0].encode())
+        current: Optional[str] = None
+        postings: List[Tuple[int, int]] = list()
+        for term, segment_postings in merged:
+            if term != current:
+                if current is not None and postings:
+                    yield current, sorted(postings)
+                current = term
+                postings = list()
+            postings.extend(
+                p for p in segment_postings if p[0] not in self.deleted
+            )
+        if current is not None and postings:
+            yield current, sorted(postings)
+
+    def postings(self, term: str) -> Dict[int, int]:
+        """Live postings for an already-normalized term: doc id -> tf"""
+        result: Dict[int, int] = dict()
+        for name in self.segment_names:
+            for doc_id, tf in self._segment(name).postings(term):
+                if doc_id not in self.deleted:
+                    result[doc_id] = tf
+        return result
+
+    def _term_scores(self, term: str) -> Dict[int, float]:
+        postings = self.postings(term)
+        idf = math.log(1 + max(len(self.docs), 1) / (1 + len(postings)))
+        return {d: (1 + math.log(tf)) * idf for d, tf in postings.items()}
+
+    def search(self, query: str, limit: int = 50) -> List[Tuple[str, float]]:
+        """Return (relative text path, score) for documents containing
+        every word of query, best first."""
+        terms = list(dict.fromkeys(self.rules.words(query)))
+        if not terms:
+            return list()
+        scores = self._term_scores(terms[0])
+        for term in terms[1:]:
+            if not scores:
+                break
+            term_scores = self._term_scores(term)
+            scores = {
+                d: s + term_scores[d]
+                for d, s in scores.items()
+                if d in term_scores
+            }
+        ranked = sorted(scores.items(), key=lambda i: (-i[1], i[0]))
+        return [(self.paths[d], s) for d, s in ranked[:limit]]
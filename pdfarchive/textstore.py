@@ -0,0 +1,435 @@
+"""Packed, compressed storage for extracted text.
+
+The Text tree normally holds one .txt file per document.  OCR of a big
+scan makes a lot of very compressible text, and millions of small files
+use up inodes and make every walk of the tree (by the search indexer, by
+backups) slow.  With the "packs" text store, once a build's jobs are done,
+the text files of each directory are folded into a pack there:
+
+* text-N.pack holds each document's text as a gzip member of its own, one
+  after another, so the whole pack is itself a gzip file (zcat reads it);
+* text-pack.json says where each document's member starts and how long it
+  is, and the size and mtime its text file had, which is what the search
+  index and the build's up-to-date checks go by.
+
+Text that changes is appended, and its old copy left as garbage until
+there is more garbage than text, when the pack is copied without it to
+text-(N+1).pack.  The jobs still write ordinary text files, which stay
+until the next packing; a text file takes precedence over a packed copy
+of the same document.  Going back to the "files" store unpacks them.
+
+A TextStore reads text wherever it is kept, loose or packed.  The search
+index reads through one, and so does text_app(), a WSGI application
+that serves the [text] links of the index pages out of the packs.  For a
+static web server, each packed document can instead be exported as
+x.txt.gz next to the pack, which nginx's gzip_static (or Apache's
+MultiViews) serves for x.txt.
+"""
+import gzip
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from .atomic import (
+    OUTPUT_MODE,
+    ChangeLog,
+    atomic_open,
+    remove,
+    write_atomically,
+)
+
+TEXT_STORES = ("files", "packs")
+DEFAULT_TEXT_STORE = "files"
+PACK_INDEX_NAME = "text-pack.json"
+
+_VERSION = 1
+_PACK_NAME = re.compile(r"text-(\d+)\.pack")
+# Pack indexes kept parsed
+_CACHED_INDEXES = 64
+
+# The offset and length of a document's member in the pack, and the size
+# and mtime_ns of the text file it came from
+_Entry = List[int]
+
+
+def pack_name(generation: int) -> str:
+    return f"text-{generation}.pack"
+
+
+def _is_text(name: str) -> bool:
+    # Hidden files are outputs still being written
+    return name.endswith(".txt") and not name.startswith(".")
+
+
+def _compress(data: bytes) -> bytes:
+    # No timestamp, so the same text always packs to the same bytes
+    return gzip.compress(data, mtime=0)
+
+
+@dataclass
+class PackIndex:
+    pack: str = ""
+    garbage: int = 0
+    documents: Dict[str, _Entry] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, directory: Path) -> Optional["PackIndex"]:
+        try:
+            saved = json.loads((directory / PACK_INDEX_NAME).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+        if not isinstance(saved, dict) or saved.get("version") != _VERSION:
+            return None
+        return cls(
+            pack=str(saved.get("pack", "")),
+            garbage=int(saved.get("garbage", 0)),
+            documents=dict(saved.get("documents", {})),
+        )
+
+    def save(self, directory: Path, changes: Optional[ChangeLog]) -> None:
+        write_atomically(
+            directory / PACK_INDEX_NAME,
+            json.dumps(
+                {
+                    "version": _VERSION,
+                    "pack": self.pack,
+                    "garbage": self.garbage,
+                    "documents": self.documents,
+                },
+                sort_keys=True,
+            ),
+            changes,
+        )
+
+    @property
+    def live(self) -> int:
+        return sum(entry[1] for entry in self.documents.values())
+
+
+class TextStore:
+    """The extracted text under text_dir, whether in text files or in
+    packs.  Paths may be absolute or relative to text_dir."""
+
+    def __init__(self, text_dir: Path) -> None:
+        self.text_dir = text_dir
+        self._indexes: "OrderedDict[Path, Tuple[int, Optional[PackIndex]]]"
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, path: Path) -> Path:
+        return path if path.is_absolute() else self.text_dir / path
+
+    def _index(self, directory: Path) -> Optional[PackIndex]:
+        """directory's pack index, if it has one, parsed again only when
+        it changes."""
+        try:
+            mtime = (directory / PACK_INDEX_NAME).stat().st_mtime_ns
+        except FileNotFoundError:
+            self._forget(directory)
+            return None
+        with self._lock:
+            cached = self._indexes.get(directory)
+            if cached is not None and cached[0] == mtime:
+                self._indexes.move_to_end(directory)
+                return cached[1]
+        index = PackIndex.load(directory)
+        with self._lock:
+            self._indexes[directory] = (mtime, index)
+            while len(self._indexes) > _CACHED_INDEXES:
+                self._indexes.popitem(last=False)
+        return index
+
+    def _forget(self, directory: Path) -> None:
+        with self._lock:
+            self._indexes.pop(directory, None)
+
+    def stat(self, path: Path) -> Optional[Tuple[int, int]]:
+        """The size and mtime_ns of the text at path, or None if there is
+        none."""
+        path = self._path(path)
+        try:
+            st = path.stat()
+            return (st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        index = self._index(path.parent)
+        entry = index.documents.get(path.name) if index else None
+        return (entry[2], entry[3]) if entry else None
+
+    def exists(self, path: Path) -> bool:
+        return self.stat(path) is not None
+
+    def read_bytes(self, path: Path) -> Optional[bytes]:
+        path = self._path(path)
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            pass
+        index = self._index(path.parent)
+        entry = index.documents.get(path.name) if index else None
+        if index is None or entry is None:
+            return None
+        try:
+            with open(path.parent / index.pack, "rb") as f:
+                f.seek(entry[0])
+                return gzip.decompress(f.read(entry[1]))
+        except FileNotFoundError:
+            # Repacked as we looked
+            return None
+
+    def read(self, path: Path) -> Optional[str]:
+        data = self.read_bytes(path)
+        return None if data is None else data.decode(errors="replace")
+
+    def scan(
+        self, directory: Path = Path("."), recursive: bool = True
+    ) -> Dict[str, Tuple[int, int]]:
+        """The size and mtime_ns of every document's text in directory,
+        and unless not recursive below it, keyed by its path relative to
+        text_dir."""
+        found: Dict[str, Tuple[int, int]] = dict()
+        stack = [self._path(directory)]
+        while stack:
+            current = stack.pop()
+            try:
+                entries = list(os.scandir(current))
+            except FileNotFoundError:
+                continue
+            relative = current.relative_to(self.text_dir)
+            if any(e.name == PACK_INDEX_NAME for e in entries):
+                index = self._index(current)
+                documents = index.documents if index else dict()
+                for name, entry in documents.items():
+                    found[str(relative / name)] = (entry[2], entry[3])
+            for e in entries:
+                if e.is_dir(follow_symlinks=False):
+                    if recursive:
+                        stack.append(Path(e.path))
+                elif _is_text(e.name) and e.is_file():
+                    st = e.stat()
+                    found[str(relative / e.name)] = (
+                        st.st_size,
+                        st.st_mtime_ns,
+                    )
+        return found
+
+    def pack(
+        self,
+        directory: Path,
+        gz: bool = False,
+        changes: Optional[ChangeLog] = None,
+    ) -> int:
+        """Fold the text files in directory (not those below it) into its
+        pack, and with gz, export every packed document as .txt.gz
+        (without, remove any such export).  Returns how many text files
+        were packed."""
+        directory = self._path(directory)
+        loose = sorted(p for p in directory.glob("*.txt") if _is_text(p.name))
+        index = PackIndex.load(directory) or PackIndex()
+        old_pack = index.pack
+        if loose:
+            index.pack = index.pack or pack_name(0)
+            self._append(directory, index, loose, changes)
+        if loose or index.pack != old_pack:
+            self._save(directory, index, old_pack, changes)
+        for p in loose:
+            remove(p, changes)
+        self._export(directory, index, gz, changes)
+        return len(loose)
+
+    def _append(
+        self,
+        directory: Path,
+        index: PackIndex,
+        loose: List[Path],
+        changes: Optional[ChangeLog],
+    ) -> None:
+        pack_path = directory / index.pack
+        existed = pack_path.exists()
+        appended = 0
+        with open(pack_path, "ab") as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            for p in loose:
+                st = p.stat()
+                data = _compress(p.read_bytes())
+                old = index.documents.get(p.name)
+                if old is not None and old[2] == st.st_size:
+                    if self._member(pack_path, old) == data:
+                        # Rebuilt the same: keep the old copy, and its
+                        # mtime, so it isn't reindexed.
+                        continue
+                if old is not None:
+                    index.garbage += old[1]
+                f.write(data)
+                index.documents[p.name] = [
+                    offset,
+                    len(data),
+                    st.st_size,
+                    st.st_mtime_ns,
+                ]
+                offset += len(data)
+                appended += 1
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(pack_path, OUTPUT_MODE)
+        if changes is not None and appended:
+            changes.record(pack_path, "changed" if existed else "added")
+
+    def _member(self, pack_path: Path, entry: _Entry) -> bytes:
+        with open(pack_path, "rb") as f:
+            f.seek(entry[0])
+            return f.read(entry[1])
+
+    def _save(
+        self,
+        directory: Path,
+        index: PackIndex,
+        old_pack: str,
+        changes: Optional[ChangeLog],
+    ) -> None:
+        """Write index, first copying the pack without its garbage if
+        there is more of that than text, and remove whatever pack it no
+        longer uses."""
+        if not index.documents:
+            remove(directory / PACK_INDEX_NAME, changes)
+            if old_pack:
+                remove(directory / old_pack, changes)
+            self._forget(directory)
+            return
+        if index.garbage > index.live:
+            self._compact(directory, index, changes)
+        index.save(directory, changes)
+        self._forget(directory)
+        if old_pack and old_pack != index.pack:
+            remove(directory / old_pack, changes)
+
+    def _compact(
+        self,
+        directory: Path,
+        index: PackIndex,
+        changes: Optional[ChangeLog],
+    ) -> None:
+        match = _PACK_NAME.fullmatch(index.pack)
+        generation = int(match.group(1)) + 1 if match else 0
+        new_pack = pack_name(generation)
+        documents: Dict[str, _Entry] = dict()
+        with open(directory / index.pack, "rb") as src:
+            with atomic_open(directory / new_pack, "wb", changes) as dst:
+                offset = 0
+                for name, entry in sorted(index.documents.items()):
+                    src.seek(entry[0])
+                    dst.write(src.read(entry[1]))
+                    documents[name] = [offset, *entry[1:]]
+                    offset += entry[1]
+        index.pack, index.garbage, index.documents = new_pack, 0, documents
+
+    def _export(
+        self,
+        directory: Path,
+        index: PackIndex,
+        gz: bool,
+        changes: Optional[ChangeLog],
+    ) -> None:
+        """Bring the .txt.gz exports in directory into line with index.
+        Each is a copy of the document's member of the pack, with the
+        mtime of its text."""
+        wanted = set(index.documents) if gz else set()
+        for export in directory.glob("*.txt.gz"):
+            if export.name[: -len(".gz")] not in wanted:
+                remove(export, changes)
+        for name in sorted(wanted):
+            entry = index.documents[name]
+            export = directory / f"{name}.gz"
+            try:
+                if export.stat().st_mtime_ns == entry[3]:
+                    continue
+            except FileNotFoundError:
+                pass
+            with atomic_open(export, "wb", changes) as f:
+                f.write(self._member(directory / index.pack, entry))
+            if export.exists():
+                os.utime(export, ns=(entry[3], entry[3]))
+
+    def prune(
+        self,
+        directory: Path,
+        keep: Set[str],
+        changes: Optional[ChangeLog] = None,
+    ) -> int:
+        """Drop the packed text of documents in directory whose names
+        (like "x.txt") are not in keep.  Returns how many were dropped."""
+        directory = self._path(directory)
+        index = PackIndex.load(directory)
+        if index is None:
+            return 0
+        gone = [name for name in index.documents if name not in keep]
+        if not gone:
+            return 0
+        for name in gone:
+            index.garbage += index.documents.pop(name)[1]
+            remove(directory / f"{name}.gz", changes)
+        self._save(directory, index, index.pack, changes)
+        return len(gone)
+
+    def unpack(
+        self, directory: Path, changes: Optional[ChangeLog] = None
+    ) -> int:
+        """Write the packed text in directory back out as text files,
+        with their old mtimes, and remove the pack and any exports.
+        Returns how many text files were written."""
+        directory = self._path(directory)
+        index = PackIndex.load(directory)
+        if index is None:
+            return 0
+        written = 0
+        for name, entry in sorted(index.documents.items()):
+            path = directory / name
+            if path.exists():
+                continue
+            data = gzip.decompress(self._member(directory / index.pack, entry))
+            with atomic_open(path, "wb", changes) as f:
+                f.write(data)
+            os.utime(path, ns=(entry[3], entry[3]))
+            written += 1
+        index.documents = dict()
+        self._export(directory, index, False, changes)
+        self._save(directory, index, index.pack, changes)
+        return written
+
+
+_Environ = Dict[str, Any]
+_StartResponse = Callable[..., Any]
+
+
+def text_app(
+    text_dir: Path,
+) -> Callable[[_Environ, _StartResponse], Iterable[bytes]]:
+    """A WSGI application serving each document's text at its path under
+    text_dir, wherever it is kept; mount it at /Text for the index pages'
+    [text] links."""
+    store = TextStore(text_dir)
+
+    def app(environ: _Environ, start_response: _StartResponse) -> List[bytes]:
+        parts = [p for p in environ.get("PATH_INFO", "").split("/") if p]
+        data = None
+        if parts and _is_text(parts[-1]) and ".." not in parts:
+            data = store.read_bytes(Path(*parts))
+        if data is None:
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b"Not found\n"]
+        start_response(
+            "200 OK",
+            [
+                ("Content-Type", "text/plain; charset=utf-8"),
+                ("Content-Length", str(len(data))),
+            ],
+        )
+        return [data]
+
+    return app
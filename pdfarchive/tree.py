@@ -0,0 +1,107 @@
+"""In-memory model of the archive tree, built by a single os.scandir walk.
+
+Each DirectoryNode knows its documents, archives, and subdirectories, so
+nothing downstream needs to list a directory again.  Entries are sorted by
+name, so page content does not depend on the order the filesystem happens
+to return them in.
+"""
+import os
+import stat
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator, List, Sequence, Tuple
+
+DOCUMENT_SUFFIXES = (".pdf", ".jpg", ".png")
+ARCHIVE_SUFFIXES = (".zip", ".gz", ".tar", ".xz", ".7z")
+
+_FILE_MODE = 0o644
+_DIR_MODE = 0o755
+
+
+@dataclass
+class DirectoryNode:
+    path: Path
+    relative_path: Path
+    dirs: List["DirectoryNode"] = field(default_factory=list)
+    files: List[Path] = field(default_factory=list)
+    archives: List[Path] = field(default_factory=list)
+
+    def walk(self) -> Iterator["DirectoryNode"]:
+        """This node and all its descendants, parents before children."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.dirs))
+
+
+def _fix_mode(entry: os.DirEntry, mode: int) -> None:
+    # The stat is cached on the DirEntry, so this costs a chmod only for
+    # the entries whose permissions are actually wrong.
+    try:
+        if stat.S_IMODE(entry.stat().st_mode) != mode:
+            os.chmod(entry.path, mode)
+    except OSError:
+        pass
+
+
+def scan_directory(
+    node: DirectoryNode, skipdirs: Sequence[str] = (), fix_modes: bool = True
+) -> List[Tuple[str, Path]]:
+    """Fill in node's files and archives and return the (name, path) of
+    its subdirectories, skipping any named in skipdirs.  With fix_modes,
+    files are made 0644 and directories 0755 along the way."""
+    subdirs: List[Tuple[str, Path]] = list()
+    with os.scandir(node.path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+        if entry.is_dir():
+            if entry.name in skipdirs:
+                continue
+            if fix_modes:
+                _fix_mode(entry, _DIR_MODE)
+            subdirs.append((entry.name, Path(node.path / entry.name)))
+        elif entry.is_file():
+            suffix = os.path.splitext(entry.name)[1].lower()
+            if suffix in DOCUMENT_SUFFIXES:
+                node.files.append(Path(node.path / entry.name))
+            elif suffix in ARCHIVE_SUFFIXES:
+                node.archives.append(Path(node.path / entry.name))
+            if fix_modes:
+                _fix_mode(entry, _FILE_MODE)
+    return subdirs
+
+
+def scan_shallow(
+    root: Path, relative_path: Path = Path("."), skipdirs: Sequence[str] = ()
+) -> DirectoryNode:
+    """Just root: its documents and archives, and its subdirectories as
+    nodes that have not been scanned."""
+    top = DirectoryNode(path=root, relative_path=relative_path)
+    for name, path in scan_directory(top, skipdirs):
+        top.dirs.append(
+            DirectoryNode(path=path, relative_path=Path(relative_path / name))
+        )
+    return top
+
+
+def scan_tree(
+    root: Path,
+    relative_path: Path = Path("."),
+    skipdirs: Sequence[str] = (),
+    fix_modes: bool = True,
+) -> DirectoryNode:
+    """Walk everything under root once.  skipdirs applies only to root's
+    own subdirectories (that's where the generated Thumbs, Text, etc.
+    live)."""
+    top = DirectoryNode(path=root, relative_path=relative_path)
+    stack = [(top, skipdirs)]
+    while stack:
+        node, skip = stack.pop()
+        for name, path in scan_directory(node, skip, fix_modes):
+            child = DirectoryNode(
+                path=path, relative_path=Path(node.relative_path / name)
+            )
+            node.dirs.append(child)
+            stack.append((child, ()))
+    return top
@@ -0,0 +1,120 @@
+"""Deciding, before extraction, which pages of a PDF need OCR.
+
+A PDF with no fonts at all has no text layer, so there is no point running
+pdftotext on it; pdffonts tells us that without rendering anything.  When
+there are fonts, pdftotext's output has a form feed after every page, so
+one run tells us which pages have text and which are images of text.  Only
+the latter go to OCR: a scanned manual with a typeset cover page gets its
+body OCRed, and a born-digital one with a single scanned diagram gets just
+that page OCRed.  A page without text that shows no images either (a blank
+separator page, or a figure drawn in vectors) has nothing to OCR, so when
+pdfimages can tell us which pages show images, only those are OCRed.
+"""
+import re
+from enum import Enum
+from logging import Logger
+from pathlib import Path
+from typing import AbstractSet, Iterator, List, Optional, Sequence, Set, Tuple
+
+from .external import ExecutionEngine, run_output
+
+# A page with fewer word characters than this is treated as having no text
+# layer (a page number or a stray header isn't worth keeping instead of OCR).
+MIN_PAGE_CHARS = 10
+
+
+class Layout(Enum):
+    TEXT = "text"
+    SCANNED = "scanned"
+    MIXED = "mixed"
+
+
+def has_fonts(
+    pdf: Path,
+    logger: Optional[Logger] = None,
+    engine: Optional[ExecutionEngine] = None,
+) -> Optional[bool]:
+    """Ask pdffonts whether pdf uses any fonts; None if it can't tell us."""
+    output = run_output(["pdffonts", f"{pdf}"], logger, engine=engine)
+    if output is None:
+        return None
+    lines = output.splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith("---"):
+            return any(rest.strip() for rest in lines[i + 1 :])
+    return None
+
+
+def image_pages(
+    pdf: Path,
+    logger: Optional[Logger] = None,
+    engine: Optional[ExecutionEngine] = None,
+) -> Optional[Set[int]]:
+    """Ask pdfimages which pages of pdf (numbered from 0) show any images;
+    None if it can't tell us."""
+    output = run_output(
+        ["pdfimages", "-list", f"{pdf}"], logger, engine=engine
+    )
+    if output is None:
+        return None
+    lines = output.splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith("---"):
+            return {
+                int(fields[0]) - 1
+                for fields in (rest.split() for rest in lines[i + 1 :])
+                if fields and fields[0].isdigit()
+            }
+    return None
+
+
+def split_pages(text: str) -> List[str]:
+    """Split pdftotext output into pages, each with its form feed."""
+    pages = text.split("\f")
+    if pages and not pages[-1].strip():
+        # pdftotext ends every page, including the last, with a form feed
+        pages.pop()
+    return [f"{p}\f" for p in pages]
+
+
+def page_has_text(text: str) -> bool:
+    return len(re.findall(r"\w", text)) >= MIN_PAGE_CHARS
+
+
+def pages_needing_ocr(
+    pages: Sequence[str], images: Optional[AbstractSet[int]] = None
+) -> List[int]:
+    """The pages without text, leaving out those that don't show any of
+    images (the pages that do), if that is known."""
+    return [
+        i
+        for i, text in enumerate(pages)
+        if not page_has_text(text) and (images is None or i in images)
+    ]
+
+
+def classify(
+    pages: Sequence[str], images: Optional[AbstractSet[int]] = None
+) -> Layout:
+    needed = len(pages_needing_ocr(pages, images))
+    if pages and not needed:
+        return Layout.TEXT
+    if needed < len(pages):
+        return Layout.MIXED
+    return Layout.SCANNED
+
+
+def page_runs(pages: Sequence[int], limit: int) -> Iterator[Tuple[int, int]]:
+    """Group sorted page numbers into (first, last) runs of consecutive
+    pages, no more than limit pages long."""
+    first: Optional[int] = None
+    last = 0
+    for page in pages:
+        if first is not None and page == last + 1 and page - first < limit:
+            last = page
+            continue
+        if first is not None:
+            yield first, last
+        first = last = page
+    if first is not None:
+        yield first, last
@@ -0,0 +1,361 @@
+"""Keeping a built archive up to date as documents come and go.
+
+A Watcher reports which directories under the archive root have changed:
+on Linux by inotify, with a watch on every directory (other than the
+generated ones at the root), and elsewhere by rescanning the tree every
+so often.  Only documents and archives count; the index pages and
+temporary files the build itself writes are ignored, as are hidden files,
+which is what most upload tools write to before renaming into place.
+
+Changes are collected until nothing has happened for a quiet period (or
+for at most max_delay, while an upload goes on and on), and then only the
+directories that changed are rescanned, their index pages rewritten,
+their new and changed documents thumbnailed and extracted, the outputs of
+removed documents deleted, and their part of the search index brought up
+to date.  A directory that appears (or the whole tree, if inotify loses
+track) is scanned all the way down.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import signal
+import struct
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from .index import Indexer
+from .metrics import BuildResult
+from .planner import format_duration
+from .tree import ARCHIVE_SUFFIXES, DOCUMENT_SUFFIXES
+
+DEFAULT_QUIET = 2.0
+DEFAULT_MAX_DELAY = 30.0
+
+# From <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_MASK = (
+    _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+    | _IN_DELETE_SELF
+    | _IN_ONLYDIR
+)
+_EVENT = struct.Struct("iIII")
+
+_RELEVANT_SUFFIXES = DOCUMENT_SUFFIXES + ARCHIVE_SUFFIXES
+
+# A snapshot of the tree, for polling: for each directory, the size and
+# mtime of each of its documents and archives
+Snapshot = Dict[Path, Dict[str, Tuple[int, int]]]
+
+
+def _relevant(name: str) -> bool:
+    if name.startswith("."):
+        return False
+    return os.path.splitext(name)[1].lower() in _RELEVANT_SUFFIXES
+
+
+@dataclass
+class Changes:
+    """Directories to rescan: trees all the way down, dirs just
+    themselves."""
+
+    trees: Set[Path] = field(default_factory=set)
+    dirs: Set[Path] = field(default_factory=set)
+
+    def __bool__(self) -> bool:
+        return bool(self.trees or self.dirs)
+
+    def file_changed(self, path: Path) -> None:
+        self.dirs.add(path.parent)
+
+    def directory_changed(self, path: Path) -> None:
+        """A directory appeared or disappeared."""
+        self.trees.add(path)
+        self.dirs.add(path.parent)
+
+    def merge(self, other: "Changes") -> None:
+        self.trees |= other.trees
+        self.dirs |= other.dirs
+
+    def resolve(self) -> Tuple[List[Path], List[Path]]:
+        """The trees and directories that still exist, with anything
+        inside a tree left out, since it will be scanned anyway."""
+        trees: List[Path] = list()
+        for path in sorted(self.trees):
+            if not path.is_dir():
+                continue
+            if not any(t == path or t in path.parents for t in trees):
+                trees.append(path)
+        dirs = [
+            path
+            for path in sorted(self.dirs)
+            if path.is_dir()
+            and not any(t == path or t in path.parents for t in trees)
+        ]
+        return (trees, dirs)
+
+
+class Watcher(ABC):
+    """Reports the changes to the documents and directories under root,
+    skipping root's subdirectories named in skipdirs."""
+
+    def __init__(self, root: Path, skipdirs: Sequence[str] = ()) -> None:
+        self.root = root
+        self.skipdirs = skipdirs
+
+    def _skipped(self, path: Path) -> bool:
+        return path.parent == self.root and path.name in self.skipdirs
+
+    @abstractmethod
+    def read(self, timeout: float) -> Changes:
+        """Wait up to timeout seconds for changes, and return them."""
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher(Watcher):
+    def __init__(self, root: Path, skipdirs: Sequence[str] = ()) -> None:
+        super().__init__(root, skipdirs)
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1: {os.strerror(err)}")
+        self._watches: Dict[int, Path] = dict()
+        self._watch_tree(root)
+
+    def _watch(self, directory: Path) -> None:
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(directory), _MASK
+        )
+        if wd >= 0:
+            self._watches[wd] = directory
+            return
+        err = ctypes.get_errno()
+        if err in (errno.ENOENT, errno.ENOTDIR):
+            # Gone again already
+            return
+        if err == errno.ENOSPC:
+            raise RuntimeError(
+                f"Out of inotify watches at '{directory}'; raise"
+                " fs.inotify.max_user_watches"
+            )
+        raise OSError(err, f"Cannot watch '{directory}': {os.strerror(err)}")
+
+    def _watch_tree(self, top: Path) -> None:
+        stack = [top]
+        while stack:
+            directory = stack.pop()
+            self._watch(directory)
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        path = Path(entry.path)
+                        if entry.is_dir() and not self._skipped(path):
+                            stack.append(path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+    def _unwatch_tree(self, top: Path) -> None:
+        for wd, directory in list(self._watches.items()):
+            if directory == top or top in directory.parents:
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+
+    def _events(self) -> bytes:
+        data = b""
+        while True:
+            try:
+                chunk = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return data
+            if not chunk:
+                return data
+            data += chunk
+
+    def read(self, timeout: float) -> Changes:
+        changes = Changes()
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return changes
+        data = self._events()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            raw = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                # Lost track: look at everything
+                changes.trees.add(self.root)
+                continue
+            if mask & _IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None or mask & _IN_DELETE_SELF:
+                continue
+            path = directory / os.fsdecode(raw)
+            if mask & _IN_ISDIR:
+                if self._skipped(path):
+                    continue
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    self._watch_tree(path)
+                elif mask & _IN_MOVED_FROM:
+                    self._unwatch_tree(path)
+                changes.directory_changed(path)
+            elif _relevant(path.name):
+                changes.file_changed(path)
+        return changes
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class PollingWatcher(Watcher):
+    """For when there is no inotify: rescans the tree (without reading
+    anything but directory entries) each time it is read."""
+
+    def __init__(self, root: Path, skipdirs: Sequence[str] = ()) -> None:
+        super().__init__(root, skipdirs)
+        self._snapshot = self._scan()
+
+    def _scan(self) -> Snapshot:
+        snapshot: Snapshot = dict()
+        stack = [self.root]
+        while stack:
+            directory = stack.pop()
+            files: Dict[str, Tuple[int, int]] = dict()
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        path = Path(entry.path)
+                        if entry.is_dir():
+                            if not self._skipped(path):
+                                stack.append(path)
+                        elif _relevant(entry.name) and entry.is_file():
+                            st = entry.stat()
+                            files[entry.name] = (st.st_size, st.st_mtime_ns)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            snapshot[directory] = files
+        return snapshot
+
+    def read(self, timeout: float) -> Changes:
+        time.sleep(timeout)
+        snapshot = self._scan()
+        changes = Changes()
+        for directory in snapshot.keys() ^ self._snapshot.keys():
+            changes.directory_changed(directory)
+        for directory in snapshot.keys() & self._snapshot.keys():
+            if snapshot[directory] != self._snapshot[directory]:
+                changes.dirs.add(directory)
+        self._snapshot = snapshot
+        return changes
+
+
+def open_watcher(root: Path, skipdirs: Sequence[str] = ()) -> Watcher:
+    """An InotifyWatcher if the platform has inotify, otherwise a
+    PollingWatcher."""
+    libc = ctypes.util.find_library("c")
+    if libc and hasattr(ctypes.CDLL(libc), "inotify_init1"):
+        return InotifyWatcher(root, skipdirs)
+    return PollingWatcher(root, skipdirs)
+
+
+def _report(indexer: Indexer, what: str, failed: int) -> BuildResult:
+    """Log how a build or update went, and write its run report and the
+    changes so far."""
+    indexer.metrics.finish()
+    result = indexer.metrics.result(
+        failed, indexer.context.report, indexer.changes.as_dict()
+    )
+    message = f"{what} took {format_duration(result.wall_time)}"
+    if failed:
+        indexer.logger.warning(f"{message}; {failed} jobs failed")
+    else:
+        indexer.logger.info(message)
+    indexer.write_run_report()
+    indexer.write_change_manifest()
+    return result
+
+
+def watch(
+    indexer: Indexer,
+    quiet: float = DEFAULT_QUIET,
+    max_delay: float = DEFAULT_MAX_DELAY,
+    watcher: Optional[Watcher] = None,
+    stop: Optional[threading.Event] = None,
+) -> None:
+    """Build the site with indexer (which must be the root Indexer) and
+    then keep it up to date until stop is set, or until interrupted or
+    terminated.  Changes are applied once there have been none for quiet
+    seconds, or max_delay seconds after the first of them."""
+    if not indexer.is_root:
+        raise RuntimeError("Can only watch from the root Indexer")
+    stop = stop or threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    # Start watching first, so nothing that happens during the build is
+    # missed.
+    watcher = watcher or open_watcher(indexer.base_dir, indexer.skip_dirs)
+    logger = indexer.logger
+    try:
+        _report(indexer, "Build", indexer.build_root())
+        logger.info(f"Watching '{indexer.base_dir}' for changes")
+        pending = Changes()
+        first = 0.0
+        while not stop.is_set():
+            try:
+                changes = watcher.read(quiet)
+            except KeyboardInterrupt:
+                break
+            if changes:
+                if not pending:
+                    first = time.monotonic()
+                pending.merge(changes)
+                if time.monotonic() - first < max_delay:
+                    continue
+            if not pending:
+                continue
+            trees, dirs = pending.resolve()
+            pending = Changes()
+            logger.info(
+                f"Updating {len(trees)} new trees and {len(dirs)}"
+                " changed directories"
+            )
+            # Each update is measured, learned from, and published on its
+            # own
+            indexer.planner.learn(indexer.metrics)
+            indexer.metrics.reset()
+            indexer.changes.clear()
+            try:
+                failed = indexer.update_directories(trees, dirs)
+            except Exception as exc:
+                # A directory removed or locked under us, say; whatever
+                # changes there next will be picked up then.
+                logger.exception(f"Update failed: {exc}")
+                failed = 1 + len(indexer.scheduler.wait())
+            _report(indexer, "Update", failed)
+    finally:
+        watcher.close()
+        indexer.close()
@@ -0,0 +1,231 @@
+"""Working through a distributed build's queue.
+
+A Worker claims tasks from a WorkQueue filled by a coordinating Indexer
+and runs each one on its own Scheduler, start to finish, as a single job:
+a scanned PDF is OCRed a batch of pages at a time in one job rather than
+in jobs of its own, since the parallelism now comes from many documents
+on many machines.  It claims only as many tasks as it has CPUs, so that
+idle machines get the rest, and keeps its leases alive while it works.
+
+Workers don't touch the shared build manifest; the coordinator records
+each task's outputs once it is done.  Each worker writes its own run
+report, named for the worker, next to the coordinator's.
+"""
+import dataclasses
+import threading
+from concurrent.futures import Future
+from functools import partial
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, Optional, Union
+
+from .context import BuildContext
+from .index import Indexer
+from .manifest import Manifest
+from .scheduler import JobClass
+from .tree import DirectoryNode
+from .workqueue import (
+    DEFAULT_LEASE,
+    DEFAULT_POLL,
+    QUEUE_DIR,
+    Lease,
+    Task,
+    WorkQueue,
+    default_worker_id,
+    safe_name,
+)
+
+
+def job_class(task: Task) -> JobClass:
+    if task.kind == "thumbnail":
+        return JobClass.THUMBNAIL
+    if task.kind == "archive":
+        return JobClass.ARCHIVE
+    if task.name.lower().endswith(".pdf"):
+        return JobClass.DOCUMENT
+    return JobClass.EXTRACT_FAST
+
+
+class Worker:
+    def __init__(
+        self,
+        context: BuildContext,
+        queue: WorkQueue,
+        worker_id: Optional[str] = None,
+        poll: float = DEFAULT_POLL,
+    ) -> None:
+        self.context = context
+        self.queue = queue
+        self.worker_id = worker_id or default_worker_id()
+        self.poll = poll
+        self.logger = context.logger
+        self.capacity = max(1, int(context.scheduler.budget.cpu))
+        self.done = 0
+        self.failed = 0
+        self._indexers: Dict[str, Indexer] = dict()
+        self._held: Dict[Path, Lease] = dict()
+        self._lock = threading.Condition()
+        self._stop = threading.Event()
+        # The seal of a run that was over before we started
+        self._stale_seal: Optional[str] = None
+
+    def _indexer(self, directory: str) -> Indexer:
+        """An Indexer for directory, without scanning it."""
+        if directory not in self._indexers:
+            relative_path = Path(directory)
+            node = DirectoryNode(
+                path=self.context.base_dir / relative_path,
+                relative_path=relative_path,
+            )
+            self._indexers[directory] = Indexer(
+                base_dir=self.context.base_dir, context=self.context, node=node
+            )
+        return self._indexers[directory]
+
+    def _start(self, lease: Lease) -> None:
+        task = lease.task
+        self.logger.info(
+            f"Claimed {task.kind} task for '{task.directory}/{task.name}'"
+        )
+        with self._lock:
+            self._held[lease.path] = lease
+        indexer = self._indexer(task.directory)
+        future = self.context.scheduler.submit(
+            job_class(task), indexer.run_task, task
+        )
+        future.add_done_callback(partial(self._finished, lease))
+
+    def _finished(self, lease: Lease, future: Future) -> None:
+        exc = future.exception()
+        if exc is not None:
+            self.queue.fail(lease, f"{type(exc).__name__}: {exc}")
+            self.failed += 1
+        elif self.queue.complete(lease):
+            self.done += 1
+        else:
+            self.logger.warning(
+                f"Lost the lease on {lease.task.kind} task for"
+                f" '{lease.task.name}'; leaving it to its new holder"
+            )
+        with self._lock:
+            del self._held[lease.path]
+            self._lock.notify_all()
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(self.queue.lease / 3):
+            with self._lock:
+                leases = list(self._held.values())
+            for lease in leases:
+                if not self.queue.heartbeat(lease):
+                    self.logger.warning(
+                        f"Lease on '{lease.task.name}' has expired"
+                    )
+
+    def _work(self) -> None:
+        while True:
+            with self._lock:
+                busy = len(self._held)
+            if busy < self.capacity:
+                lease = self.queue.claim(self.worker_id)
+                if lease is not None:
+                    self._start(lease)
+                    continue
+                for task in self.queue.reap():
+                    self.logger.warning(
+                        f"Lease on {task.kind} task for '{task.name}' expired"
+                    )
+                if not busy and self.queue.idle():
+                    seal = self.queue.seal_token()
+                    if seal is not None and seal != self._stale_seal:
+                        return
+            with self._lock:
+                self._lock.wait(self.poll)
+
+    def run(self) -> None:
+        """Work until the coordinator's run is finished: the queue is
+        sealed and nothing is pending or leased.  A queue already sealed
+        and idle when the worker starts is left over from an earlier run,
+        so the worker waits for the next one.  If interrupted, give
+        back the tasks still in progress."""
+        self.logger.info(
+            f"Worker {self.worker_id} on '{self.queue.directory}'"
+        )
+        if self.queue.idle():
+            # Whatever sealed the queue is over; wait for the next run's
+            # coordinator to reset it, rather than leaving at once.
+            self._stale_seal = self.queue.seal_token()
+        heartbeat = threading.Thread(
+            target=self._heartbeat, name="pdfarchive-heartbeat", daemon=True
+        )
+        heartbeat.start()
+        try:
+            self._work()
+        finally:
+            self._stop.set()
+            with self._lock:
+                leases = list(self._held.values())
+            for lease in leases:
+                self.queue.release(lease)
+        self.context.scheduler.wait()
+        self.logger.info(
+            f"Worker {self.worker_id} finished: {self.done} tasks done,"
+            f" {self.failed} failed"
+        )
+        engine = self.context.engine
+        engine.log_stats(self.logger)
+        self.context.metrics.finish()
+        if self.context.report:
+            self.context.metrics.write_report(
+                self.context.report, engine.stats
+            )
+        if self.context.change_manifest:
+            self.context.changes.write(self.context.change_manifest)
+        self.context.close()
+
+
+def work(
+    base_dir: Union[str, Path, None],
+    queue_dir: Union[str, Path, None] = None,
+    lease: float = DEFAULT_LEASE,
+    worker_id: Optional[str] = None,
+    report: Union[str, Path, None] = None,
+    poll: float = DEFAULT_POLL,
+    **settings: Any,
+) -> Worker:
+    """Work on the queue in queue_dir (indexer_config_dir/queue by
+    default) until the run is finished, and return the Worker.  settings
+    are passed to BuildContext.create(); they should match the
+    coordinator's."""
+    if not base_dir:
+        raise RuntimeError("base_dir must be specified")
+    worker_id = worker_id or default_worker_id()
+    with TemporaryDirectory() as tmpdir:
+        # Only the coordinator writes the shared manifest.
+        manifest = Manifest(
+            Path(tmpdir) / "manifest.sqlite3", base_dir=Path(base_dir)
+        )
+        context = BuildContext.create(
+            base_dir=base_dir, manifest=manifest, report=report, **settings
+        )
+        if report is None:
+            context = dataclasses.replace(
+                context,
+                report=context.indexer_config_dir
+                / f"run-report-{safe_name(worker_id)}.json",
+            )
+        if not settings.get("change_manifest"):
+            context = dataclasses.replace(
+                context,
+                change_manifest=context.indexer_config_dir
+                / f"changes-{safe_name(worker_id)}.json",
+            )
+        queue = WorkQueue(
+            Path(queue_dir)
+            if queue_dir
+            else context.indexer_config_dir / QUEUE_DIR,
+            lease=lease,
+        )
+        worker = Worker(context, queue, worker_id=worker_id, poll=poll)
+        worker.run()
+        manifest.close()
+    return worker
@@ -0,0 +1,303 @@
+"""A work queue for building one archive on several machines at once.
+
+The queue is a directory on the shared tree (indexer_config_dir/queue by
+default), with no broker or database behind it: every task is a small
+JSON file, and every change of state is a rename, which is atomic even
+over NFS, where SQLite's locking cannot be trusted.
+
+    pending/<seq>-<id>.json           waiting for a worker
+    leased/<seq>-<id>~<worker>.json   claimed by a worker
+    done/<id>.json                    finished
+    failed/<id>.json                  gave up on it, with the error
+
+A worker claims a task by renaming it from pending into leased; only one
+rename can succeed.  The lease lasts as long as the leased file's mtime is
+recent, so the worker touches it periodically while it works.  If the
+worker dies, its leases go stale, and the next worker or coordinator to
+look renames them back into pending.  A task whose leases have gone stale
+max_attempts times (a document that kills whatever works on it, say) is
+failed instead.
+
+Lease ages are computed from the file server's mtimes and the local
+clock, so the lease should be long compared with the clock skew between
+machines.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import time
+import uuid
+from dataclasses import asdict, dataclass, replace
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Where the queue lives, under indexer_config_dir, unless told otherwise
+QUEUE_DIR = "queue"
+DEFAULT_LEASE = 300.0
+DEFAULT_POLL = 5.0
+
+_SEALED = "sealed"
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def safe_name(name: str) -> str:
+    return re.sub(r"[^\w.-]", "_", name)
+
+
+def _write_atomic(path: Path, data: str) -> None:
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    tmp.write_text(data)
+    os.replace(tmp, path)
+
+
+@dataclass(frozen=True)
+class Task:
+    """One unit of distributed work: the thumbnail or the text of a
+    document, or the named members of an archive.  directory is relative
+    to the archive root."""
+
+    kind: str
+    directory: str
+    name: str
+    members: Tuple[str, ...] = ()
+    attempts: int = 0
+
+    @property
+    def id(self) -> str:
+        key = f"{self.kind}\0{self.directory}\0{self.name}"
+        return hashlib.sha256(key.encode()).hexdigest()[:24]
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, text: str) -> "Task":
+        data: Dict[str, Any] = json.loads(text)
+        data["members"] = tuple(data.get("members", ()))
+        return cls(**data)
+
+
+@dataclass(frozen=True)
+class Lease:
+    """A claimed task and the file that holds the claim."""
+
+    task: Task
+    path: Path
+
+
+class WorkQueue:
+    def __init__(
+        self,
+        directory: Path,
+        lease: float = DEFAULT_LEASE,
+        max_attempts: int = 3,
+    ) -> None:
+        self.directory = directory
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._pending = directory / "pending"
+        self._leased = directory / "leased"
+        self._done = directory / "done"
+        self._failed = directory / "failed"
+        for d in (self._pending, self._leased, self._done, self._failed):
+            d.mkdir(parents=True, exist_ok=True)
+        self._seq = 0
+
+    def reset(self) -> None:
+        """Forget everything; for the start of a run."""
+        (self.directory / _SEALED).unlink(missing_ok=True)
+        for d in (self._pending, self._leased, self._done, self._failed):
+            for path in d.iterdir():
+                path.unlink(missing_ok=True)
+        self._seq = 0
+
+    def put(self, task: Task) -> None:
+        self._seq += 1
+        _write_atomic(
+            self._pending / f"{self._seq:08d}-{task.id}.json", task.to_json()
+        )
+
+    def seal(self) -> None:
+        """Say that no more tasks are coming in this run.  The seal holds
+        a token of its own, so that a worker can tell the seal of the run
+        it worked on from one left over from an earlier run."""
+        _write_atomic(self.directory / _SEALED, f"{uuid.uuid4().hex}\n")
+
+    def seal_token(self) -> Optional[str]:
+        """The token of the current seal, or None if unsealed."""
+        try:
+            return (self.directory / _SEALED).read_text().strip()
+        except FileNotFoundError:
+            return None
+
+    @property
+    def sealed(self) -> bool:
+        return self.seal_token() is not None
+
+    def counts(self) -> Dict[str, int]:
+        return {
+            d.name: len(list(d.glob("*.json")))
+            for d in (self._pending, self._leased, self._done, self._failed)
+        }
+
+    def idle(self) -> bool:
+        """Whether nothing is waiting or being worked on."""
+        return not any(self._pending.glob("*.json")) and not any(
+            self._leased.glob("*.json")
+        )
+
+    def claim(self, worker: str) -> Optional[Lease]:
+        """Take the oldest pending task, or return None if there isn't
+        one."""
+        for path in sorted(self._pending.glob("*.json")):
+            leased = self._leased / f"{path.stem}~{safe_name(worker)}.json"
+            try:
+                os.rename(path, leased)
+                # Renaming doesn't change the mtime, and the mtime is what
+                # says how old the lease is.
+                os.utime(leased)
+                task = Task.from_json(leased.read_text())
+            except FileNotFoundError:
+                # Somebody else got it first (or reaped it before we could
+                # touch it)
+                continue
+            return Lease(task=task, path=leased)
+        return None
+
+    def heartbeat(self, lease: Lease) -> bool:
+        """Renew a lease.  Returns False if it has been lost."""
+        try:
+            os.utime(lease.path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def complete(self, lease: Lease) -> bool:
+        """Mark a leased task done.  If the lease was lost, the task
+        belongs to whoever claims it next, and this returns False."""
+        if not lease.path.exists():
+            return False
+        _write_atomic(
+            self._done / f"{lease.task.id}.json", lease.task.to_json()
+        )
+        lease.path.unlink(missing_ok=True)
+        return True
+
+    def fail(self, lease: Lease, error: str) -> None:
+        self._fail(lease.task, error)
+        lease.path.unlink(missing_ok=True)
+
+    def _fail(self, task: Task, error: str) -> None:
+        _write_atomic(
+            self._failed / f"{task.id}.json",
+            json.dumps({"task": asdict(task), "error": error}),
+        )
+
+    def release(self, lease: Lease) -> None:
+        """Give a task back without working on it (when a worker is
+        stopped)."""
+        stem = lease.path.stem.split("~")[0]
+        try:
+            os.rename(lease.path, self._pending / f"{stem}.json")
+        except FileNotFoundError:
+            pass
+
+    def reap(self) -> List[Task]:
+        """Put tasks whose leases have gone stale back in pending (or fail
+        them, if they have been tried too often).  Returns those tasks."""
+        now = time.time()
+        reaped: List[Task] = list()
+        for path in self._leased.glob("*.json"):
+            try:
+                if now - path.stat().st_mtime <= self.lease:
+                    continue
+                # Take the stale lease for ourselves so no other reaper
+                # requeues it too
+                reaping = path.with_name(
+                    f".{path.name}.{uuid.uuid4().hex}.reaping"
+                )
+                os.rename(path, reaping)
+            except FileNotFoundError:
+                continue
+            task = Task.from_json(reaping.read_text())
+            task = replace(task, attempts=task.attempts + 1)
+            if task.attempts >= self.max_attempts:
+                self._fail(task, f"lease expired {task.attempts} times")
+            else:
+                stem = path.stem.split("~")[0]
+                _write_atomic(self._pending / f"{stem}.json", task.to_json())
+            reaping.unlink()
+            reaped.append(task)
+        return reaped
+
+    def finished(self) -> Dict[str, Optional[str]]:
+        """Map the id of each finished task to None if it is done or to
+        its error if it failed."""
+        results: Dict[str, Optional[str]] = {
+            p.stem: None for p in self._done.glob("*.json")
+        }
+        for path in self._failed.glob("*.json"):
+            try:
+                error = json.loads(path.read_text())["error"]
+            except (ValueError, KeyError):
+                error = "unknown error"
+            results.setdefault(path.stem, str(error))
+        return results
+
+
+class Coordinator:
+    """Fills a WorkQueue for one run and waits for workers to empty it.
+    Each task has a callback (recording its outputs in the build manifest,
+    as a rule) that is run on the coordinator once the task is done."""
+
+    def __init__(
+        self,
+        queue: WorkQueue,
+        logger: Optional[logging.Logger] = None,
+        poll: float = DEFAULT_POLL,
+    ) -> None:
+        self.queue = queue
+        self.logger = logger or logging.getLogger(__name__)
+        self.poll = poll
+        self._callbacks: Dict[str, Callable[[], None]] = dict()
+        self.queue.reset()
+
+    def add(self, task: Task, on_done: Callable[[], None]) -> None:
+        self._callbacks[task.id] = on_done
+        self.queue.put(task)
+
+    def wait(self) -> List[str]:
+        """Seal the queue and block until every task is done or failed.
+        Runs the callbacks of the tasks that were done, and returns the
+        errors of those that failed."""
+        self.queue.seal()
+        total = len(self._callbacks)
+        self.logger.info(f"Queued {total} tasks in '{self.queue.directory}'")
+        last_report = 0
+        while True:
+            for task in self.queue.reap():
+                self.logger.warning(
+                    f"Lease on {task.kind} task for '{task.name}' expired"
+                )
+            finished = self.queue.finished()
+            count = sum(1 for t in self._callbacks if t in finished)
+            if count == total:
+                break
+            if count != last_report:
+                self.logger.info(f"{count}/{total} tasks finished")
+                last_report = count
+            time.sleep(self.poll)
+        errors: List[str] = list()
+        for task_id, on_done in self._callbacks.items():
+            error = finished[task_id]
+            if error is None:
+                on_done()
+            else:
+                errors.append(error)
+        return errors
@@ -0,0 +1,178 @@
+import gzip
+import io
+import os
+import tarfile
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import Any, List
+
+import pytest
+
+from benchmarks.stubs import write_stub_tools
+from pdfarchive import index
+from pdfarchive.archive import (
+    ARCHIVE_ERRORS,
+    iter_members,
+    list_members,
+    spill,
+)
+from pdfarchive.index import Indexer, build_archive
+from pdfarchive.manifest import Manifest
+from pdfarchive.scheduler import Budget, Cost, JobClass, Scheduler
+
+
+def _make_zip(path: Path) -> None:
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("docs/a.pdf", b"%PDF a")
+        zf.writestr("b.png", b"png b")
+        zf.writestr("readme.txt", b"not a document")
+        zf.writestr("../escape.pdf", b"%PDF evil")
+        zf.writestr("docs/", b"")
+
+
+def _make_tar(path: Path) -> None:
+    with tarfile.open(path, "w:gz") as tf:
+        for name, data in (("x.pdf", b"%PDF x"), ("/abs.pdf", b"%PDF abs")):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = 1000
+            tf.addfile(info, io.BytesIO(data))
+
+
+def test_zip(tmp_path: Path) -> None:
+    archive = tmp_path / "bundle.zip"
+    _make_zip(archive)
+    members = list_members(archive)
+    assert [m.name for m in members] == ["docs/a.pdf", "b.png"]
+    assert members[0].checksum.startswith("crc:")
+    streamed = {
+        m.name: stream.read() for m, stream in iter_members(archive, {"b.png"})
+    }
+    assert streamed == {"b.png": b"png b"}
+    for member, stream in iter_members(archive):
+        path = spill(member, stream, tmp_path)
+        assert path.suffix == member.path.suffix
+        assert path.read_bytes() == b"%PDF a"
+        break
+
+
+def test_encrypted_zip_member(tmp_path: Path) -> None:
+    archive = tmp_path / "bundle.zip"
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("secret.pdf", b"%PDF secret")
+        zf.writestr("open.pdf", b"%PDF open")
+    # Mark the first member encrypted, in its local and central headers
+    data = bytearray(archive.read_bytes())
+    data[6] |= 0x1
+    data[data.index(b"PK\x01\x02") + 8] |= 0x1
+    archive.write_bytes(bytes(data))
+    with zipfile.ZipFile(archive) as zf:
+        with pytest.raises(ARCHIVE_ERRORS):
+            zf.read("secret.pdf")
+    assert [m.name for m in list_members(archive)] == ["open.pdf"]
+    assert [s.read() for _, s in iter_members(archive)] == [b"%PDF open"]
+
+
+def test_tar_and_single(tmp_path: Path) -> None:
+    archive = tmp_path / "bundle.tar.gz"
+    _make_tar(archive)
+    assert [m.name for m in list_members(archive)] == ["x.pdf"]
+    assert [s.read() for _, s in iter_members(archive)] == [b"%PDF x"]
+
+    single = tmp_path / "manual.pdf.gz"
+    single.write_bytes(gzip.compress(b"%PDF manual"))
+    assert [m.name for m in list_members(single)] == ["manual.pdf"]
+    assert [s.read() for _, s in iter_members(single)] == [b"%PDF manual"]
+
+    assert list_members(tmp_path / "other.7z") == []
+
+
+def test_listing_remembered(tmp_path: Path) -> None:
+    archive = tmp_path / "bundle.tar.gz"
+    _make_tar(archive)
+    manifest = Manifest(tmp_path / "manifest.sqlite3", base_dir=tmp_path)
+    assert manifest.members(archive) is None
+    manifest.record_members(archive, list_members(archive))
+    assert manifest.members(archive) == list_members(archive)
+    st = archive.stat()
+    os.utime(archive, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert manifest.members(archive) is None
+
+
+def test_member_manifest(tmp_path: Path) -> None:
+    archive = tmp_path / "bundle.zip"
+    _make_zip(archive)
+    member = list_members(archive)[0]
+    output = tmp_path / "Text" / "bundle.zip" / "docs" / "a.txt"
+    output.parent.mkdir(parents=True)
+    output.write_text("a")
+    manifest = Manifest(tmp_path / "manifest.sqlite3", base_dir=tmp_path)
+    assert not manifest.is_member_fresh("text", member, output)
+    manifest.record_member("text", member, output)
+    assert manifest.is_member_fresh("text", member, output)
+    assert manifest.sources("text") == {
+        "Text/bundle.zip/docs/a.txt": "bundle.zip!/docs/a.pdf"
+    }
+    # Rewriting the member changes its CRC
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("docs/a.pdf", b"%PDF changed")
+    changed = list_members(archive)[0]
+    assert not manifest.is_member_fresh("text", changed, output)
+
+
+def test_members_get_jobs_of_their_own(
+    src_testdata: Path,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    stubs = write_stub_tools(tmp_path / "bin")
+    monkeypatch.setenv("PATH", f"{stubs}{os.pathsep}{os.environ['PATH']}")
+    spill_dir = tmp_path / "tmp"
+    spill_dir.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(spill_dir))
+    root = tmp_path / "archive"
+    root.mkdir()
+    pdf = (src_testdata / "input" / "index" / "pdf_with_text.pdf").read_bytes()
+    names = [f"scans/{n}.pdf" for n in range(4)]
+    with zipfile.ZipFile(root / "bundle.zip", "w") as zf:
+        for name in names:
+            zf.writestr(name, pdf)
+    # No temporary space to speak of, so one document is spilled at a time
+    scheduler = Scheduler(
+        budget=Budget(cpu=4, memory=4096, tmp=4096),
+        costs={JobClass.ARCHIVE: Cost(cpu=1, memory=64, tmp=0)},
+    )
+    opened: List[Path] = list()
+    spills: List[int] = list()
+    spill_more = Indexer._spill_more
+
+    def opening(archive: Path, names: Any) -> Any:
+        opened.append(archive)
+        return iter_members(archive, names)
+
+    def spilling(self: Indexer, state: Any) -> None:
+        spills.append(len(spills))
+        spill_more(self, state)
+
+    monkeypatch.setattr(index, "iter_members", opening)
+    monkeypatch.setattr(Indexer, "_spill_more", spilling)
+    result = build_archive(root, scheduler=scheduler)
+    scheduler.shutdown()
+    assert result.ok
+    # Four jobs, each picking up where the last left off in the archive
+    assert len(spills) == 4
+    assert opened == [root / "bundle.zip"]
+    stages = result.stages
+    assert stages["thumbnail"].jobs == 4
+    # The stub pdffonts finds no fonts, so every page is OCRed
+    assert stages["extract-ocr"].outcomes["pages"] == 4
+    for name in names:
+        stem = Path(name).with_suffix("")
+        assert (root / "Text" / "bundle.zip" / f"{stem}.txt").exists()
+        assert (root / "Thumbs" / "bundle.zip" / f"{stem}_thumb.png").exists()
+    assert list(spill_dir.iterdir()) == []
+    again = build_archive(root)
+    assert again.stages["thumbnail"].jobs == 0
+    assert again.stages["extract-ocr"].jobs == 0
@@ -0,0 +1,54 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from benchmarks.stubs import write_stub_tools
+from pdfarchive.backends import Backend, InProcessBackend, ToolBackend
+from pdfarchive.context import BuildContext
+
+
+def _check_backend(backend: Backend, pdf: Path, tmp_path: Path) -> None:
+    thumb = tmp_path / "thumb.png"
+    backend.thumbnail(pdf, thumb, "150x100")
+    assert thumb.read_bytes().startswith(b"\x89PNG")
+    assert backend.has_fonts(pdf) is True
+    text = tmp_path / "text.txt"
+    backend.pdf_text(pdf, text)
+    assert text.read_text().count("\f") == 2
+    assert backend.page_count(pdf) == 2
+    pages = tmp_path / "pages"
+    pages.mkdir()
+    images = backend.render_pages(pdf, 1, 1, pages, "120x120", "4")
+    assert len(images) == 1 and images[0].exists()
+    assert len(backend.render_pages(pdf, 0, None, pages, "120x120", "4"))
+    backend.close()
+
+
+def test_tool_backend(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    stubs = write_stub_tools(tmp_path / "bin")
+    monkeypatch.setenv("PATH", f"{stubs}{os.pathsep}{os.environ['PATH']}")
+    pdf = tmp_path / "doc.pdf"
+    pdf.write_bytes(b"%PDF-1.4\n/Type /Page /\n/Type /Page /\n(hi) Tj\n")
+    _check_backend(ToolBackend(has_pdffonts=True), pdf, tmp_path)
+    assert ToolBackend().has_fonts(pdf) is None
+    assert ToolBackend().image_pages(pdf) is None
+
+
+def test_inprocess_backend(tmp_path: Path) -> None:
+    pymupdf = pytest.importorskip("pymupdf")
+    pytest.importorskip("PIL")
+    pdf = tmp_path / "doc.pdf"
+    document = pymupdf.open()
+    for n in range(2):
+        document.new_page().insert_text((72, 72), f"Page {n} of a manual")
+    document.save(pdf)
+    backend = InProcessBackend()
+    # Text only
+    assert backend.image_pages(pdf) == set()
+    _check_backend(backend, pdf, tmp_path)
+
+
+def test_unknown_backend(tmp_path: Path) -> None:
+    with pytest.raises(RuntimeError):
+        BuildContext.create(base_dir=tmp_path, backend="pgmagick")
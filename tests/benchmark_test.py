@@ -0,0 +1,40 @@
+from pathlib import Path
+
+from benchmarks.corpus import CorpusSpec, generate_corpus
+from benchmarks.pipeline_bench import bench
+from pdfarchive.scheduler import Budget
+
+
+def _contents(root: Path) -> dict:
+    return {
+        str(p.relative_to(root)): p.read_bytes()
+        for p in root.rglob("*")
+        if p.is_file()
+    }
+
+
+def test_corpus_is_reproducible(tmp_path: Path) -> None:
+    spec = CorpusSpec(depth=1, fanout=2, files=4, pages=2, words=20)
+    first = generate_corpus(tmp_path / "a", spec)
+    second = generate_corpus(tmp_path / "b", spec)
+    assert first == second
+    assert first.directories == 3
+    assert first.pdfs + first.images == 12
+    assert _contents(tmp_path / "a") == _contents(tmp_path / "b")
+
+
+def test_stub_pipeline(tmp_path: Path) -> None:
+    spec = CorpusSpec(depth=1, fanout=2, files=4, pages=3, scanned=0.5)
+    budget = Budget(cpu=2, memory=1024, tmp=1024)
+    results = bench(spec, ["stub"], budget, tmp_path)
+    corpus = results["corpus"]
+    cold = results["modes"]["stub"]["cold"]["stages"]
+    warm = results["modes"]["stub"]["warm"]["stages"]
+    documents = corpus["pdfs"] + corpus["images"] + corpus["members"]
+    assert cold["thumbnail"]["outcomes"]["built"] == documents
+    assert cold["extract-ocr"]["outcomes"].get("built", 0) == (
+        corpus["scanned"]
+    )
+    # Nothing changed, so nothing is rebuilt
+    assert warm["thumbnail"]["outcomes"] == {"cached": documents}
+    assert warm["extract-fast"]["outcomes"] == {"cached": documents}
@@ -1,12 +1,27 @@
 import filecmp
+import gc
+import json
+import logging
+import os
+import shutil
+import threading
 from pathlib import Path
+from typing import Any, Dict, Tuple
 
-from pdfarchive.index import Indexer
+import pytest
+
+from pdfarchive.atomic import stray_temporaries, temporary_path
+from pdfarchive.context import want_swish_e
+from pdfarchive.index import Indexer, build_archive
+from pdfarchive.metrics import BuildResult
 
 
 def test_build_site(testdata: Path, src_testdata: Path) -> None:
     indexer = Indexer(
-        base_dir=Path(testdata / "index"), base_url="file:///.", debug=True
+        base_dir=Path(testdata / "index"),
+        base_url="file:///.",
+        debug=True,
+        static_search=True,
     )
     filecmp.clear_cache()
     indexer.build_site()
@@ -30,3 +45,214 @@ def test_build_site(testdata: Path, src_testdata: Path) -> None:
             with open(f"/tmp/generated-{idx}.txt", "w") as f4:
                 f4.writelines(input_lines)
         assert ok
+
+
+def test_build_site_paged(src_testdata: Path, tmp_path: Path) -> None:
+    base_dir = tmp_path / "index"
+    shutil.copytree(src_testdata / "input" / "index", base_dir)
+    Indexer(base_dir=base_dir, page_size=1).build_site()
+    listing = json.loads((base_dir / "index.json").read_text())
+    assert listing["files"] == ["has_text.png", "pdf_with_text.pdf"]
+    assert listing["thumbs"] == "./Thumbs/."
+    second = (base_dir / "index-2.html").read_text()
+    assert "pdf_with_text_thumb.png" in second
+    assert "has_text_thumb.png" not in second
+    assert "subfolder/index.html" not in second
+    # Back to one page per directory
+    Indexer(base_dir=base_dir).build_site()
+    assert not (base_dir / "index-2.html").exists()
+    assert not (base_dir / "index.json").exists()
+
+
+def test_concurrent_builds(src_testdata: Path, tmp_path: Path) -> None:
+    cwd = os.getcwd()
+    roots = [tmp_path / name for name in ("one", "two")]
+    for root in roots:
+        shutil.copytree(src_testdata / "input" / "index", root)
+    results: Dict[Path, BuildResult] = dict()
+
+    def build(root: Path) -> None:
+        results[root] = build_archive(
+            root, base_url="file:///.", archive_title="Archive"
+        )
+
+    umask = os.umask(0o077)
+    try:
+        threads = [threading.Thread(target=build, args=(r,)) for r in roots]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        os.umask(umask)
+    assert os.getcwd() == cwd
+    assert sorted(results) == roots
+    for root in roots:
+        result = results[root]
+        assert result.ok
+        assert result.base_dir == root.resolve()
+        assert result.documents > 0
+        assert result.stages["render"].jobs == result.directories
+        assert (root / "css").is_dir()
+        # Readable by the web server, whatever the umask
+        assert (root / "index.html").stat().st_mode & 0o777 == 0o644
+        assert (root / "Thumbs").stat().st_mode & 0o777 == 0o755
+    one, two = (sorted(r.glob("**/index.html")) for r in roots)
+    assert [p.relative_to(roots[0]) for p in one] == [
+        p.relative_to(roots[1]) for p in two
+    ]
+    for a, b in zip(one, two):
+        assert a.read_text() == b.read_text()
+
+
+def test_rebuild_changes_nothing(src_testdata: Path, tmp_path: Path) -> None:
+    base_dir = tmp_path / "index"
+    shutil.copytree(src_testdata / "input" / "index", base_dir)
+    first = build_archive(base_dir)
+    assert "index.html" in first.changes["added"]
+    assert "Thumbs/has_text_thumb.png" in first.changes["added"]
+    manifest = base_dir / "config" / "changes.json"
+    assert json.loads(manifest.read_text()) == first.changes
+    outputs = [
+        p
+        for p in base_dir.glob("**/*")
+        if p.is_file() and "config" not in p.relative_to(base_dir).parts
+    ]
+    mtimes = {p: p.stat().st_mtime_ns for p in outputs}
+    # Nothing has changed, so nothing is rewritten
+    second = build_archive(base_dir)
+    assert second.changes == {"added": [], "changed": [], "removed": []}
+    assert {p: p.stat().st_mtime_ns for p in outputs} == mtimes
+    (base_dir / "has_text.png").unlink()
+    indexer = Indexer(base_dir=base_dir)
+    indexer.update_directories([], [indexer.base_dir])
+    indexer.close()
+    changes = json.loads(manifest.read_text())
+    assert changes["removed"] == [
+        "Text/has_text.txt",
+        "Thumbs/has_text_thumb.png",
+    ]
+    assert changes["changed"] == ["index.html"]
+
+
+def _fail(*args: Any) -> None:
+    raise RuntimeError("failed")
+
+
+def test_repeated_builds_release_resources(
+    src_testdata: Path, tmp_path: Path
+) -> None:
+    root = tmp_path / "index"
+    shutil.copytree(src_testdata / "input" / "index", root)
+    fd_dir = Path("/proc/self/fd")
+
+    def in_use() -> Tuple[int, int]:
+        fds = len(list(fd_dir.iterdir())) if fd_dir.is_dir() else 0
+        threads = sum(
+            t.name.startswith("pdfarchive") for t in threading.enumerate()
+        )
+        return fds, threads
+
+    gc.disable()
+    try:
+        build_archive(root)
+        before = in_use()
+        for _ in range(3):
+            assert build_archive(root).ok
+        assert in_use() == before
+        # Nor do builds that fail, while they are set up or part way
+        with pytest.raises(OSError):
+            build_archive(root, cache_dir=root / "index.html")
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr(Indexer, "update_search", _fail)
+            with pytest.raises(RuntimeError):
+                build_archive(root)
+        assert in_use() == before
+    finally:
+        gc.enable()
+
+
+def test_rebuild_indexes_only_changed_text(
+    src_testdata: Path, tmp_path: Path
+) -> None:
+    root = tmp_path / "index"
+    shutil.copytree(src_testdata / "input" / "index", root)
+    first = build_archive(root)
+    assert first.stages["index"].outcomes["indexed"] > 1
+    again = build_archive(root)
+    assert again.stages["index"].outcomes.get("indexed", 0) == 0
+    # A text this build didn't write isn't looked at...
+    text = root / "Text" / "has_text.txt"
+    text.write_text("teletype")
+    again = build_archive(root)
+    assert again.stages["index"].outcomes.get("indexed", 0) == 0
+    # ...unless a build was cut short before indexing what it wrote
+    (root / "config" / "textindex-pending").touch()
+    after = build_archive(root)
+    assert after.stages["index"].outcomes["indexed"] == 1
+    assert not (root / "config" / "textindex-pending").exists()
+
+
+def test_swish_e_by_default(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    logger = logging.getLogger("test")
+    monkeypatch.setattr(shutil, "which", lambda exe: None)
+    assert not want_swish_e(logger, None, False, "files")
+    assert "no search link" in caplog.text
+    # Built whenever it is installed, as it always was
+    monkeypatch.setattr(shutil, "which", lambda exe: f"/usr/bin/{exe}")
+    caplog.clear()
+    assert want_swish_e(logger, None, False, "files")
+    assert "deprecated" in caplog.text
+    assert not want_swish_e(logger, False, False, "files")
+    assert not want_swish_e(logger, None, True, "files")
+    assert not want_swish_e(logger, None, False, "packs")
+
+
+def test_search_link(src_testdata: Path, tmp_path: Path) -> None:
+    base_dir = tmp_path / "index"
+    shutil.copytree(src_testdata / "input" / "index", base_dir)
+    # Nothing to search with: no link to a CGI nothing keeps up to date
+    Indexer(base_dir=base_dir, swish_e=False).build_site()
+    for page in (base_dir / "index.html", base_dir / "subfolder/index.html"):
+        assert "Search Text" not in page.read_text()
+    Indexer(base_dir=base_dir, static_search=True).build_site()
+    assert 'href="./search.html"' in (base_dir / "index.html").read_text()
+    subfolder = (base_dir / "subfolder" / "index.html").read_text()
+    assert 'href="../search.html"' in subfolder
+
+
+def test_same_stem_documents(
+    src_testdata: Path, tmp_path: Path, caplog: pytest.LogCaptureFixture
+) -> None:
+    base_dir = tmp_path / "index"
+    shutil.copytree(src_testdata / "input" / "index", base_dir)
+    # Would be thumbnailed and extracted to the same paths as has_text.png
+    shutil.copyfile(base_dir / "pdf_with_text.pdf", base_dir / "has_text.pdf")
+    assert build_archive(base_dir).failed_jobs == 0
+    assert "'has_text.pdf' but for its suffix" in caplog.text
+    # The first by name wins, and nothing is left half written
+    text = (base_dir / "Text" / "has_text.txt").read_text()
+    assert text == (base_dir / "Text" / "pdf_with_text.txt").read_text()
+    assert not list(base_dir.glob("**/.*.tmp*"))
+
+
+def test_temporary_paths_are_per_thread(tmp_path: Path) -> None:
+    output = tmp_path / "foo.png"
+    paths = [temporary_path(output)]
+    thread = threading.Thread(
+        target=lambda: paths.append(temporary_path(output))
+    )
+    thread.start()
+    thread.join()
+    assert paths[0] != paths[1]
+    assert all(p.suffix == ".png" and p.name[0] == "." for p in paths)
+    for p in paths:
+        p.touch()
+    assert sorted(stray_temporaries(output)) == sorted(paths)
+    # Nor is bar.png's taken for foo.png's
+    (tmp_path / f".bar.{os.getpid()}-1.tmp.png").touch()
+    assert len(stray_temporaries(output)) == 2
@@ -0,0 +1,121 @@
+import os
+import shutil
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from benchmarks.stubs import write_stub_tools
+from pdfarchive.contentstore import ContentStore, Lookup, cache_key
+from pdfarchive.index import Indexer
+
+
+def test_lookup_and_finish(tmp_path: Path) -> None:
+    store = ContentStore(tmp_path / "store", max_size=1)
+    source = tmp_path / "a.pdf"
+    source.write_bytes(b"%PDF-1.4 not really")
+    key = cache_key("text", "pdftotext 1.0", store.digest(source))
+    ready: List[bool] = list()
+    first = tmp_path / "a.txt"
+    second = tmp_path / "b.txt"
+    assert store.lookup(key, first, ready.append) is Lookup.BUILD
+    assert store.lookup(key, second, ready.append) is Lookup.WAITING
+    first.write_text("some text\n")
+    store.finish(key, first)
+    assert ready == [True]
+    assert store.fetch(key, second)
+    assert second.read_text() == "some text\n"
+    # Identical content under other settings is a different object
+    other = cache_key("text", "pdftotext 2.0", store.digest(source))
+    assert store.lookup(other, second, ready.append) is Lookup.BUILD
+    store.finish(other, None)
+    assert store.lookup(other, second, ready.append) is Lookup.BUILD
+    assert store.lookup(other, second, ready.append) is Lookup.WAITING
+    assert store.release_waiters() == 1
+    assert ready == [True, False]
+    store.close()
+
+
+def test_eviction(tmp_path: Path) -> None:
+    store = ContentStore(tmp_path / "store", max_size=1)
+    keys: List[str] = list()
+    for n in range(3):
+        output = tmp_path / f"{n}.txt"
+        output.write_bytes(bytes(400 * 1024))
+        keys.append(cache_key("text", "", f"{n:064x}"))
+        assert store.lookup(keys[-1], output, print) is Lookup.BUILD
+        store.finish(keys[-1], output)
+    # 1.2 MiB won't fit; the oldest goes, but the output made from it stays
+    target = tmp_path / "fetched.txt"
+    assert not store.fetch(keys[0], target)
+    assert store.fetch(keys[2], target)
+    assert (tmp_path / "0.txt").exists()
+    store.close()
+
+
+def test_eviction_spares_recently_fetched(tmp_path: Path) -> None:
+    store = ContentStore(tmp_path / "store", max_size=1)
+    keys = [cache_key("text", "", f"{n:064x}") for n in range(3)]
+    target = tmp_path / "fetched.txt"
+    for n, key in enumerate(keys):
+        output = tmp_path / f"{n}.txt"
+        output.write_bytes(bytes(400 * 1024))
+        assert store.lookup(key, output, print) is Lookup.BUILD
+        store.finish(key, output)
+        if n == 1:
+            # The first is used again, so the second is now the oldest
+            assert store.fetch(keys[0], target)
+    assert store.fetch(keys[0], target)
+    assert not store.fetch(keys[1], target)
+    store.close()
+    # Uses not yet written when the store closed are written then
+    store = ContentStore(tmp_path / "store", max_size=1)
+    used = dict(store._conn.execute("SELECT key, last_used FROM objects"))
+    assert used[keys[0]] > used[keys[2]]
+    store.close()
+
+
+def test_duplicates_built_once(
+    src_testdata: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    stubs = write_stub_tools(tmp_path / "bin")
+    monkeypatch.setenv("PATH", f"{stubs}{os.pathsep}{os.environ['PATH']}")
+    cache_dir = tmp_path / "cache"
+    roots = [tmp_path / "first", tmp_path / "second"]
+    for root in roots:
+        (root / "copy").mkdir(parents=True)
+        source = src_testdata / "input" / "index" / "pdf_with_text.pdf"
+        shutil.copy(source, root / "original.pdf")
+        shutil.copy(source, root / "copy" / "duplicate.pdf")
+        Indexer(base_dir=root, cache_dir=cache_dir).build_site()
+    for kind, suffix in (("Text", ".txt"), ("Thumbs", "_thumb.png")):
+        outputs = [r / kind / f"original{suffix}" for r in roots] + [
+            r / kind / "copy" / f"duplicate{suffix}" for r in roots
+        ]
+        # All four are links to the one stored object
+        assert len({o.stat().st_ino for o in outputs}) == 1
+
+
+def test_running_total(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    store = ContentStore(tmp_path / "store", max_size=1)
+    key = cache_key("text", "", f"{0:064x}")
+    output = tmp_path / "0.txt"
+    assert store.lookup(key, output, print) is Lookup.BUILD
+    for size in (300, 200):
+        output.unlink(missing_ok=True)
+        output.write_bytes(bytes(size * 1024))
+        store.finish(key, output)
+    # Stored again, the object's old size no longer counts
+    assert store._total == 200 * 1024
+    store.close()
+    store = ContentStore(tmp_path / "store", max_size=1)
+    assert store._total == 200 * 1024
+    # Linking it out again leaves its mode alone
+    os.chmod(store._path(key), 0o644)
+    chmodded: List[Path] = list()
+    monkeypatch.setattr(os, "chmod", lambda path, mode: chmodded.append(path))
+    assert store.fetch(key, tmp_path / "linked.txt")
+    assert chmodded == []
+    store.close()
@@ -0,0 +1,118 @@
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, List
+
+import pytest
+
+from pdfarchive.external import (
+    ExecutionEngine,
+    ToolPolicy,
+    parse_tool_policies,
+    run,
+    run_output,
+)
+
+
+def test_run_output() -> None:
+    engine = ExecutionEngine()
+    try:
+        assert run_output(["echo", "hello"], engine=engine) == "hello\n"
+        assert run_output(["false"], engine=engine) is None
+        assert run_output(["/no/such/tool"], engine=engine) is None
+        result = engine.run([sys.executable, "-c", "sum(range(10**6))"])
+        assert result.ok
+        assert result.cpu_time > 0
+        assert result.max_rss > 0
+        assert engine.stats["echo"].commands == 1
+        assert engine.stats["false"].failures == 1
+    finally:
+        engine.close()
+
+
+def test_timeout_kills_process_group() -> None:
+    # The child outlives its parent unless the whole group is killed.
+    script = "sleep 30 & sleep 30; wait"
+    engine = ExecutionEngine()
+    try:
+        start = time.monotonic()
+        result = engine.run(["sh", "-c", script], timeout=0.5)
+        assert result.timed_out
+        assert not result.ok
+        assert time.monotonic() - start < 10
+        assert engine.stats["sh"].timeouts == 1
+        # No logger was given; timing out must not raise either.
+        run(["sleep", "5"], timeout=0.1, engine=engine)
+    finally:
+        engine.close()
+
+
+def test_concurrency_limit() -> None:
+    engine = ExecutionEngine(policies={"sleep": ToolPolicy(concurrency=1)})
+    try:
+        start = time.monotonic()
+        threads = [
+            threading.Thread(target=engine.run, args=(["sleep", "0.3"],))
+            for _ in range(3)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert time.monotonic() - start >= 0.9
+    finally:
+        engine.close()
+
+
+def test_limits_applied() -> None:
+    engine = ExecutionEngine(
+        policies={"python3": ToolPolicy(nice=7, memory=4096)}
+    )
+    script = (
+        "import os, resource;"
+        "print(os.getpriority(os.PRIO_PROCESS, 0),"
+        " resource.getrlimit(resource.RLIMIT_AS)[0])"
+    )
+    try:
+        # Give the engine a moment to apply limits before we look.
+        result = engine.run(
+            ["python3", "-c", f"import time; time.sleep(0.2); {script}"]
+        )
+        nice, limit = result.stdout.decode().split()
+        assert int(nice) >= 7
+        assert int(limit) == 4096 * 1024 * 1024
+    finally:
+        engine.close()
+
+
+def test_spawned_off_loop(monkeypatch: pytest.MonkeyPatch) -> None:
+    spawned_on: List[str] = list()
+    popen = subprocess.Popen
+
+    def recording_popen(*args: Any, **kwargs: Any) -> subprocess.Popen:
+        spawned_on.append(threading.current_thread().name)
+        return popen(*args, **kwargs)
+
+    monkeypatch.setattr(subprocess, "Popen", recording_popen)
+    engine = ExecutionEngine()
+    try:
+        assert engine.run(["true"]).ok
+        assert engine.run(["/no/such/tool"]).returncode == 127
+    finally:
+        engine.close()
+    assert len(spawned_on) == 2
+    assert all(n.startswith("pdfarchive-spawn") for n in spawned_on)
+
+
+def test_parse_tool_policies() -> None:
+    policies = parse_tool_policies(
+        ["tesseract:timeout=900,memory=2G,jobs=4", "gm:timeout=none"]
+    )
+    assert policies["tesseract"].timeout == 900
+    assert policies["tesseract"].memory == 2048
+    assert policies["tesseract"].concurrency == 4
+    # Unmentioned settings keep their defaults
+    assert policies["tesseract"].nice == 10
+    assert policies["gm"].timeout is None
+    assert policies["pdfinfo"].timeout == 60
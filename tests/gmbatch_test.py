@@ -0,0 +1,104 @@
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from pdfarchive.external import CommandResult, ExecutionEngine
+from pdfarchive.gmbatch import GMBatch, GMBatchPool
+
+_fake_gm = f"""#!{sys.executable}
+import shlex
+import sys
+import time
+from pathlib import Path
+
+if sys.argv[1] != "batch":
+    Path(sys.argv[-1]).write_bytes(b"direct")
+    sys.exit(0)
+for line in sys.stdin:
+    args = shlex.split(line)
+    if args[0] == "identify":
+        print(f"identify: unable to open {{args[-1]}}", file=sys.stderr)
+        print("FAIL", flush=True)
+        continue
+    if "hang" in args[-2]:
+        time.sleep(60)
+    if "bad" in args[-2]:
+        print("no such file", file=sys.stderr)
+        print("FAIL", flush=True)
+        continue
+    Path(args[-1]).write_bytes(b"batched")
+    print("PASS", flush=True)
+"""
+
+
+def _make_fake_gm(tmp_path: Path) -> str:
+    gm = tmp_path / "gm"
+    gm.write_text(_fake_gm)
+    gm.chmod(0o755)
+    return str(gm)
+
+
+def test_gm_batch(tmp_path: Path, caplog: pytest.LogCaptureFixture) -> None:
+    batch = GMBatch(
+        logger=logging.getLogger("gmbatch_test"),
+        executable=_make_fake_gm(tmp_path),
+        timeout=10,
+    )
+    out = tmp_path / "with space_thumb.png"
+    assert batch.run(["convert", "in put.png", str(out)])
+    assert out.read_bytes() == b"batched"
+    first = batch._proc
+    with caplog.at_level(logging.WARNING):
+        assert not batch.run(["convert", "bad.png", str(tmp_path / "x.png")])
+    # The failure is logged with all of its stderr, and only its stderr
+    assert caplog.messages[-1].endswith(" -> stderr: no such file")
+    # One process served both commands
+    assert batch._proc is first
+    # An argument gm batch can't quote runs as its own gm
+    odd = tmp_path / 'odd"name.png'
+    assert batch.run(["convert", "in.png", str(odd)])
+    assert odd.read_bytes() == b"direct"
+    # As can one with a backslash, which gm batch would take as an escape
+    slashed = tmp_path / "back\\slash.png"
+    assert batch.run(["convert", "in.png", str(slashed)])
+    assert slashed.read_bytes() == b"direct"
+    batch.close()
+    assert batch._proc is None
+
+
+def test_gm_batch_pool(tmp_path: Path) -> None:
+    pool = GMBatchPool(executable=_make_fake_gm(tmp_path))
+    assert pool.get() is pool.get()
+    assert pool.run(["convert", "a.png", str(tmp_path / "a_thumb.png")])
+    pool.close()
+
+
+def test_gm_batch_engine(tmp_path: Path) -> None:
+    engine = ExecutionEngine()
+    seen: List[CommandResult] = list()
+    engine.listeners.append(seen.append)
+    batch = GMBatch(
+        executable=_make_fake_gm(tmp_path), timeout=1, engine=engine
+    )
+    assert batch.run(["convert", "a.png", str(tmp_path / "a_thumb.png")])
+    first = batch._proc
+    assert first is not None
+    # A command that hangs is given up on, and its gm killed
+    started = time.monotonic()
+    assert not batch.run(["convert", "hang.png", str(tmp_path / "h.png")])
+    assert time.monotonic() - started < 10
+    assert first.returncode is not None
+    # and the next command gets a new one
+    assert batch.run(["convert", "b.png", str(tmp_path / "b_thumb.png")])
+    assert batch._proc is not first
+    # Commands gm batch can't express run through the engine too
+    assert batch.run(["convert", "c.png", str(tmp_path / 'c"d.png')])
+    batch.close()
+    engine.close()
+    assert [r.timed_out for r in seen] == [False, True, False, False]
+    stats = engine.stats["gm"]
+    assert (stats.commands, stats.timeouts) == (4, 1)
@@ -0,0 +1,106 @@
+import os
+from pathlib import Path
+
+from pdfarchive.manifest import Manifest
+
+
+def test_manifest_staleness(tmp_path: Path) -> None:
+    src = tmp_path / "doc.pdf"
+    out = tmp_path / "Text" / "doc.txt"
+    out.parent.mkdir()
+    src.write_bytes(b"%PDF-1.4 original")
+    out.write_text("text")
+    manifest = Manifest(
+        tmp_path / "config" / "manifest.sqlite3",
+        base_dir=tmp_path,
+        hash_content=True,
+    )
+    manifest.set_fingerprint("text", "v1")
+    manifest.record("text", src, out)
+    assert manifest.is_fresh("text", src, out)
+
+    # Touched but unchanged: the hash says it is still fresh.
+    st = src.stat()
+    os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert manifest.is_fresh("text", src, out)
+
+    # New tools invalidate the output.
+    manifest.set_fingerprint("text", "v2")
+    assert not manifest.is_fresh("text", src, out)
+    manifest.record("text", src, out)
+
+    # Replaced content of the same size is caught by the hash.
+    src.write_bytes(b"%PDF-1.4 replaced")
+    os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns + 2 * 10**9))
+    assert not manifest.is_fresh("text", src, out)
+
+    # A missing output is never fresh.
+    out.unlink()
+    assert not manifest.is_fresh("text", src, out)
+    manifest.close()
+
+
+def test_manifest_adopts_existing_outputs(tmp_path: Path) -> None:
+    src = tmp_path / "doc.pdf"
+    out = tmp_path / "doc_thumb.png"
+    src.write_bytes(b"%PDF-1.4")
+    out.write_bytes(b"PNG")
+    st = src.stat()
+    os.utime(out, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    manifest = Manifest(tmp_path / "manifest.sqlite3", base_dir=tmp_path)
+    assert manifest.is_fresh("thumbnail", src, out)
+    manifest.close()
+    # ...and remembers it across runs.
+    manifest = Manifest(tmp_path / "manifest.sqlite3", base_dir=tmp_path)
+    os.utime(out, ns=(st.st_atime_ns, st.st_mtime_ns - 10**9))
+    assert manifest.is_fresh("thumbnail", src, out)
+    # But only the first run adopts anything: later, an output with no
+    # record of what it was made from is made again
+    text = tmp_path / "doc.txt"
+    text.write_text("text")
+    os.utime(text, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert not manifest.is_fresh("text", src, text)
+    manifest.close()
+
+
+def test_record_checks_source_unchanged(tmp_path: Path) -> None:
+    src = tmp_path / "doc.pdf"
+    out = tmp_path / "doc.txt"
+    src.write_bytes(b"%PDF-1.4")
+    out.write_text("text")
+    manifest = Manifest(tmp_path / "manifest.sqlite3", base_dir=tmp_path)
+    started = manifest.begin("text", src, out)
+    # Replaced while the job ran
+    src.write_bytes(b"%PDF-1.4 new")
+    later = out.stat().st_mtime_ns + 10**9
+    os.utime(src, ns=(later, later))
+    assert not manifest.record("text", src, out, started=started)
+    assert not manifest.is_fresh("text", src, out)
+    assert manifest.interrupted() == []
+    started = manifest.begin("text", src, out)
+    assert manifest.record("text", src, out, started=started)
+    assert manifest.is_fresh("text", src, out)
+    manifest.close()
+
+
+def test_journal(tmp_path: Path) -> None:
+    src = tmp_path / "scan.pdf"
+    out = tmp_path / "Text" / "scan.txt"
+    src.write_bytes(b"%PDF-1.4 scanned")
+    manifest = Manifest(tmp_path / "manifest.sqlite3", base_dir=tmp_path)
+    manifest.begin("text", src, out)
+    manifest.progress("text", src, 8, 4096)
+    # Killed here; a new run reopens the manifest and starts the job again
+    manifest.close()
+    manifest = Manifest(tmp_path / "manifest.sqlite3", base_dir=tmp_path)
+    assert manifest.interrupted() == [("text", "scan.pdf", "Text/scan.txt", 8)]
+    manifest.begin("text", src, out)
+    assert manifest.resume_point("text", src) == (8, 4096)
+    # A changed source starts over
+    src.write_bytes(b"%PDF-1.4 rescanned")
+    assert manifest.resume_point("text", src) == (0, 0)
+    manifest.begin("text", src, out)
+    out.parent.mkdir()
+    out.write_text("text")
+    manifest.record("text", src, out)
+    assert manifest.interrupted() == []
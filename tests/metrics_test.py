@@ -0,0 +1,82 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from pdfarchive.external import CommandResult, ToolStats
+from pdfarchive.metrics import Metrics, _labels
+
+
+def test_measure(tmp_path: Path) -> None:
+    metrics = Metrics(base_dir=tmp_path)
+    doc = tmp_path / "sub" / "a.pdf"
+    with metrics.measure("thumbnail", doc, "sub") as m:
+        m.bytes_in = 100
+        m.bytes_out = 10
+        metrics.record_command(CommandResult(args=["gm"], user_time=1.5))
+    # Commands outside any measurement aren't charged to anything
+    metrics.record_command(CommandResult(args=["gm"], user_time=100))
+    metrics.outcome("thumbnail", "built", doc, "sub")
+    metrics.outcome("thumbnail", "cached", tmp_path / "b.pdf", ".")
+    with pytest.raises(ValueError):
+        with metrics.measure("extract-fast", doc, "sub"):
+            raise ValueError("boom")
+
+    thumbs = metrics.stages["thumbnail"]
+    assert thumbs.jobs == 1
+    assert thumbs.cpu_time == 1.5
+    assert thumbs.bytes_in == 100
+    assert thumbs.outcomes == {"built": 1, "cached": 1}
+    assert metrics.directories["sub"]["thumbnail"].outcomes == {"built": 1}
+    assert metrics.files[("sub/a.pdf", "extract-fast")].outcomes == {
+        "failed": 1
+    }
+    metrics.finish()
+    metrics.reset()
+    assert metrics.finished is None
+    assert metrics.stages["thumbnail"].jobs == 0
+    assert not metrics.directories and not metrics.files
+
+
+def test_reports(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    metrics = Metrics(base_dir=tmp_path)
+    with metrics.measure("render", tmp_path / "index.html", "."):
+        pass
+    metrics.outcome("index", "indexed", n=5)
+    metrics.finish()
+    tools = {"gm": ToolStats(commands=2, user_time=1.0, max_rss=1024)}
+
+    report_path = tmp_path / "config" / "run-report.json"
+    metrics.write_report(report_path, tools)
+    report = json.loads(report_path.read_text())
+    assert report["stages"]["render"]["jobs"] == 1
+    assert report["stages"]["index"]["outcomes"] == {"indexed": 5}
+    assert report["tools"]["gm"]["commands"] == 2
+    assert report["files"][0]["path"] == "index.html"
+
+    prom_path = tmp_path / "pdfarchive.prom"
+    replaced = list()
+    replace = os.replace
+
+    def spy(src: Path, dst: Path) -> None:
+        replaced.append(Path(src).name)
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", spy)
+    metrics.write_prometheus(prom_path, tools)
+    # Never a half-written *.prom for the textfile collector to read
+    assert len(replaced) == 1
+    assert replaced[0].startswith(".pdfarchive.prom.")
+    assert replaced[0].endswith(".tmp")
+    prom = prom_path.read_text().splitlines()
+    assert "# TYPE pdfarchive_stage_jobs gauge" in prom
+    assert 'pdfarchive_stage_jobs{stage="render"} 1' in prom
+    assert (
+        'pdfarchive_stage_outcomes{stage="index",outcome="indexed"} 5' in prom
+    )
+    assert 'pdfarchive_tool_max_rss_bytes{tool="gm"} 1048576' in prom
+
+
+def test_prometheus_labels() -> None:
+    assert _labels(path='a\\b "c"\nd') == '{path="a\\\\b \\"c\\"\\nd"}'
@@ -0,0 +1,71 @@
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from pdfarchive.ocr import PageAssembler, ocr_pages
+
+
+def test_assembler_writes_in_page_order(tmp_path: Path) -> None:
+    text_path = tmp_path / "Text" / "scan.txt"
+    completed: List[Path] = list()
+    assembler = PageAssembler(text_path, 6, on_complete=completed.append)
+    assembler.add(4, ["e", "f"])
+    assembler.add(2, ["c", "d"])
+    # Nothing contiguous from page 0 yet, so nothing is written.
+    assert assembler.partial_path.read_text() == ""
+    assembler.add(0, ["a", "b"])
+    assert completed == [text_path]
+    assert text_path.read_text() == "abcdef"
+    assert not assembler.partial_path.exists()
+
+
+def test_ocr_pages_pads_missing_pages(tmp_path: Path) -> None:
+    calls: List[List[str]] = list()
+
+    def render(
+        pdf: Path, first: int, last: Optional[int], directory: Path
+    ) -> List[Path]:
+        calls.append([f"{pdf}", f"{first}", f"{last}"])
+        # Only two of the three requested pages rasterize.
+        images = [directory / f"page-{n:04d}.tif" for n in (0, 1)]
+        for image in images:
+            image.write_bytes(b"TIF")
+        return images
+
+    def recognize(images: List[Path]) -> List[str]:
+        calls.append([i.name for i in images])
+        return [f"{i.stem}\f" for i in images]
+
+    texts = ocr_pages(tmp_path / "scan.pdf", 3, 5, render, recognize)
+    assert texts == ["page-0000\f", "page-0001\f", ""]
+    assert calls[0] == [f"{tmp_path / 'scan.pdf'}", "3", "5"]
+    # One call for all the pages
+    assert calls[1] == ["page-0000.tif", "page-0001.tif"]
+    assert len(calls) == 2
+    # Without a last page, there's nothing to pad to
+    assert (
+        len(ocr_pages(tmp_path / "scan.pdf", 0, None, render, recognize)) == 2
+    )
+
+
+def test_assembler_resumes(tmp_path: Path) -> None:
+    text_path = tmp_path / "Text" / "scan.txt"
+    progress: List[Tuple[int, int]] = list()
+    assembler = PageAssembler(
+        text_path,
+        4,
+        on_complete=lambda _: None,
+        on_progress=lambda pages, size: progress.append((pages, size)),
+    )
+    assembler.add(0, ["aa", "bb"])
+    assert progress == [(2, 4)]
+    # Killed after writing some of page 2 but before noting it
+    with open(assembler.partial_path, "a") as f:
+        f.write("c")
+    completed: List[Path] = list()
+    resumed = PageAssembler(
+        text_path, 4, on_complete=completed.append, resume=progress[-1]
+    )
+    assert resumed.resumed == 2
+    resumed.add(2, ["cc", "dd"])
+    assert completed == [text_path]
+    assert text_path.read_text() == "aabbccdd"
@@ -0,0 +1,93 @@
+import os
+import threading
+from pathlib import Path
+from typing import Any, List, Optional
+
+import pytest
+
+from benchmarks.stubs import write_stub_tools
+from pdfarchive.context import BuildContext
+from pdfarchive.external import CommandResult, ExecutionEngine
+from pdfarchive.ocrpool import TesseractPool, TesserocrPool
+
+
+class _RecordingEngine(ExecutionEngine):
+    def __init__(self) -> None:
+        super().__init__()
+        self.calls: List[List[str]] = list()
+
+    def run(self, args: List[str], *rest: Any, **kwargs: Any) -> CommandResult:
+        self.calls.append(args)
+        return super().run(args, *rest, **kwargs)
+
+
+def _images(directory: Path, count: int) -> List[Path]:
+    images = [directory / f"scan-{n}.png" for n in range(count)]
+    for image in images:
+        image.write_bytes(b"PNG")
+    return images
+
+
+@pytest.fixture
+def stubs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    directory = write_stub_tools(tmp_path / "bin")
+    monkeypatch.setenv("PATH", f"{directory}{os.pathsep}{os.environ['PATH']}")
+    return directory
+
+
+def test_tesseract_pool_batches(stubs: Path, tmp_path: Path) -> None:
+    engine = _RecordingEngine()
+    pool = TesseractPool(workers=1, engine=engine, linger=0.5)
+    images = _images(tmp_path, 6)
+    results: List[Optional[str]] = [None] * len(images)
+
+    def recognize(n: int) -> None:
+        (results[n],) = pool.recognize([images[n]])
+
+    threads = [
+        threading.Thread(target=recognize, args=(n,))
+        for n in range(len(images))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool.close()
+    assert results == [
+        f"recognized text of {image.name}\n\f" for image in images
+    ]
+    # However the requests were spread over the batches, each batch is one
+    # tesseract.
+    assert len(engine.calls) < len(images)
+    assert all(call[1].endswith(".lst") for call in engine.calls)
+
+
+def test_tesseract_pool_falls_back(stubs: Path, tmp_path: Path) -> None:
+    # A tesseract that gives up on a list, but not on a single image
+    (stubs / "tesseract").write_text(
+        "#!/bin/sh\n"
+        'case "$1" in *.lst) exit 1 ;; esac\n'
+        'echo "one image" > "$2.txt"\n'
+    )
+    engine = _RecordingEngine()
+    pool = TesseractPool(workers=2, engine=engine)
+    assert pool.recognize(_images(tmp_path, 3)) == ["one image\n"] * 3
+    pool.close()
+    assert len([c for c in engine.calls if c[1].endswith(".png")]) == 3
+
+
+def test_tesserocr_pool(tmp_path: Path) -> None:
+    pytest.importorskip("tesserocr")
+    Image = pytest.importorskip("PIL.Image")
+    image = tmp_path / "blank.png"
+    Image.new("L", (200, 100), 255).save(image)
+    pool = TesserocrPool()
+    (text,) = pool.recognize([image])
+    assert text.endswith("\f")
+    assert pool.version.startswith("tesserocr:")
+    pool.close()
+
+
+def test_unknown_ocr_pool(tmp_path: Path) -> None:
+    with pytest.raises(RuntimeError):
+        BuildContext.create(base_dir=tmp_path, ocr_pool="gocr")
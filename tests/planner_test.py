@@ -0,0 +1,107 @@
+import os
+import shutil
+import sys
+from pathlib import Path
+from typing import Dict, Tuple
+
+import pytest
+
+from benchmarks.stubs import write_stub_tools
+from pdfarchive.cli import main
+from pdfarchive.index import Indexer, build_archive
+from pdfarchive.manifest import Manifest
+from pdfarchive.metrics import Metrics
+from pdfarchive.planner import Plan, Planner, Timings, format_duration
+
+
+def test_timings_learn(tmp_path: Path) -> None:
+    metrics = Metrics(base_dir=tmp_path)
+    scan = tmp_path / "scan.pdf"
+    with metrics.measure("thumbnail", scan):
+        pass
+    metrics.files[("scan.pdf", "thumbnail")].wall_time = 0.5
+    with metrics.measure("extract-ocr", scan) as m:
+        m.bytes_in = 1024 * 1024
+    metrics.files[("scan.pdf", "extract-ocr")].wall_time = 40.0
+    metrics.outcome("extract-ocr", "pages", scan, n=10)
+    path = tmp_path / "timings.json"
+    planner = Planner(path)
+    planner.learn(metrics)
+    timings = Timings.load(path)
+    assert timings.thumbnail == pytest.approx((0.3 + 0.5) / 2)
+    assert timings.ocr_per_page == pytest.approx((2.5 + 4.0) / 2)
+    assert timings.pages_per_mib == pytest.approx((4.0 + 10.0) / 2)
+    assert timings.ocr_share == pytest.approx((0.3 + 1.0) / 2)
+    # Untouched
+    assert timings.image_text == Timings().image_text
+
+
+def test_plan_report() -> None:
+    plan = Plan()
+    plan.add("thumbnail", Path("a.pdf"), 1)
+    plan.add("text", Path("a.pdf"), 3600)
+    report = plan.report(workers=2)
+    assert "total                2       1:00:01" in report
+    assert "Estimated time on 2 CPUs: 0:30:00" in report
+    assert report.splitlines()[-2].endswith("text  a.pdf")
+    assert format_duration(90061) == "25:01:01"
+
+
+def test_indexer_plan(
+    src_testdata: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    stubs = write_stub_tools(tmp_path / "bin")
+    monkeypatch.setenv("PATH", f"{stubs}{os.pathsep}{os.environ['PATH']}")
+    base_dir = tmp_path / "index"
+    shutil.copytree(src_testdata / "input" / "index", base_dir)
+    indexer = Indexer(base_dir=base_dir)
+    plan = indexer.plan()
+    kinds = {(j.kind, str(j.path)) for j in plan.jobs}
+    assert ("text", "pdf_with_text.pdf") in kinds
+    assert ("thumbnail", "has_text.png") in kinds
+    assert ("archive", "container.zip") in kinds
+    assert not (base_dir / "Thumbs" / "has_text_thumb.png").exists()
+    indexer.build_site()
+    assert (base_dir / "config" / "timings.json").exists()
+    assert Indexer(base_dir=base_dir).plan().jobs == []
+
+
+def _snapshot(root: Path) -> Dict[str, Tuple[int, bytes]]:
+    return {
+        str(p.relative_to(root)): (
+            p.stat().st_mode,
+            b"" if p.is_dir() else p.read_bytes(),
+        )
+        for p in root.rglob("*")
+    }
+
+
+def test_dry_run_changes_nothing(
+    src_testdata: Path,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture,
+) -> None:
+    stubs = write_stub_tools(tmp_path / "bin")
+    monkeypatch.setenv("PATH", f"{stubs}{os.pathsep}{os.environ['PATH']}")
+    base_dir = tmp_path / "index"
+    shutil.copytree(src_testdata / "input" / "index", base_dir)
+    build_archive(base_dir)
+    # Everything a build would fix up, and a document it would adopt
+    shutil.rmtree(base_dir / "scripts")
+    (base_dir / "pdf_with_text.pdf").chmod(0o600)
+    (base_dir / "Thumbs" / "has_text_thumb.png").unlink()
+    (base_dir / "Text" / ".has_text.tmp.txt").write_text("interrupted")
+    manifest = Manifest(base_dir / "config" / "manifest.sqlite3", base_dir)
+    manifest.begin(
+        "text", base_dir / "has_text.png", base_dir / "Text" / "has_text.txt"
+    )
+    manifest._conn.execute("DELETE FROM outputs WHERE kind = 'text'")
+    manifest.close()
+    before = _snapshot(base_dir)
+    monkeypatch.setattr(
+        sys, "argv", ["pdfarchive", "-f", str(base_dir), "--dry-run"]
+    )
+    main()
+    assert "thumbnail" in capsys.readouterr().out
+    assert _snapshot(base_dir) == before
@@ -0,0 +1,46 @@
+from pathlib import Path
+
+from pdfarchive.render import (
+    PageData,
+    PageRenderer,
+    page_links,
+    page_number,
+    paginate,
+    template_environment,
+)
+
+
+def _page(files: int) -> PageData:
+    return PageData(
+        title="scans",
+        top_name="Archive",
+        top_dir="..",
+        partial_path="scans",
+        search_url="../search.html",
+        is_root=False,
+        files=[Path(f"scan-{n}.pdf") for n in range(files)],
+        dirs=[Path("more")],
+        archives=[],
+    )
+
+
+def test_page_links() -> None:
+    assert page_links(1, 1) == [(1, "index.html")]
+    assert [n for n, _ in page_links(5, 10)] == [1, 0, 3, 4, 5, 6, 7, 0, 10]
+    assert [n for n, _ in page_links(2, 10)] == [1, 2, 3, 4, 0, 10]
+    assert page_number("index-12.html") == 12
+    assert page_number("index.html") is None
+
+
+def test_paginate() -> None:
+    pages = paginate(_page(5), 2)
+    assert [len(p.files) for p in pages] == [2, 2, 1]
+    assert [p.first_file for p in pages] == [0, 2, 4]
+    assert pages[0].dirs and not pages[1].dirs
+    assert len(paginate(_page(0), 2)) == 1
+    html = PageRenderer(template_environment()).render(pages[1])
+    assert 'id="fileid_2"' in html and 'id="fileid_0"' not in html
+    assert 'href="index.html" rel="prev"' in html
+    assert 'href="index-3.html" rel="next"' in html
+    assert 'data-listing="index.json"' in html
+    assert "scripts/listing.js" in html
@@ -0,0 +1,145 @@
+import threading
+import time
+from typing import Callable, List
+
+import pytest
+
+from pdfarchive.scheduler import Budget, Cost, JobClass, Scheduler, parse_size
+
+
+def test_budget_limits_concurrency() -> None:
+    budget = Budget(cpu=8, memory=2048, tmp=1024)
+    costs = {JobClass.PDF_OCR: Cost(cpu=1, memory=1024, tmp=0)}
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+
+    def job() -> None:
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.02)
+        with lock:
+            running -= 1
+
+    with Scheduler(budget=budget, costs=costs) as scheduler:
+        for _ in range(6):
+            scheduler.submit(JobClass.PDF_OCR, job)
+        assert scheduler.wait() == []
+    # Memory, not CPU, is the binding constraint.
+    assert peak == 2
+
+
+def test_follow_up_jobs_and_errors() -> None:
+    results = list()
+
+    def fail() -> None:
+        raise ValueError("boom")
+
+    def first(scheduler: Scheduler) -> None:
+        results.append("first")
+        scheduler.submit(JobClass.PDF_OCR, results.append, "second")
+        scheduler.submit(JobClass.THUMBNAIL, fail)
+
+    with Scheduler(budget=Budget(cpu=1, memory=1, tmp=1)) as scheduler:
+        scheduler.submit(JobClass.EXTRACT_FAST, first, scheduler)
+        errors = scheduler.wait()
+    assert results == ["first", "second"]
+    assert len(errors) == 1
+    assert isinstance(errors[0], ValueError)
+
+
+def test_longest_first_and_progress() -> None:
+    order = list()
+
+    def job(name: str, scheduler: Scheduler) -> None:
+        order.append(name)
+        if name == "scan":
+            # Hands 6 of its 10 seconds on to its pages
+            for page in range(3):
+                scheduler.submit(
+                    JobClass.PAGE_OCR, order.append, f"page {page}", estimate=2
+                )
+
+    budget = Budget(cpu=1, memory=4096, tmp=4096)
+    with Scheduler(budget=budget) as scheduler:
+        with scheduler.held():
+            for name, estimate in (("thumb", 1), ("scan", 10), ("text", 3)):
+                scheduler.submit(
+                    JobClass.EXTRACT_FAST,
+                    job,
+                    name,
+                    scheduler,
+                    estimate=estimate,
+                )
+            assert scheduler.progress() == (0, 14)
+            assert order == []
+        assert scheduler.wait() == []
+        assert scheduler.progress() == (14, 0)
+    assert order == ["scan", "text", "page 0", "page 1", "page 2", "thumb"]
+
+
+def test_parse_size() -> None:
+    assert parse_size("512") == 512
+    assert parse_size("8G") == 8192
+    assert parse_size("1.5GiB") == 1536
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+def test_many_jobs_dispatch_in_linear_time() -> None:
+    def run(jobs: int) -> float:
+        budget = Budget(cpu=4, memory=4096, tmp=4096)
+        with Scheduler(budget=budget) as scheduler:
+            start = time.monotonic()
+            with scheduler.held():
+                for n in range(jobs):
+                    job_class = (JobClass.THUMBNAIL, JobClass.PDF_OCR)[n % 2]
+                    scheduler.submit(job_class, int, estimate=n % 97)
+            assert scheduler.wait() == []
+            return time.monotonic() - start
+
+    small, large = run(2_000), run(16_000)
+    # Quadratic dispatch would take 64 times as long for 8 times the jobs
+    assert large < 24 * small + 0.5
+
+
+def test_held_until_every_build_lets_go() -> None:
+    started: List[str] = list()
+    budget = Budget(cpu=2, memory=4096, tmp=4096)
+    with Scheduler(budget=budget) as scheduler:
+        with scheduler.held():
+            with scheduler.held():
+                scheduler.submit(JobClass.THUMBNAIL, started.append, "a")
+            # Another build's block is over, but not this one's
+            time.sleep(0.05)
+            assert started == []
+        assert scheduler.wait() == []
+    assert started == ["a"]
+
+
+def test_retained_tmp() -> None:
+    started: List[str] = list()
+    releases: List[Callable[[], None]] = list()
+    go = threading.Event()
+    budget = Budget(cpu=4, memory=4096, tmp=100)
+    costs = {
+        JobClass.ARCHIVE: Cost(cpu=1, memory=0, tmp=100),
+        JobClass.THUMBNAIL: Cost(cpu=1, memory=0, tmp=0),
+    }
+    with Scheduler(budget=budget, costs=costs) as scheduler:
+
+        def spill() -> None:
+            releases.append(scheduler.retain())
+            # The job working on what was spilled
+            scheduler.submit(JobClass.THUMBNAIL, go.wait)
+
+        scheduler.submit(JobClass.ARCHIVE, spill).result()
+        scheduler.submit(JobClass.ARCHIVE, started.append, "next")
+        time.sleep(0.05)
+        assert started == []
+        releases[0]()
+        go.set()
+        assert scheduler.wait() == []
+    assert started == ["next"]
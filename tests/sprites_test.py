@@ -0,0 +1,80 @@
+import os
+import shutil
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+import pytest
+
+from benchmarks.stubs import write_stub_tools
+from pdfarchive.backends import InProcessBackend, ToolBackend
+from pdfarchive.index import Indexer
+from pdfarchive.sprites import SPRITES_NAME, pack_sprites, sprite_position
+
+
+class _RecordingBackend(ToolBackend):
+    def __init__(self) -> None:
+        super().__init__()
+        self.sheets: List[List[Optional[str]]] = list()
+
+    def sprite_sheet(
+        self,
+        thumbs: Sequence[Optional[Path]],
+        output: Path,
+        geometry: str,
+        columns: int,
+    ) -> None:
+        self.sheets.append([t.name if t else None for t in thumbs])
+        output.write_bytes(b"PNG")
+
+
+def test_sprite_position() -> None:
+    assert sprite_position(0, (150, 100)) == ("sprites-0.png", 0, 0)
+    assert sprite_position(13, (150, 100)) == ("sprites-0.png", 450, 100)
+    assert sprite_position(205, (150, 100)) == ("sprites-2.png", 750, 0)
+
+
+def test_pack_sprites_rebuilds_changed_sheets(tmp_path: Path) -> None:
+    thumbs = [tmp_path / f"{n:03d}_thumb.png" for n in range(150)]
+    for thumb in thumbs[:-1]:
+        thumb.write_bytes(b"thumb")
+    backend = _RecordingBackend()
+    assert pack_sprites(thumbs, tmp_path, "150x100", backend) == 2
+    assert backend.sheets[1][-1] is None
+    assert (tmp_path / SPRITES_NAME).exists()
+    # Nothing changed
+    assert pack_sprites(thumbs, tmp_path, "150x100", backend) == 0
+    # Only the second sheet has the new thumbnail
+    thumbs[-1].write_bytes(b"thumb")
+    assert pack_sprites(thumbs, tmp_path, "150x100", backend) == 1
+    assert backend.sheets[-1][-1] == thumbs[-1].name
+    # And then there was one sheet
+    assert pack_sprites(thumbs[:10], tmp_path, "150x100", backend) == 1
+    assert not (tmp_path / "sprites-1.png").exists()
+
+
+def test_inprocess_sprite_sheet(tmp_path: Path) -> None:
+    Image = pytest.importorskip("PIL.Image")
+    pytest.importorskip("pymupdf")
+    thumb = tmp_path / "a_thumb.png"
+    Image.new("RGB", (150, 50), "red").save(thumb)
+    sheet = tmp_path / "sheet.png"
+    InProcessBackend().sprite_sheet([None, thumb, None], sheet, "150x100", 2)
+    with Image.open(sheet) as image:
+        assert image.size == (300, 200)
+        assert image.getpixel((225, 50))[:3] == (255, 0, 0)
+        assert image.getpixel((225, 10))[3] == 0
+        assert image.getpixel((75, 50))[3] == 0
+
+
+def test_build_site_with_sprites(
+    src_testdata: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    stubs = write_stub_tools(tmp_path / "bin")
+    monkeypatch.setenv("PATH", f"{stubs}{os.pathsep}{os.environ['PATH']}")
+    base_dir = tmp_path / "index"
+    shutil.copytree(src_testdata / "input" / "index", base_dir)
+    Indexer(base_dir=base_dir, sprites=True).build_site()
+    assert (base_dir / "Thumbs" / "sprites-0.png").exists()
+    page = (base_dir / "index.html").read_text()
+    assert "./Thumbs/./sprites-0.png" in page
+    assert "object-position:-150px -0px" in page
@@ -0,0 +1,110 @@
+import json
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import pytest
+
+from pdfarchive.staticsearch import (
+    check_export_dir,
+    export_static_index,
+    shard_name,
+)
+from pdfarchive.textindex import TextIndex
+
+
+def test_shard_name() -> None:
+    assert shard_name("teletype", 2) == "te"
+    assert shard_name("a.out", 2) == "a_2e"
+    assert shard_name("x", 2) == "x"
+
+
+def test_export_static_index(tmp_path: Path) -> None:
+    text_dir = tmp_path / "Text"
+    text_dir.mkdir()
+    (text_dir / "a.txt").write_text("teletype tape")
+    (text_dir / "b.txt").write_text("teletype teletype")
+    out_dir = tmp_path / "search"
+    with TextIndex(tmp_path / "textindex", text_dir) as index:
+        index.update()
+        written = export_static_index(
+            index, {"a.txt": "scans/a.png"}, out_dir, prefix_length=2
+        )
+        # meta, two term shards, one doc shard
+        assert written == 4
+        te = json.loads((out_dir / "terms" / "te.json").read_text())
+        assert te == {"teletype": [0, 1, 1, 2]}
+        docs = json.loads((out_dir / "docs" / "0.json").read_text())
+        assert docs == {"0": ["scans/a.png", "a.txt"], "1": ["b.pdf", "b.txt"]}
+        meta = json.loads((out_dir / "meta.json").read_text())
+        assert meta["term_shards"] == ["ta", "te"]
+        # Nothing changed, so nothing is rewritten.
+        assert (
+            export_static_index(index, {"a.txt": "scans/a.png"}, out_dir) == 0
+        )
+
+        (text_dir / "a.txt").unlink()
+        index.update()
+        export_static_index(index, {}, out_dir)
+        assert not (out_dir / "terms" / "ta.json").exists()
+
+
+def test_export_incrementally(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    text_dir = tmp_path / "Text"
+    text_dir.mkdir()
+    (text_dir / "a.txt").write_text("teletype tape")
+    (text_dir / "b.txt").write_text("zebra")
+    out_dir = tmp_path / "search"
+    with TextIndex(tmp_path / "textindex", text_dir) as index:
+        index.update()
+        export_static_index(index, {}, out_dir)
+    with TextIndex(tmp_path / "textindex", text_dir) as index:
+        (text_dir / "c.txt").write_text("walrus teletype")
+        index.update()
+        prefixes: List[str] = list()
+        items = index.items
+
+        def recording_items(
+            prefix: str = "",
+        ) -> Iterator[Tuple[str, List[Tuple[int, int]]]]:
+            prefixes.append(prefix)
+            return items(prefix)
+
+        monkeypatch.setattr(index, "items", recording_items)
+        # te, wa, the doc shard, and meta
+        assert export_static_index(index, {}, out_dir, text_links=False) == 4
+        # Only the shards of c's terms were looked at
+        assert sorted(prefixes) == ["te", "wa"]
+        te = json.loads((out_dir / "terms" / "te.json").read_text())
+        assert te == {"teletype": [0, 1, 2, 1]}
+        meta = json.loads((out_dir / "meta.json").read_text())
+        assert meta["term_shards"] == ["ta", "te", "wa", "ze"]
+        assert meta["n_docs"] == 3
+        assert not meta["text_links"]
+    with TextIndex(tmp_path / "textindex", text_dir) as index:
+        (text_dir / "c.txt").unlink()
+        index.update()
+        export_static_index(index, {}, out_dir)
+        docs = json.loads((out_dir / "docs" / "0.json").read_text())
+        assert sorted(docs) == ["0", "1"]
+        # This time c's terms aren't known, so its postings stay until the
+        # index is merged
+        assert (out_dir / "terms" / "wa.json").exists()
+        index.merge()
+        export_static_index(index, {}, out_dir)
+        assert not (out_dir / "terms" / "wa.json").exists()
+        te = json.loads((out_dir / "terms" / "te.json").read_text())
+        assert te == {"teletype": [0, 1]}
+
+
+def test_check_export_dir(tmp_path: Path) -> None:
+    out_dir = tmp_path / "search"
+    check_export_dir(out_dir)
+    (out_dir / "terms").mkdir(parents=True)
+    (out_dir / "meta.json.tmp").write_text("{")
+    check_export_dir(out_dir)
+    # An archive folder that happens to be called search
+    (out_dir / "manual.pdf").write_bytes(b"%PDF")
+    with pytest.raises(RuntimeError, match="manual.pdf"):
+        check_export_dir(out_dir)
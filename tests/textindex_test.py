@@ -0,0 +1,121 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from pdfarchive.textindex import (
+    _MERGE_FACTOR,
+    TextIndex,
+    WordRules,
+    decode_postings,
+    encode_postings,
+)
+
+_site_conf = (
+    Path(__file__).parent.parent / "pdfarchive" / "assets" / "site.conf"
+)
+
+
+def test_word_rules_from_site_conf() -> None:
+    rules = WordRules.from_config(_site_conf)
+    words = list(rules.words("The Résumé of v1.2 -- see www.example.com."))
+    assert words == ["resume", "v1.2", "see", "www.example.com"]
+
+
+def test_postings_round_trip() -> None:
+    postings = [(3, 1), (4, 200), (70000, 2)]
+    encoded = encode_postings(postings)
+    assert len(encoded) < 3 * 8
+    assert decode_postings(encoded) == postings
+
+
+def test_incremental_update(tmp_path: Path) -> None:
+    text_dir = tmp_path / "Text"
+    (text_dir / "sub").mkdir(parents=True)
+    (text_dir / "a.txt").write_text("teletype model 33 manual")
+    (text_dir / "sub" / "b.txt").write_text("model 35 teletype teletype")
+    index_dir = tmp_path / "config" / "textindex"
+    with TextIndex(index_dir, text_dir) as index:
+        assert index.update() == (2, 0)
+        assert index.update() == (0, 0)
+        assert [p for p, _ in index.search("teletype")] == [
+            "sub/b.txt",
+            "a.txt",
+        ]
+        assert [p for p, _ in index.search("model 33")] == ["a.txt"]
+
+    (text_dir / "c.txt").write_text("paper tape reader")
+    (text_dir / "sub" / "b.txt").unlink()
+    st = (text_dir / "a.txt").stat()
+    (text_dir / "a.txt").write_text("paper tape punch")
+    os.utime(text_dir / "a.txt", ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    with TextIndex(index_dir, text_dir) as index:
+        assert index.update() == (2, 1)
+        assert index.search("teletype") == []
+        assert [p for p, _ in index.search("paper tape")] == [
+            "a.txt",
+            "c.txt",
+        ]
+        index.merge()
+        assert len(list(index_dir.glob("seg-*.dict"))) == 1
+        assert [p for p, _ in index.search("punch")] == ["a.txt"]
+
+
+def test_unreadable_text_is_dropped(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    text_dir = tmp_path / "Text"
+    text_dir.mkdir()
+    (text_dir / "a.txt").write_text("teletype")
+    index_dir = tmp_path / "textindex"
+    with TextIndex(index_dir, text_dir) as index:
+        assert index.update() == (1, 0)
+    os.utime(text_dir / "a.txt", ns=(0, 0))
+    with TextIndex(index_dir, text_dir) as index:
+        assert index.restored
+        # Gone between the stat and the read
+        monkeypatch.setattr(index.store, "read", lambda path: None)
+        assert index.update([text_dir / "a.txt"]) == (0, 1)
+    with TextIndex(index_dir, text_dir) as index:
+        assert index.docs == {}
+
+
+def test_directory_paths(tmp_path: Path) -> None:
+    text_dir = tmp_path / "Text"
+    (text_dir / "sub" / "deeper").mkdir(parents=True)
+    for name in ("a.txt", "sub/b.txt", "sub/deeper/c.txt"):
+        (text_dir / name).write_text("teletype")
+    with TextIndex(tmp_path / "textindex", text_dir) as index:
+        assert not index.restored
+        index.update()
+        (text_dir / "sub" / "b.txt").unlink()
+        # Still in the index, so still to be looked at
+        assert index.directory_paths(Path("sub"), recursive=False) == {
+            text_dir / "sub" / "b.txt"
+        }
+        assert index.directory_paths(Path("sub")) == {
+            text_dir / "sub" / "b.txt",
+            text_dir / "sub" / "deeper" / "c.txt",
+        }
+
+
+def test_tiered_merging(tmp_path: Path) -> None:
+    text_dir = tmp_path / "Text"
+    text_dir.mkdir()
+    index_dir = tmp_path / "textindex"
+    with TextIndex(index_dir, text_dir) as index:
+        for i in range(3 * _MERGE_FACTOR):
+            (text_dir / f"{i}.txt").write_text(f"teletype model{i}")
+            assert index.update([text_dir / f"{i}.txt"]) == (1, 0)
+            assert len(index.segment_names) < 2 * _MERGE_FACTOR
+        assert len(index.search("teletype")) == 3 * _MERGE_FACTOR
+        assert [p for p, _ in index.search("model5")] == ["5.txt"]
+        # Mostly deleted: merged into one, and the deleted forgotten
+        for i in range(2 * _MERGE_FACTOR):
+            (text_dir / f"{i}.txt").unlink()
+        index.update()
+        assert len(index.segment_names) == 1
+        assert not index.deleted
+    with TextIndex(index_dir, text_dir) as index:
+        assert len(index.search("teletype")) == _MERGE_FACTOR
+        assert index.search("model5") == []
@@ -0,0 +1,159 @@
+import gzip
+import json
+import os
+import shutil
+import sys
+from pathlib import Path
+from typing import Any, List
+
+import pytest
+
+from pdfarchive.atomic import ChangeLog
+from pdfarchive.cli import main
+from pdfarchive.index import build_archive
+from pdfarchive.textindex import TextIndex
+from pdfarchive.textstore import PACK_INDEX_NAME, TextStore, text_app
+
+
+def _write(path: Path, text: str, mtime_ns: int) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_pack_and_read(tmp_path: Path) -> None:
+    text_dir = tmp_path / "Text"
+    directory = text_dir / "manuals"
+    _write(directory / "a.txt", "alpha " * 1000, 1_000)
+    _write(directory / "b.txt", "bravo", 2_000)
+    _write(directory / "sub" / "c.txt", "charlie", 3_000)
+    store = TextStore(text_dir)
+    changes = ChangeLog(tmp_path)
+    assert store.pack(directory, changes=changes) == 2
+    assert sorted(p.name for p in directory.iterdir()) == [
+        "sub",
+        "text-0.pack",
+        PACK_INDEX_NAME,
+    ]
+    # The loose files were added and removed within the one change log
+    assert changes.as_dict()["added"] == [
+        "Text/manuals/text-0.pack",
+        "Text/manuals/text-pack.json",
+    ]
+    assert store.read(Path("manuals/a.txt")) == "alpha " * 1000
+    assert store.stat(directory / "b.txt") == (5, 2_000)
+    assert store.scan() == {
+        "manuals/a.txt": (6000, 1_000),
+        "manuals/b.txt": (5, 2_000),
+        "manuals/sub/c.txt": (7, 3_000),
+    }
+    # The pack is a gzip file in its own right
+    pack = gzip.decompress((directory / "text-0.pack").read_bytes())
+    assert pack == b"alpha " * 1000 + b"bravo"
+    assert (directory / "text-0.pack").stat().st_size < 1000
+
+
+def test_repack_prune_and_unpack(tmp_path: Path) -> None:
+    store = TextStore(tmp_path)
+    _write(tmp_path / "a.txt", "alpha", 1_000)
+    _write(tmp_path / "b.txt", "bravo", 2_000)
+    store.pack(tmp_path)
+    # Rebuilt the same: nothing is appended
+    size = (tmp_path / "text-0.pack").stat().st_size
+    _write(tmp_path / "a.txt", "alpha", 5_000)
+    store.pack(tmp_path)
+    assert (tmp_path / "text-0.pack").stat().st_size == size
+    assert store.stat(Path("a.txt")) == (5, 1_000)
+    # Changed, over and over, until the pack is compacted
+    for n in range(3):
+        _write(tmp_path / "b.txt", f"bravo {n}", 10_000 + n)
+        store.pack(tmp_path, gz=True)
+    assert not (tmp_path / "text-0.pack").exists()
+    assert store.read(Path("b.txt")) == "bravo 2"
+    assert gzip.decompress((tmp_path / "b.txt.gz").read_bytes()) == b"bravo 2"
+    assert store.prune(tmp_path, {"b.txt"}) == 1
+    assert store.read(Path("a.txt")) is None
+    assert not (tmp_path / "a.txt.gz").exists()
+    assert store.unpack(tmp_path) == 1
+    assert (tmp_path / "b.txt").read_text() == "bravo 2"
+    assert (tmp_path / "b.txt").stat().st_mtime_ns == 10_002
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["b.txt"]
+
+
+def test_text_index_reads_packs(tmp_path: Path) -> None:
+    text_dir = tmp_path / "Text"
+    _write(text_dir / "a.txt", "the widget manual", 1_000)
+    with TextIndex(tmp_path / "textindex", text_dir) as index:
+        assert index.update() == (1, 0)
+    TextStore(text_dir).pack(text_dir)
+    with TextIndex(tmp_path / "textindex", text_dir) as index:
+        # Packing changed nothing the index goes by
+        assert index.update() == (0, 0)
+        assert [path for path, _ in index.search("widget")] == ["a.txt"]
+
+
+def test_text_app(tmp_path: Path) -> None:
+    _write(tmp_path / "dir" / "a.txt", "alpha", 1_000)
+    TextStore(tmp_path).pack(tmp_path / "dir")
+    app = text_app(tmp_path)
+    statuses: List[str] = list()
+
+    def start_response(status: str, headers: Any) -> None:
+        statuses.append(status)
+
+    assert app({"PATH_INFO": "/dir/a.txt"}, start_response) == [b"alpha"]
+    app({"PATH_INFO": "/dir/b.txt"}, start_response)
+    app({"PATH_INFO": "/../dir/a.txt"}, start_response)
+    assert statuses == ["200 OK", "404 Not Found", "404 Not Found"]
+
+
+def test_build_with_packs(src_testdata: Path, tmp_path: Path) -> None:
+    base_dir = tmp_path / "index"
+    shutil.copytree(src_testdata / "input" / "index", base_dir)
+    build_archive(base_dir, text_store="packs", text_gz=True)
+    text_dir = base_dir / "Text"
+    assert not list(text_dir.glob("**/*.txt"))
+    assert (text_dir / "pdf_with_text.txt.gz").exists()
+    listing = json.loads((text_dir / PACK_INDEX_NAME).read_text())
+    assert sorted(listing["documents"]) == [
+        "has_text.txt",
+        "pdf_with_text.txt",
+    ]
+    assert (text_dir / "container.zip" / PACK_INDEX_NAME).exists()
+    # Everything is up to date, packed or not
+    result = build_archive(base_dir, text_store="packs", text_gz=True)
+    assert result.changes == {"added": [], "changed": [], "removed": []}
+    assert result.stages["extract-fast"].jobs == 0
+    # And back again, without extracting anything
+    result = build_archive(base_dir)
+    assert result.stages["extract-fast"].jobs == 0
+    assert (text_dir / "has_text.txt").exists()
+    assert not list(text_dir.glob("**/*.pack"))
+    assert not list(text_dir.glob("**/*.gz"))
+
+
+def test_search_links_with_packs(src_testdata: Path, tmp_path: Path) -> None:
+    base_dir = tmp_path / "index"
+    shutil.copytree(src_testdata / "input" / "index", base_dir)
+    meta = base_dir / "search" / "meta.json"
+    # No Text/x.txt to link search results to
+    build_archive(base_dir, text_store="packs", static_search=True)
+    assert not json.loads(meta.read_text())["text_links"]
+    build_archive(
+        base_dir, text_store="packs", text_gz=True, static_search=True
+    )
+    assert json.loads(meta.read_text())["text_links"]
+
+
+def test_text_gz_needs_packs(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture,
+) -> None:
+    monkeypatch.setattr(
+        sys, "argv", ["pdfarchive", "-f", str(tmp_path), "--text-gz"]
+    )
+    with pytest.raises(SystemExit) as exc:
+        main()
+    assert exc.value.code == 2
+    assert "--text-gz needs --text-store packs" in capsys.readouterr().err
@@ -0,0 +1,27 @@
+from pathlib import Path
+
+from pdfarchive.tree import scan_tree
+
+
+def test_scan_tree(tmp_path: Path) -> None:
+    for name in ("b.pdf", "a.PNG", "notes.txt", "bundle.zip"):
+        (tmp_path / name).write_bytes(b"")
+    (tmp_path / "Thumbs").mkdir()
+    (tmp_path / "sub" / "Thumbs").mkdir(parents=True)
+    (tmp_path / "sub" / "c.jpg").write_bytes(b"")
+    (tmp_path / "b.pdf").chmod(0o600)
+
+    root = scan_tree(tmp_path, skipdirs=("Thumbs",))
+    assert [f.name for f in root.files] == ["a.PNG", "b.pdf"]
+    assert [a.name for a in root.archives] == ["bundle.zip"]
+    # Only the top level skips the output directories
+    assert [d.relative_path for d in root.dirs] == [Path("sub")]
+    sub = root.dirs[0]
+    assert [d.relative_path for d in sub.dirs] == [Path("sub/Thumbs")]
+    assert [f.name for f in sub.files] == ["c.jpg"]
+    assert [n.relative_path for n in root.walk()] == [
+        Path("."),
+        Path("sub"),
+        Path("sub/Thumbs"),
+    ]
+    assert (tmp_path / "b.pdf").stat().st_mode & 0o777 == 0o644
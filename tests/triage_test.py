@@ -0,0 +1,109 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from benchmarks.stubs import write_stub_tools
+from pdfarchive.index import build_archive
+from pdfarchive.triage import (
+    Layout,
+    classify,
+    has_fonts,
+    image_pages,
+    page_runs,
+    pages_needing_ocr,
+    split_pages,
+)
+
+
+def test_split_and_classify() -> None:
+    text = "Chapter one, in which\n\f3\n\f\fAppendix: the full story\n\f"
+    pages = split_pages(text)
+    assert len(pages) == 4
+    assert "".join(pages) == text
+    assert pages_needing_ocr(pages) == [1, 2]
+    assert classify(pages) == Layout.MIXED
+    assert classify([pages[0], pages[3]]) == Layout.TEXT
+    assert classify([pages[1]]) == Layout.SCANNED
+    assert classify([]) == Layout.SCANNED
+    # A page without text or images has nothing to OCR
+    assert pages_needing_ocr(pages, {2}) == [2]
+    assert classify(pages, set()) == Layout.TEXT
+
+
+def test_page_runs() -> None:
+    assert list(page_runs([0, 1, 2, 3, 4, 7, 9, 10], 2)) == [
+        (0, 1),
+        (2, 3),
+        (4, 4),
+        (7, 7),
+        (9, 10),
+    ]
+    assert list(page_runs([], 4)) == []
+
+
+def test_has_fonts(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    pdffonts = bin_dir / "pdffonts"
+    pdffonts.write_text(
+        "#!/bin/sh\n"
+        'echo "name type"\n'
+        'echo "---- ----"\n'
+        'case "$1" in *scan*) ;; *) echo "Times Type1" ;; esac\n'
+    )
+    pdffonts.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}")
+    assert has_fonts(tmp_path / "typeset.pdf") is True
+    assert has_fonts(tmp_path / "scan.pdf") is False
+
+
+def _write_tool(directory: Path, name: str, script: str) -> None:
+    tool = directory / name
+    tool.write_text(f"#!/bin/sh\n{script}")
+    tool.chmod(0o755)
+
+
+def test_image_pages(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    _write_tool(
+        bin_dir,
+        "pdfimages",
+        'echo "page   num  type   width height"\n'
+        'echo "------------------------------"\n'
+        'echo "   2     0 image    2480  3508"\n'
+        'echo "   2     1 smask    2480  3508"\n'
+        'echo "   5     2 image     100   100"\n',
+    )
+    monkeypatch.setenv("PATH", f"{bin_dir}")
+    assert image_pages(tmp_path / "doc.pdf") == {1, 4}
+    monkeypatch.setenv("PATH", f"{tmp_path}")
+    assert image_pages(tmp_path / "doc.pdf") is None
+
+
+@pytest.mark.parametrize("images, ocred", [("", 0), ("   2     0 image", 1)])
+def test_blank_pages_ocred_only_with_images(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, images: str, ocred: int
+) -> None:
+    stubs = write_stub_tools(tmp_path / "bin")
+    # A typeset page, then one with no text on it
+    _write_tool(
+        stubs,
+        "pdftotext",
+        'for a; do out="$a"; done\n'
+        'printf "Preface to the manual\\f\\f" > "$out"\n',
+    )
+    _write_tool(
+        stubs, "pdfimages", f'echo "page num"\necho "---"\necho "{images}"\n'
+    )
+    monkeypatch.setenv("PATH", f"{stubs}{os.pathsep}{os.environ['PATH']}")
+    root = tmp_path / "archive"
+    root.mkdir()
+    (root / "manual.pdf").write_bytes(
+        b"%PDF-1.4\n/Type /Page /\n/Type /Page /\n(Preface) Tj\n"
+    )
+    result = build_archive(root)
+    assert result.ok
+    assert result.stages["extract-ocr"].outcomes.get("pages", 0) == ocred
+    assert (root / "Text" / "manual.txt").read_text().startswith("Preface to")
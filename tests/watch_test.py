@@ -0,0 +1,150 @@
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List
+
+import pytest
+
+from benchmarks.stubs import write_stub_tools
+from pdfarchive.index import SKIP_DIRS, Indexer
+from pdfarchive.textindex import TextIndex
+from pdfarchive.watch import (
+    Changes,
+    InotifyWatcher,
+    PollingWatcher,
+    Watcher,
+    watch,
+)
+
+
+def _wait_for(condition: Callable[[], bool], timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def _indexed(base_dir: Path) -> List[str]:
+    with TextIndex(
+        base_dir / "config" / "textindex", base_dir / "Text"
+    ) as text_index:
+        return list(text_index.docs)
+
+
+def test_resolve(tmp_path: Path) -> None:
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "c").mkdir()
+    changes = Changes()
+    changes.directory_changed(tmp_path / "a")
+    changes.directory_changed(tmp_path / "gone")
+    changes.file_changed(tmp_path / "a" / "b" / "x.pdf")
+    changes.file_changed(tmp_path / "c" / "y.pdf")
+    assert changes.resolve() == ([tmp_path / "a"], [tmp_path, tmp_path / "c"])
+
+
+@pytest.mark.parametrize("cls", [InotifyWatcher, PollingWatcher])
+def test_watcher(cls: type, tmp_path: Path) -> None:
+    (tmp_path / "Thumbs").mkdir()
+    (tmp_path / "docs").mkdir()
+    watcher: Watcher = cls(tmp_path, SKIP_DIRS)
+    (tmp_path / "Thumbs" / "x_thumb.png").write_bytes(b"png")
+    (tmp_path / "index.html").write_text("<html/>")
+    (tmp_path / "docs" / ".upload.pdf").write_bytes(b"%PDF")
+    assert not watcher.read(0.1)
+    os.rename(tmp_path / "docs" / ".upload.pdf", tmp_path / "docs" / "a.pdf")
+    (tmp_path / "new").mkdir()
+    changes = watcher.read(0.1)
+    assert changes.dirs == {tmp_path, tmp_path / "docs"}
+    assert changes.trees == {tmp_path / "new"}
+    watcher.close()
+
+
+def test_watch(
+    src_testdata: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    stubs = write_stub_tools(tmp_path / "bin")
+    monkeypatch.setenv("PATH", f"{stubs}{os.pathsep}{os.environ['PATH']}")
+    base_dir = tmp_path / "archive"
+    shutil.copytree(src_testdata / "input" / "index", base_dir)
+    indexer = Indexer(base_dir=base_dir)
+    stop = threading.Event()
+    watcher = threading.Thread(
+        target=watch, args=(indexer,), kwargs=dict(quiet=0.2, stop=stop)
+    )
+    watcher.start()
+    try:
+        text = base_dir / "Text" / "new" / "doc.txt"
+        _wait_for(lambda: (base_dir / "index.html").exists())
+        (base_dir / "new").mkdir()
+        shutil.copy(base_dir / "pdf_with_text.pdf", base_dir / "new/doc.pdf")
+        _wait_for(text.exists)
+        _wait_for(lambda: "new" in (base_dir / "index.html").read_text())
+        _wait_for(lambda: "new/doc.txt" in _indexed(base_dir))
+        (base_dir / "new" / "doc.pdf").unlink()
+        _wait_for(lambda: not text.exists())
+        _wait_for(lambda: "new/doc.txt" not in _indexed(base_dir))
+        assert not (base_dir / "Thumbs" / "new" / "doc_thumb.png").exists()
+    finally:
+        stop.set()
+        watcher.join()
+    # The metrics are for the last update alone, not the whole run
+    assert ("pdf_with_text.pdf", "extract-fast") not in indexer.metrics.files
+
+
+class _Scripted(Watcher):
+    """Reports each of batches in turn, then stops the watch."""
+
+    def __init__(
+        self, root: Path, batches: List[Changes], stop: threading.Event
+    ) -> None:
+        super().__init__(root)
+        self.batches = batches
+        self.stop = stop
+
+    def read(self, timeout: float) -> Changes:
+        if not self.batches:
+            self.stop.set()
+            return Changes()
+        return self.batches.pop(0)
+
+
+def test_watch_survives_failed_update(
+    src_testdata: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    stubs = write_stub_tools(tmp_path / "bin")
+    monkeypatch.setenv("PATH", f"{stubs}{os.pathsep}{os.environ['PATH']}")
+    base_dir = tmp_path / "archive"
+    shutil.copytree(src_testdata / "input" / "index", base_dir)
+    (base_dir / "new").mkdir()
+    shutil.copy(base_dir / "pdf_with_text.pdf", base_dir / "new" / "doc.pdf")
+    indexer = Indexer(base_dir=base_dir)
+    update = indexer.update_directories
+    calls: List[int] = list()
+
+    def flaky(trees: List[Path], dirs: List[Path]) -> int:
+        calls.append(len(calls))
+        if len(calls) == 1:
+            raise FileNotFoundError("gone")
+        shutil.copy(base_dir / "pdf_with_text.pdf", base_dir / "new/more.pdf")
+        return update(trees, dirs)
+
+    monkeypatch.setattr(indexer, "update_directories", flaky)
+    stop = threading.Event()
+    batch = Changes(dirs={base_dir / "new"})
+    watcher = _Scripted(base_dir, [batch, Changes(dirs=set(batch.dirs))], stop)
+    thread = threading.Thread(
+        target=watch,
+        args=(indexer,),
+        kwargs=dict(max_delay=0, watcher=watcher, stop=stop),
+    )
+    thread.start()
+    thread.join(timeout=60)
+    assert not thread.is_alive()
+    assert calls == [0, 1]
+    # Only what the last update changed, not the initial build's outputs
+    changes = json.loads((base_dir / "config" / "changes.json").read_text())
+    assert "Thumbs/new/more_thumb.png" in changes["added"]
+    assert "Thumbs/new/doc_thumb.png" not in changes["added"]
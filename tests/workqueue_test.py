@@ -0,0 +1,124 @@
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from benchmarks.stubs import write_stub_tools
+from pdfarchive.index import Indexer
+from pdfarchive.worker import work
+from pdfarchive.workqueue import Task, WorkQueue
+
+
+def _age(path: Path, seconds: float) -> None:
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def test_claim_and_complete(tmp_path: Path) -> None:
+    queue = WorkQueue(tmp_path / "queue", lease=60)
+    first = Task("thumbnail", "manuals", "a.pdf")
+    second = Task("archive", ".", "bundle.zip", members=("x.pdf",))
+    queue.put(first)
+    queue.put(second)
+    a = queue.claim("node1")
+    b = queue.claim("node2")
+    assert a is not None and b is not None
+    assert (a.task, b.task) == (first, second)
+    assert queue.claim("node3") is None
+    assert queue.heartbeat(a)
+    assert queue.complete(a)
+    queue.fail(b, "gm exploded")
+    assert queue.finished() == {first.id: None, second.id: "gm exploded"}
+    assert queue.idle()
+    assert queue.seal_token() is None
+    queue.seal()
+    token = queue.seal_token()
+    assert token is not None and queue.sealed
+    queue.reset()
+    assert queue.finished() == {}
+    assert queue.seal_token() is None
+    queue.seal()
+    assert queue.seal_token() != token
+
+
+def test_expired_leases(tmp_path: Path) -> None:
+    queue = WorkQueue(tmp_path / "queue", lease=60, max_attempts=2)
+    task = Task("text", "scans", "b.pdf")
+    queue.put(task)
+    lease = queue.claim("node1")
+    assert lease is not None
+    assert queue.reap() == []
+    # node1 died
+    _age(lease.path, 120)
+    assert [t.attempts for t in queue.reap()] == [1]
+    assert not queue.heartbeat(lease)
+    assert not queue.complete(lease)
+    again = queue.claim("node2")
+    assert again is not None and again.task.attempts == 1
+    # And so did node2; that's enough
+    _age(again.path, 120)
+    queue.reap()
+    assert queue.claim("node3") is None
+    assert queue.finished() == {task.id: "lease expired 2 times"}
+
+
+def test_release(tmp_path: Path) -> None:
+    queue = WorkQueue(tmp_path / "queue")
+    queue.put(Task("text", ".", "c.png"))
+    lease = queue.claim("node1")
+    assert lease is not None
+    queue.release(lease)
+    assert queue.counts()["pending"] == 1
+    assert queue.claim("node2") is not None
+
+
+def test_distributed_build(
+    src_testdata: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    stubs = write_stub_tools(tmp_path / "bin")
+    monkeypatch.setenv("PATH", f"{stubs}{os.pathsep}{os.environ['PATH']}")
+    base_dir = tmp_path / "archive"
+    shutil.copytree(src_testdata / "input" / "index", base_dir)
+    indexer = Indexer(base_dir=base_dir, coordinate=True)
+    coordinator = indexer.context.coordinator
+    assert coordinator is not None
+    coordinator.poll = 0.1
+    builder = threading.Thread(target=indexer.build_site)
+    builder.start()
+    worker = work(base_dir, worker_id="node1")
+    builder.join()
+    assert worker.done == 7
+    assert worker.failed == 0
+    assert (base_dir / "config" / "run-report-node1.json").exists()
+    # The coordinator recorded the workers' outputs, so nothing is queued
+    # the second time around
+    again = Indexer(base_dir=base_dir, coordinate=True)
+    again.build_site()
+    assert again.context.coordinator is not None
+    assert again.context.coordinator.queue.counts()["done"] == 0
+
+
+def test_worker_ignores_old_seal(
+    src_testdata: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    stubs = write_stub_tools(tmp_path / "bin")
+    monkeypatch.setenv("PATH", f"{stubs}{os.pathsep}{os.environ['PATH']}")
+    base_dir = tmp_path / "archive"
+    shutil.copytree(src_testdata / "input" / "index", base_dir)
+    # Left over from the last run
+    queue = WorkQueue(base_dir / "config" / "queue")
+    queue.seal()
+    worker = threading.Thread(
+        target=work, args=(base_dir,), kwargs={"poll": 0.05}
+    )
+    worker.start()
+    time.sleep(0.5)
+    assert worker.is_alive()
+    # The next run has nothing to do
+    queue.reset()
+    queue.seal()
+    worker.join(timeout=10)
+    assert not worker.is_alive()